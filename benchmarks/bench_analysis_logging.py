@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+NginxAnalyzer日志开销基准
+
+在内存中构造crossplane格式的大配置，分别在跟踪关闭、全量跟踪和采样跟踪下执行
+analysis_nginx_all_conf并对比耗时
+
+用法:
+    python -m benchmarks.bench_analysis_logging --vhosts 2000 --locations 5 --members 5
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client_app.client import NginxAnalyzer, DirectiveTrace, analysis_logger
+
+
+def build_config(vhosts, locations, members):
+    """构造crossplane.parse(combine=True)格式的配置，每个vhost一个upstream"""
+    parsed = []
+    line = 1
+    for index in range(vhosts):
+        upstream = {'directive': 'upstream', 'line': line, 'args': [f'backend_{index}'], 'block': [
+            {'directive': 'server', 'line': line + member + 1,
+             'args': [f'10.{index // 250 % 250}.{index % 250}.{member}:8080', 'weight=2']}
+            for member in range(members)
+        ]}
+        line += members + 2
+        server_block = [
+            {'directive': 'listen', 'line': line + 1, 'args': ['80']},
+            {'directive': 'server_name', 'line': line + 2, 'args': [f'site{index}.example.com']},
+        ]
+        for location in range(locations):
+            server_block.append({'directive': 'location', 'line': line + 3 + location, 'args': [f'/api{location}'],
+                                 'block': [
+                                     {'directive': 'proxy_pass', 'line': line + 3 + location,
+                                      'args': [f'http://backend_{index}']},
+                                     {'directive': 'proxy_set_header', 'line': line + 3 + location,
+                                      'args': ['Host', '$host']},
+                                 ]})
+        parsed.append(upstream)
+        parsed.append({'directive': 'server', 'line': line, 'args': [], 'block': server_block})
+        line += locations + 4
+    return {'status': 'ok', 'errors': [], 'config': [
+        {'file': '/etc/nginx/nginx.conf', 'status': 'ok', 'errors': [], 'parsed': []},
+        {'file': '/etc/nginx/conf.d/bench.conf', 'status': 'ok', 'errors': [], 'parsed': parsed},
+    ]}
+
+
+def count_directives(directives):
+    total = 0
+    stack = list(directives)
+    while stack:
+        directive = stack.pop()
+        total += 1
+        stack.extend(directive.get('block', []))
+    return total
+
+
+def run(config, level, sample_every, repeat):
+    analysis_logger.setLevel(level)
+    best = None
+    for _ in range(repeat):
+        analyzer = NginxAnalyzer(nginx_obj_dict=config)
+        trace = DirectiveTrace(sample_every=sample_every)
+        started = time.perf_counter()
+        analyzer.analysis_nginx_all_conf(trace=trace)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NginxAnalyzer日志开销基准')
+    parser.add_argument('--vhosts', type=int, default=2000)
+    parser.add_argument('--locations', type=int, default=5)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # 日志写到/dev/null，只计算格式化和handler开销，不计终端输出
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('{levelname} {asctime} {module} {message}', style='{'))
+    analysis_logger.addHandler(handler)
+    analysis_logger.propagate = False
+
+    config = build_config(args.vhosts, args.locations, args.members)
+    directives = count_directives(config['config'][1]['parsed'])
+    print(f'directives={directives}')
+
+    cases = [
+        ('tracing off (INFO)', logging.INFO, 0),
+        ('debug, tracing off', logging.DEBUG, 0),
+        ('debug, trace sample 1/100', logging.DEBUG, 100),
+        ('debug, trace every directive', logging.DEBUG, 1),
+    ]
+    for name, level, sample_every in cases:
+        elapsed = run(config, level, sample_every, args.repeat)
+        print(f'{name:<32} {elapsed * 1000:9.1f} ms  {directives / elapsed:12.0f} directives/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+解析器和分析器基准
+
+在临时目录生成合成配置树，分别测量crossplane解析、_manual_parse_nginx_config和
+analysis_nginx_all_conf的耗时、峰值内存和每秒处理指令数，结果保存为JSON，
+用--compare与之前提交的结果对比
+
+用法:
+    python -m benchmarks.bench_parser --files 50 --vhosts 2000 --locations 5 --members 5 --include-depth 2
+    python -m benchmarks.bench_parser --compare benchmarks/results/<旧结果>.json
+"""
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crossplane
+
+from benchmarks.synthetic import generate_tree
+from client_app.client import NginxAnalyzer, analysis_logger, parse_logger
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def count_directives(configs):
+    total = 0
+    for config in configs:
+        stack = list(config.get('parsed', []))
+        while stack:
+            directive = stack.pop()
+            total += 1
+            stack.extend(directive.get('block', []))
+    return total
+
+
+def measure(func, repeat, setup=None):
+    """
+    返回 (最佳耗时秒数, 峰值内存字节数, 最后一次结果)
+
+    setup的返回值作为func的参数，不计入耗时和内存；计时和内存分别测量，避免tracemalloc影响耗时
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        gc.collect()
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    args = (setup(),) if setup else ()
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(params, repeat):
+    with tempfile.TemporaryDirectory(prefix='nginx-bench-') as root:
+        tree = generate_tree(root, **params)
+        contents = {}
+        for path in tree['files']:
+            with open(path, encoding='utf-8') as f:
+                contents[path] = f.read()
+        total_bytes = sum(len(content.encode('utf-8')) for content in contents.values())
+
+        cases = {}
+
+        seconds, peak, payload = measure(lambda: crossplane.parse(tree['main'], catch_errors=True), repeat)
+        directives = count_directives(payload['config'])
+        cases['crossplane_parse'] = (seconds, peak, directives)
+
+        analyzer = NginxAnalyzer(nginx_main_conf_path=tree['main'])
+        seconds, peak, manual = measure(
+            lambda: [analyzer._manual_parse_nginx_config(content, path) for path, content in contents.items()],
+            repeat)
+        cases['manual_parse'] = (seconds, peak, count_directives({'parsed': parsed} for parsed in manual))
+
+        # 所有文件拼成一个大文件，检查容错解析在单个大文件上保持线性
+        large_content = '\n'.join(contents.values())
+        seconds, peak, large = measure(lambda: analyzer._manual_parse_nginx_config(large_content, 'large.conf'),
+                                       repeat)
+        cases['manual_parse_large'] = (seconds, peak, count_directives([{'parsed': large}]))
+
+        # 分析会修改传入的解析结果，每次使用一份副本，复制不计入测量
+        seconds, peak, _ = measure(
+            lambda config: NginxAnalyzer(nginx_main_conf_path=tree['main'],
+                                         nginx_obj_dict=config).analysis_nginx_all_conf(),
+            repeat, setup=lambda: copy.deepcopy(payload))
+        cases['analysis'] = (seconds, peak, directives)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'crossplane': getattr(crossplane, '__version__', None),
+        'params': params,
+        'files': len(tree['files']),
+        'bytes': total_bytes,
+        'repeat': repeat,
+        'cases': {
+            name: {
+                'seconds': round(seconds, 6),
+                'peak_memory_bytes': peak,
+                'directives': count,
+                'directives_per_second': round(count / seconds) if seconds else None
+            } for name, (seconds, peak, count) in cases.items()
+        }
+    }
+
+
+def print_report(result, baseline=None):
+    print(f"commit={result['commit']} files={result['files']} bytes={result['bytes']} params={result['params']}")
+    print(f"{'case':<18}{'time ms':>12}{'peak MB':>12}{'directives':>12}{'dir/s':>14}{'vs base':>10}")
+    for name, case in result['cases'].items():
+        delta = ''
+        base_case = (baseline or {}).get('cases', {}).get(name)
+        if base_case and base_case['seconds']:
+            delta = f"{(case['seconds'] / base_case['seconds'] - 1) * 100:+.1f}%"
+        print(f"{name:<18}{case['seconds'] * 1000:>12.1f}{case['peak_memory_bytes'] / 1e6:>12.2f}"
+              f"{case['directives']:>12}{case['directives_per_second'] or 0:>14}{delta:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nginx配置解析和分析基准')
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--vhosts', type=int, default=500)
+    parser.add_argument('--locations', type=int, default=5)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--include-depth', type=int, default=2)
+    parser.add_argument('--stream-upstreams', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='结果JSON路径，默认保存到benchmarks/results/')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比')
+    args = parser.parse_args()
+
+    # 基准只关心解析和分析本身，关闭INFO日志
+    analysis_logger.setLevel(logging.WARNING)
+    parse_logger.setLevel(logging.WARNING)
+
+    params = {
+        'files': args.files,
+        'vhosts': args.vhosts,
+        'locations': args.locations,
+        'members': args.members,
+        'include_depth': args.include_depth,
+        'stream_upstreams': args.stream_upstreams,
+    }
+    result = run_benchmarks(params, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f"注意: 对比结果的规模参数不同 {baseline.get('params')}")
+    print_report(result, baseline)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{result['commit'] or 'nocommit'}-{time.strftime('%Y%m%d%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+
+
+if __name__ == '__main__':
+    main()
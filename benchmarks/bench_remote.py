@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+远程操作基准
+
+在进程内SSH/SFTP夹具（benchmarks.ssh_fixture）上运行NginxParamikoClient的典型操作，
+统计每个场景的远程往返次数（exec + SFTP请求）、线路字节数、nginx -t和reload次数以及耗时，
+结果保存为JSON，用--compare与之前提交的结果对比
+
+用法:
+    python -m benchmarks.bench_remote --latency 0.02 --files 10 --vhosts 200 --batch-files 5
+    python -m benchmarks.bench_remote --compare benchmarks/results/<旧结果>.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_parser import RESULTS_DIR, git_commit
+from benchmarks.ssh_fixture import FakeNginxHost
+from benchmarks.synthetic import generate_tree
+from client_app.client import NginxParamikoClient, analysis_logger, parse_logger
+from client_app.host_queue import queued_commit
+from client_app.transaction import NginxConfigTransaction
+from client_app.upstream_edit import UpstreamEditor
+
+COUNTERS = ('round_trips', 'execs', 'sftp_requests', 'bytes_in', 'bytes_out', 'config_tests', 'reloads')
+
+
+def _touch(path):
+    """在文件末尾追加注释，内容变化但语法不变"""
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+    return {'file_path': path, 'file_content': content + f'# bench {time.time_ns()}\n'}
+
+
+def _generated_upstreams(path, members):
+    """生成一个大的upstream文件，模拟由服务发现生成的配置"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# generated, do not edit\n')
+        for index in range(members):
+            if index % 50 == 0:
+                f.write(f'upstream pool{index // 50} {{\n')
+            f.write(f'    server 10.{index // 65536}.{index // 256 % 256}.{index % 256}:8080 weight=1 max_fails=3;\n')
+            if index % 50 == 49 or index == members - 1:
+                f.write('}\n')
+    return path
+
+
+def _toggle_member(client, path, nginx_path, use_patch):
+    """切换第一个upstream中第一个server的状态；use_patch为False时下载整文件、写回整文件"""
+    content = client.read_config_files([path], use_cache=use_patch)[path]['content']
+    editor = UpstreamEditor(content)
+    statement = editor.blocks[0].servers[0]
+    editor.set_status(statement.upstream, statement.address, 'up' if statement.status == 'down' else 'down')
+    edit = editor.as_edit(path)
+    if not use_patch:
+        edit['patch'] = None
+    return NginxConfigTransaction(client, [edit], nginx_path=nginx_path).commit()
+
+
+def _burst(clients, targets, nginx_path, commit, stagger=0.0):
+    """每个文件一个并发请求（各自的SSH连接），模拟同一主机上的突发修改；stagger为相邻请求的到达间隔（秒）"""
+    def submit(index):
+        time.sleep(index * stagger)
+        return commit(NginxConfigTransaction(clients[index], [_touch(targets[index])], nginx_path=nginx_path))
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        return list(executor.map(submit, range(len(clients))))
+
+
+def run_scenario(host, func, repeat):
+    """返回 (最佳耗时秒数, 最后一次的服务端统计, 最后一次结果)"""
+    best = None
+    result = None
+    stats = None
+    for _ in range(repeat):
+        host.stats.reset()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        stats = host.stats.snapshot()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, stats, result
+
+
+def run_benchmarks(params, host_params, batch_files, repeat, upstream_members=20000, reload_window=0.5, stagger=0.1):
+    with FakeNginxHost(**host_params) as host, tempfile.TemporaryDirectory(prefix='nginx-bench-local-') as local_dir:
+        tree = generate_tree(os.path.join(host.work_dir, 'etc', 'nginx'), **params)
+        # 站点和upstream文件，作为事务修改的目标
+        targets = [path for path in tree['files'] if '/conf.d/' in path or '/upstreams/' in path][:batch_files]
+
+        client = NginxParamikoClient('127.0.0.1', host.port, host.username, host.password)
+        # 远程配置的本地副本写到临时目录，不污染仓库中的local_nginx_configs
+        client.local_config_dir = local_dir
+
+        cases = {}
+        checks = {}
+
+        seconds, stats, connected = run_scenario(host, client.connect, 1)
+        if not connected:
+            raise RuntimeError('无法连接到夹具主机')
+        cases['connect'] = (seconds, stats)
+
+        seconds, stats, analysis = run_scenario(host, lambda: client.analyze_nginx_config(tree['main']), repeat)
+        cases['analyze_nginx_config'] = (seconds, stats)
+        checks['analyze_nginx_config'] = len(analysis.virtual_servers) if analysis else 0
+
+        seconds, stats, result = run_scenario(
+            host, lambda: client.write_config_file(targets[0], _touch(targets[0])['file_content']), repeat)
+        cases['write_config_file'] = (seconds, stats)
+        checks['write_config_file'] = result['success']
+
+        seconds, stats, result = run_scenario(
+            host, lambda: NginxConfigTransaction(client, [_touch(targets[0])], nginx_path=tree['main']).commit(),
+            repeat)
+        cases['transaction_single'] = (seconds, stats)
+        checks['transaction_single'] = result['success']
+
+        seconds, stats, result = run_scenario(
+            host, lambda: NginxConfigTransaction(client, [_touch(path) for path in targets],
+                                                 nginx_path=tree['main']).commit(), repeat)
+        cases['transaction_batch'] = (seconds, stats)
+        checks['transaction_batch'] = result['success']
+
+        # 对照：同样的文件逐个提交事务，每个文件一次nginx -t和reload
+        seconds, stats, results = run_scenario(
+            host, lambda: [NginxConfigTransaction(client, [_touch(path)], nginx_path=tree['main']).commit()
+                           for path in targets], repeat)
+        cases['transaction_per_file'] = (seconds, stats)
+        checks['transaction_per_file'] = all(result['success'] for result in results)
+
+        # 并发突发修改：各请求直接提交时步骤交错、每个请求一次reload；经主机操作队列时串行执行并合并reload
+        burst_clients = [NginxParamikoClient('127.0.0.1', host.port, host.username, host.password) for _ in targets]
+        for burst_client in burst_clients:
+            burst_client.local_config_dir = local_dir
+            burst_client.connect()
+        for name, commit in (('burst_direct', NginxConfigTransaction.commit), ('burst_queued', queued_commit)):
+            seconds, stats, results = run_scenario(
+                host, lambda: _burst(burst_clients, targets, tree['main'], commit), repeat)
+            cases[name] = (seconds, stats)
+            checks[name] = all(result['success'] for result in results)
+        # 请求陆续到达：没有合并窗口时前一批执行期间到达的才能合并；有窗口时窗口内到达的都由一次reload生效
+        for name, window in (('burst_staggered', 0.0), ('burst_window', reload_window)):
+            seconds, stats, results = run_scenario(
+                host, lambda: _burst(burst_clients, targets, tree['main'],
+                                     lambda transaction: queued_commit(transaction, window), stagger), repeat)
+            cases[name] = (seconds, stats)
+            checks[name] = all(result['success'] for result in results)
+        for burst_client in burst_clients:
+            burst_client.close()
+
+        # 大upstream文件中修改一个server：整文件下载和上传，对比只传输补丁（内容缓存有效时不下载）
+        generated = _generated_upstreams(os.path.join(os.path.dirname(tree['main']), 'upstreams', 'generated.conf'),
+                                         upstream_members)
+        for name, use_patch in (('upstream_edit_full', False), ('upstream_edit_patch', True)):
+            seconds, stats, result = run_scenario(
+                host, lambda: _toggle_member(client, generated, tree['main'], use_patch), repeat)
+            cases[name] = (seconds, stats)
+            checks[name] = result['success']
+
+        client.close()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'params': params,
+        'host': host_params,
+        'batch_files': len(targets),
+        'upstream_members': upstream_members,
+        'reload_window': reload_window,
+        'stagger': stagger,
+        'repeat': repeat,
+        'checks': checks,
+        'cases': {
+            name: dict({'seconds': round(seconds, 6)}, **{counter: stats[counter] for counter in COUNTERS})
+            for name, (seconds, stats) in cases.items()
+        }
+    }
+
+
+def print_report(result, baseline=None):
+    print(f"commit={result['commit']} host={result['host']} batch_files={result['batch_files']} "
+          f"params={result['params']}")
+    print(f"{'case':<22}{'time ms':>10}{'trips':>7}{'exec':>6}{'sftp':>6}{'KB in':>9}{'KB out':>9}"
+          f"{'tests':>7}{'reloads':>9}{'vs base':>10}")
+    for name, case in result['cases'].items():
+        delta = ''
+        base_case = (baseline or {}).get('cases', {}).get(name)
+        if base_case:
+            delta = f"{case['round_trips'] - base_case['round_trips']:+d} rt"
+        print(f"{name:<22}{case['seconds'] * 1000:>10.1f}{case['round_trips']:>7}{case['execs']:>6}"
+              f"{case['sftp_requests']:>6}{case['bytes_in'] / 1024:>9.1f}{case['bytes_out'] / 1024:>9.1f}"
+              f"{case['config_tests']:>7}{case['reloads']:>9}{delta:>10}")
+    failed = [name for name, ok in result['checks'].items() if not ok]
+    if failed:
+        print(f"注意: 以下场景执行失败 {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nginx远程操作往返次数基准')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--vhosts', type=int, default=100)
+    parser.add_argument('--locations', type=int, default=3)
+    parser.add_argument('--members', type=int, default=3)
+    parser.add_argument('--include-depth', type=int, default=2)
+    parser.add_argument('--stream-upstreams', type=int, default=2)
+    parser.add_argument('--batch-files', type=int, default=5, help='批量事务修改的文件数')
+    parser.add_argument('--upstream-members', type=int, default=20000, help='生成的大upstream文件中的server数')
+    parser.add_argument('--reload-window', type=float, default=0.5, help='burst_window场景的合并窗口（秒）')
+    parser.add_argument('--stagger', type=float, default=0.1, help='陆续到达场景中相邻请求的间隔（秒）')
+    parser.add_argument('--latency', type=float, default=0.01, help='每个exec和SFTP请求附加的延迟（秒）')
+    parser.add_argument('--nginx-test-latency', type=float, default=0.0)
+    parser.add_argument('--reload-latency', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='结果JSON路径，默认保存到benchmarks/results/')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比')
+    args = parser.parse_args()
+
+    analysis_logger.setLevel(logging.WARNING)
+    parse_logger.setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+
+    params = {
+        'files': args.files,
+        'vhosts': args.vhosts,
+        'locations': args.locations,
+        'members': args.members,
+        'include_depth': args.include_depth,
+        'stream_upstreams': args.stream_upstreams,
+    }
+    host_params = {
+        'latency': args.latency,
+        'nginx_test_latency': args.nginx_test_latency,
+        'reload_latency': args.reload_latency,
+    }
+    result = run_benchmarks(params, host_params, args.batch_files, args.repeat, args.upstream_members,
+                            args.reload_window, args.stagger)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params or baseline.get('host') != host_params:
+            print(f"注意: 对比结果的参数不同 {baseline.get('params')} {baseline.get('host')}")
+    print_report(result, baseline)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR,
+                              f"remote-{result['commit'] or 'nocommit'}-{time.strftime('%Y%m%d%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+进程内SSH/SFTP服务端夹具
+
+用paramiko在本机回环地址上模拟一台装有nginx的远程主机：exec请求交给本地shell执行，
+PATH前面放了假的nginx和systemctl（nginx -t用crossplane检查语法），SFTP直接读写本地文件系统；
+每个exec和SFTP请求可以附加固定延迟模拟网络往返，并统计往返次数和线路上的字节数
+
+用法:
+    with FakeNginxHost(latency=0.02) as host:
+        client = NginxParamikoClient('127.0.0.1', host.port, host.username, host.password)
+        ...
+        print(host.stats.snapshot())
+"""
+
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+import paramiko
+
+FAKE_NGINX = textwrap.dedent('''\
+    import os
+    import sys
+    import time
+
+    state_dir = os.environ['FAKE_NGINX_STATE']
+
+
+    def event(name):
+        with open(os.path.join(state_dir, 'events.log'), 'a') as f:
+            f.write(name + '\\n')
+
+
+    def main(args):
+        if '-t' in args:
+            event('test')
+            time.sleep(float(os.environ.get('FAKE_NGINX_TEST_LATENCY', '0')))
+            path = args[args.index('-c') + 1] if '-c' in args else '/etc/nginx/nginx.conf'
+            if os.environ.get('FAKE_NGINX_TEST_FAIL') == '1':
+                sys.stderr.write(f'nginx: [emerg] test failure injected in {path}\\n')
+                return 1
+            import crossplane
+            payload = crossplane.parse(path, catch_errors=False)
+            if payload['errors']:
+                sys.stderr.write(f"nginx: [emerg] {payload['errors'][0]['error']}\\n")
+                return 1
+            sys.stderr.write(f'nginx: the configuration file {path} syntax is ok\\n'
+                             f'nginx: configuration file {path} test is successful\\n')
+            return 0
+        if '-s' in args:
+            event(args[args.index('-s') + 1])
+            time.sleep(float(os.environ.get('FAKE_NGINX_RELOAD_LATENCY', '0')))
+            return 0
+        if '-v' in args or '-V' in args:
+            sys.stderr.write('nginx version: nginx/1.24.0\\n')
+            if '-V' in args:
+                sys.stderr.write('configure arguments: --prefix=/etc/nginx --with-stream '
+                                 '--with-http_ssl_module --with-http_stub_status_module\\n')
+            return 0
+        return 0
+
+
+    sys.exit(main(sys.argv[1:]))
+''')
+
+FAKE_SYSTEMCTL = textwrap.dedent('''\
+    import os
+    import subprocess
+    import sys
+
+    args = sys.argv[1:]
+    action = args[0] if args else 'status'
+    if action in ('reload', 'restart'):
+        sys.exit(subprocess.call(['nginx', '-s', 'reload']))
+    if action == 'is-active':
+        print('active')
+        sys.exit(0)
+    print('* nginx.service - A high performance web server and a reverse proxy server')
+    print('   Active: active (running)')
+    sys.exit(0)
+''')
+
+
+class HostStats:
+    """服务端统计：exec和SFTP请求数、线路字节数、nginx -t和reload次数"""
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.execs = 0
+            self.sftp_requests = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.commands = []
+        events_path = os.path.join(self.state_dir, 'events.log')
+        if os.path.exists(events_path):
+            os.unlink(events_path)
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def events(self):
+        events_path = os.path.join(self.state_dir, 'events.log')
+        if not os.path.exists(events_path):
+            return []
+        with open(events_path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def snapshot(self):
+        events = self.events()
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'execs': self.execs,
+                'sftp_requests': self.sftp_requests,
+                'round_trips': self.execs + self.sftp_requests,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'config_tests': events.count('test'),
+                'reloads': events.count('reload'),
+                'commands': list(self.commands),
+            }
+
+
+class CountingSocket:
+    """统计收发字节数的socket包装，计入SSH协议本身的开销"""
+
+    def __init__(self, sock, stats):
+        self._sock = sock
+        self._stats = stats
+
+    def recv(self, size):
+        data = self._sock.recv(size)
+        self._stats.add(bytes_in=len(data))
+        return data
+
+    def send(self, data):
+        sent = self._sock.send(data)
+        self._stats.add(bytes_out=sent)
+        return sent
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+        self._stats.add(bytes_out=len(data))
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, host):
+        self.host = host
+
+    def check_auth_password(self, username, password):
+        if username == self.host.username and password == self.host.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode('utf-8', errors='replace') if isinstance(command, bytes) else command
+        threading.Thread(target=self.host._run_exec, args=(channel, command), daemon=True).start()
+        return True
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def __init__(self, host, flags=0):
+        super().__init__(flags)
+        self.host = host
+
+    def read(self, offset, length):
+        self.host._sftp_request()
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        self.host._sftp_request()
+        return super().write(offset, data)
+
+    def stat(self):
+        self.host._sftp_request()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        self.host._sftp_request()
+        return paramiko.SFTP_OK
+
+
+class _SFTPServerInterface(paramiko.SFTPServerInterface):
+    """直接映射本地文件系统的SFTP实现，每个请求计数并附加延迟"""
+
+    def __init__(self, server, host, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = host
+
+    def _call(self, func, *args):
+        self.host._sftp_request()
+        try:
+            return func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if path.startswith('/') else '/' + path)
+
+    def list_folder(self, path):
+        def list_folder():
+            result = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        return self._call(list_folder)
+
+    def stat(self, path):
+        return self._call(lambda: paramiko.SFTPAttributes.from_stat(os.stat(path)))
+
+    def lstat(self, path):
+        return self._call(lambda: paramiko.SFTPAttributes.from_stat(os.lstat(path)))
+
+    def open(self, path, flags, attr):
+        def open_file():
+            mode = getattr(attr, 'st_mode', None) or 0o644
+            fd = os.open(path, flags, stat.S_IMODE(mode))
+            if flags & os.O_WRONLY:
+                fmode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                fmode = 'rb'
+            handle = _SFTPHandle(self.host, flags)
+            handle.filename = path
+            handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+            return handle
+        return self._call(open_file)
+
+    def remove(self, path):
+        return self._call(lambda: os.remove(path) or paramiko.SFTP_OK)
+
+    def rename(self, oldpath, newpath):
+        def rename():
+            if os.path.exists(newpath):
+                return paramiko.SFTP_FAILURE
+            os.rename(oldpath, newpath)
+            return paramiko.SFTP_OK
+        return self._call(rename)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(lambda: os.replace(oldpath, newpath) or paramiko.SFTP_OK)
+
+    def mkdir(self, path, attr):
+        return self._call(lambda: os.mkdir(path) or paramiko.SFTP_OK)
+
+    def rmdir(self, path):
+        return self._call(lambda: os.rmdir(path) or paramiko.SFTP_OK)
+
+    def chattr(self, path, attr):
+        def chattr():
+            if attr.st_mode is not None:
+                os.chmod(path, stat.S_IMODE(attr.st_mode))
+            return paramiko.SFTP_OK
+        return self._call(chattr)
+
+
+class FakeNginxHost:
+    """
+    模拟的nginx主机
+
+    参数:
+        latency: 每个exec和SFTP请求附加的延迟（秒），模拟网络往返
+        nginx_test_latency: nginx -t额外耗时
+        reload_latency: reload额外耗时
+        nginx_test_fails: 为True时nginx -t总是失败
+    """
+
+    username = 'bench'
+    password = 'bench'
+
+    def __init__(self, latency=0.0, nginx_test_latency=0.0, reload_latency=0.0, nginx_test_fails=False):
+        self.latency = latency
+        self.nginx_test_latency = nginx_test_latency
+        self.reload_latency = reload_latency
+        self.nginx_test_fails = nginx_test_fails
+        self.work_dir = tempfile.mkdtemp(prefix='fake-nginx-host-')
+        self.bin_dir = os.path.join(self.work_dir, 'bin')
+        self.state_dir = os.path.join(self.work_dir, 'state')
+        os.makedirs(self.bin_dir)
+        os.makedirs(self.state_dir)
+        self._install_shim('nginx', FAKE_NGINX)
+        self._install_shim('systemctl', FAKE_SYSTEMCTL)
+        self.stats = HostStats(self.state_dir)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.port = None
+        self._socket = None
+        self._transports = []
+        self._stopped = threading.Event()
+
+    def _install_shim(self, name, source):
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f'#!{sys.executable}\n{source}')
+        os.chmod(path, 0o755)
+
+    @property
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'PATH': f"{self.bin_dir}:{env.get('PATH', '/usr/bin:/bin')}",
+            'FAKE_NGINX_STATE': self.state_dir,
+            'FAKE_NGINX_TEST_LATENCY': str(self.nginx_test_latency),
+            'FAKE_NGINX_RELOAD_LATENCY': str(self.reload_latency),
+            'FAKE_NGINX_TEST_FAIL': '1' if self.nginx_test_fails else '0',
+            'PYTHONPATH': os.pathsep.join(sys.path),
+        })
+        return env
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+        self._socket.settimeout(0.2)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for transport in self._transports:
+            transport.close()
+        if self._socket:
+            self._socket.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                sock, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            sock.settimeout(None)
+            self.stats.add(connections=1)
+            transport = paramiko.Transport(CountingSocket(sock, self.stats))
+            transport.add_server_key(self.host_key)
+            host = self
+
+            class SFTPServer(_SFTPServerInterface):
+                def __init__(self, server, *args, **kwargs):
+                    super().__init__(server, host, *args, **kwargs)
+
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPServer)
+            transport.start_server(server=_ServerInterface(self))
+            self._transports.append(transport)
+            threading.Thread(target=self._channel_loop, args=(transport,), daemon=True).start()
+
+    @staticmethod
+    def _channel_loop(transport):
+        # exec和sftp都在ServerInterface回调中处理，这里只需要持续接受通道；
+        # 接受的通道必须保留引用，否则被回收时会自动关闭
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(timeout=0.5)
+            if channel is not None:
+                channels.append(channel)
+            channels = [channel for channel in channels if not channel.closed]
+
+    def _sftp_request(self):
+        self.stats.add(sftp_requests=1)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _run_exec(self, channel, command):
+        self.stats.add(execs=1)
+        with self.stats.lock:
+            self.stats.commands.append(command)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            process = subprocess.run(['/bin/sh', '-c', command], capture_output=True, env=self.env)
+            channel.sendall(process.stdout)
+            channel.sendall_stderr(process.stderr)
+            channel.send_exit_status(process.returncode)
+        except Exception as e:
+            channel.sendall_stderr(str(e).encode('utf-8'))
+            channel.send_exit_status(255)
+        finally:
+            # exec请求的应答在本回调返回后才由传输线程发出，立即close会让客户端先收到关闭而报
+            # Channel closed；先发EOF，等客户端关闭通道（或超时）后再关闭
+            channel.shutdown_write()
+            deadline = time.monotonic() + 5
+            while not channel.closed and time.monotonic() < deadline:
+                time.sleep(0.01)
+            channel.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+合成Nginx配置树生成器
+
+按给定规模在目录中写出一套可被nginx和crossplane解析的配置：
+主配置nginx.conf通过glob引入conf.d/*.conf和upstreams/*.conf，每个站点文件引入多层snippets，
+stream块引入streams/*.conf
+"""
+
+import os
+
+
+def _write(path, lines):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def generate_tree(root, files=20, vhosts=200, locations=5, members=5, include_depth=2, stream_upstreams=0):
+    """
+    生成配置树
+
+    参数:
+        root: 输出目录，作为nginx的配置目录
+        files: 站点和upstream配置文件数，vhost和upstream平均分布到这些文件中
+        vhosts: 虚拟主机总数，每个vhost一个upstream
+        locations: 每个vhost的location数
+        members: 每个upstream的成员数
+        include_depth: 每个站点文件引入的snippet嵌套层数
+        stream_upstreams: stream块中的四层upstream数
+
+    返回:
+        dict: 主配置路径以及生成的文件列表
+    """
+    root = os.path.abspath(root)
+    main_path = os.path.join(root, 'nginx.conf')
+    generated = [main_path]
+
+    _write(main_path, [
+        'user nginx;',
+        'worker_processes auto;',
+        'pid /run/nginx.pid;',
+        'events {',
+        '    worker_connections 1024;',
+        '}',
+        'http {',
+        '    sendfile on;',
+        '    keepalive_timeout 65;',
+        f'    include {root}/upstreams/*.conf;',
+        f'    include {root}/conf.d/*.conf;',
+        '}',
+        'stream {',
+        f'    include {root}/streams/*.conf;',
+        '}',
+    ])
+
+    # 多层snippet: level_0引入level_1，直到include_depth层
+    for level in range(include_depth):
+        lines = [
+            f'proxy_set_header X-Level-{level} $host;',
+            'proxy_set_header X-Real-IP $remote_addr;',
+            'proxy_read_timeout 60s;',
+        ]
+        if level + 1 < include_depth:
+            lines.append(f'include {root}/snippets/level_{level + 1}.conf;')
+        path = os.path.join(root, 'snippets', f'level_{level}.conf')
+        _write(path, lines)
+        generated.append(path)
+
+    files = max(1, files)
+    for file_index in range(files):
+        site_lines = []
+        upstream_lines = []
+        for index in range(file_index, vhosts, files):
+            upstream_lines.append(f'upstream backend_{index} {{')
+            for member in range(members):
+                upstream_lines.append(
+                    f'    server 10.{index // 250 % 250}.{index % 250}.{member + 1}:8080 weight={member % 3 + 1}'
+                    f'{" backup" if member == members - 1 and members > 2 else ""};')
+            upstream_lines.append('}')
+
+            site_lines.append('server {')
+            site_lines.append('    listen 80;')
+            site_lines.append(f'    server_name site{index}.example.com;')
+            for location in range(locations):
+                site_lines.append(f'    location /api{location} {{')
+                site_lines.append(f'        proxy_pass http://backend_{index};')
+                if include_depth:
+                    site_lines.append(f'        include {root}/snippets/level_0.conf;')
+                site_lines.append('    }')
+            site_lines.append('}')
+
+        site_path = os.path.join(root, 'conf.d', f'site_{file_index}.conf')
+        upstream_path = os.path.join(root, 'upstreams', f'upstream_{file_index}.conf')
+        _write(site_path, site_lines)
+        _write(upstream_path, upstream_lines)
+        generated.extend((site_path, upstream_path))
+
+    stream_lines = []
+    for index in range(stream_upstreams):
+        stream_lines.append(f'upstream tcp_{index} {{')
+        for member in range(members):
+            stream_lines.append(f'    server 10.200.{index % 250}.{member + 1}:{3306 + index};')
+        stream_lines.append('}')
+        stream_lines.append('server {')
+        stream_lines.append(f'    listen {13306 + index};')
+        stream_lines.append(f'    proxy_pass tcp_{index};')
+        stream_lines.append('}')
+    stream_path = os.path.join(root, 'streams', 'tcp.conf')
+    _write(stream_path, stream_lines)
+    generated.append(stream_path)
+
+    return {'main': main_path, 'files': generated}
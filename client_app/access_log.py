@@ -0,0 +1,245 @@
+import re
+import shlex
+from datetime import datetime
+
+# nginx内置的combined格式
+LOG_FORMAT_COMBINED = ('$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+                       '"$http_referer" "$http_user_agent"')
+
+# 推荐的日志格式：在combined之后追加虚拟主机、upstream名称和上游耗时，按upstream统计需要这些字段；
+# 重试时upstream变量是"502, 200"这样的列表，加引号后不会与后面的字段错位
+LOG_FORMAT_UPSTREAM = (LOG_FORMAT_COMBINED + ' $host "$proxy_host" "$upstream_addr" "$upstream_status" '
+                       '"$upstream_response_time" $request_time')
+
+# 统计用到的变量，其余变量在正则中不捕获
+_FIELDS = ('status', 'body_bytes_sent', 'bytes_sent', 'time_local', 'time_iso8601', 'msec', 'host',
+           'server_name', 'proxy_host', 'upstream_addr', 'upstream_response_time', 'request_time')
+
+_VARIABLE_RE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+# 重试或内部跳转时upstream变量的值是以", "和" : "分隔的列表，没有引号时按列表匹配，不在第一个空格处截断
+_LIST_PATTERN = r'[^ ,]*(?:(?:, | : )[^ ,]*)*'
+_LIST_SEPARATOR_RE = re.compile(r'\s*(?:,| : )\s*')
+
+TAIL_HEADER = b'@@tail '
+
+# 单次读取的默认字节上限，积压的日志分多个周期追上
+DEFAULT_TAIL_BYTES = 8 * 1024 * 1024
+
+
+class LogFormat:
+    """
+    把nginx的log_format编译为正则
+
+    变量匹配到下一个字面字符为止（"$request"匹配[^"]*），行内不需要回溯；
+    只捕获统计用到的变量
+    """
+
+    def __init__(self, log_format=LOG_FORMAT_COMBINED):
+        self.log_format = log_format
+        self.fields = set()
+        parts = []
+        position = 0
+        matches = list(_VARIABLE_RE.finditer(log_format))
+        for index, match in enumerate(matches):
+            parts.append(re.escape(log_format[position:match.start()]))
+            name = match.group(1) or match.group(2)
+            position = match.end()
+            following = log_format[position:matches[index + 1].start()] if index + 1 < len(matches) \
+                else log_format[position:]
+            if following and following[0] == ' ' and name.startswith('upstream_'):
+                pattern = _LIST_PATTERN
+            elif following:
+                pattern = f'[^{re.escape(following[0])}]*'
+            elif index + 1 < len(matches):
+                pattern = r'\S*?'
+            else:
+                pattern = '.*'
+            if name in _FIELDS and name not in self.fields:
+                self.fields.add(name)
+                parts.append(f'(?P<{name}>{pattern})')
+            else:
+                parts.append(f'(?:{pattern})')
+        parts.append(re.escape(log_format[position:]))
+        self.regex = re.compile(''.join(parts))
+        self._minutes = {}
+
+    def _minute(self, fields):
+        """请求所在分钟的时间戳，同一分钟的时间字符串只解析一次"""
+        if 'msec' in fields:
+            return int(float(fields['msec'])) // 60 * 60
+        if 'time_local' in fields:
+            value = fields['time_local']
+            key = value[:17] + value[20:]  # 10/Oct/2000:13:55 -0700
+            layout = '%d/%b/%Y:%H:%M %z'
+        else:
+            value = fields['time_iso8601']
+            key = value[:16] + value[19:]  # 2000-10-10T13:55+08:00
+            layout = None
+        minute = self._minutes.get(key)
+        if minute is None:
+            parsed = datetime.strptime(key, layout) if layout else datetime.fromisoformat(key)
+            minute = int(parsed.timestamp())
+            if len(self._minutes) > 1024:
+                self._minutes.clear()
+            self._minutes[key] = minute
+        return minute
+
+    @property
+    def has_time(self):
+        return bool(self.fields & {'msec', 'time_local', 'time_iso8601'})
+
+    def parse(self, line):
+        """
+        解析一行日志
+
+        返回:
+            tuple: (分钟时间戳, 虚拟主机, upstream, 状态码, 响应字节数, 上游耗时秒数或None)；
+            格式不符时返回None
+        """
+        match = self.regex.match(line)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        try:
+            minute = self._minute(fields)
+            status = int(fields.get('status') or 0)
+        except ValueError:
+            return None
+        sent = fields.get('body_bytes_sent') or fields.get('bytes_sent') or '0'
+        vhost = fields.get('host') or fields.get('server_name') or '-'
+
+        # 重试时$upstream_addr和$upstream_response_time为列表，最后一个地址给出最终响应，耗时为各次之和
+        upstream = fields.get('proxy_host') or '-'
+        if upstream == '-':
+            upstream = _LIST_SEPARATOR_RE.split(fields.get('upstream_addr') or '-')[-1].strip()
+        upstream_time = None
+        if fields.get('upstream_response_time') not in (None, '', '-'):
+            try:
+                upstream_time = sum(float(value) for value in
+                                    _LIST_SEPARATOR_RE.split(fields['upstream_response_time'])
+                                    if value.strip() not in ('', '-'))
+            except ValueError:
+                upstream_time = None
+        return minute, vhost, upstream, status, int(sent) if sent.isdigit() else 0, upstream_time
+
+
+def tail_command(path, inode=None, offset=0, max_bytes=DEFAULT_TAIL_BYTES):
+    """
+    从上次的位置读取日志的远程脚本
+
+    输出由若干帧组成，每帧是一行 "@@tail 类型 inode 起始偏移 字节数 文件大小" 加上恰好该字节数的内容：
+    文件被轮转（inode变化）时先输出旧文件path.1中未读的部分（rotated帧），再从新文件开头读取（current帧）；
+    文件被截断时从头读取；第一次读取（没有inode）时从文件末尾开始
+    """
+    old = '' if inode is None else str(int(inode))
+    return f'''f={shlex.quote(path)}; old={old}; off={int(offset)}; max={int(max_bytes)}
+st=$(stat -Lc '%i %s' "$f") || exit 2
+set -- $st; inode=$1; size=$2
+if [ -z "$old" ]; then off=$size
+elif [ "$inode" != "$old" ]; then
+    if [ -f "$f.1" ] && [ "$(stat -Lc %i "$f.1")" = "$old" ]; then
+        rsize=$(stat -Lc %s "$f.1"); n=$((rsize - off)); [ $n -gt $max ] && n=$max; [ $n -lt 0 ] && n=0
+        echo "@@tail rotated $old $off $n $rsize"
+        [ $n -gt 0 ] && tail -c +$((off + 1)) "$f.1" | head -c $n
+        max=$((max - n))
+    fi
+    off=0
+elif [ "$size" -lt "$off" ]; then off=0; fi
+n=$((size - off)); [ $n -gt $max ] && n=$max; [ $n -lt 0 ] && n=0
+echo "@@tail current $inode $off $n $size"
+[ $n -gt 0 ] && tail -c +$((off + 1)) "$f" | head -c $n
+exit 0'''
+
+
+class AccessLogTail:
+    """
+    一次增量读取
+
+    迭代产出 (行, (inode, 偏移))，偏移为该行之后的位置，调用方可以在任意一行之后保存位置；
+    current帧末尾不完整的行不消费，留给下一次读取。迭代结束后inode、offset为新的读取位置
+    """
+
+    def __init__(self, client, path, inode=None, offset=0, max_bytes=DEFAULT_TAIL_BYTES, timeout=60):
+        self.client = client
+        self.path = path
+        self.inode = inode
+        self.offset = offset
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.bytes_read = 0
+        self.lines = 0
+        self.rotated = False
+        self.rotating = False
+        self.result = None
+
+    def _frame(self, header):
+        fields = header[len(TAIL_HEADER):].split()
+        if len(fields) != 5:
+            raise ValueError(f'无法识别的帧头: {header[:100]!r}')
+        kind = fields[0].decode()
+        inode, start, count, size = (int(value) for value in fields[1:])
+        return kind, inode, start, count, size
+
+    def _end_frame(self, frame, pending, position):
+        """帧读完时处理末尾不完整的行，返回需要补充产出的最后一行"""
+        kind, inode, start, count, size = frame
+        if kind == 'rotated':
+            if start + count < size:
+                return None
+            # 旧文件已读完，最后一行即使没有换行也是完整的
+            self.rotating = False
+            self.inode, self.offset = inode, size
+            return pending or None
+        if pending and position == start and count >= self.max_bytes:
+            # 单行超过读取上限，跳过已读到的部分，避免位置永远停在这一行
+            self.offset = start + count
+        return None
+
+    def __iter__(self):
+        command = tail_command(self.path, self.inode, self.offset, self.max_bytes)
+        # 帧头额外占用的空间
+        limit = self.max_bytes + 4096
+        with self.client.open_command_stream(command, timeout=self.timeout, max_output_bytes=limit) as stream:
+            buffer = b''
+            frame = None
+            remaining = 0
+            pending = b''
+            position = 0
+            for stream_name, data in stream.iter_chunks():
+                if stream_name == 'stderr':
+                    stream.stderr_chunks.append(data)
+                    continue
+                buffer += data
+                while frame is not None or b'\n' in buffer:
+                    if frame is None:
+                        newline = buffer.index(b'\n')
+                        frame = self._frame(buffer[:newline])
+                        buffer = buffer[newline + 1:]
+                        kind, inode, position, remaining, size = frame
+                        if kind == 'rotated':
+                            self.rotated = self.rotating = True
+                            self.inode, self.offset = inode, position
+                        elif not self.rotating:
+                            self.inode, self.offset = inode, position
+                        # 旧文件受字节上限限制没有读完时current帧为空，读取位置保持在旧文件上
+                    elif remaining:
+                        if not buffer:
+                            break
+                        piece, buffer = buffer[:remaining], buffer[remaining:]
+                        remaining -= len(piece)
+                        self.bytes_read += len(piece)
+                        *lines, pending = (pending + piece).split(b'\n')
+                        for line in lines:
+                            position += len(line) + 1
+                            self.offset = position
+                            self.lines += 1
+                            yield line.decode('utf-8', errors='replace'), (self.inode, position)
+                    if remaining == 0:
+                        last = self._end_frame(frame, pending, position)
+                        if last is not None:
+                            self.lines += 1
+                            yield last.decode('utf-8', errors='replace'), (self.inode, self.offset)
+                        frame = None
+                        pending = b''
+            self.result = stream.result(b'')
@@ -0,0 +1,208 @@
+import posixpath
+import shlex
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 探测结果在ClientInfo上的缓存时间（秒）
+CAPABILITY_TTL = 6 * 3600
+
+# 可能用到的工具，探测时逐个command -v
+PROBE_TOOLS = ('ss', 'netstat', 'sha256sum', 'md5sum', 'tar', 'find', 'pgrep', 'sync', 'sudo', 'curl')
+
+# 不在PATH中时依次尝试的nginx安装位置
+NGINX_CANDIDATES = ('/usr/sbin/nginx', '/usr/local/sbin/nginx', '/usr/local/nginx/sbin/nginx',
+                    '/opt/nginx/sbin/nginx', '/usr/local/openresty/nginx/sbin/nginx')
+
+NGINX_V_MARKER = '@@nginx -V'
+
+# 一次远程命令完成全部探测：init系统、nginx路径、nginx -V输出、可用工具
+PROBE_SCRIPT = f'''
+if [ -d /run/systemd/system ] && command -v systemctl >/dev/null 2>&1; then echo "init=systemd"
+elif command -v rc-service >/dev/null 2>&1; then echo "init=openrc"
+elif command -v service >/dev/null 2>&1; then echo "init=sysv"
+else echo "init=none"; fi
+bin=$(command -v nginx 2>/dev/null)
+if [ -z "$bin" ]; then
+    for p in {' '.join(NGINX_CANDIDATES)}; do if [ -x "$p" ]; then bin=$p; break; fi; done
+fi
+echo "nginx_bin=$bin"
+for t in {' '.join(PROBE_TOOLS)}; do echo "tool.$t=$(command -v $t 2>/dev/null)"; done
+echo "uid=$(id -u)"
+if [ -n "$bin" ]; then echo "{NGINX_V_MARKER}"; "$bin" -V 2>&1; fi
+'''
+
+STATUS_COMMANDS = {
+    'systemd': 'systemctl status nginx --no-pager',
+    'openrc': 'rc-service nginx status',
+    'sysv': 'service nginx status',
+}
+
+
+class HostCapabilities:
+    """
+    远程主机能力探测结果
+
+    根据探测结果生成针对该主机的命令，后续操作不再用 a || b || c 的方式逐个尝试
+    """
+
+    def __init__(self, init_system='none', nginx_bin=None, nginx_version=None, nginx_modules=(),
+                 nginx_prefix=None, nginx_conf_path=None, nginx_pid_path=None, tools=None, uid=None,
+                 probed_at=None):
+        self.init_system = init_system
+        self.nginx_bin = nginx_bin
+        self.nginx_version = nginx_version
+        self.nginx_modules = list(nginx_modules)
+        self.nginx_prefix = nginx_prefix
+        self.nginx_conf_path = nginx_conf_path
+        self.nginx_pid_path = nginx_pid_path
+        self.tools = dict(tools or {})
+        self.uid = uid
+        self.probed_at = probed_at
+
+    @classmethod
+    def parse(cls, output):
+        """解析PROBE_SCRIPT的输出"""
+        caps = cls()
+        lines = output.splitlines()
+        if NGINX_V_MARKER in lines:
+            marker = lines.index(NGINX_V_MARKER)
+            lines, nginx_v = lines[:marker], lines[marker + 1:]
+        else:
+            nginx_v = []
+
+        for line in lines:
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            value = value.strip()
+            if key == 'init':
+                caps.init_system = value or 'none'
+            elif key == 'nginx_bin':
+                caps.nginx_bin = value or None
+            elif key == 'uid':
+                caps.uid = int(value) if value.isdigit() else None
+            elif key.startswith('tool.') and value:
+                caps.tools[key[len('tool.'):]] = value
+
+        for line in nginx_v:
+            if line.startswith('nginx version:'):
+                caps.nginx_version = line.split('/', 1)[-1].strip()
+            elif line.startswith('configure arguments:'):
+                caps._parse_configure_arguments(line[len('configure arguments:'):])
+
+        if caps.nginx_conf_path is None and caps.nginx_prefix:
+            caps.nginx_conf_path = posixpath.join(caps.nginx_prefix, 'conf', 'nginx.conf')
+        return caps
+
+    def _parse_configure_arguments(self, arguments):
+        try:
+            arguments = shlex.split(arguments)
+        except ValueError:
+            arguments = arguments.split()
+        for argument in arguments:
+            option, _, value = argument.partition('=')
+            if option == '--prefix':
+                self.nginx_prefix = value
+            elif option == '--conf-path':
+                self.nginx_conf_path = value
+            elif option == '--pid-path':
+                self.nginx_pid_path = value
+            elif option.startswith('--with-') and option.endswith('_module'):
+                self.nginx_modules.append(option[len('--with-'):])
+            elif option in ('--with-stream', '--with-mail') and value in ('', 'dynamic'):
+                self.nginx_modules.append(option[len('--with-'):])
+            elif option in ('--add-module', '--add-dynamic-module'):
+                self.nginx_modules.append(posixpath.basename(value.rstrip('/')))
+
+    def to_dict(self):
+        return {
+            'init_system': self.init_system,
+            'nginx_bin': self.nginx_bin,
+            'nginx_version': self.nginx_version,
+            'nginx_modules': list(self.nginx_modules),
+            'nginx_prefix': self.nginx_prefix,
+            'nginx_conf_path': self.nginx_conf_path,
+            'nginx_pid_path': self.nginx_pid_path,
+            'tools': dict(self.tools),
+            'uid': self.uid,
+        }
+
+    @classmethod
+    def from_dict(cls, data, probed_at=None):
+        return cls(probed_at=probed_at, **{key: data.get(key) for key in (
+            'init_system', 'nginx_bin', 'nginx_version', 'nginx_prefix', 'nginx_conf_path', 'nginx_pid_path',
+            'tools', 'uid')}, nginx_modules=data.get('nginx_modules') or ())
+
+    def has_tool(self, name):
+        return name in self.tools
+
+    def has_module(self, name):
+        return name in self.nginx_modules
+
+    @property
+    def nginx(self):
+        return shlex.quote(self.nginx_bin) if self.nginx_bin else 'nginx'
+
+    def test_command(self, nginx_path=None):
+        nginx_path = nginx_path or self.nginx_conf_path
+        return f'{self.nginx} -t -c {shlex.quote(nginx_path)}' if nginx_path else f'{self.nginx} -t'
+
+    def reload_command(self):
+        return f'{self.nginx} -s reload'
+
+    def status_command(self):
+        """nginx不一定由init系统管理，服务状态查询失败时在同一条命令里退回进程列表"""
+        process_command = "ps aux | grep '[n]ginx'"
+        status_command = STATUS_COMMANDS.get(self.init_system)
+        if status_command:
+            return f'{status_command} || {process_command}'
+        return process_command
+
+    def listen_command(self):
+        if self.has_tool('ss'):
+            return 'ss -tln'
+        if self.has_tool('netstat'):
+            return 'netstat -tln'
+        return None
+
+    def checksum_command(self, *paths):
+        tool = 'sha256sum' if self.has_tool('sha256sum') else 'md5sum'
+        return f'{tool} {" ".join(shlex.quote(path) for path in paths)}'
+
+
+def cached_capabilities(server, ttl=CAPABILITY_TTL):
+    """读取ClientInfo上未过期的探测结果，不存在或已过期时返回None"""
+    if not server.capabilities or not server.capabilities_probed_at:
+        return None
+    if timezone.now() - server.capabilities_probed_at > timedelta(seconds=ttl):
+        return None
+    return HostCapabilities.from_dict(server.capabilities, probed_at=server.capabilities_probed_at)
+
+
+def store_capabilities(server, caps):
+    """把探测结果保存到ClientInfo，只更新这两个字段"""
+    server.capabilities = caps.to_dict()
+    server.capabilities_probed_at = caps.probed_at or timezone.now()
+    server.save(update_fields=['capabilities', 'capabilities_probed_at'])
+
+
+def attach_capabilities(client, server, ttl=CAPABILITY_TTL):
+    """
+    为客户端挂上ClientInfo缓存的探测结果
+
+    缓存有效时不产生远程命令；缓存过期时客户端在第一次需要时探测一次，结果写回ClientInfo
+    """
+    client.capabilities = cached_capabilities(server, ttl)
+
+    def on_probed(caps):
+        try:
+            store_capabilities(server, caps)
+        except Exception as e:
+            logger.warning('保存主机能力探测结果失败 host=%s error=%s', server.host, e)
+
+    client.on_capabilities_probed = on_probed
+    return client.capabilities
@@ -1,12 +1,51 @@
-import tempfile
-
 import paramiko
-from io import StringIO
+from io import StringIO, BytesIO
 import json
 import os
+import stat
+import uuid
+import shlex
+import hashlib
+import posixpath
+import select
+import time
 import logging
 import crossplane
+from .records import intern_args
+from .routing import RoutingGraph
+from .includes import RemoteFileListing, IncludeResolver
+from .fallback_parser import parse_config
+from .instrumentation import record, span
+from .capabilities import HostCapabilities, PROBE_SCRIPT
+from .patch import EXIT_STALE, compare_and_rename_command, content_cache, parse_patch_output, parse_stale_output
+from .visitor import DirectiveVisitor, default_extractors, collect_analysis
 logger = logging.getLogger(__name__)
+# 分子系统的日志器，可在settings.LOGGING中分别设置级别
+analysis_logger = logging.getLogger(f'{__name__}.analysis')
+parse_logger = logging.getLogger(f'{__name__}.parse')
+
+
+class DirectiveTrace:
+    """
+    采样的指令级调试跟踪
+
+    只有analysis日志器开启DEBUG并且设置了采样间隔时才生效，每sample_every条指令记录一条，
+    采样间隔默认取环境变量NGINX_ANALYSIS_TRACE_SAMPLE，为0时关闭
+    """
+
+    def __init__(self, log=analysis_logger, sample_every=None):
+        if sample_every is None:
+            sample_every = int(os.environ.get('NGINX_ANALYSIS_TRACE_SAMPLE', '0') or 0)
+        self.log = log
+        self.sample_every = sample_every
+        self.enabled = sample_every > 0 and log.isEnabledFor(logging.DEBUG)
+        self.count = 0
+
+    def directive(self, file_path, depth, directive, args):
+        self.count += 1
+        if self.count % self.sample_every == 0:
+            self.log.debug('trace seq=%d file=%s depth=%d directive=%s args=%s',
+                           self.count, file_path, depth, directive, args)
 
 class NginxAnalyzer:
     def __init__(self, nginx_main_conf_path="/etc/nginx/nginx.conf", nginx_obj_dict=None):
@@ -54,7 +93,6 @@ class NginxAnalyzer:
                                 raise Exception("请把http块下的server块和upstream块的配置移出主配置文件")
                     if file_per_directive_dict["directive"] == "stream":
                         for http_per_directive_dict in file_per_directive_dict['block']:
-                            print(http_per_directive_dict)
                             if http_per_directive_dict['directive'] == 'server' or http_per_directive_dict[
                                 'directive'] == 'upstream':
                                 raise Exception("请把stream块下的server块和upstream块的配置移出主配置文件")
@@ -82,232 +120,58 @@ class NginxAnalyzer:
                             }
         return backend_server_info_dict
     def _manual_parse_nginx_config(self, file_content, file_path):
-        """手动解析Nginx配置文件，提取关键配置"""
-        import re
-        parsed_directives = []
-
+        """crossplane解析失败时的容错解析，单次扫描得到完整的指令树，语法错误记录后继续解析"""
         try:
-            # 提取server块
-            server_pattern = r'server\s*\{([^}]+)\}'
-            server_matches = re.findall(server_pattern, file_content, re.DOTALL)
-
-            for i, server_content in enumerate(server_matches):
-                # 创建server指令
-                server_directive = {
-                    'directive': 'server',
-                    'args': [f'server_{i}'],
-                    'line': 1,  # 简化处理，使用默认行号
-                    'block': []
-                }
-
-                # 提取server_name
-                server_name_pattern = r'server_name\s+([^;]+);'
-                server_name_match = re.search(server_name_pattern, server_content)
-                if server_name_match:
-                    server_names = server_name_match.group(1).strip().split()
-                    server_directive['block'].append({
-                        'directive': 'server_name',
-                        'args': server_names,
-                        'line': 1
-                    })
-
-                # 提取listen
-                listen_pattern = r'listen\s+([^;]+);'
-                listen_match = re.search(listen_pattern, server_content)
-                if listen_match:
-                    listen_args = listen_match.group(1).strip().split()
-                    server_directive['block'].append({
-                        'directive': 'listen',
-                        'args': listen_args,
-                        'line': 1
-                    })
-
-                # 提取location块
-                location_pattern = r'location\s+([^{]+)\{([^}]+)\}'
-                location_matches = re.findall(location_pattern, server_content, re.DOTALL)
-
-                for location_match in location_matches:
-                    location_path = location_match[0].strip()
-                    location_content = location_match[1]
-
-                    location_directive = {
-                        'directive': 'location',
-                        'args': [location_path],
-                        'line': 1,
-                        'block': []
-                    }
-
-                    # 提取proxy_pass
-                    proxy_pass_pattern = r'proxy_pass\s+([^;]+);'
-                    proxy_pass_match = re.search(proxy_pass_pattern, location_content)
-                    if proxy_pass_match:
-                        proxy_pass_args = [proxy_pass_match.group(1).strip()]
-                        location_directive['block'].append({
-                            'directive': 'proxy_pass',
-                            'args': proxy_pass_args,
-                            'line': 1
-                        })
-
-                    server_directive['block'].append(location_directive)
-
-                parsed_directives.append(server_directive)
-
-            # 提取upstream块
-            upstream_pattern = r'upstream\s+([^{]+)\{([^}]+)\}'
-            upstream_matches = re.findall(upstream_pattern, file_content, re.DOTALL)
-
-            for upstream_match in upstream_matches:
-                upstream_name = upstream_match[0].strip()
-                upstream_content = upstream_match[1]
-
-                upstream_directive = {
-                    'directive': 'upstream',
-                    'args': [upstream_name],
-                    'line': 1,
-                    'block': []
-                }
-
-                # 提取server指令
-                server_pattern = r'server\s+([^;]+);'
-                server_matches = re.findall(server_pattern, upstream_content)
-
-                for server_match in server_matches:
-                    server_args = server_match.strip().split()
-                    upstream_directive['block'].append({
-                        'directive': 'server',
-                        'args': server_args,
-                        'line': 1
-                    })
-
-                parsed_directives.append(upstream_directive)
-
-            print(f"手动解析成功，找到 {len(parsed_directives)} 个关键配置块")
-            return parsed_directives
-
+            result = parse_config(file_content, file_path)
+            for error in result['errors']:
+                parse_logger.warning('手动解析发现语法错误 file=%s line=%s error=%s', file_path, error['line'],
+                                     error['error'])
+            parse_logger.debug('手动解析完成 file=%s directives=%d errors=%d', file_path, len(result['parsed']),
+                               len(result['errors']))
+            return result['parsed']
         except Exception as e:
-            print(f"手动解析失败: {e}")
+            parse_logger.warning('手动解析失败 file=%s error=%s', file_path, e)
             return []
 
-    def analysis_nginx_all_conf(self):
-        virtual_server_name_list = []
-        virtual_servers_info_dict = {}
-        upstream_name_list = []
-        upstreams_info_dict = {}
-        backend_server_ip_port_list = []
-        backend_servers_info_dict = {}
+    def analysis_nginx_all_conf(self, trace=None):
+        """分析所有配置文件，返回原有的6元组结构"""
+        return self.analyze(trace).to_tuple()
+
+    def analyze(self, trace=None):
+        """分析所有配置文件，返回NginxAnalysis记录对象"""
+        with span('analysis'):
+            return self._analyze(trace)
 
-        print(f"开始执行analysis_nginx_all_conf，配置文件数量: {len(self.nginx_conf)}")
-        print(f"配置文件列表: {[file['file'] for file in self.nginx_conf]}")
+    def _analyze(self, trace=None):
+        trace = trace or DirectiveTrace()
+        debug = analysis_logger.isEnabledFor(logging.DEBUG)
+
+        analysis_logger.info('开始配置分析 files=%d', len(self.nginx_conf))
+        if debug:
+            analysis_logger.debug('配置文件列表 files=%s', [file['file'] for file in self.nginx_conf])
 
         try:
             self.check_main_conf_file()
         except Exception as e:
             # 如果验证失败，记录警告信息但继续执行分析
-            print(f"警告: {e}")
-            print("配置分析将继续进行，但结果可能不准确")
+            analysis_logger.warning('主配置文件检查未通过，分析结果可能不准确 error=%s', e)
 
         processed_files = 0
         valid_files = 0  # 有效配置文件计数
 
-        # 新增：递归处理配置块的辅助函数
-        def process_directives(directives, file_path, depth=0):
-            """递归处理指令列表，包括嵌套块中的指令"""
-            for directive_dict in directives:
-                directive = directive_dict.get('directive', '')
-                args = directive_dict.get('args', [])
-                block = directive_dict.get('block', [])
-
-                # 根据深度缩进显示
-                indent = "  " * depth
-                print(f"{indent}处理指令: {directive}, 深度: {depth}")
-
-                if directive == 'upstream':
-                    upstream_name = "".join(args)
-                    print(f"{indent}找到upstream: {upstream_name}")
-                    if upstream_name not in upstream_name_list:
-                        upstream_name_list.append(upstream_name)
-                    else:
-                        print(f"{indent}警告: upstream命名重复: {upstream_name}，跳过重复项")
-                        continue
-
-                    upstreams_info_dict[upstream_name] = {
-                        'file_path': file_path,
-                        'backend_servers': []
-                    }
-
-                    # 处理upstream块中的server指令
-                    for upstream_per_directive_dict in block:
-                        if upstream_per_directive_dict['directive'] == 'server':
-                            backend_server_args_list = upstream_per_directive_dict['args']
-                            upstreams_info_dict[upstream_name]['backend_servers'].append(backend_server_args_list)
-                            backend_server_ip_port = backend_server_args_list[0]
-                            backend_server_ip_port_list.append(backend_server_ip_port)
-                            backend_servers_info_dict[backend_server_ip_port] = {
-                                'file_path': file_path,
-                                'upstream': upstream_name,
-                                'args': backend_server_args_list[1:]
-                            }
-                            print(f"{indent}找到后端服务器: {backend_server_ip_port}")
-
-                elif directive == 'server':
-                    server_name = ""
-                    # 先查找server_name指令
-                    for server_per_directive_dict in block:
-                        if server_per_directive_dict['directive'] == "server_name":
-                            server_name_args = server_per_directive_dict['args']
-                            server_name = ",".join(server_name_args)
-                            if server_name not in virtual_server_name_list:
-                                virtual_server_name_list.append(server_name)
-                                virtual_servers_info_dict[server_name] = {
-                                    'filepath': file_path,
-                                    'location_proxy': {},
-                                    'proxy_pass': []
-                                }
-                            print(f"{indent}找到虚拟主机: {server_name}")
-                            break
-
-                    # 如果没有找到server_name，使用默认名称
-                    if not server_name:
-                        server_name = f"server_{len(virtual_server_name_list)}"
-                        if server_name not in virtual_server_name_list:
-                            virtual_server_name_list.append(server_name)
-                            virtual_servers_info_dict[server_name] = {
-                                'filepath': file_path,
-                                'location_proxy': {},
-                                'proxy_pass': []
-                            }
-                        print(f"{indent}找到未命名虚拟主机，使用默认名称: {server_name}")
-
-                    # 处理server块中的location指令
-                    for server_per_directive_dict in block:
-                        if server_per_directive_dict['directive'] == "location":
-                            location_arg = "".join(server_per_directive_dict['args'])
-                            location_block = server_per_directive_dict.get('block', [])
-                            for location_per_directive_dict in location_block:
-                                if location_per_directive_dict["directive"] == "proxy_pass":
-                                    proxy_pass_args = location_per_directive_dict["args"]
-                                    if proxy_pass_args:
-                                        proxy_pass = "".join(proxy_pass_args)
-                                        # 处理proxy_pass格式
-                                        if '//' in proxy_pass:
-                                            proxy_pass = proxy_pass.split('//')[1]
-                                        virtual_servers_info_dict[server_name]['proxy_pass'].append(proxy_pass)
-                                        virtual_servers_info_dict[server_name]['location_proxy'][
-                                            location_arg] = proxy_pass
-                                        print(f"{indent}找到proxy_pass: {proxy_pass}")
-
-                # 递归处理嵌套块中的指令（如http块中的server块）
-                if block:
-                    print(f"{indent}发现嵌套块，指令: {directive}, 深度: {depth}")
-                    process_directives(block, file_path, depth + 1)
+        # 单次遍历：所有提取器挂在同一个遍历器上，每条指令只访问一次
+        extractors = default_extractors()
+        upstream_extractor, server_extractor, include_extractor = extractors[0], extractors[1], extractors[-1]
+        visitor = DirectiveVisitor(extractors, trace=trace)
+        visited_directives = 0
 
-        for file in self.nginx_conf:
+        for file_index, file in enumerate(self.nginx_conf):
             file_path = file['file']
             file_status = file.get('status', 'unknown')
 
             # 关键修改：不再跳过主配置文件，只跳过mime.types文件
             if 'mime.types' in file_path:
-                print(f"跳过mime.types文件: {file_path}")
+                analysis_logger.debug('跳过mime.types文件 file=%s', file_path)
                 continue
 
             # 关键修改：改进错误处理逻辑
@@ -316,7 +180,7 @@ class NginxAnalyzer:
 
             # 修复：简化解析逻辑，避免重复解析
             if file_status in ['error', 'exception', 'manual', 'failed']:
-                print(f"文件 {file_path} 状态为 {file_status}，尝试检查是否包含有效内容")
+                analysis_logger.debug('文件解析状态异常，尝试检查本地内容 file=%s status=%s', file_path, file_status)
 
                 # 检查本地文件是否存在且包含有效内容
                 local_file_path = os.path.join(self.local_config_dir, os.path.basename(file_path))
@@ -327,7 +191,6 @@ class NginxAnalyzer:
 
                         # 检查文件内容是否包含server或upstream配置
                         if 'server {' in file_content or 'upstream ' in file_content:
-                            print(f"文件 {file_path} 包含有效配置，尝试重新解析")
                             try:
                                 # 尝试重新解析
                                 parsed_config = crossplane.parse(local_file_path, catch_errors=True, combine=True)
@@ -335,26 +198,25 @@ class NginxAnalyzer:
                                     # 更新解析结果
                                     file['parsed'] = parsed_config['config'][0].get('parsed', [])
                                     file['status'] = 'ok'
-                                    print(f"文件 {file_path} 重新解析成功")
+                                    analysis_logger.info('文件重新解析成功 file=%s', file_path)
                                 else:
                                     # 如果crossplane解析失败，尝试手动解析关键配置
-                                    print(f"crossplane解析失败，尝试手动解析关键配置")
                                     manual_parsed = self._manual_parse_nginx_config(file_content, file_path)
                                     if manual_parsed:
                                         file['parsed'] = manual_parsed
                                         file['status'] = 'manual_ok'
-                                        print(f"文件 {file_path} 手动解析成功")
+                                        analysis_logger.info('crossplane解析失败，手动解析成功 file=%s', file_path)
                             except Exception as e:
-                                print(f"文件 {file_path} 重新解析失败: {e}")
+                                analysis_logger.warning('文件重新解析失败 file=%s error=%s', file_path, e)
                     except Exception as e:
-                        print(f"读取本地文件 {local_file_path} 失败: {e}")
+                        analysis_logger.warning('读取本地文件失败 file=%s error=%s', local_file_path, e)
                 else:
-                    print(f"本地文件不存在: {local_file_path}，无法进行手动解析")
+                    analysis_logger.warning('本地文件不存在，无法进行手动解析 file=%s', local_file_path)
 
             # 修复：简化测试逻辑，避免重复解析
             # 只在文件状态仍然是failed且没有进行过手动解析时才进行测试
             if file_path == '/etc/nginx/conf.d/test.conf' and file_status == 'failed':
-                print(f"测试手动解析功能，强制对文件 {file_path} 进行手动解析")
+                analysis_logger.debug('测试手动解析功能，强制手动解析 file=%s', file_path)
                 local_file_path = os.path.join(self.local_config_dir, os.path.basename(file_path))
                 if os.path.exists(local_file_path):
                     try:
@@ -364,22 +226,20 @@ class NginxAnalyzer:
                         # 调用手动解析方法
                         manual_parsed = self._manual_parse_nginx_config(file_content, file_path)
                         if manual_parsed:
-                            print(
-                                f"手动解析成功，原指令数量: {len(parsed_directives)}，手动解析后指令数量: {len(manual_parsed)}")
-                            # 比较两种解析方式的结果差异
-                            original_directives = [d.get('directive', '') for d in parsed_directives]
-                            manual_directives = [d.get('directive', '') for d in manual_parsed]
-                            print(f"原解析指令: {original_directives}")
-                            print(f"手动解析指令: {manual_directives}")
+                            if debug:
+                                # 比较两种解析方式的结果差异
+                                analysis_logger.debug(
+                                    '手动解析结果对比 file=%s original=%s manual=%s', file_path,
+                                    [d.get('directive', '') for d in parsed_directives],
+                                    [d.get('directive', '') for d in manual_parsed])
 
                             # 更新文件解析结果
                             file['parsed'] = manual_parsed
                             file['status'] = 'manual_ok'
-                            print(f"文件 {file_path} 已更新为手动解析结果")
                     except Exception as e:
-                        print(f"测试手动解析失败: {e}")
+                        analysis_logger.warning('测试手动解析失败 file=%s error=%s', file_path, e)
                 else:
-                    print(f"本地文件不存在: {local_file_path}，无法进行手动解析")
+                    analysis_logger.warning('本地文件不存在，无法进行手动解析 file=%s', local_file_path)
 
             # 更新解析后的指令列表和状态
             parsed_directives = file.get('parsed', [])
@@ -395,54 +255,211 @@ class NginxAnalyzer:
 
             # 修复：改进跳过逻辑，正确处理手动解析后的文件
             if file_status in ['error', 'exception', 'empty', 'skipped', 'failed'] and not has_valid_directives:
-                print(f"跳过状态为 {file_status} 且不包含有效指令的文件: {file_path}")
+                analysis_logger.debug('跳过不包含有效指令的文件 file=%s status=%s', file_path, file_status)
                 continue
 
             processed_files += 1
             if has_valid_directives or file_status not in ['error', 'exception', 'empty', 'skipped', 'failed']:
                 valid_files += 1
 
-            print(f"处理第{processed_files}个配置文件: {file_path}, 状态: {file_status}")
             file_all_directives_dict = file['parsed']
-            print(f'配置文件解析结果包含指令数量: {len(file_all_directives_dict)}')
-
-            # 详细记录文件内容，便于调试
-            print(f"文件 {file_path} 的详细指令:")
-            for i, directive in enumerate(file_all_directives_dict):
-                directive_name = directive.get('directive', '未知')
-                args = directive.get('args', [])
-                line = directive.get('line', '未知')
-                print(f"  指令 {i}: {directive_name}, 行号: {line}, 参数: {args}")
-
-            # 使用新的递归处理函数处理所有指令
-            process_directives(file_all_directives_dict, file_path)
-
-        print(f"分析完成，处理了{processed_files}个配置文件，其中{valid_files}个有效")
-        print(
-            f"找到虚拟主机: {len(virtual_server_name_list)}, upstream: {len(upstream_name_list)}, 后端服务器: {len(backend_server_ip_port_list)}")
-
-        # 如果没有找到任何配置，记录详细日志
-        if len(virtual_server_name_list) == 0 and len(upstream_name_list) == 0:
-            print("警告: 未找到任何虚拟主机或upstream配置")
-            print("详细配置文件状态:")
-            for file in self.nginx_conf:
-                file_path = file['file']
-                file_status = file.get('status', 'unknown')
-                parsed_count = len(file.get('parsed', []))
-                print(f"  文件: {file_path}, 状态: {file_status}, 指令数量: {parsed_count}")
-
-                # 显示每个文件的详细指令
-                parsed_directives = file.get('parsed', [])
-                for i, directive in enumerate(parsed_directives):
-                    directive_name = directive.get('directive', '未知')
-                    args = directive.get('args', [])
-                    line = directive.get('line', '未知')
-                    print(f"    指令 {i}: {directive_name}, 行号: {line}, 参数: {args}")
-
-        return (virtual_server_name_list, virtual_servers_info_dict,
-                upstream_name_list, upstreams_info_dict,
-                backend_server_ip_port_list, backend_servers_info_dict)
+            analysis_logger.debug('处理配置文件 seq=%d file=%s status=%s directives=%d',
+                                  processed_files, file_path, file_status, len(file_all_directives_dict))
+
+            # 被include在stream块中的文件按四层配置分析；context由IncludeResolver给出，
+            # crossplane直接解析的结果则取同一次遍历中从include索引得到的协议
+            if 'context' in file:
+                protocol = 'stream' if 'stream' in file['context'] else 'http'
+            else:
+                protocol = include_extractor.protocols.get(file_index, 'http')
+            visited_directives += visitor.visit(file_path, file_all_directives_dict, protocol)
+
+        analysis = collect_analysis(upstream_extractor, server_extractor)
+        analysis.config_files = intern_args(self.get_file_path_list())
+        for file_index, file in enumerate(self.nginx_conf):
+            if 'context' in file:
+                context = tuple(file['context'])
+            elif file['file'] == self.nginx_main_conf_path:
+                context = ()
+            else:
+                context = (include_extractor.protocols.get(file_index, 'http'),)
+            analysis.file_contexts[file['file']] = context
+        analysis.pid_file_path = self.get_pid_file_path()
+        analysis.routing = RoutingGraph.from_analysis(analysis)
+
+        analysis_logger.info('配置分析完成 processed=%d valid=%d directives=%d virtual_servers=%d upstreams=%d '
+                             'backend_servers=%d stream_servers=%d stream_upstreams=%d', processed_files,
+                             valid_files, visited_directives, len(analysis.virtual_servers),
+                             len(analysis.upstreams), len(analysis.backend_server_addrs),
+                             len(analysis.stream_servers), len(analysis.stream_upstreams))
+
+        # 如果没有找到任何配置，记录各文件状态
+        if not analysis.virtual_servers and not analysis.upstreams and not analysis.stream_upstreams:
+            analysis_logger.warning('未找到任何虚拟主机或upstream配置')
+            if debug:
+                for file in self.nginx_conf:
+                    analysis_logger.debug('配置文件状态 file=%s status=%s directives=%s', file['file'],
+                                          file.get('status', 'unknown'),
+                                          [(d.get('directive'), d.get('line'), d.get('args')) for d in
+                                           file.get('parsed', [])])
+
+        return analysis
+
+
+class RemoteCommandStream:
+    """
+    流式远程命令执行
+
+    stdout和stderr在同一个循环里分别排空，任何一路输出过大都不会把SSH窗口塞满导致死锁；
+    输出超过max_output_bytes或执行超过timeout时立即关闭通道终止命令
+    """
+    CHUNK_SIZE = 32768
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, channel, timeout=None, max_output_bytes=None, host=None, command_bytes=0):
+        self.channel = channel
+        self.host = host
+        self.command_bytes = command_bytes
+        self.started = time.perf_counter()
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.stderr_chunks = []
+        self.truncated = False
+        self.timed_out = False
+        self.terminated = False
+        self.return_code = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _accept(self, stream_name, data):
+        """按剩余额度截断数据，确实丢弃了数据时才标记truncated，输出恰好等于上限不算截断"""
+        if self.max_output_bytes is None:
+            return data
+        remaining = self.max_output_bytes - self.stdout_bytes - self.stderr_bytes
+        if len(data) > remaining:
+            self.truncated = True
+            return data[:max(remaining, 0)]
+        return data
+
+    def _wait(self):
+        """等待新数据到达，stderr数据不会唤醒select，因此等待时间有上限"""
+        timeout = self.POLL_INTERVAL
+        if self.deadline:
+            timeout = max(min(timeout, self.deadline - time.monotonic()), 0)
+        try:
+            select.select([self.channel], [], [], timeout)
+        except (OSError, ValueError):
+            time.sleep(timeout)
+
+    def iter_chunks(self):
+        """逐块产出 (stream_name, bytes)，stream_name为stdout或stderr"""
+        channel = self.channel
+        readers = (
+            ('stdout', channel.recv_ready, channel.recv),
+            ('stderr', channel.recv_stderr_ready, channel.recv_stderr),
+        )
+        try:
+            while True:
+                received = False
+                for stream_name, ready, recv in readers:
+                    if not ready():
+                        continue
+                    data = self._accept(stream_name, recv(self.CHUNK_SIZE))
+                    received = received or bool(data)
+                    if stream_name == 'stdout':
+                        self.stdout_bytes += len(data)
+                    else:
+                        self.stderr_bytes += len(data)
+                    if data:
+                        yield stream_name, data
+                    if self.truncated:
+                        return
+                if received:
+                    continue
+                if channel.eof_received and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    return
+                if self.deadline and time.monotonic() >= self.deadline:
+                    self.timed_out = True
+                    return
+                self._wait()
+        finally:
+            self._finish()
+
+    def iter_lines(self):
+        """逐行产出stdout，stderr在后台按额度收集到self.stderr_chunks"""
+        pending = b''
+        for stream_name, data in self.iter_chunks():
+            if stream_name == 'stderr':
+                self.stderr_chunks.append(data)
+                continue
+            pending += data
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                yield line.decode('utf-8', errors='replace')
+        if pending:
+            yield pending.decode('utf-8', errors='replace')
+
+    def _record(self):
+        record('ssh_exec', time.perf_counter() - self.started, self.host, round_trips=1,
+               bytes_in=self.stdout_bytes + self.stderr_bytes, bytes_out=self.command_bytes)
+
+    def _finish(self):
+        if self.return_code is not None:
+            return
+        channel = self.channel
+        if self.truncated or self.timed_out or not channel.eof_received:
+            # 提前终止：关闭通道即向远程进程发送EOF并释放资源
+            self.terminated = True
+            self.return_code = -1
+            channel.close()
+            self._record()
+            return
+        wait_timeout = max(self.deadline - time.monotonic(), 0) if self.deadline else None
+        if channel.status_event.wait(wait_timeout):
+            self.return_code = channel.recv_exit_status()
+        else:
+            self.timed_out = True
+            self.terminated = True
+            self.return_code = -1
+        channel.close()
+        self._record()
+
+    def close(self):
+        if self.return_code is None:
+            self.terminated = True
+            self.return_code = -1
+            self.channel.close()
+            self._record()
+
+    def result(self, output=b''):
+        """构造与execute_command一致的结果字典"""
+        error = b''.join(self.stderr_chunks).decode('utf-8', errors='replace')
+        if self.timed_out:
+            error += f'\n命令执行超时({self.timeout}秒)，已终止'
+        elif self.truncated:
+            error += f'\n命令输出超过{self.max_output_bytes}字节，已截断并终止'
+        return {
+            'success': self.return_code == 0 and not self.truncated and not self.timed_out,
+            'output': output.decode('utf-8', errors='replace') if isinstance(output, bytes) else output,
+            'error': error,
+            'return_code': self.return_code,
+            'truncated': self.truncated,
+            'timed_out': self.timed_out
+        }
+
+
 class NginxParamikoClient:
+    # 单条命令默认的超时时间和最大输出字节数
+    command_timeout = 300
+    command_max_output_bytes = 64 * 1024 * 1024
+
     def __init__(self, host, port=22, username=None, password=None, key_file=None, key_content=None):
         self.host = host
         self.port = port
@@ -451,11 +468,19 @@ class NginxParamikoClient:
         self.key_file = key_file
         self.key_content = key_content  # 新增：支持直接传入密钥内容
         self.ssh_client = None
+        self.sftp_client = None  # 复用的SFTP通道
+        # 主机能力探测结果，由attach_capabilities从ClientInfo缓存载入，或在第一次需要时探测
+        self.capabilities = None
+        self.on_capabilities_probed = None
         self.local_config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_nginx_configs')
         os.makedirs(self.local_config_dir, exist_ok=True)
 
     def connect(self):
         """建立SSH连接 - 支持多种认证方式"""
+        with span('ssh_connect', self.host):
+            return self._connect()
+
+    def _connect(self):
         try:
             self.ssh_client = paramiko.SSHClient()
             self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -483,27 +508,96 @@ class NginxParamikoClient:
             logger.error(f"SSH连接失败: {e}")
             return False
 
-    def execute_command(self, command):
-        """执行远程命令"""
+    def open_command_stream(self, command, timeout=None, max_output_bytes=None):
+        """
+        打开流式远程命令
+
+        参数:
+            command: 远程命令
+            timeout: 超时时间（秒），在通道上强制执行，默认使用command_timeout
+            max_output_bytes: stdout和stderr合计最大字节数，默认使用command_max_output_bytes
+
+        返回:
+            RemoteCommandStream: 可迭代chunk或行，也可作为上下文管理器使用
+        """
+        timeout = self.command_timeout if timeout is None else timeout
+        max_output_bytes = self.command_max_output_bytes if max_output_bytes is None else max_output_bytes
+        channel = self.ssh_client.get_transport().open_session(timeout=timeout)
+        channel.exec_command(command)
+        return RemoteCommandStream(channel, timeout=timeout, max_output_bytes=max_output_bytes, host=self.host,
+                                   command_bytes=len(command.encode('utf-8')))
+
+    def execute_command(self, command, timeout=None, max_output_bytes=None):
+        """执行远程命令，输出大小和执行时间受限"""
         try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(command)
-            output = stdout.read().decode()
-            error = stderr.read().decode()
-            return_code = stdout.channel.recv_exit_status()
-
-            return {
-                'success': return_code == 0,
-                'output': output,
-                'error': error,
-                'return_code': return_code
-            }
+            with self.open_command_stream(command, timeout=timeout, max_output_bytes=max_output_bytes) as stream:
+                stdout_chunks = []
+                for stream_name, data in stream.iter_chunks():
+                    if stream_name == 'stdout':
+                        stdout_chunks.append(data)
+                    else:
+                        stream.stderr_chunks.append(data)
+                return stream.result(b''.join(stdout_chunks))
         except Exception as e:
             logger.error(f"命令执行失败: {e}")
             return {'success': False, 'error': str(e)}
 
-    def check_nginx_config(self, nginx_path='/etc/nginx/nginx.conf'):
-        """检查Nginx配置语法"""
-        command = f"nginx -t -c {nginx_path}"
+    def execute_sections(self, sections, timeout=None, max_output_bytes=None):
+        """
+        把多条互不依赖的命令合并为一次远程执行
+
+        参数:
+            sections: [(名称, 命令), ...]，每条命令的stderr合并到输出中
+
+        返回:
+            dict: 名称 -> {'output', 'return_code'}；远程执行失败时为空dict
+        """
+        marker = f'@@{uuid.uuid4().hex[:8]}'
+        script = '; '.join(f'echo "{marker} {name}"; {{ {command}; }} 2>&1; echo "{marker} rc=$?"'
+                           for name, command in sections)
+        result = self.execute_command(script, timeout=timeout, max_output_bytes=max_output_bytes)
+        sections_output = {}
+        name, lines = None, []
+        for line in result.get('output', '').split('\n'):
+            if not line.startswith(marker + ' '):
+                lines.append(line)
+                continue
+            value = line[len(marker) + 1:]
+            if value.startswith('rc=') and name is not None:
+                return_code = value[3:]
+                sections_output[name] = {
+                    'output': '\n'.join(lines),
+                    'return_code': int(return_code) if return_code.lstrip('-').isdigit() else -1
+                }
+                name = None
+            else:
+                name, lines = value, []
+        return sections_output
+
+    def probe_capabilities(self):
+        """一次远程命令探测init系统、nginx路径/版本/模块、主配置路径和可用工具"""
+        result = self.execute_command(PROBE_SCRIPT, timeout=15, max_output_bytes=1024 * 1024)
+        if not result['success']:
+            logger.warning('主机能力探测失败 host=%s error=%s', self.host, result.get('error', ''))
+            return None
+        caps = HostCapabilities.parse(result['output'])
+        self.capabilities = caps
+        if self.on_capabilities_probed:
+            self.on_capabilities_probed(caps)
+        return caps
+
+    def get_capabilities(self):
+        """返回主机能力，没有缓存时探测一次；探测失败返回None，调用方使用通用命令"""
+        if self.capabilities is None:
+            self.probe_capabilities()
+        return self.capabilities
+
+    def check_nginx_config(self, nginx_path=None):
+        """检查Nginx配置语法，未指定路径时使用探测到的主配置路径"""
+        caps = self.get_capabilities()
+        if caps:
+            return self.execute_command(caps.test_command(nginx_path))
+        command = f"nginx -t -c {nginx_path or '/etc/nginx/nginx.conf'}"
         return self.execute_command(command)
 
     def save_remote_file_to_local(self, remote_file_path):
@@ -526,7 +620,7 @@ class NginxParamikoClient:
             with open(local_file_path, 'w', encoding='utf-8') as f:
                 f.write(file_content)
 
-            print(f"远程文件 {remote_file_path} 已保存到本地: {local_file_path}")
+            parse_logger.debug('远程文件已保存到本地 remote=%s local=%s', remote_file_path, local_file_path)
             return {
                 'success': True,
                 'local_path': local_file_path,
@@ -538,244 +632,333 @@ class NginxParamikoClient:
             return {'success': False, 'error': str(e)}
     def reload_nginx(self):
         """重载Nginx配置"""
-        command = "nginx -s reload"
+        caps = self.get_capabilities()
+        command = caps.reload_command() if caps else "nginx -s reload"
         return self.execute_command(command)
 
     def get_nginx_status(self):
-        """获取Nginx状态"""
-        command = "systemctl status nginx || ps aux | grep nginx"
-        return self.execute_command(command)
+        """获取Nginx状态，按探测到的init系统只执行对应的状态命令"""
+        caps = self.get_capabilities()
+        command = caps.status_command() if caps else "systemctl status nginx || ps aux | grep nginx"
+        return self.execute_command(command, timeout=10, max_output_bytes=1024 * 1024)
 
     def read_config_file(self, file_path):
         """读取配置文件内容"""
         command = f"cat {file_path}"
         return self.execute_command(command)
 
-    def write_config_file(self, file_path, content):
-        """写入配置文件"""
-        # 使用echo命令写入内容
-        escaped_content = content.replace('"', '\\"').replace('$', '\\$')
-        command = f'echo "{escaped_content}" > {file_path}'
-        return self.execute_command(command)
-
-    def upload_config_file(self, local_file_path, remote_file_path):
-        """使用SCP上传本地文件到远程服务器"""
-        try:
-            # 创建SFTP客户端
-            sftp = self.ssh_client.open_sftp()
+    def read_config_files(self, file_paths, use_cache=False):
+        """
+        通过复用的SFTP通道读取多个文件的原始内容
 
-            # 上传文件
-            sftp.put(local_file_path, remote_file_path)
-
-            # 关闭SFTP连接
-            sftp.close()
+        与cat不同，内容按字节原样返回（包括末尾是否有换行），适合修改后整文件写回；
+        use_cache为True时先stat，大小和修改时间与缓存一致的文件不再下载
 
+        返回:
+            dict: 文件路径 -> {'success', 'content', 'error', 'cached'}
+        """
+        results = {}
+        try:
+            sftp = self.get_sftp()
+        except Exception as e:
+            return {file_path: {'success': False, 'content': None, 'error': str(e), 'cached': False}
+                    for file_path in file_paths}
+        with span('sftp', self.host) as counters:
+            for file_path in file_paths:
+                try:
+                    attributes = None
+                    if use_cache:
+                        counters['round_trips'] += 1
+                        attributes = sftp.stat(file_path)
+                        content = content_cache.get(self.host, file_path, attributes.st_size, attributes.st_mtime)
+                        if content is not None:
+                            results[file_path] = {'success': True, 'content': content, 'error': '', 'cached': True}
+                            continue
+                    # open、read、close各计一次SFTP往返
+                    counters['round_trips'] += 3
+                    with sftp.open(file_path, 'rb') as remote_file:
+                        remote_file.prefetch()
+                        data = remote_file.read()
+                    counters['bytes_in'] += len(data)
+                    content = data.decode('utf-8')
+                    if attributes is not None and len(data) == attributes.st_size:
+                        content_cache.put(self.host, file_path, attributes.st_size, attributes.st_mtime, content)
+                    results[file_path] = {'success': True, 'content': content, 'error': '', 'cached': False}
+                except Exception as e:
+                    results[file_path] = {'success': False, 'content': None, 'error': f'读取{file_path}失败: {e}',
+                                          'cached': False}
+        return results
+
+    def forget_config_files(self, file_paths):
+        """文件被回滚或在别处修改后，丢弃缓存的内容"""
+        content_cache.forget(self.host, file_paths)
+
+    def get_sftp(self):
+        """获取复用的SFTP通道，通道不存在或已关闭时重新打开"""
+        if self.sftp_client is None or self.sftp_client.sock.closed:
+            self.sftp_client = self.ssh_client.open_sftp()
+        return self.sftp_client
+
+    def write_config_file(self, file_path, content, fsync=False, verify_checksum=False, base_sha256=None):
+        """
+        原子写入配置文件
+
+        通过复用的SFTP通道把内容流式写入目标文件同目录下的临时文件，
+        可选fsync落盘和sha256校验，最后rename覆盖目标文件，
+        任何一步失败都会删除临时文件，目标文件保持不变
+
+        base_sha256为调用方读取时文件内容的sha256：rename与比较当前文件的sha256在同一次远程命令中执行，
+        不一致说明文件在读取之后已被他人修改，不覆盖，返回stale为True和当前的current_sha256
+        """
+        data = content.encode('utf-8')
+        local_sha256 = hashlib.sha256(data).hexdigest()
+        dir_path, base_name = posixpath.split(file_path)
+        temp_path = posixpath.join(dir_path, f'.{base_name}.{uuid.uuid4().hex[:8]}.tmp')
+        sftp = None
+        try:
+            sftp = self.get_sftp()
+
+            # 目标文件已存在时沿用其权限；stat、上传、chmod各计一次SFTP往返
+            with span('sftp', self.host, bytes_out=len(data)) as counters:
+                counters['round_trips'] += 1
+                try:
+                    file_mode = stat.S_IMODE(sftp.stat(file_path).st_mode)
+                except IOError:
+                    file_mode = None
+
+                counters['round_trips'] += 1
+                sftp.putfo(BytesIO(data), temp_path, file_size=len(data))
+                if file_mode is not None:
+                    counters['round_trips'] += 1
+                    sftp.chmod(temp_path, file_mode)
+
+            # fsync和校验合并为一次远程命令
+            commands = []
+            if fsync:
+                commands.append(f'(sync {shlex.quote(temp_path)} 2>/dev/null || sync)')
+            if verify_checksum:
+                # 在远程比较，校验失败时不会执行后面的rename
+                temp = shlex.quote(temp_path)
+                commands.append(f'[ "$(sha256sum {temp} | cut -d" " -f1)" = {local_sha256} ] || '
+                                f'{{ echo "校验和不一致: 本地 {local_sha256}" >&2; exit 1; }}')
+            if base_sha256 is not None:
+                # 比较和rename在同一次远程命令中完成，中间没有额外的往返
+                commands.append(compare_and_rename_command(file_path, temp_path, base_sha256))
+            if commands:
+                result = self.execute_command(' && '.join(commands))
+                if result.get('return_code') == EXIT_STALE:
+                    # 临时文件已由远程命令删除
+                    current_sha256 = parse_stale_output(result.get('output', ''))
+                    content_cache.forget(self.host, [file_path])
+                    return {
+                        'success': False,
+                        'stale': True,
+                        'current_sha256': current_sha256,
+                        'error': f'{file_path}在读取之后已被修改（当前sha256 {current_sha256 or "无"}），未覆盖'
+                    }
+                if not result['success']:
+                    raise Exception(f'临时文件落盘、校验或替换失败: {result.get("error", "")}')
+
+            if base_sha256 is None:
+                try:
+                    with span('sftp', self.host, round_trips=1):
+                        sftp.posix_rename(temp_path, file_path)
+                except IOError:
+                    # 服务端不支持posix-rename扩展时退回mv
+                    result = self.execute_command(f'mv -f {shlex.quote(temp_path)} {shlex.quote(file_path)}')
+                    if not result['success']:
+                        raise Exception(f'重命名临时文件失败: {result.get("error", "")}')
+
+            content_cache.forget(self.host, [file_path])
             return {
                 'success': True,
-                'message': f'文件上传成功: {local_file_path} -> {remote_file_path}'
+                'output': f'文件写入成功: {file_path}',
+                'error': '',
+                'return_code': 0,
+                'sha256': local_sha256,
+                'bytes_written': len(data)
             }
         except Exception as e:
-            logger.error(f"SCP上传失败: {e}")
-            return {
-                'success': False,
-                'error': f'SCP上传失败: {str(e)}'
-            }
-
-    def upload_config_content(self, content, remote_file_path):
-        """将配置内容写入临时文件并上传到远程服务器"""
+            logger.error(f"写入配置文件失败: {e}")
+            if sftp is not None:
+                try:
+                    sftp.remove(temp_path)
+                except Exception:
+                    pass
+            return {'success': False, 'error': f'写入配置文件失败: {str(e)}'}
+
+    def apply_config_patch(self, file_path, patch, content=None, fsync=False, verify_checksum=False):
+        """
+        只传输补丁修改远程文件
+
+        补丁（ConfigPatch）连同应用它的脚本作为一个文件上传到目标文件同目录，再用一次远程命令执行：
+        校验文件大小和每处原内容，拼出新文件后rename覆盖。文件在读取之后被他人修改时不做任何改动，
+        返回stale为True。content为修改后的完整内容，传入时更新内容缓存
+
+        返回:
+            dict: success、stale、error、bytes_written（实际传输的字节数）
+        """
+        dir_path, base_name = posixpath.split(file_path)
+        token = uuid.uuid4().hex[:8]
+        patch_path = posixpath.join(dir_path, f'.{base_name}.{token}.patch')
+        temp_path = posixpath.join(dir_path, f'.{base_name}.{token}.tmp')
+        data = patch.script(file_path, patch_path, temp_path, fsync=fsync, verify_checksum=verify_checksum)
         try:
-            # 创建临时文件
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.conf') as temp_file:
-                temp_file.write(content)
-                temp_file_path = temp_file.name
-
-            # 上传临时文件
-            result = self.upload_config_file(temp_file_path, remote_file_path)
+            with span('sftp', self.host, round_trips=1, bytes_out=len(data)):
+                self.get_sftp().putfo(BytesIO(data), patch_path, file_size=len(data))
+        except Exception as e:
+            logger.error(f"上传补丁失败: {e}")
+            return {'success': False, 'stale': False, 'error': f'上传补丁失败: {str(e)}'}
+
+        result = self.execute_command(f'sh {shlex.quote(patch_path)}')
+        outcome = parse_patch_output(result.get('output', ''))
+        if result['success'] and outcome['status'] == 'ok':
+            if content is not None:
+                content_cache.put(self.host, file_path, outcome['size'], outcome['mtime'], content)
+            else:
+                content_cache.forget(self.host, [file_path])
+            return {'success': True, 'stale': False, 'error': '', 'bytes_written': len(data),
+                    'hunks': len(patch)}
+
+        content_cache.forget(self.host, [file_path])
+        stale = result.get('return_code') == EXIT_STALE
+        if stale:
+            error = f'{file_path}在读取之后已被修改（{outcome.get("detail", "")}），补丁未应用'
+        elif outcome['status'] == 'checksum':
+            error = f'{file_path}应用补丁后的校验和不一致，补丁未应用'
+        else:
+            error = f'应用补丁失败: {result.get("error", "")}'
+            # 脚本没有执行时补丁文件还在
+            self.execute_command(f'rm -f {shlex.quote(patch_path)} {shlex.quote(temp_path)}')
+        return {'success': False, 'stale': stale, 'error': error}
 
-            # 删除临时文件
-            os.unlink(temp_file_path)
+    def upload_config_file(self, local_file_path, remote_file_path):
+        """通过复用的SFTP通道上传本地文件到远程服务器"""
+        try:
+            with span('sftp', self.host, round_trips=1, bytes_out=os.path.getsize(local_file_path)):
+                self.get_sftp().put(local_file_path, remote_file_path)
 
-            return result
+            return {
+                'success': True,
+                'message': f'文件上传成功: {local_file_path} -> {remote_file_path}'
+            }
         except Exception as e:
-            logger.error(f"配置内容上传失败: {e}")
+            logger.error(f"SFTP上传失败: {e}")
             return {
                 'success': False,
-                'error': f'配置内容上传失败: {str(e)}'
+                'error': f'SFTP上传失败: {str(e)}'
             }
+
+    def upload_config_content(self, content, remote_file_path, fsync=False, verify_checksum=False):
+        """将配置内容原子写入远程服务器，保留旧接口供调用方使用"""
+        return self.write_config_file(remote_file_path, content, fsync=fsync, verify_checksum=verify_checksum)
     def get_nginx_config_files(self, config_dir='/etc/nginx/'):
         """获取Nginx配置目录下的所有文件"""
         command = f"find {config_dir} -name '*.conf' -type f"
-        result = self.execute_command(command)
-        print('文件查找结果',result)
+        result = self.execute_command(command, timeout=60, max_output_bytes=4 * 1024 * 1024)
+        logger.debug('文件查找结果 config_dir=%s success=%s', config_dir, result['success'])
         if result['success']:
             files = [f.strip() for f in result['output'].split('\n') if f.strip()]
             return files
         return []
 
-    def _parse_nginx_config_recursive(self, file_path, parsed_files=None):
-        """简化版：专门解析nginx.conf中的http块include指令，保存所有.conf文件到本地"""
-        if parsed_files is None:
-            parsed_files = set()
-
-        # 检查文件是否已经解析过
-        if file_path in parsed_files:
-            print(f"文件 {file_path} 已经解析过，跳过")
+    def list_config_files(self, root):
+        """一次find获取目录下的所有文件，跟随符号链接（如sites-enabled）"""
+        command = f"find -L {shlex.quote(root)} -type f 2>/dev/null"
+        result = self.execute_command(command, timeout=60, max_output_bytes=4 * 1024 * 1024)
+        # 存在失效的符号链接时find返回非0，但输出仍然可用
+        if not result.get('output') and not result['success']:
+            parse_logger.warning('获取文件清单失败 root=%s error=%s', root, result.get('error', '未知错误'))
             return []
-        parsed_files.add(file_path)
+        return [line.strip() for line in result['output'].split('\n') if line.strip()]
 
-        print(f"开始解析配置文件: {file_path}")
-
-        # 1. 保存远程文件到本地
+    def _load_config_file(self, file_path):
+        """下载并解析单个配置文件，返回crossplane格式的config项"""
+        parse_logger.debug('开始解析配置文件 file=%s', file_path)
         save_result = self.save_remote_file_to_local(file_path)
         if not save_result['success']:
-            print(f"保存远程文件到本地失败: {save_result.get('error', '未知错误')}")
-            return [{
+            parse_logger.warning('保存远程文件到本地失败 file=%s error=%s', file_path, save_result.get('error', '未知错误'))
+            return {
                 'file': file_path,
                 'status': 'error',
+                'errors': [],
                 'parsed': [{'directive': 'error_log', 'args': [f'保存到本地失败: {save_result.get("error", "未知错误")}'], 'line': 1}]
-            }]
+            }
 
         local_file_path = save_result['local_path']
-        file_content = save_result['content']
-        print(f"配置文件 {file_path} 已保存到本地: {local_file_path}")
-
         # 跳过mime.types文件
         if 'mime.types' in file_path:
-            print(f"跳过mime.types文件: {file_path}")
+            parse_logger.debug('跳过mime.types文件 file=%s', file_path)
             try:
                 os.unlink(local_file_path)
-            except:
+            except OSError:
                 pass
-            return [{
+            return {
                 'file': file_path,
                 'status': 'skipped',
+                'errors': [],
                 'parsed': [{'directive': 'types', 'args': ['MIME类型定义文件，跳过解析'], 'line': 1}]
-            }]
+            }
 
-        # 2. 解析主配置文件
-        print(f"解析主配置文件 {file_path}")
         try:
-            parsed_config = crossplane.parse(local_file_path, catch_errors=True, combine=True)
-            print(f"主配置文件 {file_path} 解析完成")
+            # include由IncludeResolver处理；被include的文件单独解析时不在原上下文中，不检查指令上下文
+            with span('parse', self.host):
+                payload = crossplane.parse(local_file_path, catch_errors=True, single=True, check_ctx=False)
+            config = payload['config'][0]
+            for error in config.get('errors', []):
+                error['file'] = file_path
+                error['error'] = error.get('error', '').replace(local_file_path, file_path)
         except Exception as e:
-            print(f"主配置文件 {file_path} 解析失败: {e}")
-            parsed_config = {
+            parse_logger.warning('配置文件解析失败 file=%s error=%s', file_path, e)
+            config = {
                 'status': 'error',
                 'errors': [str(e)],
-                'config': [{
-                    'file': file_path,
-                    'status': 'error',
-                    'parsed': [{'directive': 'error_log', 'args': [f'解析失败: {str(e)}'], 'line': 1}]
-                }]
+                'parsed': [{'directive': 'error_log', 'args': [f'解析失败: {str(e)}'], 'line': 1}]
             }
+        config['file'] = file_path
+        return config
 
-        configs = parsed_config.get('config', [])
-        all_configs = []
-
-        # 处理当前文件的配置
-        for config in configs:
-            config['file'] = file_path  # 确保文件路径正确
-            all_configs.append(config)
-
-        # 3. 提取http块中的include目录，通过远程命令获取所有.conf文件
-        print(f"提取http块中的include目录")
-        include_dirs = self._extract_http_include_directories(file_content)
-        print(f"找到http块中的include目录: {include_dirs}")
-
-        for include_dir in include_dirs:
-            print(f"处理include目录: {include_dir}")
-            # 通过远程命令获取目录下所有.conf文件
-            conf_files = self._get_conf_files_from_remote_dir(include_dir)
-            print(f"在目录 {include_dir} 中找到 {len(conf_files)} 个.conf文件")
-
-            for conf_file in conf_files:
-                if conf_file not in parsed_files:
-                    print(f"开始处理include文件: {conf_file}")
-                    # 递归处理include文件
-                    include_configs = self._parse_nginx_config_recursive(conf_file, parsed_files)
-                    all_configs.extend(include_configs)
-                else:
-                    print(f"文件 {conf_file} 已经处理过，跳过")
-
-        print(f"文件 {file_path} 处理完成，总共得到 {len(all_configs)} 个配置块")
-        return all_configs
-
-    def _extract_http_include_directories(self, file_content):
-        """提取http块中的include指令指定的目录路径"""
-        import re
-        include_dirs = set()
-
-        # 首先检查是否包含http块
-        if 'http {' not in file_content:
-            print("文件中不包含http块，跳过http块include指令提取")
-            return []
-
-        print("检测到http块，开始提取其中的include指令")
-
-        # 匹配http块中的include指令
-        include_pattern = r'include\s+([^;#\n]+)[;#\n]'
-        matches = re.findall(include_pattern, file_content)
-
-        for match in matches:
-            include_pattern = match.strip().strip('"').strip("'")
+    def resolve_includes(self, nginx_main_conf_path='/etc/nginx/nginx.conf'):
+        """
+        从主配置文件开始解析所有include，得到nginx实际加载的文件集合
 
-            # 清理路径，移除可能的注释
-            if '#' in include_pattern:
-                include_pattern = include_pattern.split('#')[0].strip()
+        配置目录只执行一次find获取文件清单，glob在本地展开；每个文件只下载和解析一次
 
-            # 跳过mime.types文件
-            if 'mime.types' in include_pattern:
-                print(f"跳过mime.types文件: {include_pattern}")
-                continue
+        返回:
+            tuple: (IncludeResult, 按加载顺序的crossplane config列表)
+        """
+        config_root = posixpath.dirname(nginx_main_conf_path) or '/'
+        listing = RemoteFileListing(self.list_config_files(config_root), roots=[config_root])
+        listing.add_file(nginx_main_conf_path)
+        resolver = IncludeResolver(nginx_main_conf_path, listing, list_files=self.list_config_files)
 
-            # 提取目录路径（移除通配符部分）
-            if '*.conf' in include_pattern:
-                # 提取目录路径，例如：/etc/nginx/conf.d/*.conf -> /etc/nginx/conf.d
-                dir_path = include_pattern.replace('*.conf', '').rstrip('/')
-                if dir_path and dir_path.startswith('/'):
-                    include_dirs.add(dir_path)
-                    print(f"添加include目录: {dir_path}")
+        configs = {}
 
-        return list(include_dirs)
+        def load(file_path):
+            configs[file_path] = self._load_config_file(file_path)
+            return configs[file_path].get('parsed', [])
 
-    def _get_conf_files_from_remote_dir(self, dir_path):
-        """通过远程命令获取指定目录下所有.conf文件并保存到本地"""
-        try:
-            # 使用find命令查找目录下所有.conf文件
-            command = f"find {dir_path} -name '*.conf' -type f"
-            result = self.execute_command(command)
-
-            if result['success']:
-                files = [f.strip() for f in result['output'].split('\n') if f.strip()]
-                print(f"在目录 {dir_path} 中找到.conf文件: {files}")
-
-                # 保存每个文件到本地
-                saved_files = []
-                for file_path in files:
-                    save_result = self.save_remote_file_to_local(file_path)
-                    if save_result['success']:
-                        saved_files.append(file_path)
-                        print(f"文件 {file_path} 已保存到本地: {save_result['local_path']}")
-                    else:
-                        print(f"保存文件 {file_path} 到本地失败: {save_result.get('error', '未知错误')}")
+        include_result = resolver.resolve(load)
+        for file_path, context in include_result.contexts.items():
+            configs[file_path]['context'] = list(context)
+        parse_logger.info('include解析完成 main=%s files=%d missing=%d cycles=%d', nginx_main_conf_path,
+                          len(include_result.files), len(include_result.missing), len(include_result.cycles))
+        return include_result, [configs[file_path] for file_path in include_result.files]
 
-                return saved_files
-            else:
-                print(f"查找目录 {dir_path} 中的.conf文件失败: {result.get('error', '未知错误')}")
-                return []
-        except Exception as e:
-            print(f"获取目录 {dir_path} 中的.conf文件时发生异常: {e}")
-            return []
+    def _parse_nginx_config_recursive(self, file_path):
+        """解析主配置文件及其include的所有文件，返回按加载顺序的config列表"""
+        return self.resolve_includes(file_path)[1]
 
     def get_nginx_config_analysis(self, nginx_main_conf_path='/etc/nginx/nginx.conf'):
-        """获取Nginx配置的完整分析结果"""
-        try:
-            print(f"开始获取Nginx配置分析，主配置文件路径: {nginx_main_conf_path}")
+        """获取Nginx配置的完整分析结果，返回可JSON序列化的dict"""
+        return self.analyze_nginx_config(nginx_main_conf_path).to_dict()
 
+    def analyze_nginx_config(self, nginx_main_conf_path='/etc/nginx/nginx.conf'):
+        """获取Nginx配置的完整分析结果，返回NginxAnalysis记录对象，适合长期保存"""
+        try:
             # 1. 递归解析所有配置文件（包括include引入的文件）
-            print("开始递归解析Nginx配置文件...")
             all_configs = self._parse_nginx_config_recursive(nginx_main_conf_path)
-            print(f"递归解析完成，总共解析了 {len(all_configs)} 个配置文件")
+            parse_logger.info('递归解析完成 main=%s files=%d', nginx_main_conf_path, len(all_configs))
 
             # 构建crossplane兼容的配置结构
             parsed_config = {
@@ -784,37 +967,17 @@ class NginxParamikoClient:
                 'config': all_configs
             }
 
-            print(f"最终配置结构包含 {len(all_configs)} 个配置文件")
-            for config in all_configs:
-                print(f"配置文件: {config.get('file', '未知')}")
-
             # 2. 创建Nginx分析实例
             nginx_analyzer = NginxAnalyzer(
                 nginx_main_conf_path=nginx_main_conf_path,
                 nginx_obj_dict=parsed_config
             )
-            print("NginxAnalyzer实例创建成功")
 
-            # 3. 执行完整的配置分析
-            print("开始执行analysis_nginx_all_conf方法...")
-            analysis_result = nginx_analyzer.analysis_nginx_all_conf()
-            print("analysis_nginx_all_conf方法执行完成")
-
-            # 直接返回分析结果，不包含success和error字段
-            return {
-                'virtual_servers': analysis_result[0],  # 虚拟主机列表
-                'virtual_servers_info': analysis_result[1],  # 虚拟主机详细信息
-                'upstreams': analysis_result[2],  # upstream列表
-                'upstreams_info': analysis_result[3],  # upstream详细信息
-                'backend_servers': analysis_result[4],  # 后端服务器列表
-                'backend_servers_info': analysis_result[5],  # 后端服务器详细信息
-                'config_files': nginx_analyzer.get_file_path_list(),
-                'pid_file_path': nginx_analyzer.get_pid_file_path()
-            }
+            # 3. 执行完整的配置分析，不包含success和error字段
+            return nginx_analyzer.analyze()
 
         except Exception as e:
-            logger.error(f"配置分析失败: {e}")
-            print(f"配置分析过程中发生异常: {e}")
+            logger.error('配置分析失败 error=%s', e)
             # 发生异常时直接抛出，让调用方处理
             raise e
 
@@ -888,6 +1051,12 @@ class NginxParamikoClient:
         }
     def close(self):
         """关闭连接"""
+        if self.sftp_client:
+            try:
+                self.sftp_client.close()
+            except Exception:
+                pass
+            self.sftp_client = None
         if self.ssh_client:
             self.ssh_client.close()
 
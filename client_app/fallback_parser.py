@@ -0,0 +1,186 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 一个正则覆盖所有token类型，finditer单次线性扫描全文
+_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<special>[{};])
+  | (?P<quoted>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+  | (?P<unterminated>["'][^\n]*)
+  | (?P<word>(?:\\.|\$\{[^}\s]*\}?|[^\s{};\\]|\\$)+)
+''', re.VERBOSE | re.DOTALL)
+
+# 只能出现在特定父块中的块指令；出现在其他块中时多半是前面漏写了"}"
+_BLOCK_PARENTS = {
+    'http': {None},
+    'stream': {None},
+    'events': {None},
+    'mail': {None},
+    'server': {None, 'http', 'stream', 'mail'},
+    'upstream': {None, 'http', 'stream'},
+    'location': {None, 'server', 'location'},
+}
+
+
+def tokenize(content):
+    """
+    把配置文本切分为token
+
+    返回:
+        生成器，每项为 (token, 行号, 类型)；类型为'special'、'quoted'、'word'或'error'，
+        'error'表示未闭合的引号，token为错误说明，紧跟在由该行剩余部分构成的参数之后
+    """
+    line = 1
+    for match in _TOKEN_RE.finditer(content):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'space':
+            line += text.count('\n')
+        elif kind == 'comment':
+            continue
+        elif kind == 'special':
+            yield text, line, kind
+        elif kind == 'quoted':
+            quote = text[0]
+            # 与crossplane一致，只反转义引号本身，其余转义原样保留
+            yield text[1:-1].replace('\\' + quote, quote), line, kind
+            line += text.count('\n')
+        elif kind == 'unterminated':
+            # 按行恢复：把本行剩余部分当作一个带引号的参数
+            yield text[1:], line, 'quoted'
+            yield f'unterminated {text[0]} quote', line, 'error'
+        else:
+            yield text, line, kind
+            if '\\' in text:
+                line += text.count('\n')
+
+
+def scan(content):
+    """
+    带位置的token扫描，用于在原文上做局部修改
+
+    返回:
+        生成器，每项为 (类型, 原文, 起始偏移, 结束偏移)；注释和空白也会产出，
+        带引号的参数保留引号原样
+    """
+    for match in _TOKEN_RE.finditer(content):
+        yield match.lastgroup, match.group(), match.start(), match.end()
+
+
+class FallbackParser:
+    """
+    容错的Nginx配置解析器
+
+    crossplane解析失败时使用：单次扫描token流，用栈处理任意嵌套的块，保留真实行号，
+    遇到语法错误时记录并恢复继续解析，输出与crossplane相同结构的指令树
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.errors = []
+
+    def _error(self, line, message):
+        self.errors.append({'file': self.file_path, 'line': line, 'error': message})
+
+    @staticmethod
+    def _directive(words):
+        (name, line), args = words[0], [word for word, _ in words[1:]]
+        directive = {'directive': name, 'line': line, 'args': args}
+        if name == 'if' and args and args[0].startswith('(') and args[-1].endswith(')'):
+            # 与crossplane一致，去掉if条件两侧的括号
+            args[0] = args[0][1:].lstrip()
+            args[-1] = args[-1][:-1].rstrip()
+            args[:] = args[int(not args[0]):len(args) - int(not args[-1])]
+        return directive
+
+    def _recover_parent(self, stack, name, line):
+        """块指令出现在不允许的父块中时，假定缺少"}"并向上退到合法的父块"""
+        parents = _BLOCK_PARENTS.get(name)
+        if parents is None or stack[-1][0] in parents:
+            return
+        for depth in range(len(stack) - 2, -1, -1):
+            if stack[depth][0] in parents:
+                for unclosed_name, _, unclosed_line in stack[depth + 1:]:
+                    self._error(line, f'"{unclosed_name}" block opened on line {unclosed_line} '
+                                      f'is not closed before "{name}"')
+                del stack[depth + 1:]
+                return
+
+    def parse(self, content):
+        """
+        解析配置文本
+
+        返回:
+            list: 与crossplane的parsed字段结构相同的指令列表
+        """
+        parsed = []
+        # 栈元素: (块指令名, 块内指令列表, 开始行号)，栈底为文件顶层；名称为False表示丢弃的块
+        stack = [(None, parsed, 0)]
+        words = []
+
+        for token, line, kind in tokenize(content):
+            if kind == 'error':
+                self._error(line, token)
+                # 未闭合引号所在的指令到行尾结束，下一行的指令照常解析
+                if words:
+                    stack[-1][1].append(self._directive(words))
+                    words = []
+            elif kind != 'special':
+                words.append((token, line))
+            elif token == ';':
+                if words:
+                    stack[-1][1].append(self._directive(words))
+                    words = []
+                else:
+                    self._error(line, 'unexpected ";"')
+            elif token == '{':
+                if words:
+                    self._recover_parent(stack, words[0][0], line)
+                    directive = self._directive(words)
+                    directive['block'] = []
+                    stack[-1][1].append(directive)
+                    stack.append((directive['directive'], directive['block'], line))
+                    words = []
+                else:
+                    self._error(line, 'unexpected "{"')
+                    stack.append((False, [], line))
+            else:
+                if words:
+                    # 缺少";"，仍然保留这条指令
+                    self._error(line, 'unexpected "}", expecting ";"')
+                    stack[-1][1].append(self._directive(words))
+                    words = []
+                if len(stack) > 1:
+                    stack.pop()
+                else:
+                    self._error(line, 'unexpected "}"')
+
+        if words:
+            self._error(words[-1][1], 'unexpected end of file, expecting ";" or "}"')
+            stack[-1][1].append(self._directive(words))
+        for name, _, line in stack[:0:-1]:
+            if name is not False:
+                self._error(line, f'unexpected end of file, "{name}" block opened on line {line} is not closed')
+        return parsed
+
+
+def parse_config(content, file_path=None):
+    """
+    容错解析配置文本
+
+    返回:
+        dict: 与crossplane单个文件结果相同的结构 file、status、errors、parsed
+    """
+    parser = FallbackParser(file_path)
+    parsed = parser.parse(content)
+    if parser.errors:
+        logger.debug('容错解析发现语法错误 file=%s errors=%d', file_path, len(parser.errors))
+    return {
+        'file': file_path,
+        'status': 'failed' if parser.errors else 'ok',
+        'errors': parser.errors,
+        'parsed': parsed
+    }
@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+import uuid
+
+from .instrumentation import record, registry
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    """队列中的一个修改操作：配置事务，或需要独占主机的函数"""
+
+    __slots__ = ('transaction', 'func', 'window', 'enqueued', 'result', 'error', 'done')
+
+    def __init__(self, transaction=None, func=None, window=0.0):
+        self.transaction = transaction
+        self.func = func
+        self.window = window
+        self.enqueued = time.monotonic()
+        self.result = None
+        self.error = None
+        self.done = False
+
+    def outcome(self):
+        """操作中的异常在提交它的线程中抛出，而不是在代为执行的线程中"""
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class HostOperationQueue:
+    """
+    单台主机的修改操作队列
+
+    同一主机上的备份、写入、nginx -t和reload按提交顺序串行执行，不同请求的步骤不会交错；
+    读取操作不经过队列。没有执行者时提交线程自己执行队列，执行期间到达的事务在下一轮合并：
+    依次备份和写入后只做一次nginx -t和一次reload，合并检查失败时回滚整批再逐个检查，
+    只有出错的事务失败，其余事务仍然共用一次reload。
+
+    事务可以带合并窗口：队首事务入队后等待窗口结束再执行，窗口内到达的修改都由同一次reload生效，
+    自动化批量修改时一台主机在窗口内最多reload一次
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.pending = []
+        self.running = False
+        self.condition = threading.Condition()
+
+    def commit(self, transaction, window=0.0):
+        """
+        排队执行配置事务
+
+        参数:
+            window: 合并窗口（秒），该事务排在队首时至少等到入队window秒后才执行
+
+        返回:
+            dict: 与NginxConfigTransaction.commit相同，另有reload_id（生效的那次reload，未执行到reload时为None）、
+            batch_tx_ids（同一次reload生效的事务）和batch_size
+        """
+        return self._submit(_Pending(transaction=transaction, window=window))
+
+    def run(self, func):
+        """排队独占主机执行func()，不与其他操作合并"""
+        return self._submit(_Pending(func=func))
+
+    def _submit(self, item):
+        started = time.perf_counter()
+        with self.condition:
+            self.pending.append(item)
+            while not item.done and self.running:
+                self.condition.wait()
+            if item.done:
+                record('queue_wait', time.perf_counter() - started, self.host)
+                return item.outcome()
+            self.running = True
+        record('queue_wait', time.perf_counter() - started, self.host)
+
+        # 成为执行者，直到自己的操作完成后交给下一个等待的线程
+        try:
+            while not item.done:
+                with self.condition:
+                    self._wait_window()
+                    batch = self._take_batch()
+                self._execute(batch)
+                with self.condition:
+                    for pending in batch:
+                        pending.done = True
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+        return item.outcome()
+
+    def _wait_window(self):
+        """队首是事务时等到它的合并窗口结束，等待期间释放锁，其他请求可以继续入队"""
+        first = self.pending[0]
+        if first.func is not None:
+            return
+        deadline = first.enqueued + first.window
+        remaining = deadline - time.monotonic()
+        while remaining > 0:
+            self.condition.wait(remaining)
+            remaining = deadline - time.monotonic()
+
+    def _take_batch(self):
+        """取出队首的一个独占操作，或连续的、主配置路径相同的一组事务"""
+        first = self.pending[0]
+        if first.func is not None:
+            return [self.pending.pop(0)]
+        batch = []
+        while self.pending and self.pending[0].func is None \
+                and self.pending[0].transaction.nginx_path == first.transaction.nginx_path:
+            batch.append(self.pending.pop(0))
+        return batch
+
+    def _execute(self, batch):
+        try:
+            if batch[0].func is not None:
+                batch[0].result = batch[0].func()
+                return
+            results = commit_batch([pending.transaction for pending in batch])
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception as e:
+            logger.error('主机 %s 的排队操作失败: %s', self.host, e)
+            for pending in batch:
+                pending.error = e
+
+
+def commit_batch(transactions):
+    """
+    同一主机、同一主配置的多个事务共用一次nginx -t和一次reload
+
+    返回:
+        list: 与transactions一一对应的事务结果
+    """
+    results = [dict(transaction.new_result(), reload_id=None, batch_tx_ids=[], batch_size=0)
+               for transaction in transactions]
+    prepared = []
+    for transaction, result in zip(transactions, results):
+        try:
+            transaction.prepare(result)
+            prepared.append((transaction, result))
+        except Exception as e:
+            # 只回滚该事务自己写入的文件，之前的事务不受影响
+            transaction.fail(result, e)
+    if not prepared:
+        return results
+
+    client = prepared[0][0].client
+    try:
+        prepared[0][0].check(prepared[0][1])
+        for _, result in prepared[1:]:
+            result['stage'] = 'check'
+            result['check_result'] = prepared[0][1]['check_result']
+    except Exception as e:
+        if len(prepared) == 1:
+            prepared[0][0].fail(prepared[0][1], e)
+            return results
+        # 合并检查失败，倒序回滚整批后逐个写入并检查，找出出错的事务
+        logger.warning('主机 %s 上%d个事务的合并检查失败，逐个重试', client.host, len(prepared))
+        for transaction, _ in reversed(prepared):
+            transaction.rollback()
+        retried = []
+        for transaction, result in prepared:
+            transaction.written_files = []
+            result.update(transaction.new_result())
+            try:
+                transaction.prepare(result)
+                transaction.check(result)
+                retried.append((transaction, result))
+            except Exception as error:
+                transaction.fail(result, error)
+        prepared = retried
+        if not prepared:
+            return results
+
+    registry.inc('queued_transactions', len(prepared), '经主机操作队列提交的配置事务数', host=client.host)
+    batch_tx_ids = [transaction.tx_id for transaction, _ in prepared]
+    for _, result in prepared:
+        result['batch_tx_ids'] = batch_tx_ids
+        result['batch_size'] = len(prepared)
+    if any(transaction.reload for transaction, _ in prepared):
+        reload_id = uuid.uuid4().hex[:12]
+        for _, result in prepared:
+            result['reload_id'] = reload_id
+        registry.inc('coalesced_reloads', 1, '主机操作队列实际执行的reload次数', host=client.host)
+        try:
+            prepared[0][0].apply_reload(prepared[0][1])
+        except Exception as e:
+            # reload失败时整批倒序回滚，再重新检查并重载一次
+            for transaction, result in reversed(prepared):
+                result['stage'] = 'reload'
+                result['reload_result'] = prepared[0][1]['reload_result']
+                transaction.fail(result, e, reload_after_rollback=transaction is prepared[0][0])
+            return results
+        for _, result in prepared[1:]:
+            result['stage'] = 'reload'
+            result['reload_result'] = prepared[0][1]['reload_result']
+
+    for transaction, result in prepared:
+        transaction.finish(result)
+    return results
+
+
+class HostQueues:
+    """按主机保存操作队列，队列在进程内共享；多个工作进程之间仍由远程的版本比较兜底"""
+
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            queue = self.queues.get(host)
+            if queue is None:
+                queue = self.queues[host] = HostOperationQueue(host)
+            return queue
+
+
+host_queues = HostQueues()
+
+
+def reload_window(server):
+    """ClientInfo上配置的合并窗口，单位秒"""
+    return (server.reload_window_ms or 0) / 1000
+
+
+def queued_commit(transaction, window=0.0):
+    """通过事务所在主机的操作队列提交事务，window为合并窗口（秒）"""
+    return host_queues.get(transaction.client.host).commit(transaction, window)
@@ -0,0 +1,171 @@
+import glob
+import fnmatch
+import posixpath
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteFileListing:
+    """
+    远程配置文件清单
+
+    按目录组织一次性获取的文件列表，glob展开只在内存中进行，不再为每个include目录执行find
+    """
+
+    def __init__(self, files=(), roots=()):
+        self.roots = set()
+        self.files = set()
+        self.files_by_dir = {}  # 目录 -> {文件名}
+        self.dirs_by_parent = {}  # 目录 -> {子目录名}
+        for root in roots:
+            self.roots.add(root.rstrip('/') or '/')
+        for file_path in files:
+            self.add_file(file_path)
+
+    def add_file(self, file_path):
+        if file_path in self.files:
+            return
+        self.files.add(file_path)
+        directory, name = posixpath.split(file_path)
+        self.files_by_dir.setdefault(directory, set()).add(name)
+        while directory != '/':
+            parent, name = posixpath.split(directory)
+            children = self.dirs_by_parent.setdefault(parent, set())
+            if name in children:
+                break
+            children.add(name)
+            directory = parent
+
+    def covers(self, path):
+        """路径是否位于已获取清单的目录下"""
+        return any(path == root or path.startswith(root.rstrip('/') + '/') for root in self.roots)
+
+    @staticmethod
+    def _match(names, pattern):
+        if not glob.has_magic(pattern):
+            return [pattern] if pattern in names else []
+        # 与glob(3)一致，通配符不匹配以点号开头的隐藏文件
+        return [name for name in names
+                if fnmatch.fnmatchcase(name, pattern) and (pattern.startswith('.') or not name.startswith('.'))]
+
+    def expand(self, pattern):
+        """在清单中展开glob，结果按nginx(glob(3))的顺序排序"""
+        components = [component for component in pattern.split('/') if component]
+        directories = ['/']
+        for component in components[:-1]:
+            directories = [posixpath.join(directory, name) for directory in directories
+                           for name in self._match(self.dirs_by_parent.get(directory, ()), component)]
+            if not directories:
+                return []
+        return sorted(posixpath.join(directory, name) for directory in directories
+                      for name in self._match(self.files_by_dir.get(directory, ()), components[-1]))
+
+
+class IncludeResult:
+    """include解析结果"""
+
+    def __init__(self):
+        self.files = []  # nginx加载文件的顺序，每个文件只出现一次
+        self.contexts = {}  # 文件 -> 首次被include时所处的块上下文，如 ('http', 'server')
+        self.includes = []  # (文件, 行号, include参数, 上下文, [展开后的文件])
+        self.missing = []  # (文件, 行号, include参数)，没有匹配到文件的非glob include
+        self.cycles = []  # 形成循环的include链
+
+    def to_dict(self):
+        return {
+            'files': list(self.files),
+            'includes': [{'file': file_path, 'line': line, 'pattern': pattern, 'context': list(context),
+                          'resolved': resolved} for file_path, line, pattern, context, resolved in self.includes],
+            'missing': [{'file': file_path, 'line': line, 'pattern': pattern}
+                        for file_path, line, pattern in self.missing],
+            'cycles': [list(chain) for chain in self.cycles]
+        }
+
+
+class IncludeResolver:
+    """
+    按nginx的规则从解析树解析include指令
+
+    包括任意块中的include（http、stream、server、location、upstream）、单文件和任意glob模式、
+    多层嵌套include，相对路径相对于主配置文件所在目录；发现循环include时记录并跳过
+    """
+
+    def __init__(self, nginx_main_conf_path, listing, list_files=None):
+        self.nginx_main_conf_path = nginx_main_conf_path
+        self.prefix = posixpath.dirname(nginx_main_conf_path) or '/'
+        self.listing = listing
+        # list_files(root) -> [文件路径]，include指向清单之外的目录时补充获取一次
+        self.list_files = list_files
+
+    def absolute(self, pattern):
+        return posixpath.normpath(posixpath.join(self.prefix, pattern))
+
+    def _ensure_listed(self, path):
+        if self.listing.covers(path) or self.list_files is None:
+            return
+        # 取第一个通配符之前的目录作为补充清单的根
+        root = posixpath.dirname(path)
+        while glob.has_magic(root):
+            root = posixpath.dirname(root)
+        logger.debug('include位于清单目录之外，补充获取 root=%s', root)
+        for file_path in self.list_files(root):
+            self.listing.add_file(file_path)
+        self.listing.roots.add(root)
+
+    def expand(self, pattern):
+        path = self.absolute(pattern)
+        self._ensure_listed(path)
+        return self.listing.expand(path)
+
+    def resolve(self, load):
+        """
+        从主配置文件开始按加载顺序解析所有include
+
+        参数:
+            load: load(file_path) -> 解析后的指令列表，失败时返回None
+
+        返回:
+            IncludeResult
+        """
+        result = IncludeResult()
+        loaded = {}
+        path = []  # 当前include链，用于检测循环
+
+        def visit(file_path, context):
+            if file_path in path:
+                chain = path[path.index(file_path):] + [file_path]
+                logger.warning('检测到循环include chain=%s', ' -> '.join(chain))
+                result.cycles.append(chain)
+                return
+            if file_path in loaded:
+                return
+            directives = load(file_path)
+            loaded[file_path] = directives
+            result.files.append(file_path)
+            result.contexts[file_path] = context
+            if not directives:
+                return
+
+            path.append(file_path)
+            stack = [(directive, context) for directive in reversed(directives)]
+            while stack:
+                directive, block_context = stack.pop()
+                name = directive.get('directive')
+                if name == 'include' and directive.get('args'):
+                    pattern = directive['args'][0]
+                    resolved = self.expand(pattern)
+                    result.includes.append((file_path, directive.get('line'), pattern, block_context, resolved))
+                    if not resolved and not glob.has_magic(pattern):
+                        result.missing.append((file_path, directive.get('line'), pattern))
+                    for included in resolved:
+                        visit(included, block_context)
+                    continue
+                block = directive.get('block')
+                if block:
+                    child_context = block_context + (name,)
+                    stack.extend((child, child_context) for child in reversed(block))
+            path.pop()
+
+        visit(self.nginx_main_conf_path, ())
+        return result
@@ -0,0 +1,195 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# 秒，覆盖单条命令到整次配置分析的范围
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """
+    单个请求的耗时分解
+
+    按span名称汇总次数和耗时（ssh_connect、ssh_exec、sftp、parse、analysis、db），
+    并累计远程往返次数和线路字节数，用于生成Server-Timing响应头
+    """
+
+    def __init__(self, view=None):
+        self.view = view
+        self.started = time.perf_counter()
+        self.spans = {}  # span名称 -> [次数, 总耗时]
+        self.hosts = set()
+        self.round_trips = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, host=None, round_trips=0, bytes_in=0, bytes_out=0, calls=1):
+        with self.lock:
+            total = self.spans.setdefault(name, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+            if host:
+                self.hosts.add(host)
+            self.round_trips += round_trips
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """生成Server-Timing响应头的值，耗时单位为毫秒"""
+        with self.lock:
+            entries = [f'{name};dur={seconds * 1000:.1f};desc="{count}x"'
+                       for name, (count, seconds) in self.spans.items()]
+            if self.round_trips or self.bytes_in or self.bytes_out:
+                entries.append(f'ssh;desc="round_trips={self.round_trips} bytes_in={self.bytes_in} '
+                               f'bytes_out={self.bytes_out}"')
+        entries.append(f'total;dur={self.elapsed * 1000:.1f}')
+        return ', '.join(entries)
+
+
+class Histogram:
+    """累积直方图，与Prometheus的histogram类型对应"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class MetricsRegistry:
+    """
+    进程内指标
+
+    histogram按 (指标名, 标签) 保存，counter同理；标签只使用视图名、主机和span名，
+    数量受主机数限制，不会无限增长
+    """
+
+    def __init__(self, prefix='nginx_manager'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> 值
+        self.help = {}
+
+    def observe(self, name, value, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+                self.help.setdefault(name, help_text)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.help.setdefault(name, help_text)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in items)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+    def render(self):
+        """Prometheus文本格式"""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            helps = dict(self.help)
+
+        current = None
+        for (name, labels), histogram in histograms:
+            metric = f'{self.prefix}_{name}'
+            if name != current:
+                current = name
+                lines.append(f'# HELP {metric} {helps.get(name, "")}')
+                lines.append(f'# TYPE {metric} histogram')
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'{metric}_bucket{self._labels(labels, [("le", repr(bound))])} {count}')
+            lines.append(f'{metric}_bucket{self._labels(labels, [("le", "+Inf")])} {histogram.count}')
+            lines.append(f'{metric}_sum{self._labels(labels)} {histogram.sum:.6f}')
+            lines.append(f'{metric}_count{self._labels(labels)} {histogram.count}')
+
+        current = None
+        for (name, labels), value in counters:
+            metric = f'{self.prefix}_{name}_total'
+            if name != current:
+                current = name
+                lines.append(f'# HELP {metric} {helps.get(name, "")}')
+                lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def start_profile(view=None):
+    """开始记录当前请求，返回用于end_profile的token"""
+    profile = RequestProfile(view)
+    return profile, _current_profile.set(profile)
+
+
+def end_profile(token):
+    _current_profile.reset(token)
+
+
+def current_profile():
+    return _current_profile.get()
+
+
+def record(name, seconds, host=None, round_trips=0, bytes_in=0, bytes_out=0, calls=1):
+    """
+    记录一个已完成的span：计入当前请求的分解，并写入按视图和主机划分的直方图
+
+    calls为汇总进该span的操作次数，只影响Server-Timing中的计数
+    """
+    profile = _current_profile.get()
+    view = profile.view if profile and profile.view else 'none'
+    if profile is not None:
+        profile.add(name, seconds, host, round_trips, bytes_in, bytes_out, calls)
+    host = host or ''
+    registry.observe('span_seconds', seconds, '远程操作、解析、分析和数据库各阶段耗时',
+                     view=view, host=host, span=name)
+    if round_trips:
+        registry.inc('round_trips', round_trips, 'SSH远程往返次数（exec和SFTP请求）', view=view, host=host)
+    if bytes_in:
+        registry.inc('bytes', bytes_in, 'SSH传输的负载字节数', view=view, host=host, direction='in')
+    if bytes_out:
+        registry.inc('bytes', bytes_out, 'SSH传输的负载字节数', view=view, host=host, direction='out')
+
+
+@contextmanager
+def span(name, host=None, round_trips=0, bytes_in=0, bytes_out=0):
+    """
+    计时一段操作
+
+    产出的dict可在块内补充round_trips、bytes_in、bytes_out，块结束（包括异常）时一并记录
+    """
+    counters = {'round_trips': round_trips, 'bytes_in': bytes_in, 'bytes_out': bytes_out}
+    started = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(name, time.perf_counter() - started, host, **counters)
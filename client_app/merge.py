@@ -0,0 +1,163 @@
+import difflib
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 读取时保存的基准内容总字节数上限，冲突时用来生成三方对比
+SNAPSHOT_BYTES = 32 * 1024 * 1024
+
+
+def content_sha256(content):
+    """配置内容的sha256，与远程sha256sum的结果一致"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class SnapshotStore:
+    """
+    按sha256保存读取过的文件内容
+
+    修改请求只携带基准内容的sha256，写入被拒绝时从这里找回基准内容做三方对比；
+    进程重启或基准已被淘汰时找不到，调用方退化为两方对比
+    """
+
+    def __init__(self, max_bytes=SNAPSHOT_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def put(self, content):
+        digest = content_sha256(content)
+        size = len(content)
+        if size > self.max_bytes // 4:
+            return digest
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return digest
+            self.entries[digest] = content
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return digest
+
+    def get(self, digest):
+        with self.lock:
+            content = self.entries.get(digest)
+            if content is not None:
+                self.entries.move_to_end(digest)
+            return content
+
+
+snapshots = SnapshotStore()
+
+
+def unified_diff(old, new, old_name='a', new_name='b', context=3):
+    return ''.join(difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True),
+                                        old_name, new_name, n=context))
+
+
+def _changes(base, other, side):
+    """other相对base的修改: [(base起始行, base结束行, 新行列表, side)]"""
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return [(i1, i2, other[j1:j2], side) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def _apply(base, start, end, changes):
+    """在base[start:end]上应用同一方的修改"""
+    lines = []
+    position = start
+    for change_start, change_end, replacement, _ in changes:
+        lines.extend(base[position:change_start])
+        lines.extend(replacement)
+        position = change_end
+    lines.extend(base[position:end])
+    return lines
+
+
+def three_way_merge(base, yours, theirs, labels=('yours', 'base', 'current')):
+    """
+    按行三方合并
+
+    两方修改不重叠的区域直接合并；重叠且结果不同的区域用diff3风格的冲突标记同时保留双方内容
+
+    返回:
+        tuple: (合并后的内容, 冲突数)
+    """
+    base_lines = base.splitlines(keepends=True)
+    changes = sorted(_changes(base_lines, yours.splitlines(keepends=True), 'yours')
+                     + _changes(base_lines, theirs.splitlines(keepends=True), 'theirs'),
+                     key=lambda change: (change[0], change[1]))
+
+    merged = []
+    conflicts = 0
+    position = 0
+    index = 0
+    while index < len(changes):
+        group = [changes[index]]
+        start, end = changes[index][0], changes[index][1]
+        index += 1
+        # 区间重叠，或在同一位置插入，归为一组
+        while index < len(changes) and (changes[index][0] < end or changes[index][0] == start):
+            end = max(end, changes[index][1])
+            group.append(changes[index])
+            index += 1
+
+        merged.extend(base_lines[position:start])
+        position = end
+        sides = {side: [change for change in group if change[3] == side] for side in ('yours', 'theirs')}
+        if not sides['theirs'] or not sides['yours']:
+            merged.extend(_apply(base_lines, start, end, group))
+            continue
+        ours = _apply(base_lines, start, end, sides['yours'])
+        others = _apply(base_lines, start, end, sides['theirs'])
+        if ours == others:
+            merged.extend(ours)
+            continue
+        conflicts += 1
+        for marker, lines in ((f'<<<<<<< {labels[0]}\n', ours), (f'||||||| {labels[1]}\n', base_lines[start:end]),
+                              ('=======\n', others)):
+            merged.append(marker)
+            merged.extend(_terminated(lines))
+        merged.append(f'>>>>>>> {labels[2]}\n')
+    merged.extend(base_lines[position:])
+    return ''.join(merged), conflicts
+
+
+def _terminated(lines):
+    """冲突标记必须独占一行，最后一行没有换行时补上"""
+    if lines and not lines[-1].endswith('\n'):
+        return lines[:-1] + [lines[-1] + '\n']
+    return lines
+
+
+def conflict_report(file_path, base, yours, theirs):
+    """
+    写入被拒绝时返回给调用方的对比信息
+
+    参数:
+        base: 基准内容，找不到时为None，只给出当前内容到待写入内容的两方对比
+
+    返回:
+        dict: current_sha256、diff（base到current、base到yours，或current到yours）、
+        merged（三方合并结果）和conflicts（冲突数）
+    """
+    report = {
+        'file_path': file_path,
+        'current_sha256': content_sha256(theirs),
+        'base_available': base is not None,
+        'merged': None,
+        'conflicts': None,
+    }
+    if base is None:
+        report['diff'] = {'current_to_yours': unified_diff(theirs, yours, 'current', 'yours')}
+        return report
+    report['diff'] = {
+        'base_to_current': unified_diff(base, theirs, 'base', 'current'),
+        'base_to_yours': unified_diff(base, yours, 'base', 'yours'),
+    }
+    report['merged'], report['conflicts'] = three_way_merge(base, yours, theirs)
+    return report
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0002_clientinfo_host_clientinfo_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientinfo',
+            name='capabilities',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='clientinfo',
+            name='capabilities_probed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0003_clientinfo_capabilities_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientinfo',
+            name='stub_status_url',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0004_clientinfo_stub_status_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientinfo',
+            name='reload_window_ms',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
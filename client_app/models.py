@@ -9,6 +9,13 @@ class ClientInfo(models.Model):
     client_ip = models.GenericIPAddressField(unique=True,null=True,blank=True)
     client_port = models.IntegerField()
     nginx_config_path = models.CharField(max_length=200,null=True,blank=True)
+    # 主机能力探测结果（init系统、nginx路径/版本/模块、可用工具），过期后重新探测
+    capabilities = models.JSONField(null=True, blank=True)
+    capabilities_probed_at = models.DateTimeField(null=True, blank=True)
+    # stub_status地址，在远程主机本地请求，为空时使用默认地址
+    stub_status_url = models.CharField(max_length=200, null=True, blank=True)
+    # 配置修改的合并窗口（毫秒），窗口内的修改共用一次nginx -t和reload，0表示排队后立即执行
+    reload_window_ms = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
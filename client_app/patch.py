@@ -0,0 +1,225 @@
+import hashlib
+import shlex
+import threading
+from collections import OrderedDict
+
+# 超过这个数量的修改处逐段拼接反而比整文件上传慢，调用方应改为写入完整内容
+MAX_PATCH_HUNKS = 200
+
+PATCH_MARKER = '@@patch'
+STALE_MARKER = '@@stale'
+
+# 内容缓存的总字节数上限
+CONTENT_CACHE_BYTES = 64 * 1024 * 1024
+
+# 远程脚本的退出码
+EXIT_STALE = 3
+EXIT_FAILED = 4
+EXIT_CHECKSUM = 5
+
+
+class ConfigPatch:
+    """
+    对一个远程文件的局部替换，偏移和内容都按字节计
+
+    hunks: [(起始偏移, 原内容, 新内容)]，按偏移排序且互不重叠；base_size、base_sha256为生成补丁时文件的字节数和sha256，
+    new_sha256为应用补丁后文件内容的sha256
+    """
+
+    __slots__ = ('hunks', 'base_size', 'base_sha256', 'new_sha256')
+
+    def __init__(self, hunks, base_size, new_sha256=None, base_sha256=None):
+        self.hunks = hunks
+        self.base_size = base_size
+        self.base_sha256 = base_sha256
+        self.new_sha256 = new_sha256
+
+    @classmethod
+    def from_replacements(cls, content, replacements):
+        """
+        由按字符偏移的替换生成补丁
+
+        参数:
+            content: 原文
+            replacements: [(起始偏移, 结束偏移, 新文本)]，按偏移排序且互不重叠
+        """
+        hunks = []
+        parts = []
+        char_position = byte_position = 0
+        for start, end, text in replacements:
+            before = content[char_position:start].encode('utf-8')
+            old = content[start:end].encode('utf-8')
+            new = text.encode('utf-8')
+            byte_position += len(before)
+            hunks.append((byte_position, old, new))
+            parts.extend((before, new))
+            byte_position += len(old)
+            char_position = end
+        tail = content[char_position:].encode('utf-8')
+        parts.append(tail)
+        return cls(hunks, byte_position + len(tail), hashlib.sha256(b''.join(parts)).hexdigest(),
+                   hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+    def __len__(self):
+        return len(self.hunks)
+
+    @property
+    def bytes_out(self):
+        """传输的补丁数据量（原内容用于远程校验，也计算在内）"""
+        return sum(len(old) + len(new) for _, old, new in self.hunks)
+
+    def apply(self, data):
+        """在本地字节内容上应用补丁，原内容不符时抛出ValueError"""
+        if len(data) != self.base_size:
+            raise ValueError(f'文件大小不符: 期望{self.base_size}字节，实际{len(data)}字节')
+        parts = []
+        position = 0
+        for start, old, new in self.hunks:
+            if data[start:start + len(old)] != old:
+                raise ValueError(f'偏移{start}处的内容与补丁不符')
+            parts.extend((data[position:start], new))
+            position = start + len(old)
+        parts.append(data[position:])
+        return b''.join(parts)
+
+    def script(self, file_path, patch_path, temp_path, fsync=False, verify_checksum=False):
+        """
+        生成自包含的远程补丁文件：前面是sh脚本，exit之后是数据区（所有原内容，再是所有新内容）
+
+        脚本在远程主机上校验文件大小、sha256（有sha256sum时）和每处原内容，用head/tail从原文件和数据区
+        拼出新文件写入临时文件，再rename覆盖；文件已被他人修改时不做任何改动，以EXIT_STALE退出。
+        执行方式: sh patch_path
+        """
+        olds, news = [], []
+        old_offset = 0
+        new_offset = sum(len(old) for _, old, _ in self.hunks)
+        checks, pieces = [], []
+        position = 0
+        for start, old, new in self.hunks:
+            if old:
+                checks.append(f'tail -c +{start + 1} "$f" | head -c {len(old)}')
+            if start > position:
+                pieces.append(f'head -c {start} "$f"' if position == 0
+                              else f'tail -c +{position + 1} "$f" | head -c {start - position}')
+            if new:
+                pieces.append(f'tail -c +$((d + {new_offset + 1})) "$p" | head -c {len(new)}')
+            olds.append(old)
+            news.append(new)
+            old_offset += len(old)
+            new_offset += len(new)
+            position = start + len(old)
+        pieces.append(f'tail -c +{position + 1} "$f"')
+
+        lines = [
+            f'f={shlex.quote(file_path)}; p={shlex.quote(patch_path)}; t={shlex.quote(temp_path)}',
+            'trap \'rm -f "$p" "$t"\' EXIT',
+            'size=$(stat -Lc %s "$f") || exit ' + str(EXIT_FAILED),
+            f'[ "$size" = {self.base_size} ] || {{ echo "{PATCH_MARKER} stale size=$size"; exit {EXIT_STALE}; }}',
+        ]
+        if self.base_sha256:
+            lines.append(f'if command -v sha256sum >/dev/null 2>&1; then cur=$(sha256sum "$f" | cut -d" " -f1); '
+                         f'[ "$cur" = {self.base_sha256} ] || '
+                         f'{{ echo "{PATCH_MARKER} stale sha256=$cur"; exit {EXIT_STALE}; }}; fi')
+        if checks:
+            lines.append(f'a=$({{ {"; ".join(checks)}; }} | cksum)')
+            lines.append(f'b=$(tail -c +$((d + 1)) "$p" | head -c {old_offset} | cksum)')
+            lines.append(f'[ "$a" = "$b" ] || {{ echo "{PATCH_MARKER} stale content"; exit {EXIT_STALE}; }}')
+        lines.append('{ ' + '; '.join(pieces) + f'; }} > "$t" || exit {EXIT_FAILED}')
+        lines.append(f'chmod "$(stat -Lc %a "$f")" "$t" || exit {EXIT_FAILED}')
+        if verify_checksum and self.new_sha256:
+            lines.append(f'[ "$(sha256sum "$t" | cut -d" " -f1)" = {self.new_sha256} ] || '
+                         f'{{ echo "{PATCH_MARKER} checksum"; exit {EXIT_CHECKSUM}; }}')
+        if fsync:
+            lines.append('sync "$t" 2>/dev/null || sync')
+        lines.append(f'mv -f "$t" "$f" || exit {EXIT_FAILED}')
+        lines.append(f'stat -Lc "{PATCH_MARKER} ok %s %Y" "$f"')
+        lines.append('exit 0')
+        # 第二行是数据区在补丁文件中的偏移，定宽书写，脚本长度与偏移的位数无关
+        head, body = lines[0] + '\n', '\n'.join(lines[1:]) + '\n'
+        offset = len(head.encode('utf-8')) + len('d=\n') + 12 + len(body.encode('utf-8'))
+        script = f'{head}d={offset:<12}\n{body}'
+        return script.encode('utf-8') + b''.join(olds) + b''.join(news)
+
+
+def compare_and_rename_command(file_path, temp_path, base_sha256):
+    """
+    文件当前内容的sha256与base_sha256一致时用temp_path替换它，否则输出当前sha256并以EXIT_STALE退出
+
+    文件不存在时当前sha256为空，只有base_sha256为空字符串时才替换（新建文件）
+    """
+    path, temp = shlex.quote(file_path), shlex.quote(temp_path)
+    return (f'{{ command -v sha256sum >/dev/null 2>&1 || {{ echo "远程主机缺少sha256sum，无法比较文件版本" >&2; exit 1; }}; '
+            f'cur=""; if [ -e {path} ]; then cur=$(sha256sum {path} | cut -d" " -f1) || exit 1; fi; '
+            f'[ "$cur" = {shlex.quote(base_sha256)} ] || {{ rm -f {temp}; echo "{STALE_MARKER} $cur"; exit {EXIT_STALE}; }}; '
+            f'mv -f {temp} {path}; }}')
+
+
+def parse_stale_output(output):
+    """从compare_and_rename_command的输出中取出文件当前的sha256"""
+    for line in output.splitlines():
+        if line.startswith(STALE_MARKER):
+            return line[len(STALE_MARKER):].strip()
+    return ''
+
+
+def parse_patch_output(output):
+    """
+    解析补丁脚本的输出
+
+    返回:
+        dict: status为ok、stale或checksum；ok时包含应用后的size和mtime，用于更新内容缓存
+    """
+    for line in reversed(output.splitlines()):
+        if not line.startswith(PATCH_MARKER + ' '):
+            continue
+        fields = line[len(PATCH_MARKER) + 1:].split()
+        if fields[0] == 'ok' and len(fields) == 3:
+            return {'status': 'ok', 'size': int(fields[1]), 'mtime': int(fields[2])}
+        return {'status': fields[0], 'detail': ' '.join(fields[1:])}
+    return {'status': 'unknown'}
+
+
+class ContentCache:
+    """
+    远程配置文件内容缓存: (主机, 路径) -> (字节数, 修改时间, 内容)
+
+    大文件反复编辑时只需一次SFTP stat确认文件没有变化，不必每次整文件下载；
+    修改时间只精确到秒，缓存过期但大小和时间恰好相同的情况由补丁脚本的原内容校验兜底
+    """
+
+    def __init__(self, max_bytes=CONTENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, host, file_path, size, mtime):
+        with self.lock:
+            entry = self.entries.get((host, file_path))
+            if entry is None or entry[0] != size or entry[1] != mtime:
+                return None
+            self.entries.move_to_end((host, file_path))
+            return entry[2]
+
+    def put(self, host, file_path, size, mtime, content):
+        with self.lock:
+            self._pop((host, file_path))
+            if size > self.max_bytes // 2:
+                return
+            self.entries[(host, file_path)] = (size, mtime, content)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def forget(self, host, file_paths):
+        with self.lock:
+            for file_path in file_paths:
+                self._pop((host, file_path))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+
+content_cache = ContentCache()
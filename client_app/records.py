@@ -0,0 +1,193 @@
+import sys
+from functools import lru_cache
+
+# 文件路径、upstream名称、location路径、server参数等在同一主机和不同主机之间大量重复，统一驻留只保存一份；
+# 后端地址、server_name这类基本不重复的值驻留没有收益，直接引用解析结果中的字符串
+intern = sys.intern
+
+
+@lru_cache(maxsize=4096)
+def _interned_tuple(args):
+    return tuple(intern(arg) for arg in args)
+
+
+def intern_args(args):
+    """参数元组本身也复用，weight=2、backup这类相同参数组合只保存一个元组"""
+    return _interned_tuple(tuple(args))
+
+
+class Location:
+    """location中的一条proxy_pass"""
+
+    __slots__ = ('path', 'proxy_pass')
+
+    def __init__(self, path, proxy_pass):
+        self.path = intern(path)
+        self.proxy_pass = intern(proxy_pass)
+
+    def __repr__(self):
+        return f'Location({self.path!r}, {self.proxy_pass!r})'
+
+
+class VirtualServer:
+    """虚拟主机，locations按出现顺序保存，同一路径可能出现多次"""
+
+    __slots__ = ('name', 'file_path', 'locations')
+
+    def __init__(self, name, file_path, locations=None):
+        self.name = name
+        self.file_path = intern(file_path)
+        self.locations = locations if locations is not None else []
+
+    @property
+    def proxy_pass(self):
+        return [location.proxy_pass for location in self.locations]
+
+    @property
+    def location_proxy(self):
+        return {location.path: location.proxy_pass for location in self.locations}
+
+    def to_dict(self):
+        return {
+            'filepath': self.file_path,
+            'location_proxy': self.location_proxy,
+            'proxy_pass': self.proxy_pass
+        }
+
+    def __repr__(self):
+        return f'VirtualServer({self.name!r}, {self.file_path!r}, locations={len(self.locations)})'
+
+
+class StreamServer:
+    """stream块中的四层server，按listen区分，proxy_pass直接写在server块中"""
+
+    __slots__ = ('name', 'file_path', 'listen', 'proxy_pass')
+
+    def __init__(self, name, file_path, listen=(), proxy_pass=None):
+        self.name = name
+        self.file_path = intern(file_path)
+        self.listen = listen  # 每条listen指令的参数元组
+        self.proxy_pass = proxy_pass
+
+    def to_dict(self):
+        return {
+            'filepath': self.file_path,
+            'listen': [list(args) for args in self.listen],
+            'proxy_pass': self.proxy_pass
+        }
+
+    def __repr__(self):
+        return f'StreamServer({self.name!r}, proxy_pass={self.proxy_pass!r})'
+
+
+class BackendServer:
+    """upstream成员，params为地址之后的参数，如 weight=2、backup"""
+
+    __slots__ = ('address', 'upstream', 'file_path', 'params', 'protocol')
+
+    def __init__(self, address, upstream, file_path, params=(), protocol='http'):
+        self.address = address
+        self.upstream = intern(upstream)
+        self.file_path = intern(file_path)
+        self.params = intern_args(params)
+        self.protocol = protocol
+
+    @property
+    def args(self):
+        """与crossplane一致的完整参数列表"""
+        return [self.address, *self.params]
+
+    def to_dict(self):
+        return {
+            'file_path': self.file_path,
+            'upstream': self.upstream,
+            'args': list(self.params)
+        }
+
+    def __repr__(self):
+        return f'BackendServer({self.address!r}, upstream={self.upstream!r})'
+
+
+class Upstream:
+    """upstream块及其成员，protocol为http或stream"""
+
+    __slots__ = ('name', 'file_path', 'members', 'protocol')
+
+    def __init__(self, name, file_path, members=None, protocol='http'):
+        self.name = intern(name)
+        self.file_path = intern(file_path)
+        self.members = members if members is not None else []
+        self.protocol = protocol
+
+    def to_dict(self):
+        return {
+            'file_path': self.file_path,
+            'backend_servers': [member.args for member in self.members]
+        }
+
+    def __repr__(self):
+        return f'Upstream({self.name!r}, members={len(self.members)})'
+
+
+class NginxAnalysis:
+    """
+    一台主机的配置分析结果
+
+    用记录对象代替嵌套的dict和list保存，需要JSON时再通过to_dict/to_tuple转换为原有结构；
+    http和stream的upstream是两个独立的命名空间，stream的结果单独保存
+    """
+
+    __slots__ = ('virtual_servers', 'upstreams', 'backend_servers', 'backend_server_addrs', 'stream_servers',
+                 'stream_upstreams', 'stream_backend_servers', 'server_names', 'config_files', 'file_contexts',
+                 'pid_file_path', 'routing')
+
+    def __init__(self, virtual_servers=None, upstreams=None, backend_servers=None, backend_server_addrs=None,
+                 stream_servers=None, stream_upstreams=None, stream_backend_servers=None, server_names=None,
+                 config_files=(), file_contexts=None, pid_file_path=None):
+        self.virtual_servers = virtual_servers if virtual_servers is not None else {}  # 名称 -> VirtualServer
+        self.upstreams = upstreams if upstreams is not None else {}  # 名称 -> Upstream
+        self.backend_servers = backend_servers if backend_servers is not None else {}  # 地址 -> BackendServer
+        # 按出现顺序的后端地址，同一地址在多个upstream中出现时会重复
+        self.backend_server_addrs = backend_server_addrs if backend_server_addrs is not None else []
+        self.stream_servers = stream_servers if stream_servers is not None else {}  # listen -> StreamServer
+        self.stream_upstreams = stream_upstreams if stream_upstreams is not None else {}  # 名称 -> Upstream
+        self.stream_backend_servers = stream_backend_servers if stream_backend_servers is not None else {}
+        # (server_name, listen) -> 首先定义它的文件，与nginx一样后定义的同名server不生效
+        self.server_names = server_names if server_names is not None else {}
+        self.config_files = intern_args(config_files)
+        # 文件 -> 被include时所处的块上下文，主配置为()，如 ('http',)、('stream',)、('http', 'server')
+        self.file_contexts = file_contexts if file_contexts is not None else {}
+        self.pid_file_path = pid_file_path
+        self.routing = None  # RoutingGraph，分析完成后构建
+
+    def upstreams_for(self, protocol):
+        return self.stream_upstreams if protocol == 'stream' else self.upstreams
+
+    def to_tuple(self):
+        """转换为analysis_nginx_all_conf原有的6元组，只包含http部分"""
+        return (list(self.virtual_servers),
+                {name: server.to_dict() for name, server in self.virtual_servers.items()},
+                list(self.upstreams),
+                {name: upstream.to_dict() for name, upstream in self.upstreams.items()},
+                list(self.backend_server_addrs),
+                {addr: backend.to_dict() for addr, backend in self.backend_servers.items()})
+
+    def to_dict(self):
+        """转换为get_nginx_config_analysis原有的JSON结构"""
+        (virtual_servers, virtual_servers_info, upstreams, upstreams_info,
+         backend_servers, backend_servers_info) = self.to_tuple()
+        return {
+            'virtual_servers': virtual_servers,
+            'virtual_servers_info': virtual_servers_info,
+            'upstreams': upstreams,
+            'upstreams_info': upstreams_info,
+            'backend_servers': backend_servers,
+            'backend_servers_info': backend_servers_info,
+            'stream_servers_info': {name: server.to_dict() for name, server in self.stream_servers.items()},
+            'stream_upstreams': list(self.stream_upstreams),
+            'stream_upstreams_info': {name: upstream.to_dict() for name, upstream in self.stream_upstreams.items()},
+            'stream_backend_servers_info': {addr: backend.to_dict()
+                                            for addr, backend in self.stream_backend_servers.items()},
+            'config_files': list(self.config_files),
+            'pid_file_path': self.pid_file_path
+        }
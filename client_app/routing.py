@@ -0,0 +1,187 @@
+import re
+
+INACTIVE_PARAMS = ('down', 'backup')
+PORT_PATTERN = re.compile(r'^(\[[^\]]+\]|[^:]+):\d+$')
+
+
+def address_host(address):
+    """去掉后端地址中的端口，10.0.0.5:8080 -> 10.0.0.5，[::1]:80 -> ::1"""
+    if address.startswith('unix:'):
+        return address
+    match = PORT_PATTERN.match(address)
+    host = match.group(1) if match else address
+    return host.strip('[]')
+
+
+def proxy_pass_host(target):
+    """proxy_pass目标（已去掉协议）的主机部分，包含变量时无法静态解析返回None"""
+    if '$' in target:
+        return None
+    if target.startswith('unix:'):
+        return target
+    return target.split('/', 1)[0]
+
+
+class Route:
+    """
+    一条路由: server_name下的location经proxy_pass转发到upstream或直接转发到后端，
+    stream路由的server_name为listen，location为None
+    """
+
+    __slots__ = ('protocol', 'server_name', 'location', 'target', 'upstream', 'backend')
+
+    def __init__(self, protocol, server_name, location, target, upstream=None, backend=None):
+        self.protocol = protocol
+        self.server_name = server_name
+        self.location = location
+        self.target = target
+        self.upstream = upstream
+        self.backend = backend
+
+    def to_dict(self):
+        return {
+            'protocol': self.protocol,
+            'server_name': self.server_name,
+            'location': self.location,
+            'proxy_pass': self.target,
+            'upstream': self.upstream,
+            'backend': self.backend
+        }
+
+
+class RoutingGraph:
+    """
+    路由图 server_name -> location -> upstream -> backend
+
+    分析完成后按记录对象线性构建一次，同时建立反向索引，
+    影响查询只做字典查找，不再扫描配置
+    """
+
+    def __init__(self):
+        # upstream和虚拟主机的键都是 (协议, 名称)，http和stream各自独立
+        self.routes_by_server = {}  # (协议, server_name) -> [Route]
+        self.routes_by_upstream = {}  # (协议, upstream名称) -> [Route]
+        self.routes_by_backend = {}  # 直接proxy_pass的后端地址 -> [Route]
+        self.members_by_upstream = {}  # (协议, upstream名称) -> [BackendServer]
+        self.active_members = {}  # (协议, upstream名称) -> 非down/backup成员数
+        self.upstreams_by_backend = {}  # 后端地址 -> {(协议, upstream名称): 该地址在此upstream中的活动成员数}
+        self.addresses_by_host = {}  # 不带端口的主机 -> {后端地址}
+        self.unresolved_routes = []  # proxy_pass包含变量等无法静态解析的路由
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        graph = cls()
+        for upstream in (*analysis.upstreams.values(), *analysis.stream_upstreams.values()):
+            key = (upstream.protocol, upstream.name)
+            graph.members_by_upstream[key] = upstream.members
+            graph.active_members[key] = sum(1 for member in upstream.members if graph.is_active(member))
+            for member in upstream.members:
+                upstreams = graph.upstreams_by_backend.setdefault(member.address, {})
+                upstreams[key] = upstreams.get(key, 0) + graph.is_active(member)
+                graph._index_address(member.address)
+
+        for server_name, server in analysis.virtual_servers.items():
+            for location in server.locations:
+                graph._add_route('http', server_name, location.path, location.proxy_pass)
+        for server_name, server in analysis.stream_servers.items():
+            if server.proxy_pass:
+                graph._add_route('stream', server_name, None, server.proxy_pass)
+        return graph
+
+    def _add_route(self, protocol, server_name, location, target):
+        host = proxy_pass_host(target)
+        if host is None:
+            route = Route(protocol, server_name, location, target)
+            self.unresolved_routes.append(route)
+        elif (protocol, host) in self.members_by_upstream:
+            route = Route(protocol, server_name, location, target, upstream=host)
+            self.routes_by_upstream.setdefault((protocol, host), []).append(route)
+        else:
+            route = Route(protocol, server_name, location, target, backend=host)
+            self.routes_by_backend.setdefault(host, []).append(route)
+            self._index_address(host)
+        self.routes_by_server.setdefault((protocol, server_name), []).append(route)
+
+    @staticmethod
+    def is_active(member):
+        return not any(param in INACTIVE_PARAMS for param in member.params)
+
+    def _index_address(self, address):
+        self.addresses_by_host.setdefault(address_host(address), set()).add(address)
+
+    def resolve_addresses(self, backend):
+        """backend可以是ip:port或不带端口的ip，后者匹配该主机的所有端口"""
+        if backend in self.upstreams_by_backend or backend in self.routes_by_backend:
+            return {backend}
+        return self.addresses_by_host.get(address_host(backend), set())
+
+    def routes_for_server(self, server_name, protocol='http'):
+        """正向查询: 虚拟主机的每个location（stream为listen）转发到哪些后端"""
+        result = []
+        for route in self.routes_by_server.get((protocol, server_name), ()):
+            item = route.to_dict()
+            if route.upstream:
+                item['backends'] = [member.address
+                                    for member in self.members_by_upstream[(route.protocol, route.upstream)]]
+            else:
+                item['backends'] = [route.backend] if route.backend else []
+            result.append(item)
+        return result
+
+    def impact(self, backend):
+        """
+        影响查询: 摘除backend后哪些upstream、路由和虚拟主机受影响
+
+        backend为ip时同时摘除该主机的所有端口；upstream中剩余的非down/backup成员为0时视为不可用
+
+        返回:
+            dict: addresses、upstreams、routes，以及受影响和不可用的http虚拟主机、stream server
+        """
+        addresses = self.resolve_addresses(backend)
+        drained_active = {}
+        for address in addresses:
+            for key, active in self.upstreams_by_backend.get(address, {}).items():
+                drained_active[key] = drained_active.get(key, 0) + active
+
+        upstreams = []
+        unavailable_upstreams = set()
+        for key, drained in drained_active.items():
+            remaining = self.active_members[key] - drained
+            if remaining <= 0:
+                unavailable_upstreams.add(key)
+            upstreams.append({
+                'protocol': key[0],
+                'upstream': key[1],
+                'members': len(self.members_by_upstream[key]),
+                'active': self.active_members[key],
+                'remaining_active': max(remaining, 0),
+                'unavailable': remaining <= 0
+            })
+
+        routes = []
+        unavailable_routes = []
+        for key in drained_active:
+            for route in self.routes_by_upstream.get(key, ()):
+                routes.append(route)
+                if key in unavailable_upstreams:
+                    unavailable_routes.append(route)
+        for address in addresses:
+            # 直接proxy_pass到后端地址的路由没有其它成员可以接管
+            direct_routes = self.routes_by_backend.get(address, ())
+            routes.extend(direct_routes)
+            unavailable_routes.extend(direct_routes)
+
+        return {
+            'backend': backend,
+            'addresses': sorted(addresses),
+            'upstreams': upstreams,
+            'routes': [route.to_dict() for route in routes],
+            'affected_virtual_servers': self._server_names(routes, 'http'),
+            'unavailable_virtual_servers': self._server_names(unavailable_routes, 'http'),
+            'affected_stream_servers': self._server_names(routes, 'stream'),
+            'unavailable_stream_servers': self._server_names(unavailable_routes, 'stream')
+        }
+
+    @staticmethod
+    def _server_names(routes, protocol):
+        return sorted({route.server_name for route in routes if route.protocol == protocol})
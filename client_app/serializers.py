@@ -2,8 +2,20 @@ from rest_framework import serializers
 from .models import ClientInfo
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+
+# 合并窗口上限（毫秒），窗口过长会让排队的修改迟迟不生效
+MAX_RELOAD_WINDOW_MS = 60000
+
+
 class ClientInfoSerializer(serializers.ModelSerializer):
+    reload_window_ms = serializers.IntegerField(min_value=0, max_value=MAX_RELOAD_WINDOW_MS, required=False)
+
     class Meta:
         model = ClientInfo
-        fields = ['id', 'client_ip', 'client_port','created_at','updated_at']
+        fields = ['id', 'client_ip', 'client_port', 'reload_window_ms', 'created_at', 'updated_at']
+
 
+class ReloadWindowSerializer(serializers.Serializer):
+    """设置主机配置修改的合并窗口"""
+    client_ip = serializers.IPAddressField()
+    reload_window_ms = serializers.IntegerField(min_value=0, max_value=MAX_RELOAD_WINDOW_MS)
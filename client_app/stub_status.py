@@ -0,0 +1,48 @@
+import re
+import shlex
+
+DEFAULT_STUB_STATUS_URL = 'http://127.0.0.1/nginx_status'
+
+_ACTIVE_RE = re.compile(r'Active connections:\s*(\d+)')
+_COUNTERS_RE = re.compile(r'server accepts handled requests\s+(\d+)\s+(\d+)\s+(\d+)')
+_STATES_RE = re.compile(r'Reading:\s*(\d+)\s+Writing:\s*(\d+)\s+Waiting:\s*(\d+)')
+
+
+def stub_status_command(url, caps=None, timeout=5):
+    """在远程主机本地请求stub_status，优先curl，没有curl时用wget"""
+    if caps is not None and not caps.has_tool('curl'):
+        return f'wget -q -T {timeout} -O - {shlex.quote(url)}'
+    return f'curl -s -m {timeout} {shlex.quote(url)}'
+
+
+def http_status_command(url, caps=None, timeout=5):
+    """在远程主机本地请求url，只输出HTTP状态码，连接失败时输出000"""
+    if caps is not None and not caps.has_tool('curl'):
+        return (f"wget -q -S -T {timeout} -O /dev/null {shlex.quote(url)} 2>&1 "
+                f"| awk '/^  HTTP\\//{{code=$2}} END{{print code ? code : \"000\"}}'")
+    return f"curl -s -o /dev/null -m {timeout} -w '%{{http_code}}' {shlex.quote(url)}"
+
+
+def parse_stub_status(text):
+    """
+    解析ngx_http_stub_status_module的输出
+
+    返回:
+        dict: active、accepts、handled、requests、reading、writing、waiting；格式不符时返回None
+    """
+    active = _ACTIVE_RE.search(text)
+    counters = _COUNTERS_RE.search(text)
+    states = _STATES_RE.search(text)
+    if not (active and counters and states):
+        return None
+    accepts, handled, requests = (int(value) for value in counters.groups())
+    reading, writing, waiting = (int(value) for value in states.groups())
+    return {
+        'active': int(active.group(1)),
+        'accepts': accepts,
+        'handled': handled,
+        'requests': requests,
+        'reading': reading,
+        'writing': writing,
+        'waiting': waiting,
+    }
@@ -1,3 +1,882 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+import crossplane
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from .access_log import LOG_FORMAT_COMBINED, LOG_FORMAT_UPSTREAM, AccessLogTail, LogFormat
+from .client import RemoteCommandStream
+from .fallback_parser import parse_config
+from .host_queue import HostOperationQueue, commit_batch, reload_window
+from .includes import IncludeResolver, RemoteFileListing
+from .merge import SnapshotStore, conflict_report, content_sha256, three_way_merge
+from .models import ClientInfo
+from .patch import EXIT_STALE, parse_patch_output
+from .transaction import NginxConfigTransaction
+from .upstream_edit import UpstreamEditError, UpstreamEditor, apply_operations
+from .validator import NginxConfigValidator, ValidationContext
+
+
+class FakeChannel:
+    """在本地sh中执行命令的SSH通道，供RemoteCommandStream读取"""
+
+    def __init__(self, command):
+        result = subprocess.run(['sh', '-c', command], capture_output=True)
+        self.stdout = result.stdout
+        self.stderr = result.stderr
+        self.exit_status = result.returncode
+        self.eof_received = True
+        self.status_event = threading.Event()
+        self.status_event.set()
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        data, self.stdout = self.stdout[:size], self.stdout[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr[:size], self.stderr[size:]
+        return data
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+
+class FakeNginxClient:
+    """
+    本地目录模拟的主机
+
+    备份、回滚等远程命令在本地sh中执行，写入直接写文件；内容包含broken;的文件让nginx -t失败，
+    on_check在每次检查时调用，用来让执行者在检查中停下
+    """
+
+    def __init__(self, root, fail_reload=False, on_check=None):
+        self.host = 'fake'
+        self.root = root
+        self.fail_reload = fail_reload
+        self.on_check = on_check
+        self.checks = 0
+        self.reloads = 0
+
+    def execute_command(self, command, timeout=None, max_output_bytes=None):
+        result = subprocess.run(['sh', '-c', command], capture_output=True, text=True)
+        return {'success': result.returncode == 0, 'output': result.stdout, 'error': result.stderr,
+                'return_code': result.returncode}
+
+    def open_command_stream(self, command, timeout=None, max_output_bytes=None):
+        return RemoteCommandStream(FakeChannel(command), timeout=timeout, max_output_bytes=max_output_bytes,
+                                   host=self.host)
+
+    def write_config_file(self, file_path, content, fsync=False, verify_checksum=False, base_sha256=None):
+        if base_sha256 is not None:
+            current = ''
+            if os.path.exists(file_path):
+                with open(file_path, 'rb') as f:
+                    current = hashlib.sha256(f.read()).hexdigest()
+            if current != base_sha256:
+                return {'success': False, 'stale': True, 'current_sha256': current, 'error': f'{file_path}已被修改'}
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return {'success': True, 'error': ''}
+
+    def check_nginx_config(self, nginx_path=None):
+        self.checks += 1
+        if self.on_check is not None:
+            self.on_check()
+        for name in sorted(os.listdir(self.root)):
+            with open(os.path.join(self.root, name), encoding='utf-8') as f:
+                if 'broken;' in f.read():
+                    return {'success': False, 'output': '', 'error': f'unknown directive "broken" in {name}'}
+        return {'success': True, 'output': '', 'error': ''}
+
+    def reload_nginx(self):
+        self.reloads += 1
+        if self.fail_reload:
+            return {'success': False, 'output': '', 'error': 'reload failed'}
+        return {'success': True, 'output': '', 'error': ''}
+
+    def forget_config_files(self, file_paths):
+        pass
+
+
+class HostQueueTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.client = FakeNginxClient(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(self.path(name), encoding='utf-8') as f:
+            return f.read()
+
+    def transaction(self, name, content, **kwargs):
+        return NginxConfigTransaction(self.client, [{'file_path': self.path(name), 'file_content': content}],
+                                      **kwargs)
+
+    def backups(self):
+        return [name for name in os.listdir(self.root) if '.backup-' in name]
+
+    def test_batch_shares_one_check_and_reload(self):
+        self.write('a.conf', 'a0\n')
+        results = commit_batch([self.transaction('a.conf', 'a1\n'), self.transaction('b.conf', 'b1\n')])
+
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual((self.client.checks, self.client.reloads), (1, 1))
+        self.assertEqual(results[0]['reload_id'], results[1]['reload_id'])
+        self.assertEqual([result['batch_size'] for result in results], [2, 2])
+        self.assertEqual((self.read('a.conf'), self.read('b.conf')), ('a1\n', 'b1\n'))
+        self.assertEqual(self.backups(), [])
+
+    def test_failed_batch_check_retries_each_transaction(self):
+        self.write('a.conf', 'a0\n')
+        self.write('b.conf', 'b0\n')
+        results = commit_batch([self.transaction('a.conf', 'a1\n'), self.transaction('b.conf', 'broken;\n'),
+                                self.transaction('c.conf', 'c1\n')])
+
+        self.assertEqual([result['success'] for result in results], [True, False, True])
+        self.assertEqual(results[1]['stage'], 'check')
+        self.assertTrue(results[1]['rolled_back'])
+        self.assertEqual(results[0]['batch_tx_ids'], [results[0]['tx_id'], results[2]['tx_id']])
+        # 合并检查1次，逐个检查3次，出错的事务不参与reload
+        self.assertEqual((self.client.checks, self.client.reloads), (4, 1))
+        self.assertEqual((self.read('a.conf'), self.read('b.conf'), self.read('c.conf')), ('a1\n', 'b0\n', 'c1\n'))
+        self.assertEqual(self.backups(), [])
+
+    def test_failed_reload_rolls_back_whole_batch(self):
+        self.client.fail_reload = True
+        self.write('a.conf', 'a0\n')
+        results = commit_batch([self.transaction('a.conf', 'a1\n'), self.transaction('b.conf', 'b1\n')])
+
+        self.assertEqual([(result['success'], result['stage']) for result in results],
+                         [(False, 'reload'), (False, 'reload')])
+        self.assertTrue(all(result['rolled_back'] for result in results))
+        self.assertEqual(self.read('a.conf'), 'a0\n')
+        self.assertFalse(os.path.exists(self.path('b.conf')))
+        self.assertEqual(self.backups(), [])
+
+    def test_stale_transaction_fails_without_touching_the_file(self):
+        self.write('a.conf', 'theirs\n')
+        edits = [{'file_path': self.path('a.conf'), 'file_content': 'yours\n',
+                  'base_sha256': hashlib.sha256(b'base\n').hexdigest()}]
+        results = commit_batch([NginxConfigTransaction(self.client, edits), self.transaction('b.conf', 'b1\n')])
+
+        self.assertEqual([result['success'] for result in results], [False, True])
+        self.assertTrue(results[0]['stale'])
+        self.assertEqual(self.read('a.conf'), 'theirs\n')
+        self.assertEqual(results[1]['batch_size'], 1)
+
+    def test_revert_restores_kept_backups(self):
+        self.write('a.conf', 'a0\n')
+        transaction = self.transaction('a.conf', 'a1\n', keep_backups=True)
+        self.assertTrue(commit_batch([transaction])[0]['success'])
+        self.assertEqual(len(self.backups()), 1)
+
+        self.assertTrue(transaction.revert()['success'])
+        self.assertEqual(self.read('a.conf'), 'a0\n')
+        self.assertEqual(self.backups(), [])
+        self.assertEqual(self.client.reloads, 2)
+
+    def test_revert_keeps_files_changed_after_commit(self):
+        self.write('a.conf', 'a0\n')
+        self.write('b.conf', 'b0\n')
+        transaction = NginxConfigTransaction(self.client, [
+            {'file_path': self.path('a.conf'), 'file_content': 'a1\n'},
+            {'file_path': self.path('b.conf'), 'file_content': 'b1\n'},
+            {'file_path': self.path('c.conf'), 'file_content': 'c1\n'},
+        ], keep_backups=True)
+        self.assertTrue(commit_batch([transaction])[0]['success'])
+        self.write('a.conf', 'theirs\n')
+
+        result = transaction.revert()
+
+        self.assertFalse(result['success'])
+        self.assertEqual(result['conflicts'], [self.path('a.conf')])
+        self.assertEqual(self.read('a.conf'), 'theirs\n')
+        self.assertEqual(self.read('b.conf'), 'b0\n')
+        self.assertFalse(os.path.exists(self.path('c.conf')))
+        self.assertEqual(self.backups(), [])
+        self.assertEqual(self.client.reloads, 2)
+
+    def test_revert_without_restorable_files_does_not_reload(self):
+        transaction = self.transaction('a.conf', 'a1\n', keep_backups=True)
+        self.assertTrue(commit_batch([transaction])[0]['success'])
+        self.write('a.conf', 'theirs\n')
+
+        result = transaction.revert()
+
+        self.assertEqual(result['conflicts'], [self.path('a.conf')])
+        self.assertIsNone(result['reload_result'])
+        self.assertEqual(self.read('a.conf'), 'theirs\n')
+        self.assertEqual(self.client.reloads, 1)
+
+    def test_transactions_arriving_during_a_commit_are_batched(self):
+        gate = threading.Event()
+        self.client.on_check = lambda: gate.wait(5)
+        queue = HostOperationQueue('fake')
+        results = {}
+
+        def commit(name):
+            results[name] = queue.commit(self.transaction(name, f'{name}\n'))
+
+        leader = threading.Thread(target=commit, args=('a.conf',))
+        leader.start()
+        while self.client.checks == 0:
+            time.sleep(0.01)
+        followers = [threading.Thread(target=commit, args=(name,)) for name in ('b.conf', 'c.conf', 'd.conf')]
+        for thread in followers:
+            thread.start()
+        while len(queue.pending) < 3:
+            time.sleep(0.01)
+        gate.set()
+        for thread in [leader] + followers:
+            thread.join(10)
+
+        self.assertTrue(all(result['success'] for result in results.values()))
+        self.assertEqual(self.client.reloads, 2)
+        self.assertEqual(results['a.conf']['batch_size'], 1)
+        self.assertEqual({results[name]['reload_id'] for name in ('b.conf', 'c.conf', 'd.conf')},
+                         {results['b.conf']['reload_id']})
+        self.assertEqual(results['b.conf']['batch_size'], 3)
+        self.assertFalse(queue.running)
+
+    def test_window_coalesces_staggered_commits(self):
+        queue = HostOperationQueue('fake')
+        results = []
+        threads = [threading.Thread(target=lambda name=name: results.append(
+            queue.commit(self.transaction(name, f'{name}\n'), window=0.3))) for name in ('a.conf', 'b.conf')]
+        threads[0].start()
+        time.sleep(0.05)
+        threads[1].start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(self.client.reloads, 1)
+        self.assertEqual([result['batch_size'] for result in results], [2, 2])
+
+    def test_run_raises_in_the_submitting_thread(self):
+        queue = HostOperationQueue('fake')
+
+        def fail():
+            raise ValueError('boom')
+
+        with self.assertRaisesRegex(ValueError, 'boom'):
+            queue.run(fail)
+        self.assertFalse(queue.running)
+        self.assertEqual(queue.run(lambda: 42), 42)
+        self.assertTrue(queue.commit(self.transaction('a.conf', 'a1\n'))['success'])
+
+
+class ValidatorTestCase(SimpleTestCase):
+    def validate(self, file_path, content, validation_context=None, **edit):
+        return NginxConfigValidator(validation_context).validate(
+            [dict(edit, file_path=file_path, file_content=content)])
+
+    @staticmethod
+    def checks(issues):
+        return [issue['check'] for issue in issues]
+
+    def test_stream_include_uses_context_from_include_tree(self):
+        context = ValidationContext(file_contexts={'/etc/nginx/stream.d/db.conf': ('stream',)},
+                                    known_upstreams={('stream', 'db'): '/etc/nginx/stream.d/up.conf'},
+                                    analyzed=True)
+        result = self.validate('/etc/nginx/stream.d/db.conf', 'server { listen 3306; proxy_pass db; }', context)
+        self.assertEqual((result['errors'], result['warnings']), ([], []))
+
+    def test_explicit_context_overrides_guess(self):
+        result = self.validate('/etc/nginx/snippets/api.conf', 'location /api { proxy_pass http://10.0.0.1; }',
+                               context='server')
+        self.assertEqual(result['errors'], [])
+
+    def test_unknown_file_is_guessed_and_misplaced_directives_only_warn(self):
+        result = self.validate('/etc/nginx/stream.d/db.conf', 'server { listen 3306; proxy_pass 10.0.0.1:3306; }')
+        self.assertTrue(result['valid'])
+        self.assertEqual(result['warnings'], [])
+
+        result = self.validate('/etc/nginx/misc.conf', 'location / { }')
+        self.assertTrue(result['valid'])
+        self.assertIn('context', self.checks(result['warnings']))
+
+    def test_dangling_proxy_pass_is_an_error_only_with_analysis(self):
+        content = 'server { location / { proxy_pass http://backend; } }'
+        result = self.validate('/etc/nginx/conf.d/a.conf', content, ValidationContext())
+        self.assertTrue(result['valid'])
+        self.assertEqual(self.checks(result['warnings']), ['dangling_proxy_pass'])
+
+        result = self.validate('/etc/nginx/conf.d/a.conf', content, ValidationContext(analyzed=True))
+        self.assertEqual(self.checks(result['errors']), ['dangling_proxy_pass'])
+
+        result = self.validate('/etc/nginx/conf.d/a.conf', content,
+                               ValidationContext(analyzed=True, known_proxy_hosts={'backend'}))
+        self.assertTrue(result['valid'])
+
+    def test_duplicates_against_other_files_but_not_the_edited_one(self):
+        context = ValidationContext(known_upstreams={('http', 'app'): '/etc/nginx/conf.d/up.conf'},
+                                    known_server_names={('a.com', '80'): '/etc/nginx/conf.d/a.conf'},
+                                    analyzed=True)
+        result = self.validate('/etc/nginx/conf.d/b.conf',
+                               'upstream app { server 10.0.0.1; }\nserver { server_name a.com; }', context)
+        self.assertEqual(self.checks(result['errors']), ['duplicate_upstream', 'duplicate_server_name'])
+
+        result = self.validate('/etc/nginx/conf.d/a.conf', 'server { server_name a.com; }', context)
+        self.assertTrue(result['valid'])
+
+    def test_unknown_include_is_checked_against_loaded_files(self):
+        context = ValidationContext(known_files={'/etc/nginx/mime.types'}, analyzed=True)
+        result = self.validate('/etc/nginx/conf.d/a.conf',
+                               'include mime.types;\ninclude conf.d/missing.conf;\ninclude sites/*.conf;', context)
+        self.assertEqual([(issue['check'], issue['line']) for issue in result['errors']], [('unknown_include', 2)])
+
+        result = self.validate('/etc/nginx/conf.d/a.conf', 'include conf.d/missing.conf;', ValidationContext())
+        self.assertTrue(result['valid'])
+
+    def test_syntax_error_line_refers_to_original_file(self):
+        result = self.validate('/etc/nginx/conf.d/a.conf', 'server {\n    listen 80\n}\n')
+        self.assertEqual([(issue['check'], issue['line']) for issue in result['errors']], [('syntax', 2)])
+
+
+UPSTREAM_CONF = """# 应用后端
+upstream app {
+    server 10.0.0.1:8080 weight=2;  # 主
+    server 10.0.0.2:8080;
+    server 10.0.0.3:8080 backup;
+}
+
+upstream api { server 10.0.1.1:80; }
+"""
+
+
+class UpstreamEditorTestCase(SimpleTestCase):
+    def test_operations_only_touch_affected_statements(self):
+        editor = apply_operations(UPSTREAM_CONF, [
+            {'op': 'set_status', 'upstream': 'app', 'address': '10.0.0.1:8080', 'status': 'down'},
+            {'op': 'set_weight', 'upstream': 'app', 'address': '10.0.0.3:8080', 'weight': 5},
+            {'op': 'remove_server', 'upstream': 'app', 'address': '10.0.0.2:8080'},
+            {'op': 'add_server', 'upstream': 'app', 'address': '10.0.0.4:8080', 'params': ['max_fails=2']},
+            {'op': 'add_server', 'upstream': 'api', 'address': '10.0.1.2:80'},
+        ])
+        self.assertEqual(editor.render(), """# 应用后端
+upstream app {
+    server 10.0.0.1:8080 weight=2 down;  # 主
+    server 10.0.0.3:8080 weight=5 backup;
+    server 10.0.0.4:8080 max_fails=2;
+}
+
+upstream api { server 10.0.1.1:80; server 10.0.1.2:80; }
+""")
+        self.assertEqual([change['op'] for change in editor.changes],
+                         ['set_status', 'set_weight', 'remove_server', 'add_server', 'add_server'])
+        self.assertEqual((editor.changes[0]['old_status'], editor.changes[0]['new_status']), ('up', 'down'))
+
+    def test_unchanged_status_is_not_recorded(self):
+        editor = UpstreamEditor(UPSTREAM_CONF)
+        self.assertFalse(editor.set_status('app', '10.0.0.3:8080', 'backup'))
+        self.assertEqual((editor.changes, editor.render()), ([], UPSTREAM_CONF))
+
+    def test_set_matching_status_by_host(self):
+        content = 'upstream a { server 10.0.0.1:80; server 10.0.0.1:81; server 10.0.0.2:80; }\n'
+        editor = UpstreamEditor(content)
+        editor.set_matching_status('10.0.0.1', 'down')
+        self.assertEqual(editor.render(),
+                         'upstream a { server 10.0.0.1:80 down; server 10.0.0.1:81 down; server 10.0.0.2:80; }\n')
+
+    def test_add_upstream_after_last_block_or_to_file_without_upstreams(self):
+        editor = UpstreamEditor(UPSTREAM_CONF)
+        editor.add_upstream('db', [('10.0.2.1:5432', [])])
+        self.assertTrue(editor.render().endswith('upstream api { server 10.0.1.1:80; }\n\n'
+                                                 'upstream db {\n    server 10.0.2.1:5432;\n}\n'))
+
+        editor = UpstreamEditor('server { listen 80; }')
+        editor.add_upstream('db', [('10.0.2.1:5432', ['weight=2'])])
+        self.assertEqual(editor.render(), 'server { listen 80; }\nupstream db {\n    server 10.0.2.1:5432 weight=2;\n}\n')
+
+    def test_invalid_operations_raise(self):
+        editor = UpstreamEditor(UPSTREAM_CONF)
+        with self.assertRaises(UpstreamEditError):
+            editor.set_status('missing', '10.0.0.1:8080', 'down')
+        with self.assertRaises(UpstreamEditError):
+            editor.add_server('app', '10.0.0.1:8080')
+        with self.assertRaises(UpstreamEditError):
+            editor.add_upstream('app', [('10.0.0.9:80', [])])
+        with self.assertRaises(UpstreamEditError):
+            editor.remove_server('api', '10.0.0.1:8080')
+
+    def test_patch_matches_render_locally_and_remotely(self):
+        editor = apply_operations(UPSTREAM_CONF, [
+            {'op': 'set_status', 'upstream': 'app', 'address': '10.0.0.2:8080', 'status': 'down'},
+            {'op': 'add_server', 'upstream': 'api', 'address': '10.0.1.2:80'},
+        ])
+        patch = editor.patch()
+        expected = editor.render().encode('utf-8')
+        self.assertEqual(patch.apply(UPSTREAM_CONF.encode('utf-8')), expected)
+        self.assertLess(patch.bytes_out, len(expected))
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        file_path = os.path.join(root, 'upstream.conf')
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(UPSTREAM_CONF)
+        output = self.run_patch(patch, file_path, verify_checksum=True)
+        self.assertEqual(parse_patch_output(output)['status'], 'ok')
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(sorted(os.listdir(root)), ['upstream.conf'])
+
+    def test_patch_script_refuses_a_modified_file(self):
+        patch = apply_operations(UPSTREAM_CONF, [
+            {'op': 'set_status', 'upstream': 'app', 'address': '10.0.0.2:8080', 'status': 'down'}]).patch()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        file_path = os.path.join(root, 'upstream.conf')
+        # 大小不变、内容不同
+        modified = UPSTREAM_CONF.replace('10.0.0.2', '10.0.0.7')
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(modified)
+        with self.assertRaises(ValueError):
+            patch.apply(modified.encode('utf-8'))
+
+        output = self.run_patch(patch, file_path, expected_code=EXIT_STALE)
+        self.assertEqual(parse_patch_output(output)['status'], 'stale')
+        with open(file_path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), modified)
+
+    def run_patch(self, patch, file_path, expected_code=0, **kwargs):
+        directory = os.path.dirname(file_path)
+        patch_path = os.path.join(directory, '.upstream.conf.patch')
+        with open(patch_path, 'wb') as f:
+            f.write(patch.script(file_path, patch_path, os.path.join(directory, '.upstream.conf.tmp'), **kwargs))
+        result = subprocess.run(['sh', patch_path], capture_output=True, text=True)
+        self.assertEqual(result.returncode, expected_code, result.stderr)
+        self.assertFalse(os.path.exists(patch_path))
+        return result.stdout
+
+
+class ThreeWayMergeTestCase(SimpleTestCase):
+    BASE = 'a\nb\nc\nd\ne\n'
+
+    def test_non_overlapping_changes_merge_cleanly(self):
+        merged, conflicts = three_way_merge(self.BASE, 'A\nb\nc\nd\ne\n', 'a\nb\nc\nd\nE\n')
+        self.assertEqual((merged, conflicts), ('A\nb\nc\nd\nE\n', 0))
+
+    def test_identical_changes_are_not_conflicts(self):
+        merged, conflicts = three_way_merge(self.BASE, 'a\nB\nc\nd\ne\n', 'a\nB\nc\nd\ne\n')
+        self.assertEqual((merged, conflicts), ('a\nB\nc\nd\ne\n', 0))
+
+    def test_overlapping_changes_keep_both_sides_with_markers(self):
+        merged, conflicts = three_way_merge(self.BASE, 'a\nmine\nc\nd\ne\n', 'a\ntheirs\nc\nd\ne\n')
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, 'a\n<<<<<<< yours\nmine\n||||||| base\nb\n=======\ntheirs\n>>>>>>> current\n'
+                                 'c\nd\ne\n')
+
+    def test_inserts_at_the_same_position_conflict(self):
+        merged, conflicts = three_way_merge('a\n', 'a\nx\n', 'a\ny\n')
+        self.assertEqual(conflicts, 1)
+        self.assertIn('x\n', merged)
+        self.assertIn('y\n', merged)
+
+    def test_conflict_markers_stay_on_their_own_line(self):
+        merged, conflicts = three_way_merge('a\nb', 'a\nmine', 'a\ntheirs')
+        self.assertEqual(conflicts, 1)
+        self.assertIn('mine\n||||||| base\nb\n=======\ntheirs\n>>>>>>> current\n', merged)
+
+    def test_conflict_report_without_base_falls_back_to_two_way_diff(self):
+        report = conflict_report('/etc/nginx/a.conf', None, 'yours\n', 'theirs\n')
+        self.assertFalse(report['base_available'])
+        self.assertIsNone(report['merged'])
+        self.assertIn('current_to_yours', report['diff'])
+        self.assertEqual(report['current_sha256'], content_sha256('theirs\n'))
+
+        report = conflict_report('/etc/nginx/a.conf', self.BASE, 'A\nb\nc\nd\ne\n', 'a\nb\nc\nd\nE\n')
+        self.assertEqual((report['merged'], report['conflicts']), ('A\nb\nc\nd\nE\n', 0))
+
+    def test_snapshot_store_evicts_least_recently_used(self):
+        store = SnapshotStore(max_bytes=40)
+        first, second = store.put('x' * 10), store.put('y' * 10)
+        store.get(first)
+        for content in ('z' * 10, 'w' * 10, 'u' * 10):
+            store.put(content)
+        self.assertIsNotNone(store.get(first))
+        self.assertIsNone(store.get(second))
+        # 超过上限四分之一的内容不保存
+        self.assertIsNone(store.get(store.put('v' * 11)))
+
+
+class ReloadWindowApiTestCase(TestCase):
+    def setUp(self):
+        self.api = APIClient()
+        self.client_info = ClientInfo.objects.create(client_ip='10.0.0.1', client_port=8000)
+
+    def test_update_reload_window(self):
+        response = self.api.post('/api/clients/reload-window/',
+                                 {'client_ip': '10.0.0.1', 'reload_window_ms': 500}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['reload_window_ms'], 500)
+        self.client_info.refresh_from_db()
+        self.assertEqual(reload_window(self.client_info), 0.5)
+
+    def test_reject_out_of_range(self):
+        for value in (-1, 60001, 'soon'):
+            response = self.api.post('/api/clients/reload-window/',
+                                     {'client_ip': '10.0.0.1', 'reload_window_ms': value}, format='json')
+            self.assertEqual(response.status_code, 400)
+        self.client_info.refresh_from_db()
+        self.assertEqual(self.client_info.reload_window_ms, 0)
+
+    def test_unknown_client(self):
+        response = self.api.post('/api/clients/reload-window/',
+                                 {'client_ip': '10.0.0.2', 'reload_window_ms': 100}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_register_keeps_window_unless_given(self):
+        registration = {'client_ip': '10.0.0.1', 'client_port': 8000, 'username': 'root'}
+        self.api.post('/api/clients/register/', dict(registration, reload_window_ms=200), format='json')
+        self.client_info.refresh_from_db()
+        self.assertEqual(self.client_info.reload_window_ms, 200)
+
+        self.api.post('/api/clients/register/', registration, format='json')
+        self.client_info.refresh_from_db()
+        self.assertEqual(self.client_info.reload_window_ms, 200)
+
+        response = self.api.post('/api/clients/register/', dict(registration, reload_window_ms=70000),
+                                 format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class LogFormatTestCase(SimpleTestCase):
+    COMBINED = '10.0.0.9 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 200 612 "-" "curl/8.0"'
+
+    def test_combined_time_local(self):
+        parsed = LogFormat(LOG_FORMAT_COMBINED).parse(self.COMBINED)
+        self.assertEqual(parsed, (971211300, '-', '-', 200, 612, None))
+
+    def test_msec(self):
+        parsed = LogFormat('$msec $status $body_bytes_sent').parse('971211336.123 404 0')
+        self.assertEqual(parsed, (971211300, '-', '-', 404, 0, None))
+
+    def test_retried_request_with_quoted_lists(self):
+        line = (self.COMBINED + ' example.com "-" "10.0.0.1:80, 10.0.0.2:80" "502, 200" "0.010, 0.020" 0.031')
+        parsed = LogFormat(LOG_FORMAT_UPSTREAM).parse(line)
+        self.assertEqual(parsed[1:4], ('example.com', '10.0.0.2:80', 200))
+        self.assertAlmostEqual(parsed[5], 0.03)
+
+    def test_retried_request_with_unquoted_lists(self):
+        log_format = (LOG_FORMAT_COMBINED + ' $host "$proxy_host" "$upstream_addr" $upstream_status '
+                      '$upstream_response_time $request_time')
+        line = self.COMBINED + ' example.com "app" "10.0.0.1:80, 10.0.0.2:80" 502, 200 0.010, 0.020 0.031'
+        parsed = LogFormat(log_format).parse(line)
+        self.assertEqual(parsed[1:4], ('example.com', 'app', 200))
+        self.assertAlmostEqual(parsed[5], 0.03)
+
+    def test_internal_redirect_list(self):
+        log_format = '$msec $status $body_bytes_sent $upstream_addr $upstream_response_time $request_time'
+        parsed = LogFormat(log_format).parse('971211336.1 200 10 10.0.0.1:80 : 10.0.0.3:80 0.010 : 0.005 0.02')
+        self.assertEqual(parsed[2], '10.0.0.3:80')
+        self.assertAlmostEqual(parsed[5], 0.015)
+
+    def test_unmatched_line(self):
+        self.assertIsNone(LogFormat(LOG_FORMAT_COMBINED).parse('garbage'))
+
+
+class AccessLogTailTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.client = FakeNginxClient(self.root)
+        self.path = os.path.join(self.root, 'access.log')
+
+    def append(self, data, path=None):
+        with open(path or self.path, 'ab') as f:
+            f.write(data)
+
+    def tail(self, position, max_bytes=1024):
+        tail = AccessLogTail(self.client, self.path, *position, max_bytes=max_bytes)
+        lines = [line for line, _ in tail]
+        return lines, (tail.inode, tail.offset), tail
+
+    def test_first_read_starts_at_end_and_keeps_partial_line(self):
+        self.append(b'old\n')
+        lines, position, _ = self.tail((None, 0))
+        self.assertEqual((lines, position[1]), ([], 4))
+
+        self.append(b'a\nb\npart')
+        lines, position, tail = self.tail(position)
+        self.assertEqual(lines, ['a', 'b'])
+        self.assertEqual(position[1], 8)
+        self.assertTrue(tail.result['success'])
+
+        self.append(b'ial\n')
+        lines, position, _ = self.tail(position)
+        self.assertEqual((lines, position[1]), (['partial'], 16))
+
+    def test_rotated_file_is_finished_before_the_new_one(self):
+        self.append(b'a\n')
+        _, position, _ = self.tail((None, 0))
+        self.append(b'b\nlast')
+        os.rename(self.path, self.path + '.1')
+        self.append(b'c\n')
+
+        lines, new_position, tail = self.tail(position)
+
+        self.assertEqual(lines, ['b', 'last', 'c'])
+        self.assertTrue(tail.rotated)
+        self.assertEqual(new_position, (os.stat(self.path).st_ino, 2))
+
+    def test_rotated_frame_beyond_limit_stays_on_old_file(self):
+        self.append(b'a\n')
+        _, position, _ = self.tail((None, 0))
+        self.append(b'bbbb\ncccc\n')
+        old_inode = position[0]
+        os.rename(self.path, self.path + '.1')
+        self.append(b'new\n')
+
+        lines, position, _ = self.tail(position, max_bytes=5)
+        self.assertEqual((lines, position), (['bbbb'], (old_inode, 7)))
+
+        lines, position, _ = self.tail(position, max_bytes=64)
+        self.assertEqual(lines, ['cccc', 'new'])
+        self.assertEqual(position, (os.stat(self.path).st_ino, 4))
+
+    def test_truncated_file_is_read_from_start(self):
+        self.append(b'a\n')
+        _, position, _ = self.tail((None, 0))
+        self.append(b'bbbbbbbb\n')
+        _, position, _ = self.tail(position)
+        with open(self.path, 'wb') as f:
+            f.write(b'x\n')
+
+        lines, position, _ = self.tail(position)
+        self.assertEqual((lines, position[1]), (['x'], 2))
+
+
+VALID_CONF = r"""user nginx;
+events { worker_connections 1024; }
+http {
+    log_format main '$remote_addr "$request"' "x\"y";
+    map $http_upgrade $connection_upgrade {
+        default upgrade;
+        '' close;
+    }
+    server {
+        listen 80;
+        server_name example.com "*.example.org";
+        location ~ ^/api/(.*)$ {
+            if ($request_method = POST) { return 405; }
+            if ( $http_x = "a b" ) {
+                set $x "y z";
+            }
+            location /api/inner { proxy_pass http://app; }
+        }
+        location / { try_files $uri $uri/ =404; }  # comment
+    }
+}
+stream {
+    upstream dns { server 10.0.0.1:53; }
+    server { listen 53 udp; proxy_pass dns; }
+}
+"""
+
+
+class FallbackParserTestCase(SimpleTestCase):
+    def crossplane_parse(self, content):
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+        payload = crossplane.parse(f.name, single=True, check_ctx=False, check_args=False, comments=False)
+        self.assertEqual(payload['errors'], [])
+        return payload['config'][0]['parsed']
+
+    def parse(self, content):
+        result = parse_config(content, 'x.conf')
+        return result['parsed'], [(error['line'], error['error']) for error in result['errors']]
+
+    def test_valid_config_matches_crossplane(self):
+        parsed, errors = self.parse(VALID_CONF)
+        self.assertEqual(errors, [])
+        self.assertEqual(parsed, self.crossplane_parse(VALID_CONF))
+
+    def test_status(self):
+        self.assertEqual(parse_config('events {}\n')['status'], 'ok')
+        self.assertEqual(parse_config('events {\n')['status'], 'failed')
+
+    def test_missing_close_brace_before_sibling_block(self):
+        parsed, errors = self.parse('http {\n    server {\n        listen 80;\n\n    server {\n        listen 81;\n'
+                                    '    }\n}\nstream {\n    server { listen 53; }\n}\n')
+
+        self.assertEqual(errors, [(5, '"server" block opened on line 2 is not closed before "server"')])
+        http, stream = parsed
+        self.assertEqual([(server['line'], server['block'][0]['args']) for server in http['block']],
+                         [(2, ['80']), (5, ['81'])])
+        self.assertEqual((stream['directive'], stream['line']), ('stream', 9))
+
+    def test_missing_close_brace_at_end_of_file(self):
+        parsed, errors = self.parse('http {\n    server {\n        listen 80;\n')
+
+        self.assertEqual(errors, [(2, 'unexpected end of file, "server" block opened on line 2 is not closed'),
+                                  (1, 'unexpected end of file, "http" block opened on line 1 is not closed')])
+        self.assertEqual(parsed[0]['block'][0]['block'], [{'directive': 'listen', 'line': 3, 'args': ['80']}])
+
+    def test_unterminated_quote_ends_at_line_end(self):
+        parsed, errors = self.parse('server {\n    server_name "broken;\n    listen 80;\n    root \'/srv;\n}\n')
+
+        self.assertEqual(errors, [(2, 'unterminated " quote'), (4, "unterminated ' quote")])
+        self.assertEqual([(directive['directive'], directive['line'], directive['args'])
+                          for directive in parsed[0]['block']],
+                         [('server_name', 2, ['broken;']), ('listen', 3, ['80']), ('root', 4, ['/srv;'])])
+
+    def test_stray_semicolon_and_missing_semicolon(self):
+        parsed, errors = self.parse('http {\n    ;\n    server { listen 80;; }\n    server { listen 81 }\n}\n')
+
+        self.assertEqual(errors, [(2, 'unexpected ";"'), (3, 'unexpected ";"'), (4, 'unexpected "}", expecting ";"')])
+        self.assertEqual([(server['line'], server['block']) for server in parsed[0]['block']],
+                         [(3, [{'directive': 'listen', 'line': 3, 'args': ['80']}]),
+                          (4, [{'directive': 'listen', 'line': 4, 'args': ['81']}])])
+
+    def test_unexpected_braces(self):
+        parsed, errors = self.parse('}\nevents {\n    { worker_connections 1; }\n}\n')
+
+        self.assertEqual(errors, [(1, 'unexpected "}"'), (3, 'unexpected "{"')])
+        self.assertEqual(parsed, [{'directive': 'events', 'line': 2, 'args': [], 'block': []}])
+
+
+class IncludeResolverTestCase(SimpleTestCase):
+    MAIN = '/etc/nginx/nginx.conf'
+
+    def setUp(self):
+        self.files = {
+            self.MAIN: 'events {}\nhttp {\n    include mime.types;\n    include conf.d/*.conf;\n'
+                       '    include sites-*/*.conf;\n    include missing.conf;\n    include none/*.conf;\n}\n'
+                       'stream {\n    include /opt/stream/*.conf;\n}\n',
+            '/etc/nginx/mime.types': 'types { text/html html; }\n',
+            '/etc/nginx/conf.d/b.conf': 'server {\n    include snippets/proxy.conf;\n}\n',
+            '/etc/nginx/conf.d/a.conf': 'upstream app { server 10.0.0.1; }\n',
+            '/etc/nginx/conf.d/.hidden.conf': 'server { listen 1; }\n',
+            '/etc/nginx/conf.d/notes.txt': '',
+            '/etc/nginx/sites-enabled/site.conf': 'server { location / { include snippets/proxy.conf; } }\n',
+            '/etc/nginx/sites-available/unused.conf': 'server { listen 2; }\n',
+            '/etc/nginx/snippets/proxy.conf': 'proxy_set_header Host $host;\n',
+            '/opt/stream/dns.conf': 'server { listen 53 udp; }\n',
+        }
+        self.listed_roots = []
+
+    def list_files(self, root):
+        self.listed_roots.append(root)
+        return [path for path in self.files if path.startswith(root + '/')]
+
+    def resolve(self):
+        listing = RemoteFileListing([path for path in self.files if path.startswith('/etc/nginx/')],
+                                    roots=['/etc/nginx'])
+        resolver = IncludeResolver(self.MAIN, listing, list_files=self.list_files)
+        return resolver.resolve(lambda path: parse_config(self.files[path], path)['parsed']
+                                if path in self.files else None)
+
+    def test_load_order_globs_and_hidden_files(self):
+        result = self.resolve()
+
+        self.assertEqual(result.files, [
+            self.MAIN,
+            '/etc/nginx/mime.types',
+            '/etc/nginx/conf.d/a.conf',
+            '/etc/nginx/conf.d/b.conf',
+            '/etc/nginx/snippets/proxy.conf',
+            '/etc/nginx/sites-available/unused.conf',
+            '/etc/nginx/sites-enabled/site.conf',
+            '/opt/stream/dns.conf',
+        ])
+
+    def test_contexts_follow_the_first_include(self):
+        contexts = self.resolve().contexts
+
+        self.assertEqual(contexts['/etc/nginx/snippets/proxy.conf'], ('http', 'server'))
+        self.assertEqual(contexts['/etc/nginx/conf.d/a.conf'], ('http',))
+        self.assertEqual(contexts['/opt/stream/dns.conf'], ('stream',))
+
+    def test_nested_include_is_recorded_for_each_occurrence(self):
+        includes = [(file_path, line, context) for file_path, line, pattern, context, _ in self.resolve().includes
+                    if pattern == 'snippets/proxy.conf']
+
+        self.assertEqual(includes, [('/etc/nginx/conf.d/b.conf', 2, ('http', 'server')),
+                                    ('/etc/nginx/sites-enabled/site.conf', 1, ('http', 'server', 'location'))])
+
+    def test_missing_only_reports_plain_paths(self):
+        self.assertEqual(self.resolve().missing, [(self.MAIN, 6, 'missing.conf')])
+
+    def test_supplementary_listing_outside_roots_is_fetched_once(self):
+        self.files[self.MAIN] += 'include /opt/stream/dns.conf;\n'
+        self.resolve()
+
+        self.assertEqual(self.listed_roots, ['/opt/stream'])
+
+    def test_cycle_is_reported_and_skipped(self):
+        self.files['/etc/nginx/snippets/proxy.conf'] = 'include /etc/nginx/conf.d/b.conf;\n'
+        result = self.resolve()
+
+        self.assertEqual(result.cycles, [['/etc/nginx/conf.d/b.conf', '/etc/nginx/snippets/proxy.conf',
+                                          '/etc/nginx/conf.d/b.conf']])
+        self.assertEqual(result.files.count('/etc/nginx/conf.d/b.conf'), 1)
+
+    def test_listing_expand(self):
+        listing = RemoteFileListing(['/a/x/1.conf', '/a/y/2.conf', '/a/.z/3.conf', '/a/x/.4.conf'])
+
+        self.assertEqual(listing.expand('/a/*/*.conf'), ['/a/x/1.conf', '/a/y/2.conf'])
+        self.assertEqual(listing.expand('/a/.*/*.conf'), ['/a/.z/3.conf'])
+        self.assertEqual(listing.expand('/a/x/.*'), ['/a/x/.4.conf'])
+        self.assertEqual(listing.expand('/a/x/1.conf'), ['/a/x/1.conf'])
+        self.assertEqual(listing.expand('/b/*.conf'), [])
+
+
+class RemoteCommandStreamTestCase(SimpleTestCase):
+    def run_stream(self, command, max_output_bytes, chunk_size=None):
+        stream = RemoteCommandStream(FakeChannel(command), max_output_bytes=max_output_bytes)
+        if chunk_size:
+            stream.CHUNK_SIZE = chunk_size
+        output = b''
+        for name, data in stream.iter_chunks():
+            if name == 'stderr':
+                stream.stderr_chunks.append(data)
+            else:
+                output += data
+        return output, stream.result(output)
+
+    def test_output_exactly_at_limit_is_not_truncated(self):
+        output, result = self.run_stream('printf abcd', 4)
+        self.assertEqual(output, b'abcd')
+        self.assertFalse(result['truncated'])
+        self.assertTrue(result['success'])
+
+    def test_output_over_limit_is_truncated(self):
+        output, result = self.run_stream('printf abcde', 4)
+        self.assertEqual(output, b'abcd')
+        self.assertTrue(result['truncated'])
+        self.assertFalse(result['success'])
+
+    def test_more_output_after_filling_the_limit_is_truncated(self):
+        output, result = self.run_stream('printf abcdef', 4, chunk_size=4)
+        self.assertEqual(output, b'abcd')
+        self.assertTrue(result['truncated'])
+
+    def test_stderr_counts_towards_the_limit(self):
+        output, result = self.run_stream('printf ab; printf cd >&2', 4)
+        self.assertEqual(output, b'ab')
+        self.assertFalse(result['truncated'])
+        self.assertEqual(result['error'], 'cd')
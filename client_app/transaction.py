@@ -0,0 +1,280 @@
+import shlex
+import uuid
+import logging
+
+from .merge import content_sha256
+from .patch import EXIT_STALE, compare_and_rename_command
+
+logger = logging.getLogger(__name__)
+
+
+class StaleFileError(Exception):
+    """补丁的原内容与远程文件不符，文件在读取之后已被修改"""
+
+
+class NginxConfigTransaction:
+    """
+    多文件配置事务
+
+    对同一台主机的N个文件修改统一备份、写入，只执行一次nginx -t和一次reload，
+    任一步骤失败时所有文件一起回滚到事务开始前的状态；
+    prepare、check、apply_reload、finish、fail也可以由主机操作队列分别调用，让多个事务共用一次nginx -t和reload
+    """
+
+    def __init__(self, client, edits, nginx_path=None, fsync=False, verify_checksum=False,
+                 reload=True, keep_backups=False):
+        self.client = client
+        # edits: [{'file_path': ..., 'file_content': ...}, ...]；带patch（ConfigPatch）的修改只传输补丁，
+        # 带base_sha256的修改只在远程文件仍是该版本时写入
+        self.edits = list(edits)
+        # 未指定时由客户端使用探测到的主配置路径
+        self.nginx_path = nginx_path
+        self.fsync = fsync
+        self.verify_checksum = verify_checksum
+        self.reload = reload
+        # 提交后保留备份，之后可以用revert撤销（例如灰度发布的健康检查未通过）
+        self.keep_backups = keep_backups
+        self.tx_id = uuid.uuid4().hex[:12]
+        self.backups = {}  # file_path -> 备份路径，新建文件为None
+        self.written_files = []
+        self.written_sha256 = {}  # file_path -> 写入内容的sha256，revert时据此判断文件是否又被他人修改
+        self.stale_files = []
+        self.staged = False
+
+    def _backup_path(self, file_path):
+        return f'{file_path}.backup-{self.tx_id}'
+
+    def stage(self):
+        """一次远程命令备份所有待修改文件，并记录哪些文件是新建的"""
+        file_paths = [edit['file_path'] for edit in self.edits]
+        if len(set(file_paths)) != len(file_paths):
+            raise ValueError('同一事务中存在重复的文件路径')
+
+        commands = []
+        for index, file_path in enumerate(file_paths):
+            path = shlex.quote(file_path)
+            backup = shlex.quote(self._backup_path(file_path))
+            commands.append(
+                f'if [ -f {path} ]; then cp -p {path} {backup} && echo "E:{index}"; '
+                f'else mkdir -p "$(dirname {path})" && echo "N:{index}"; fi'
+            )
+        if not commands:
+            # 不修改文件的事务（只检查并重载）
+            self.staged = True
+            return
+        result = self.client.execute_command(' && '.join(commands))
+        if not result['success']:
+            raise Exception(f'文件备份失败: {result.get("error", "")}')
+
+        existing = {line[2:] for line in result['output'].split() if line.startswith('E:')}
+        for index, file_path in enumerate(file_paths):
+            self.backups[file_path] = self._backup_path(file_path) if str(index) in existing else None
+        self.staged = True
+
+    def write_all(self):
+        """通过复用的SFTP通道原子写入所有文件，带补丁的文件只传输补丁"""
+        for edit in self.edits:
+            if edit.get('patch') is not None:
+                write_result = self.client.apply_config_patch(edit['file_path'], edit['patch'],
+                                                              content=edit.get('file_content'), fsync=self.fsync,
+                                                              verify_checksum=self.verify_checksum)
+            else:
+                write_result = self.client.write_config_file(edit['file_path'], edit['file_content'],
+                                                             fsync=self.fsync, verify_checksum=self.verify_checksum,
+                                                             base_sha256=edit.get('base_sha256'))
+            if write_result.get('stale'):
+                self.stale_files.append(edit['file_path'])
+                raise StaleFileError(write_result['error'])
+            if not write_result['success']:
+                raise Exception(f'{edit["file_path"]}: {write_result["error"]}')
+            self.written_files.append(edit['file_path'])
+            self.written_sha256[edit['file_path']] = self._written_sha256(edit)
+
+    @staticmethod
+    def _written_sha256(edit):
+        patch = edit.get('patch')
+        if patch is not None and patch.new_sha256:
+            return patch.new_sha256
+        if edit.get('file_content') is not None:
+            return content_sha256(edit['file_content'])
+        return None
+
+    def rollback(self):
+        """
+        一次远程命令恢复已写入文件的备份，删除事务中新建的文件
+
+        没有写入的文件（包括因已被他人修改而拒绝写入的文件）只删除备份，不用备份覆盖，
+        以免冲掉别人在备份之后的修改
+        """
+        if not self.staged:
+            return {'success': True}
+        commands = []
+        written = set(self.written_files)
+        for file_path, backup_path in self.backups.items():
+            if file_path not in written:
+                if backup_path:
+                    commands.append(f'rm -f {shlex.quote(backup_path)}')
+            elif backup_path:
+                commands.append(f'mv -f {shlex.quote(backup_path)} {shlex.quote(file_path)}')
+            else:
+                commands.append(f'rm -f {shlex.quote(file_path)}')
+        if not commands:
+            self.staged = False
+            return {'success': True}
+        result = self.client.execute_command('; '.join(commands))
+        if not result['success']:
+            logger.error(f"事务 {self.tx_id} 回滚失败: {result.get('error', '')}")
+        self.client.forget_config_files(list(self.backups))
+        self.staged = False
+        return result
+
+    def cleanup(self):
+        """提交成功后删除备份文件"""
+        backup_paths = [shlex.quote(path) for path in self.backups.values() if path]
+        if backup_paths:
+            self.client.execute_command(f'rm -f {" ".join(backup_paths)}')
+        self.staged = False
+
+    def _reload_after_rollback(self):
+        """回滚后重新检查并重载，让运行中的nginx与回滚后的文件一致"""
+        check_result = self.client.check_nginx_config(self.nginx_path)
+        if check_result['success']:
+            return self.client.reload_nginx()
+        return check_result
+
+    def new_result(self):
+        return {
+            'success': False,
+            'tx_id': self.tx_id,
+            'stage': 'backup',
+            'files': [edit['file_path'] for edit in self.edits],
+            'check_result': None,
+            'reload_result': None,
+            'rolled_back': False,
+            'stale': False,
+            'stale_files': self.stale_files,
+            'error': ''
+        }
+
+    def prepare(self, result):
+        """备份并写入所有文件，失败时抛出异常，由fail回滚"""
+        result['stage'] = 'backup'
+        self.stage()
+        result['stage'] = 'write'
+        self.write_all()
+
+    def check(self, result):
+        result['stage'] = 'check'
+        check_result = self.client.check_nginx_config(self.nginx_path)
+        result['check_result'] = check_result
+        if not check_result['success']:
+            raise Exception(f'Nginx配置检查失败: {check_result.get("error", "")}')
+
+    def apply_reload(self, result):
+        result['stage'] = 'reload'
+        reload_result = self.client.reload_nginx()
+        result['reload_result'] = reload_result
+        if not reload_result['success']:
+            raise Exception(f'Nginx重载失败: {reload_result.get("error", "")}')
+
+    def finish(self, result, keep_backups=False):
+        result['stage'] = 'done'
+        result['success'] = True
+        if not (keep_backups or self.keep_backups):
+            self.cleanup()
+        return result
+
+    def revert(self):
+        """
+        撤销已提交且保留了备份的事务：恢复写入过的文件、删除新建的文件，再检查并重载
+
+        提交之后文件可能又被他人修改，每个文件只在内容仍是本事务写入的版本时才恢复（比较sha256后rename），
+        否则保留他人的版本、删除备份，记入conflicts；没有任何文件被恢复时不重载
+
+        返回:
+            dict: success、rollback_result、reload_result（检查失败时为检查结果，未重载时为None）、
+            conflicts（因已被他人修改而没有恢复的文件）
+        """
+        commands = []
+        targets = []
+        written = set(self.written_files)
+        for file_path, backup_path in self.backups.items():
+            if file_path not in written:
+                if backup_path:
+                    commands.append(f'rm -f {shlex.quote(backup_path)}')
+                continue
+            expected = self.written_sha256.get(file_path) or ''
+            if backup_path:
+                command = compare_and_rename_command(file_path, backup_path, expected)
+            else:
+                path = shlex.quote(file_path)
+                command = (f'cur=""; if [ -e {path} ]; then cur=$(sha256sum {path} | cut -d" " -f1) || exit 1; fi; '
+                           f'[ "$cur" = {shlex.quote(expected)} ] || exit {EXIT_STALE}; rm -f {path}')
+            # 每个文件在子shell中执行，逐个输出退出码，一个文件冲突不影响其他文件
+            commands.append(f'( {command} ) >/dev/null; echo "R:{len(targets)}:$?"')
+            targets.append(file_path)
+
+        conflicts, failed = [], []
+        rollback_result = {'success': True}
+        if commands:
+            rollback_result = self.client.execute_command('; '.join(commands))
+            codes = {}
+            for line in rollback_result.get('output', '').split():
+                if line.startswith('R:'):
+                    index, _, code = line[2:].partition(':')
+                    codes[int(index)] = code
+            for index, file_path in enumerate(targets):
+                code = codes.get(index)
+                if code == str(EXIT_STALE):
+                    conflicts.append(file_path)
+                elif code != '0':
+                    failed.append(file_path)
+            if failed:
+                rollback_result = dict(rollback_result, success=False,
+                                       error=rollback_result.get('error') or f'恢复失败: {", ".join(failed)}')
+            if conflicts:
+                logger.warning(f"事务 {self.tx_id} 撤销时以下文件已被他人修改，保留当前版本: {', '.join(conflicts)}")
+            self.client.forget_config_files(list(self.backups))
+        self.staged = False
+
+        reload_result = None
+        if len(conflicts) < len(targets):
+            reload_result = self._reload_after_rollback()
+        success = rollback_result.get('success', False) and not conflicts \
+            and (reload_result is None or reload_result.get('success', False))
+        return {
+            'success': success,
+            'rollback_result': rollback_result,
+            'reload_result': reload_result,
+            'conflicts': conflicts,
+        }
+
+    def fail(self, result, error, reload_after_rollback=True):
+        """记录失败原因并回滚；reload阶段失败时nginx可能处于中间状态，回滚后再重载一次"""
+        logger.error(f"配置事务 {self.tx_id} 在 {result['stage']} 阶段失败: {error}")
+        result['error'] = str(error)
+        result['stale'] = isinstance(error, StaleFileError)
+        if self.staged:
+            rollback_result = self.rollback()
+            result['rolled_back'] = rollback_result.get('success', False)
+            if reload_after_rollback and result['stage'] == 'reload' and self.edits:
+                self._reload_after_rollback()
+        return result
+
+    def commit(self, keep_backups=False):
+        """
+        执行事务：备份 -> 写入 -> nginx -t -> reload
+
+        返回:
+            dict: success、失败阶段stage、各阶段结果以及是否已回滚；stale为True表示文件在读取之后已被他人修改，
+            修改没有写入，stale_files为这些文件
+        """
+        result = self.new_result()
+        try:
+            self.prepare(result)
+            self.check(result)
+            if self.reload:
+                self.apply_reload(result)
+            return self.finish(result, keep_backups)
+        except Exception as e:
+            return self.fail(result, e)
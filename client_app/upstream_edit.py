@@ -0,0 +1,448 @@
+from .fallback_parser import scan
+from .patch import MAX_PATCH_HUNKS, ConfigPatch
+from .routing import address_host
+
+STATUS_PARAMS = ('down', 'backup')
+
+
+class ServerStatement:
+    """
+    upstream块中的一条server指令在原文中的位置
+
+    start、end为从server到分号（含）的偏移；params保留参数原文（包括引号），
+    未修改的参数写回时与原文完全一致
+    """
+
+    __slots__ = ('upstream', 'address', 'params', 'start', 'end', 'line')
+
+    def __init__(self, upstream, address, params, start, end, line):
+        self.upstream = upstream
+        self.address = address
+        self.params = params
+        self.start = start
+        self.end = end
+        self.line = line
+
+    @property
+    def status(self):
+        return _params_status(self.params)
+
+    def render(self, params=None):
+        return _render_server(self.address, self.params if params is None else params)
+
+    def __repr__(self):
+        return f'ServerStatement({self.upstream!r}, {self.address!r}, line={self.line})'
+
+
+class UpstreamBlock:
+    """
+    一个upstream块在原文中的位置
+
+    start为upstream关键字的偏移，close为右花括号的偏移；indent为upstream所在行的缩进
+    """
+
+    __slots__ = ('name', 'context', 'start', 'close', 'line', 'indent', 'servers')
+
+    def __init__(self, name, context, start, line, indent):
+        self.name = name
+        self.context = context
+        self.start = start
+        self.close = None
+        self.line = line
+        self.indent = indent
+        self.servers = []
+
+    def __repr__(self):
+        return f'UpstreamBlock({self.name!r}, servers={len(self.servers)}, line={self.line})'
+
+
+def _line_start(content, offset):
+    return content.rfind('\n', 0, offset) + 1
+
+
+def _indent(content, offset):
+    """offset所在行开头的空白"""
+    start = _line_start(content, offset)
+    prefix = content[start:offset]
+    return prefix[:len(prefix) - len(prefix.lstrip())]
+
+
+def find_upstreams(content):
+    """
+    扫描配置文本中的upstream块及其server指令
+
+    返回:
+        list: UpstreamBlock，按在文件中的顺序；没有闭合的块不返回
+    """
+    blocks = []
+    stack = []  # 每层块的 (指令名, 第一个参数, UpstreamBlock或None)
+    words = []  # 当前指令的 (原文, 起始偏移, 行号)
+    line = 1
+    for kind, text, start, end in scan(content):
+        if kind == 'space':
+            line += text.count('\n')
+            continue
+        if kind == 'comment':
+            continue
+        if kind == 'special':
+            if text == '{':
+                name = words[0][0] if words else None
+                argument = words[1][0] if len(words) > 1 else None
+                block = None
+                if name == 'upstream' and argument is not None:
+                    context = stack[-1][0] if stack else None
+                    block = UpstreamBlock(argument, context, words[0][1], words[0][2],
+                                          _indent(content, words[0][1]))
+                stack.append((name, argument, block))
+            elif text == '}':
+                if stack:
+                    block = stack.pop()[2]
+                    if block is not None:
+                        block.close = start
+                        blocks.append(block)
+            elif stack and stack[-1][2] is not None and len(words) >= 2 and words[0][0] == 'server':
+                block = stack[-1][2]
+                block.servers.append(ServerStatement(block.name, words[1][0], [word[0] for word in words[2:]],
+                                                     words[0][1], end, words[0][2]))
+            words = []
+            continue
+        words.append((text, start, line))
+        line += text.count('\n')
+    blocks.sort(key=lambda block: block.start)
+    return blocks
+
+
+def find_upstream_servers(content):
+    """
+    扫描配置文本中所有upstream块的server指令
+
+    返回:
+        list: ServerStatement，按在文件中的顺序
+    """
+    return [statement for block in find_upstreams(content) for statement in block.servers]
+
+
+def address_matches(address, target):
+    """target为ip:port时精确匹配，为不带端口的主机时匹配该主机的所有端口"""
+    address = address.strip('"\'')
+    if address == target:
+        return True
+    return address_host(target) == target and address_host(address) == target
+
+
+def apply_replacements(content, replacements):
+    """
+    按偏移替换原文片段
+
+    参数:
+        replacements: [(start, end, 新文本), ...]，区间不能重叠
+    """
+    parts = []
+    position = 0
+    for start, end, text in sorted(replacements):
+        parts.append(content[position:start])
+        parts.append(text)
+        position = end
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+class UpstreamEditError(ValueError):
+    """编辑操作与文件内容不符：upstream或server不存在、重复添加等"""
+
+
+def _params_status(params):
+    for param in STATUS_PARAMS:
+        if param in params:
+            return param
+    return 'up'
+
+
+class UpstreamEditor:
+    """
+    在原文上对upstream做结构化修改
+
+    操作先记录在解析出的块和server指令上，最后只对受影响的区间生成替换：修改参数时替换该条server指令，
+    删除时去掉它所在的行，添加server插在右花括号所在行之前，新upstream放在文件中最后一个upstream之后；
+    其余文本（注释、缩进、空行）保持原样
+
+    用法:
+        editor = UpstreamEditor(content)
+        editor.set_status('app', '10.0.0.1:8080', 'down')
+        editor.add_server('app', '10.0.0.9:8080', ['weight=2'])
+        new_content = editor.render()
+    """
+
+    OPERATIONS = ('set_status', 'set_weight', 'add_server', 'remove_server', 'add_upstream')
+
+    def __init__(self, content):
+        self.content = content
+        self.blocks = find_upstreams(content)
+        self.params = {}  # statement.start -> 修改后的参数
+        self.removed = set()  # 被删除的statement.start
+        self.added = {}  # block.start -> [(地址, 参数)]
+        self.appended = []  # [(upstream名称, [(地址, 参数)])]
+        self.changes = []
+
+    # ---- 查找 ----
+
+    def block(self, upstream):
+        matches = [block for block in self.blocks if block.name == upstream]
+        if not matches:
+            raise UpstreamEditError(f'upstream {upstream} 不存在')
+        if len(matches) > 1:
+            raise UpstreamEditError(f'upstream {upstream} 在文件中定义了{len(matches)}次')
+        return matches[0]
+
+    def server(self, upstream, address):
+        block = self.block(upstream)
+        for statement in block.servers:
+            if statement.start not in self.removed and statement.address.strip('"\'') == address:
+                return block, statement
+        raise UpstreamEditError(f'upstream {upstream} 中没有server {address}')
+
+    def _current(self, statement):
+        return self.params.get(statement.start, statement.params)
+
+    def _record(self, op, upstream, address, line, old, new, **extra):
+        self.changes.append(dict({'op': op, 'upstream': upstream, 'address': address, 'line': line,
+                                  'old': old, 'new': new}, **extra))
+
+    # ---- 操作 ----
+
+    def _set_params(self, op, statement, params, **extra):
+        old = statement.render(self._current(statement)) if statement.start in self.params \
+            else self.content[statement.start:statement.end]
+        self.params[statement.start] = params
+        self._record(op, statement.upstream, statement.address, statement.line, old, statement.render(params),
+                     **extra)
+
+    def _set_status(self, statement, status):
+        params = self._current(statement)
+        old_status = _params_status(params)
+        if old_status == status:
+            return False
+        params = [param for param in params if param not in STATUS_PARAMS]
+        if status != 'up':
+            params.append(status)
+        self._set_params('set_status', statement, params, old_status=old_status, new_status=status)
+        return True
+
+    def set_status(self, upstream, address, status):
+        """设置server状态（up、down、backup），状态已经一致时不修改，返回是否修改"""
+        if status not in ('up',) + STATUS_PARAMS:
+            raise UpstreamEditError(f'无效的状态: {status}')
+        return self._set_status(self.server(upstream, address)[1], status)
+
+    def set_matching_status(self, address, status, upstreams=None):
+        """
+        修改所有upstream中与address匹配的server状态
+
+        参数:
+            address: ip:port，或不带端口的ip（匹配该主机的所有端口）
+            upstreams: 只修改这些upstream（可选）
+        """
+        for block in self.blocks:
+            if upstreams and block.name not in upstreams:
+                continue
+            for statement in block.servers:
+                if statement.start not in self.removed and address_matches(statement.address, address):
+                    self._set_status(statement, status)
+        return self.changes
+
+    def set_weight(self, upstream, address, weight):
+        """设置server的weight参数，替换已有的weight，没有时插在状态参数之前"""
+        weight = int(weight)
+        if weight < 1:
+            raise UpstreamEditError(f'weight必须大于0: {weight}')
+        statement = self.server(upstream, address)[1]
+        params = self._current(statement)
+        new_param = f'weight={weight}'
+        if new_param in params:
+            return False
+        others = [param for param in params if not param.startswith('weight=')]
+        position = next((index for index, param in enumerate(others) if param in STATUS_PARAMS), len(others))
+        self._set_params('set_weight', statement, others[:position] + [new_param] + others[position:],
+                         weight=weight)
+        return True
+
+    def add_server(self, upstream, address, params=()):
+        block = self.block(upstream)
+        existing = {statement.address.strip('"\'') for statement in block.servers
+                    if statement.start not in self.removed}
+        existing.update(added for added, _ in self.added.get(block.start, []))
+        if address in existing:
+            raise UpstreamEditError(f'upstream {upstream} 中已有server {address}')
+        self.added.setdefault(block.start, []).append((address, list(params)))
+        self._record('add_server', upstream, address, None, '', _render_server(address, params))
+        return True
+
+    def remove_server(self, upstream, address):
+        block, statement = self.server(upstream, address)
+        self.removed.add(statement.start)
+        self._record('remove_server', upstream, address, statement.line,
+                     self.content[statement.start:statement.end], '')
+        return True
+
+    def add_upstream(self, upstream, servers):
+        """
+        新建upstream
+
+        参数:
+            servers: [(地址, 参数列表)]，不能为空
+        """
+        if not servers:
+            raise UpstreamEditError(f'新建的upstream {upstream} 至少需要一个server')
+        if any(block.name == upstream for block in self.blocks) or any(name == upstream for name, _ in self.appended):
+            raise UpstreamEditError(f'upstream {upstream} 已存在')
+        servers = [(address, list(params)) for address, params in servers]
+        self.appended.append((upstream, servers))
+        self._record('add_upstream', upstream, None, None, '', self._render_upstream(upstream, servers, ''))
+        return True
+
+    def apply(self, operation):
+        """
+        执行一个字典形式的操作，op为OPERATIONS之一，其余键为对应方法的参数：
+        upstream、address、status、weight、params、servers（[{'address', 'params'}]）
+        """
+        op = operation.get('op')
+        if op not in self.OPERATIONS:
+            raise UpstreamEditError(f'不支持的操作: {op}')
+        upstream = operation.get('upstream')
+        if op == 'add_upstream':
+            return self.add_upstream(upstream, [(server['address'], server.get('params') or [])
+                                                for server in operation.get('servers') or []])
+        address = operation.get('address')
+        if op == 'set_status':
+            return self.set_status(upstream, address, operation.get('status'))
+        if op == 'set_weight':
+            return self.set_weight(upstream, address, operation.get('weight'))
+        if op == 'add_server':
+            return self.add_server(upstream, address, operation.get('params') or [])
+        return self.remove_server(upstream, address)
+
+    # ---- 生成修改 ----
+
+    def _render_upstream(self, upstream, servers, indent):
+        lines = [f'{indent}upstream {upstream} {{']
+        lines.extend(f'{indent}    {_render_server(address, params)}' for address, params in servers)
+        lines.append(f'{indent}}}')
+        return '\n'.join(lines)
+
+    def _removal(self, statement):
+        """删除区间：server独占一行（后面只有空白或注释）时删除整行，否则只删除指令本身和其后的空格"""
+        content = self.content
+        line_start = _line_start(content, statement.start)
+        line_end = content.find('\n', statement.end)
+        line_end = len(content) if line_end == -1 else line_end + 1
+        rest = content[statement.end:line_end].strip()
+        if not content[line_start:statement.start].strip() and (not rest or rest.startswith('#')):
+            return line_start, line_end
+        end = statement.end
+        while end < len(content) and content[end] in ' \t':
+            end += 1
+        return statement.start, end
+
+    def _closing(self, block, after=''):
+        """在右花括号所在行之前插入新server，after追加在右花括号之后"""
+        content = self.content
+        added = [_render_server(address, params) for address, params in self.added.get(block.start, [])]
+        line_start = _line_start(content, block.close)
+        if not added:
+            return block.close, block.close + 1, '}' + after
+        if not content[line_start:block.close].strip():
+            members = [statement for statement in block.servers if statement.start not in self.removed] \
+                or block.servers
+            indent = _indent(content, members[-1].start) if members else block.indent + '    '
+            text = ''.join(f'{indent}{line}\n' for line in added)
+            return line_start, block.close + 1, text + content[line_start:block.close] + '}' + after
+        return block.close, block.close + 1, ' '.join(added) + ' }' + after
+
+    def replacements(self):
+        """
+        返回:
+            list: [(起始偏移, 结束偏移, 新文本)]，按偏移排序且互不重叠
+        """
+        replacements = []
+        for block in self.blocks:
+            for statement in block.servers:
+                if statement.start in self.removed:
+                    replacements.append(self._removal(statement) + ('',))
+                elif statement.start in self.params:
+                    replacements.append((statement.start, statement.end,
+                                         statement.render(self.params[statement.start])))
+
+        after = ''
+        if self.appended:
+            indent = self.blocks[-1].indent if self.blocks else ''
+            after = ''.join('\n\n' + self._render_upstream(name, servers, indent) for name, servers in self.appended)
+        for index, block in enumerate(self.blocks):
+            last = index == len(self.blocks) - 1
+            if block.start in self.added or (last and after):
+                replacements.append(self._closing(block, after if last else ''))
+        if after and not self.blocks:
+            # 文件中没有upstream时追加到文件末尾，替换最后一个字符以便应用补丁时校验文件末尾
+            content = self.content
+            position = max(len(content) - 1, 0)
+            tail = content[position:]
+            separator = '' if not content or tail == '\n' else '\n'
+            replacements.append((position, len(content), tail + separator + after.lstrip('\n') + '\n'))
+        return sorted(replacements)
+
+    def render(self):
+        return apply_replacements(self.content, self.replacements())
+
+    def patch(self):
+        """受影响区间的字节级补丁，见client_app.patch.ConfigPatch"""
+        return ConfigPatch.from_replacements(self.content, self.replacements())
+
+    def as_edit(self, file_path):
+        """
+        转换为NginxConfigTransaction的一项修改
+
+        修改处不多时附带补丁，事务只传输补丁；修改处过多时整文件写入
+        """
+        replacements = self.replacements()
+        content = apply_replacements(self.content, replacements)
+        patch = ConfigPatch.from_replacements(self.content, replacements) \
+            if len(replacements) <= MAX_PATCH_HUNKS else None
+        return {'file_path': file_path, 'file_content': content, 'patch': patch}
+
+
+def _render_server(address, params=()):
+    return 'server ' + ' '.join([address, *params]) + ';'
+
+
+def apply_operations(content, operations):
+    """
+    依次执行操作
+
+    返回:
+        UpstreamEditor: changes为所有修改，render()/patch()给出结果；操作与文件不符时抛出UpstreamEditError
+    """
+    editor = UpstreamEditor(content)
+    for operation in operations:
+        editor.apply(operation)
+    return editor
+
+
+def set_server_status(content, address, status, upstreams=None):
+    """
+    修改所有upstream中指定地址的server状态
+
+    只替换命中的server指令本身，缩进、注释和其它指令保持原样；status为up时去掉down/backup参数，
+    为down或backup时替换已有的状态参数
+
+    参数:
+        address: ip:port，或不带端口的ip（匹配该主机的所有端口）
+        status: up、down或backup
+        upstreams: 只修改这些upstream（可选）
+
+    返回:
+        tuple: (新内容, 修改列表)，没有命中或状态已经一致时内容不变
+    """
+    editor = UpstreamEditor(content)
+    changes = editor.set_matching_status(address, status, upstreams)
+    if not changes:
+        return content, []
+    return editor.render(), changes
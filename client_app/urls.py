@@ -9,4 +9,5 @@ urlpatterns = [
 
     path('health/', views.health_check, name='health_check'),
     path('register/',views.register_client,name='register_client'),
+    path('reload-window/', views.update_reload_window, name='update_reload_window'),
 ]
\ No newline at end of file
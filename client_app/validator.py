@@ -0,0 +1,286 @@
+import os
+import re
+import glob
+import tempfile
+import posixpath
+import logging
+import crossplane
+from crossplane.analyzer import DIRECTIVES
+
+logger = logging.getLogger(__name__)
+
+# 可以在请求中显式指定的文件上下文 -> 文件被include时所处的块
+FILE_CONTEXTS = {
+    'main': (),
+    'http': ('http',),
+    'stream': ('stream',),
+    'server': ('http', 'server'),
+    'location': ('http', 'server', 'location'),
+    'upstream': ('http', 'upstream'),
+    'stream_server': ('stream', 'server'),
+    'stream_upstream': ('stream', 'upstream'),
+}
+# 把内容包进原上下文解析时，各块指令使用的占位参数
+WRAP_ARGS = {'http': '', 'stream': '', 'events': '', 'server': '', 'location': '/', 'upstream': '_',
+             'if': '($_)', 'limit_except': 'GET', 'map': '$_ $_', 'geo': '$_', 'split_clients': '$_ $_'}
+# 上下文未知的文件依次尝试的上下文
+GUESS_CONTEXTS = (('http',), ('stream',))
+VARIABLE_PATTERN = re.compile(r'\$')
+IP_PATTERN = re.compile(r'^\[?[0-9a-fA-F:.]+\]?$')
+
+
+class ValidationContext:
+    """
+    主机上已知的配置信息，用于跨文件检查
+
+    known_upstreams: {(protocol, upstream名称): 所在文件}
+    known_server_names: {(server_name, listen): 所在文件}
+    known_files: 主机上nginx加载的配置文件路径集合，为空时跳过include检查
+    file_contexts: {文件: 被include时所处的块上下文}，如 ('http',)、('stream',)、('http', 'server')
+    known_proxy_hosts: 主机上已有proxy_pass直接转发的主机名，不是upstream也能解析
+    analyzed: 以上信息是否来自主机的配置分析；只有数据库记录时无法确认引用是否悬空，只给出警告
+    """
+
+    def __init__(self, nginx_main_conf_path='/etc/nginx/nginx.conf', known_upstreams=None,
+                 known_server_names=None, known_files=None, file_contexts=None, known_proxy_hosts=None,
+                 analyzed=False):
+        self.nginx_main_conf_path = nginx_main_conf_path
+        self.known_upstreams = known_upstreams or {}
+        self.known_server_names = known_server_names or {}
+        self.known_files = set(known_files or ())
+        self.file_contexts = file_contexts or {}
+        self.known_proxy_hosts = set(known_proxy_hosts or ())
+        self.analyzed = analyzed
+
+    def without_files(self, file_paths):
+        """去掉即将被修改的文件中原有的定义，避免与新内容误报重复"""
+        file_paths = set(file_paths)
+        return ValidationContext(
+            nginx_main_conf_path=self.nginx_main_conf_path,
+            known_upstreams={k: v for k, v in self.known_upstreams.items() if v not in file_paths},
+            known_server_names={k: v for k, v in self.known_server_names.items() if v not in file_paths},
+            known_files=self.known_files | file_paths if self.known_files else (),
+            file_contexts=self.file_contexts,
+            known_proxy_hosts=self.known_proxy_hosts,
+            analyzed=self.analyzed
+        )
+
+
+class NginxConfigValidator:
+    """
+    本地配置校验引擎
+
+    在任何远程I/O之前，用与NginxAnalyzer相同的crossplane解析对待写入的内容做检查：
+    语法和指令上下文、upstream和server_name重复、proxy_pass指向不存在的upstream、
+    include引用了主机上不存在的文件。
+
+    文件按它在include树中所处的块上下文检查；不在已知include树中的文件分别按http和stream尝试，
+    指令位置的问题只作为警告
+    """
+
+    def __init__(self, context=None):
+        self.context = context or ValidationContext()
+
+    def _file_context(self, file_path, content, context_name=None):
+        """
+        文件被include时所处的块上下文：请求中指定的、主配置、include树中记录的，
+        或根据顶层的events/http/stream块判断为主配置；都无法确定时返回None
+        """
+        if context_name:
+            return FILE_CONTEXTS[context_name] if isinstance(context_name, str) else tuple(context_name)
+        if file_path == self.context.nginx_main_conf_path:
+            return ()
+        blocks = self.context.file_contexts.get(file_path)
+        if blocks is not None and all(block in WRAP_ARGS for block in blocks):
+            return tuple(blocks)
+        if re.search(r'^\s*(events|http|stream)\s*\{', content, re.MULTILINE):
+            return ()
+        return None
+
+    def parse_content(self, file_path, content, blocks=()):
+        """
+        解析单个文件内容，返回 (parsed, errors)
+
+        内容会被依次包进blocks中的块再解析，指令上下文按原位置检查，行号会还原到原文件
+        """
+        line_offset = len(blocks)
+        if blocks:
+            opening = ''.join(f'{" ".join(filter(None, (block, WRAP_ARGS[block])))} {{\n' for block in blocks)
+            content = f'{opening}{content}\n{"}" * len(blocks)}\n'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = os.path.join(temp_dir, posixpath.basename(file_path) or 'nginx.conf')
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            payload = crossplane.parse(temp_path, single=True, catch_errors=True, check_ctx=True, check_args=True)
+
+        errors = []
+        for error in payload.get('errors', []):
+            message = error.get('error', '').replace(temp_path, file_path)
+            line = error.get('line')
+            if line is not None:
+                line = max(line - line_offset, 1)
+                message = re.sub(rf'{re.escape(file_path)}:\d+', f'{file_path}:{line}', message)
+            check = 'context' if 'is not allowed here' in message else 'syntax'
+            errors.append(self._issue(file_path, line, check, message))
+
+        parsed = payload['config'][0].get('parsed', []) if payload.get('config') else []
+        for _ in blocks:
+            parsed = parsed[0].get('block', []) if parsed else []
+        if line_offset:
+            self._shift_lines(parsed, line_offset)
+        return parsed, errors
+
+    def _parse_guessed(self, file_path, content):
+        """上下文未知的文件按指令位置问题最少的上下文解析，位置问题降为警告"""
+        candidates = []
+        for blocks in GUESS_CONTEXTS:
+            parsed, errors = self.parse_content(file_path, content, blocks)
+            candidates.append((sum(error['check'] == 'context' for error in errors), blocks, parsed, errors))
+        _, blocks, parsed, errors = min(candidates, key=lambda candidate: candidate[0])
+        warnings = []
+        for error in errors:
+            if error['check'] == 'context':
+                error['error'] += f'（文件不在已分析的include树中，按{blocks[0]}上下文检查，可通过context指定）'
+                warnings.append(error)
+        return blocks, parsed, [error for error in errors if error['check'] != 'context'], warnings
+
+    def _shift_lines(self, directives, offset):
+        stack = list(directives)
+        while stack:
+            directive = stack.pop()
+            directive['line'] = directive.get('line', 1) - offset
+            stack.extend(directive.get('block', []))
+
+    @staticmethod
+    def _issue(file_path, line, check, message):
+        return {'file': file_path, 'line': line, 'check': check, 'error': message}
+
+    def validate(self, edits, context_names=None):
+        """
+        校验一组文件修改
+
+        参数:
+            edits: [{'file_path': ..., 'file_content': ..., 'context': 可选}, ...]，
+                   context为FILE_CONTEXTS中的名称，指定文件被include时所处的块
+            context_names: 可选，{file_path: FILE_CONTEXTS中的名称}
+
+        返回:
+            dict: valid、errors、warnings
+        """
+        context_names = context_names or {}
+        context = self.context.without_files(edit['file_path'] for edit in edits)
+        upstreams = dict(context.known_upstreams)
+        server_names = dict(context.known_server_names)
+        proxy_targets = []  # (protocol, 目标名称, file_path, line)
+        includes = []  # (include参数, file_path, line)
+        errors = []
+        warnings = []
+
+        for edit in edits:
+            file_path = edit['file_path']
+            blocks = self._file_context(file_path, edit['file_content'],
+                                        edit.get('context') or context_names.get(file_path))
+            if blocks is None:
+                blocks, parsed, parse_errors, parse_warnings = self._parse_guessed(file_path, edit['file_content'])
+                warnings.extend(parse_warnings)
+            else:
+                parsed, parse_errors = self.parse_content(file_path, edit['file_content'], blocks)
+            errors.extend(parse_errors)
+            file_protocol = blocks[0] if blocks else 'main'
+            if blocks[-1:] == ('server',) and file_protocol == 'http':
+                # 被include在server块中的文件，顶层的server_name属于该server
+                self._check_server_names(parsed, file_path, 1, server_names, errors)
+
+            # 单次遍历收集upstream、server_name、proxy_pass、include和未知指令
+            stack = [(directive, file_protocol) for directive in reversed(parsed)]
+            while stack:
+                directive, protocol = stack.pop()
+                name = directive.get('directive', '')
+                args = directive.get('args', [])
+                line = directive.get('line')
+                block = directive.get('block')
+
+                if name in ('http', 'stream'):
+                    protocol = name
+                elif name not in DIRECTIVES:
+                    warnings.append(self._issue(file_path, line, 'directive', f'未知指令 "{name}"，可能来自第三方模块'))
+
+                if name == 'upstream' and args:
+                    key = (protocol, args[0])
+                    if key in upstreams:
+                        errors.append(self._issue(file_path, line, 'duplicate_upstream',
+                                                  f'upstream {args[0]} 重复定义，已存在于 {upstreams[key]}'))
+                    else:
+                        upstreams[key] = file_path
+                elif name == 'server' and block is not None and protocol == 'http':
+                    self._check_server_names(block, file_path, line, server_names, errors)
+                elif name == 'proxy_pass' and args:
+                    proxy_targets.append((protocol, args[0], file_path, line))
+                elif name == 'include' and args:
+                    includes.append((args[0], file_path, line))
+
+                if block:
+                    stack.extend((child, protocol) for child in reversed(block))
+
+        for protocol, target, file_path, line in proxy_targets:
+            host = self._proxy_host(target)
+            if not host or (protocol, host) in upstreams or host in context.known_proxy_hosts \
+                    or not self._looks_like_upstream_name(host):
+                continue
+            if context.analyzed:
+                errors.append(self._issue(file_path, line, 'dangling_proxy_pass',
+                                          f'proxy_pass {target} 指向的upstream {host} 不存在'))
+            else:
+                # 主机没有分析结果时已知的upstream可能不全，host也可能是单标签域名，由nginx -t最终确认
+                warnings.append(self._issue(file_path, line, 'dangling_proxy_pass',
+                                            f'proxy_pass {target} 指向的upstream {host} 未在已同步的配置中找到'))
+
+        if context.known_files:
+            prefix = posixpath.dirname(context.nginx_main_conf_path)
+            for include_arg, file_path, line in includes:
+                include_path = posixpath.normpath(posixpath.join(prefix, include_arg))
+                if glob.has_magic(include_path):
+                    continue
+                if include_path not in context.known_files:
+                    errors.append(self._issue(file_path, line, 'unknown_include',
+                                              f'include的文件 {include_path} 在主机上不存在'))
+
+        return {'valid': not errors, 'errors': errors, 'warnings': warnings}
+
+    @staticmethod
+    def _check_server_names(block, file_path, line, server_names, errors):
+        listens = [directive['args'][0] for directive in block
+                   if directive.get('directive') == 'listen' and directive.get('args')] or ['80']
+        for directive in block:
+            if directive.get('directive') != 'server_name':
+                continue
+            for server_name in directive.get('args', []):
+                if server_name in ('', '_'):
+                    continue
+                for listen in listens:
+                    key = (server_name, listen)
+                    if key in server_names:
+                        errors.append(NginxConfigValidator._issue(
+                            file_path, line, 'duplicate_server_name',
+                            f'server_name {server_name} 在 {listen} 上重复定义，已存在于 {server_names[key]}'))
+                    else:
+                        server_names[key] = file_path
+
+    @staticmethod
+    def _proxy_host(target):
+        """从proxy_pass参数中取出主机部分，包含变量或unix socket时返回None"""
+        if VARIABLE_PATTERN.search(target):
+            return None
+        if '//' in target:
+            target = target.split('//', 1)[1]
+        if target.startswith('unix:'):
+            return None
+        return target.split('/', 1)[0]
+
+    @staticmethod
+    def _looks_like_upstream_name(host):
+        """不带端口、不是IP、不含点号的主机名只可能是upstream名称"""
+        if ':' in host or '.' in host or host == 'localhost':
+            return False
+        return not IP_PATTERN.match(host)
@@ -2,11 +2,14 @@
 
 
 
+import re
+
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from .models import ClientInfo
-from .serializers import ClientInfoSerializer
+from .serializers import ClientInfoSerializer, ReloadWindowSerializer
 from .client import NginxParamikoClient
+from .capabilities import attach_capabilities
 @api_view(['POST'])
 def health_check(request):
     """
@@ -53,24 +56,31 @@ def health_check(request):
 
         # 建立SSH连接
         if client.connect():
-            # 检查Nginx进程是否存在
-            nginx_process_result = client.execute_command('ps aux | grep nginx | grep -v grep')
-
-            # 检查Nginx端口（默认80和443）
-            port_80_result = client.execute_command('ss -tlnp | grep :80')
-            port_443_result = client.execute_command('ss -tlnp | grep :443')
-
-            # 检查Nginx服务状态
-            service_result = client.execute_command(
-                'systemctl status nginx 2>/dev/null || service nginx status 2>/dev/null || echo "无法获取服务状态"')
-            print('systemct ',service_result)
+            # 已登记的主机复用缓存的能力探测结果，否则探测一次
+            server = ClientInfo.objects.filter(host=host, port=port).first()
+            if server is not None:
+                attach_capabilities(client, server)
+            caps = client.get_capabilities()
+
+            # 进程、监听端口和服务状态合并为一次远程命令
+            # 诊断命令的输出限制在1MB、执行限制在10秒内，避免繁忙主机拖垮worker
+            sections = [('process', "ps aux | grep '[n]ginx'")]
+            listen_command = caps.listen_command() if caps else 'ss -tln'
+            if listen_command:
+                sections.append(('listen', listen_command))
+            sections.append(('service', caps.status_command() if caps else
+                             'systemctl status nginx 2>/dev/null || service nginx status 2>/dev/null'))
+            results = client.execute_sections(sections, timeout=10, max_output_bytes=1024 * 1024)
             client.close()
 
             # 分析结果
-            nginx_running = nginx_process_result['success'] and 'nginx' in nginx_process_result['output']
-            port_80_open = port_80_result['success'] and ':80' in port_80_result['output']
-            port_443_open = port_443_result['success'] and ':443' in port_443_result['output']
-            service_active = 'active (running)' in service_result['output'] if service_result['success'] else False
+            process_output = results.get('process', {}).get('output', '')
+            listen_output = results.get('listen', {}).get('output', '')
+            service_output = results.get('service', {}).get('output', '')
+            nginx_running = 'nginx' in process_output
+            port_80_open = re.search(r':80\b', listen_output) is not None
+            port_443_open = re.search(r':443\b', listen_output) is not None
+            service_active = 'active (running)' in service_output
 
             # 构建响应
             response_data = {
@@ -123,6 +133,7 @@ def register_client(request):
     password = request.data.get('password')  # 新增：SSH密码
     name = request.data.get('name')  # 新增：客户端名称
     nginx_config_path = request.data.get('nginx_config_path')  # 新增：Nginx配置路径
+    reload_window_ms = request.data.get('reload_window_ms')  # 配置修改的合并窗口（毫秒），不传时保持原值
 
     # 验证必填参数
     if not client_ip:
@@ -137,6 +148,16 @@ def register_client(request):
             'status': 400
         }, status=400)
 
+    if reload_window_ms is not None:
+        window_serializer = ReloadWindowSerializer(data={'client_ip': client_ip, 'reload_window_ms': reload_window_ms})
+        if not window_serializer.is_valid():
+            return Response({
+                'msg': '参数验证失败',
+                'errors': window_serializer.errors,
+                'status': 400
+            }, status=400)
+        reload_window_ms = window_serializer.validated_data['reload_window_ms']
+
     # 创建或更新客户端信息
     client, created = ClientInfo.objects.get_or_create(
         client_ip=client_ip,  # 修改：使用正确的字段名
@@ -147,7 +168,8 @@ def register_client(request):
             'username': username,
             'password': password,
             'name': name,
-            'nginx_config_path': nginx_config_path
+            'nginx_config_path': nginx_config_path,
+            'reload_window_ms': reload_window_ms or 0
         }
     )
 
@@ -160,6 +182,8 @@ def register_client(request):
         client.password = password
         client.name = name
         client.nginx_config_path = nginx_config_path
+        if reload_window_ms is not None:
+            client.reload_window_ms = reload_window_ms
         client.save()
 
     return Response({
@@ -174,11 +198,48 @@ def register_client(request):
             'host': client.host,
             'port': client.port,
             'username': client.username,
-            'nginx_config_path': client.nginx_config_path
+            'nginx_config_path': client.nginx_config_path,
+            'reload_window_ms': client.reload_window_ms
         }
     })
 
 
+@api_view(['POST'])
+def update_reload_window(request):
+    """
+    设置主机配置修改的合并窗口
+    API端点: POST /api/clients/reload-window/
+
+    参数:
+        request: 包含client_ip和reload_window_ms（0到60000毫秒，0表示排队后立即执行）的POST请求
+
+    返回:
+        Response: 更新后的客户端信息
+    """
+    serializer = ReloadWindowSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'msg': '参数验证失败',
+            'errors': serializer.errors,
+            'status': 400
+        }, status=400)
+
+    client_ip = serializer.validated_data['client_ip']
+    updated = ClientInfo.objects.filter(client_ip=client_ip).update(
+        reload_window_ms=serializer.validated_data['reload_window_ms'])
+    if not updated:
+        return Response({
+            'msg': f'未找到客户端 {client_ip}',
+            'status': 404
+        }, status=404)
+
+    return Response({
+        'msg': f'客户端 {client_ip} 的合并窗口已设置为 {serializer.validated_data["reload_window_ms"]} 毫秒',
+        'data': ClientInfoSerializer(ClientInfo.objects.get(client_ip=client_ip)).data,
+        'status': 200
+    })
+
+
 @api_view(['GET'])
 def get_clients(request):
     """获取客户端列表"""
@@ -0,0 +1,322 @@
+import logging
+
+from .records import Location, VirtualServer, StreamServer, BackendServer, Upstream, NginxAnalysis
+
+PROTOCOL_BLOCKS = ('http', 'stream')
+
+logger = logging.getLogger(__name__)
+
+
+class VisitContext:
+    """
+    遍历过程中的上下文：当前文件、从根到当前指令的父指令名栈，
+    以及当前所处的协议（http或stream），被include的文件从include所在的块继承协议
+    """
+
+    __slots__ = ('file_path', 'parents', 'protocol')
+
+    def __init__(self, file_path, protocol='http'):
+        self.file_path = file_path
+        self.parents = []
+        self.protocol = protocol
+
+    @property
+    def parent(self):
+        return self.parents[-1] if self.parents else None
+
+    @property
+    def depth(self):
+        return len(self.parents)
+
+
+class DirectiveExtractor:
+    """
+    提取器基类
+
+    directives声明关心的指令名，遍历器只在这些指令进入和离开时回调，
+    enter返回False时跳过该指令的子块
+    """
+
+    directives = ()
+
+    def enter(self, directive, context):
+        return True
+
+    def leave(self, directive, context):
+        pass
+
+
+class DirectiveVisitor:
+    """
+    单次遍历引擎
+
+    用显式栈深度优先遍历crossplane解析树，每条指令只访问一次，
+    按指令名分发给注册的提取器，新增提取器不会增加遍历次数
+    """
+
+    def __init__(self, extractors, trace=None):
+        self.extractors = list(extractors)
+        self.trace = trace if trace is not None and trace.enabled else None
+        self.dispatch = {}
+        for extractor in self.extractors:
+            for name in extractor.directives:
+                self.dispatch.setdefault(name, []).append(extractor)
+
+    def visit(self, file_path, directives, protocol='http'):
+        """遍历一个文件的指令列表，返回访问的指令数"""
+        context = VisitContext(file_path, protocol)
+        dispatch = self.dispatch
+        trace = self.trace
+        parents = context.parents
+        protocols = []
+        visited = 0
+        # 栈元素: (指令, 是否为离开事件)
+        stack = [(directive, False) for directive in reversed(directives)]
+        while stack:
+            directive, leaving = stack.pop()
+            name = directive.get('directive', '')
+            handlers = dispatch.get(name)
+
+            if leaving:
+                parents.pop()
+                if name in PROTOCOL_BLOCKS:
+                    context.protocol = protocols.pop()
+                if handlers:
+                    for extractor in handlers:
+                        extractor.leave(directive, context)
+                continue
+
+            visited += 1
+            if trace:
+                trace.directive(file_path, len(parents), name, directive.get('args', []))
+
+            descend = True
+            if handlers:
+                for extractor in handlers:
+                    if extractor.enter(directive, context) is False:
+                        descend = False
+
+            block = directive.get('block')
+            if block is None:
+                continue
+            if not descend:
+                if handlers:
+                    for extractor in handlers:
+                        extractor.leave(directive, context)
+                continue
+            parents.append(name)
+            if name in PROTOCOL_BLOCKS:
+                protocols.append(context.protocol)
+                context.protocol = name
+            stack.append((directive, True))
+            stack.extend((child, False) for child in reversed(block))
+        return visited
+
+
+class UpstreamExtractor(DirectiveExtractor):
+    """提取upstream及其成员，http和stream分别按名称去重，重复定义的整个块被跳过"""
+
+    directives = ('upstream', 'server')
+
+    def __init__(self):
+        self.upstreams = {'http': {}, 'stream': {}}  # 协议 -> {upstream名称: Upstream}
+        self.backend_servers = {'http': {}, 'stream': {}}  # 协议 -> {后端地址: BackendServer}
+        self.backend_server_addrs = []  # 按出现顺序的http后端地址，可能重复
+        self.current = None
+
+    def enter(self, directive, context):
+        name = directive['directive']
+        if name == 'upstream':
+            upstream_name = "".join(directive.get('args', []))
+            upstreams = self.upstreams[context.protocol]
+            if upstream_name in upstreams:
+                logger.warning('upstream命名重复，跳过重复项 protocol=%s upstream=%s file=%s',
+                               context.protocol, upstream_name, context.file_path)
+                return False
+            self.current = Upstream(upstream_name, context.file_path, protocol=context.protocol)
+            upstreams[self.current.name] = self.current
+        elif context.parent == 'upstream' and self.current is not None:
+            args = directive.get('args', [])
+            if not args:
+                return True
+            backend = BackendServer(args[0], self.current.name, context.file_path, args[1:],
+                                    protocol=context.protocol)
+            self.current.members.append(backend)
+            if context.protocol == 'http':
+                self.backend_server_addrs.append(backend.address)
+            self.backend_servers[context.protocol][backend.address] = backend
+        return True
+
+    def leave(self, directive, context):
+        if directive['directive'] == 'upstream':
+            self.current = None
+
+
+class ServerExtractor(DirectiveExtractor):
+    """
+    提取虚拟主机
+
+    进入server块时创建待定记录，server_name（stream中为listen）子指令填入名称，离开时按名称合并登记，
+    同名http server块的location合并到同一条记录
+    """
+
+    directives = ('server', 'server_name', 'listen')
+
+    def __init__(self):
+        self.virtual_servers = {}  # 名称 -> VirtualServer
+        self.stream_servers = {}  # listen -> StreamServer
+        self.server_names = {}  # (server_name, listen) -> 所在文件
+        self.stack = []  # 嵌套的待定记录
+        self.listens = []  # 与stack对应，各待定记录的listen参数
+
+    @property
+    def current(self):
+        return self.stack[-1] if self.stack else None
+
+    @staticmethod
+    def listen_name(args):
+        """stream server的名称，如 3306、0.0.0.0:53/udp"""
+        return f"{args[0]}/udp" if 'udp' in args[1:] else args[0]
+
+    def enter(self, directive, context):
+        name = directive['directive']
+        if name == 'server':
+            if context.parent == 'upstream':
+                return True
+            if directive.get('block') is not None:
+                listen = []
+                if context.protocol == 'stream':
+                    self.stack.append(StreamServer(None, context.file_path, listen=listen))
+                else:
+                    self.stack.append(VirtualServer(None, context.file_path))
+                self.listens.append(listen)
+        elif not self.stack or context.parent != 'server':
+            return True
+        elif name == 'listen':
+            if directive.get('args'):
+                self.listens[-1].append(tuple(directive['args']))
+        elif self.stack[-1].name is None:
+            self.stack[-1].name = ",".join(directive.get('args', [])) or None
+        return True
+
+    def leave(self, directive, context):
+        if directive['directive'] != 'server' or not self.stack or context.parent == 'upstream':
+            return
+        server = self.stack.pop()
+        listen = self.listens.pop()
+        if isinstance(server, StreamServer):
+            server.listen = tuple(server.listen)
+            server.name = server.name or (self.listen_name(server.listen[0]) if server.listen
+                                          else f"stream_{len(self.stream_servers)}")
+            if server.name in self.stream_servers:
+                logger.warning('stream server重复，跳过重复项 listen=%s file=%s', server.name, context.file_path)
+            else:
+                self.stream_servers[server.name] = server
+            return
+        if server.name:
+            # 没有listen的server监听80端口
+            for server_name in server.name.split(','):
+                if server_name not in ('', '_'):
+                    for args in listen or [('80',)]:
+                        self.server_names.setdefault((server_name, args[0]), server.file_path)
+        server.name = server.name or f"server_{len(self.virtual_servers)}"
+        existing = self.virtual_servers.get(server.name)
+        if existing is None:
+            self.virtual_servers[server.name] = server
+        else:
+            existing.locations.extend(server.locations)
+
+
+class LocationExtractor(DirectiveExtractor):
+    """维护当前所在的location路径栈"""
+
+    directives = ('location',)
+
+    def __init__(self):
+        self.stack = []
+
+    @property
+    def current(self):
+        return self.stack[-1] if self.stack else None
+
+    def enter(self, directive, context):
+        if directive.get('block') is not None:
+            self.stack.append("".join(directive.get('args', [])))
+        return True
+
+    def leave(self, directive, context):
+        if directive.get('block') is not None and self.stack:
+            self.stack.pop()
+
+
+class ProxyPassExtractor(DirectiveExtractor):
+    """把location中的proxy_pass记录到所在的虚拟主机"""
+
+    directives = ('proxy_pass',)
+
+    def __init__(self, servers, locations):
+        self.servers = servers
+        self.locations = locations
+
+    @staticmethod
+    def normalize(args):
+        proxy_pass = "".join(args)
+        # 去掉协议部分
+        if '//' in proxy_pass:
+            proxy_pass = proxy_pass.split('//')[1]
+        return proxy_pass
+
+    def enter(self, directive, context):
+        server = self.servers.current
+        args = directive.get('args', [])
+        if server is None or not args:
+            return True
+        if isinstance(server, StreamServer):
+            # stream中proxy_pass直接写在server块中，参数是upstream名称或地址
+            if context.parent == 'server':
+                server.proxy_pass = self.normalize(args)
+            return True
+        location = self.locations.current
+        if location is None or context.parent != 'location':
+            return True
+        server.locations.append(Location(location, self.normalize(args)))
+        return True
+
+
+class IncludeContextExtractor(DirectiveExtractor):
+    """
+    记录crossplane include索引对应的协议
+
+    crossplane不带single解析时，include指令带有被引入文件在config列表中的索引，
+    引入方总是排在被引入文件之前，因此在同一次遍历中即可得到每个文件所处的协议
+    """
+
+    directives = ('include',)
+
+    def __init__(self):
+        self.protocols = {}  # config索引 -> 协议
+
+    def enter(self, directive, context):
+        for index in directive.get('includes', ()):
+            self.protocols.setdefault(index, context.protocol)
+        return True
+
+
+def collect_analysis(upstreams, servers):
+    """把提取器的结果组装为NginxAnalysis"""
+    return NginxAnalysis(virtual_servers=servers.virtual_servers, upstreams=upstreams.upstreams['http'],
+                         backend_servers=upstreams.backend_servers['http'],
+                         backend_server_addrs=upstreams.backend_server_addrs,
+                         stream_servers=servers.stream_servers, stream_upstreams=upstreams.upstreams['stream'],
+                         stream_backend_servers=upstreams.backend_servers['stream'],
+                         server_names=servers.server_names)
+
+
+def default_extractors():
+    """分析使用的默认提取器组合"""
+    upstreams = UpstreamExtractor()
+    servers = ServerExtractor()
+    locations = LocationExtractor()
+    proxy_passes = ProxyPassExtractor(servers, locations)
+    includes = IncludeContextExtractor()
+    return upstreams, servers, locations, proxy_passes, includes
@@ -55,6 +55,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # 请求耗时分解：Server-Timing响应头和/api/servers/metrics/指标
+    'nginx_app.middleware.RequestTimingMiddleware',
 ]
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -231,5 +233,12 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        # 配置解析和分析分子系统设置级别，DEBUG时配合NGINX_ANALYSIS_TRACE_SAMPLE开启采样跟踪
+        'client_app.client.analysis': {
+            'level': os.environ.get('NGINX_ANALYSIS_LOG_LEVEL', 'INFO'),
+        },
+        'client_app.client.parse': {
+            'level': os.environ.get('NGINX_PARSE_LOG_LEVEL', 'INFO'),
+        },
     },
 }
\ No newline at end of file
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+访问日志的分钟汇总
+增量读取到的日志行逐行累加到内存中的分钟汇总（键为分钟、虚拟主机、upstream），汇总数量达到上限时
+连同读取位置一起合并写入数据库，内存占用与日志量无关；上游耗时用固定的对数分桶直方图统计，
+多个分钟、多个进程写入的结果都可以直接相加
+"""
+
+import bisect
+import time
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .models import AccessLogRollup, AccessLogSource, BackendServerInfo
+
+# 上游耗时直方图各桶的上界（秒），相邻桶相差约19%；最后一个桶记录超过120秒的请求
+LATENCY_BOUNDS = np.geomspace(0.0005, 120, 72)
+_BOUNDS = LATENCY_BOUNDS.tolist()
+HISTOGRAM_SIZE = len(_BOUNDS) + 1
+HISTOGRAM_DTYPE = np.dtype('<u4')
+
+STATUS_FIELDS = ('status_1xx', 'status_2xx', 'status_3xx', 'status_4xx', 'status_5xx')
+COUNTER_FIELDS = ('requests',) + STATUS_FIELDS + ('bytes_sent', 'upstream_requests', 'upstream_time_sum')
+
+# 内存中最多保留的汇总数，超过时写入数据库
+DEFAULT_MAX_BUCKETS = 5000
+# 每分钟最多单独统计的虚拟主机数，$host来自请求头，超出部分归入OTHER_VHOST
+MAX_VHOSTS_PER_MINUTE = 200
+OTHER_VHOST = '~other'
+
+ROLLUP_RETENTION_SECONDS = 14 * 86400
+
+
+class _Bucket:
+    __slots__ = ('requests', 'statuses', 'bytes_sent', 'upstream_requests', 'upstream_time_sum', 'histogram')
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = [0] * len(STATUS_FIELDS)
+        self.bytes_sent = 0
+        self.upstream_requests = 0
+        self.upstream_time_sum = 0.0
+        self.histogram = [0] * HISTOGRAM_SIZE
+
+
+class RollupAggregator:
+    """
+    一个日志源的流式汇总
+
+    参数:
+        source: AccessLogSource
+        upstream_names: 后端地址（IP）到upstream名称的映射，日志中没有$proxy_host时用$upstream_addr查找
+        max_buckets: 内存中最多保留的汇总数
+    """
+
+    def __init__(self, source, upstream_names=None, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.source = source
+        self.upstream_names = upstream_names or {}
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.vhosts = {}  # 分钟 -> 已单独统计的虚拟主机
+        self.lines = 0
+        self.flushes = 0
+
+    @classmethod
+    def for_source(cls, source, max_buckets=DEFAULT_MAX_BUCKETS):
+        upstream_names = {}
+        for address, upstream in BackendServerInfo.objects.filter(client_id=source.client_id) \
+                .values_list('backend_server_addr', 'upstream'):
+            upstream_names.setdefault(address, upstream)
+        return cls(source, upstream_names, max_buckets)
+
+    def _upstream(self, upstream):
+        if upstream in self.upstream_names:
+            return upstream
+        host = upstream.rsplit(':', 1)[0].strip('[]') if ':' in upstream and not upstream.startswith('unix:') \
+            else upstream
+        return self.upstream_names.get(host, upstream)
+
+    @property
+    def full(self):
+        return len(self.buckets) >= self.max_buckets
+
+    def add(self, record):
+        """累加LogFormat.parse的一条结果"""
+        minute, vhost, upstream, status, sent, upstream_time = record
+        vhosts = self.vhosts.setdefault(minute, set())
+        if vhost not in vhosts:
+            if len(vhosts) >= MAX_VHOSTS_PER_MINUTE:
+                vhost = OTHER_VHOST
+            vhosts.add(vhost)
+        key = (minute, vhost[:255], self._upstream(upstream)[:255])
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _Bucket()
+        bucket.requests += 1
+        if 100 <= status < 600:
+            bucket.statuses[status // 100 - 1] += 1
+        bucket.bytes_sent += sent
+        if upstream_time is not None:
+            bucket.upstream_requests += 1
+            bucket.upstream_time_sum += upstream_time
+            bucket.histogram[bisect.bisect_left(_BOUNDS, upstream_time)] += 1
+        self.lines += 1
+
+    def flush(self, inode, offset):
+        """
+        把内存中的汇总合并到数据库，并在同一个事务中保存读取位置
+
+        汇总和读取位置同时提交，进程中途退出后从上次提交的位置重新读取，不会重复计数
+        """
+        source = self.source
+        with transaction.atomic():
+            existing = {}
+            if self.buckets:
+                minutes = {minute for minute, _, _ in self.buckets}
+                for row in AccessLogRollup.objects.select_for_update().filter(
+                        client_id=source.client_id, minute__in=minutes):
+                    existing[(row.minute, row.vhost, row.upstream)] = row
+
+            created, updated = [], []
+            for key, bucket in self.buckets.items():
+                row = existing.get(key)
+                if row is None:
+                    minute, vhost, upstream = key
+                    row = AccessLogRollup(client_id=source.client_id, minute=minute, vhost=vhost,
+                                          upstream=upstream)
+                    histogram = np.zeros(HISTOGRAM_SIZE, dtype=HISTOGRAM_DTYPE)
+                    created.append(row)
+                else:
+                    histogram = _histogram(row.latency_histogram)
+                    updated.append(row)
+                row.requests += bucket.requests
+                for field, count in zip(STATUS_FIELDS, bucket.statuses):
+                    setattr(row, field, getattr(row, field) + count)
+                row.bytes_sent += bucket.bytes_sent
+                row.upstream_requests += bucket.upstream_requests
+                row.upstream_time_sum += bucket.upstream_time_sum
+                row.latency_histogram = (histogram + np.array(bucket.histogram, dtype=HISTOGRAM_DTYPE)).tobytes()
+
+            AccessLogRollup.objects.bulk_create(created, batch_size=500)
+            AccessLogRollup.objects.bulk_update(updated, list(COUNTER_FIELDS) + ['latency_histogram'],
+                                                batch_size=500)
+            source.inode, source.offset = inode, offset
+            source.last_read_at = timezone.now()
+            source.last_error = ''
+            source.save(update_fields=['inode', 'offset', 'last_read_at', 'last_error', 'updated_at'])
+
+        self.buckets.clear()
+        self.vhosts.clear()
+        self.flushes += 1
+        return len(created) + len(updated)
+
+
+def _histogram(data):
+    data = bytes(data)
+    if not data:
+        return np.zeros(HISTOGRAM_SIZE, dtype=HISTOGRAM_DTYPE)
+    return np.frombuffer(data, dtype=HISTOGRAM_DTYPE).copy()
+
+
+def quantiles(histograms, q):
+    """
+    按直方图估算分位数，桶内线性插值
+
+    参数:
+        histograms: (n, HISTOGRAM_SIZE) 的桶计数
+        q: 0~1之间的分位
+
+    返回:
+        list: 每行的分位数（秒），没有样本的行为None
+    """
+    histograms = np.asarray(histograms, dtype=np.float64)
+    if histograms.ndim == 1:
+        histograms = histograms[None, :]
+    totals = histograms.sum(axis=1)
+    cumulative = np.cumsum(histograms, axis=1)
+    target = q * totals
+    index = np.minimum(np.argmax(cumulative >= target[:, None], axis=1), len(_BOUNDS) - 1)
+    rows = np.arange(len(histograms))
+    lower = np.where(index > 0, LATENCY_BOUNDS[np.maximum(index - 1, 0)], 0.0)
+    upper = LATENCY_BOUNDS[index]
+    before = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0.0)
+    in_bucket = histograms[rows, index]
+    fraction = np.where(in_bucket > 0, (target - before) / np.maximum(in_bucket, 1), 1.0)
+    values = lower + (upper - lower) * np.clip(fraction, 0, 1)
+    return [round(float(value), 4) if total else None for value, total in zip(values, totals)]
+
+
+def query_rollups(client_id, start, end, step=60, vhost=None, upstream=None, group_by=('vhost', 'upstream')):
+    """
+    查询分钟汇总
+
+    参数:
+        step: 返回的时间间隔（秒），按60取整
+        vhost、upstream: 只返回指定的虚拟主机或upstream
+        group_by: 分组字段，vhost、upstream的子集；为空时所有请求合为一个序列
+
+    返回:
+        list: 每个分组一个序列，包括每个时间点的请求数、每秒请求数、状态码分布、上游耗时p50/p99，
+        以及整个区间的合计
+    """
+    step = max(int(step) // 60, 1) * 60
+    rows = AccessLogRollup.objects.filter(client_id=client_id, minute__gte=start, minute__lt=end)
+    if vhost:
+        rows = rows.filter(vhost=vhost)
+    if upstream:
+        rows = rows.filter(upstream=upstream)
+    rows = list(rows.values_list('minute', 'vhost', 'upstream', *COUNTER_FIELDS, 'latency_histogram'))
+    if not rows:
+        return []
+
+    groups = {}
+    for row in rows:
+        key = tuple(row[1] if field == 'vhost' else row[2] for field in group_by)
+        groups.setdefault(key, []).append(row)
+
+    series = []
+    for key, group_rows in sorted(groups.items()):
+        minutes = np.array([row[0] for row in group_rows], dtype=np.int64)
+        counters = np.array([row[3:3 + len(COUNTER_FIELDS)] for row in group_rows], dtype=np.float64)
+        histograms = np.stack([_histogram(row[-1]) for row in group_rows]).astype(np.int64)
+
+        slots = (minutes - minutes % step)
+        timestamps, inverse = np.unique(slots, return_inverse=True)
+        counter_sums = np.zeros((len(timestamps), len(COUNTER_FIELDS)))
+        np.add.at(counter_sums, inverse, counters)
+        histogram_sums = np.zeros((len(timestamps), HISTOGRAM_SIZE), dtype=np.int64)
+        np.add.at(histogram_sums, inverse, histograms)
+
+        requests = counter_sums[:, 0]
+        totals = counter_sums.sum(axis=0)
+        total_histogram = histogram_sums.sum(axis=0)
+        item = dict(zip(group_by, key))
+        item.update({
+            'timestamps': timestamps.tolist(),
+            'requests': requests.astype(np.int64).tolist(),
+            'requests_per_second': np.round(requests / step, 3).tolist(),
+            'status': {field[len('status_'):]: counter_sums[:, index + 1].astype(np.int64).tolist()
+                       for index, field in enumerate(STATUS_FIELDS)},
+            'upstream_p50': quantiles(histogram_sums, 0.5),
+            'upstream_p99': quantiles(histogram_sums, 0.99),
+            'total': {
+                'requests': int(totals[0]),
+                'status': {field[len('status_'):]: int(totals[index + 1]) for index, field in enumerate(STATUS_FIELDS)},
+                'bytes_sent': int(totals[len(STATUS_FIELDS) + 1]),
+                'upstream_avg': round(totals[-1] / totals[-2], 4) if totals[-2] else None,
+                'upstream_p50': quantiles(total_histogram, 0.5)[0],
+                'upstream_p99': quantiles(total_histogram, 0.99)[0],
+            },
+        })
+        series.append(item)
+    return series
+
+
+def enforce_retention(now=None):
+    """删除超过保留期的分钟汇总"""
+    now = int(now or time.time())
+    return AccessLogRollup.objects.filter(minute__lt=now - ROLLUP_RETENTION_SECONDS).delete()[0]
+
+
+def record_error(source, error):
+    AccessLogSource.objects.filter(pk=source.pk).update(last_error=str(error)[:500], last_read_at=timezone.now())
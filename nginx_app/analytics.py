@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+后端服务器列式统计模块
+把BackendServerInfo一次性加载为NumPy列式数组，用bincount等向量化运算做整个集群的容量统计。
+upstream按(协议, 名称)区分，http和stream中的同名upstream分别统计；不按主机过滤时，
+各主机上的同名upstream视为集群中的同一个upstream合并统计，hosts给出它出现在多少台主机上
+"""
+
+import threading
+
+import numpy as np
+from django.db.models import Count, Max
+
+from client_app.models import ClientInfo
+from .models import BackendServerInfo
+
+STATUS_CODES = ('up', 'down', 'backup')
+
+
+class BackendColumns:
+    """
+    BackendServerInfo的列式快照
+
+    字符串列按字典编码为整数codes，统计时只操作整数数组；upstream_codes编码(协议, 名称)，
+    第i个upstream为(upstream_protocols[i], upstream_names[i])
+    """
+
+    def __init__(self, client_ids, protocols, upstreams, statuses, weights):
+        self.size = len(client_ids)
+        self.client_ids = np.asarray(client_ids, dtype=np.int64)
+        protocol_names, protocol_codes = np.unique(np.asarray(protocols, dtype=object).astype(str),
+                                                   return_inverse=True)
+        names, name_codes = np.unique(np.asarray(upstreams, dtype=object).astype(str), return_inverse=True)
+        keys, self.upstream_codes = np.unique(name_codes * max(len(protocol_names), 1) + protocol_codes,
+                                              return_inverse=True)
+        self.upstream_names = names[keys // max(len(protocol_names), 1)]
+        self.upstream_protocols = protocol_names[keys % max(len(protocol_names), 1)]
+        status_index = {status: code for code, status in enumerate(STATUS_CODES)}
+        self.status_codes = np.fromiter((status_index.get(status, 0) for status in statuses),
+                                        dtype=np.int8, count=self.size)
+        self.weights = np.asarray(weights, dtype=np.int64)
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        rows = list(queryset.values_list('client_id', 'protocol', 'upstream', 'status', 'weight'))
+        if not rows:
+            return cls([], [], [], [], [])
+        return cls(*zip(*rows))
+
+    def filter_client(self, client_id):
+        """按客户端过滤，返回新的列式快照"""
+        mask = self.client_ids == client_id
+        subset = BackendColumns.__new__(BackendColumns)
+        subset.size = int(mask.sum())
+        subset.client_ids = self.client_ids[mask]
+        subset.upstream_names = self.upstream_names
+        subset.upstream_protocols = self.upstream_protocols
+        subset.upstream_codes = self.upstream_codes[mask]
+        subset.status_codes = self.status_codes[mask]
+        subset.weights = self.weights[mask]
+        return subset
+
+
+_snapshot_lock = threading.Lock()
+_snapshot = {'version': None, 'columns': None, 'generation': 0}
+
+
+def _table_version():
+    """
+    用行数和最近更新时间判断快照是否过期，只需一次聚合查询
+
+    QuerySet.update()和bulk_update()不会自动更新auto_now字段，修改status、weight等快照中的列时
+    需要同时写入updated_at，否则其他进程看不到变化；本进程的写入方另外调用invalidate_backend_columns。
+    探测器只写健康状态列，不在快照中，不影响版本
+    """
+    stats = BackendServerInfo.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    with _snapshot_lock:
+        generation = _snapshot['generation']
+    return generation, stats['count'], stats['updated_at']
+
+
+def invalidate_backend_columns():
+    """本进程修改了后端行之后调用，下次统计时重新加载快照"""
+    with _snapshot_lock:
+        _snapshot['generation'] += 1
+
+
+def load_backend_columns():
+    """获取列式快照，表未变化时复用进程内缓存"""
+    version = _table_version()
+    with _snapshot_lock:
+        if _snapshot['version'] != version:
+            _snapshot['columns'] = BackendColumns.from_queryset(BackendServerInfo.objects.all())
+            _snapshot['version'] = version
+        return _snapshot['columns']
+
+
+def upstream_status_counts(columns):
+    """每个upstream中up/down/backup成员数"""
+    upstream_count = len(columns.upstream_names)
+    if columns.size == 0:
+        return np.zeros((0, len(STATUS_CODES)), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    counts = np.bincount(columns.upstream_codes * len(STATUS_CODES) + columns.status_codes,
+                         minlength=upstream_count * len(STATUS_CODES)).reshape(upstream_count, len(STATUS_CODES))
+    return counts, counts.sum(axis=1)
+
+
+def upstream_host_counts(columns):
+    """每个upstream出现在多少台主机上"""
+    upstream_count = len(columns.upstream_names)
+    if columns.size == 0:
+        return np.zeros(upstream_count, dtype=np.int64)
+    hosts = int(columns.client_ids.max()) + 1
+    pairs = np.unique(columns.upstream_codes * hosts + columns.client_ids)
+    return np.bincount(pairs // hosts, minlength=upstream_count)
+
+
+def upstream_weight_stats(columns):
+    """每个upstream的权重总和、最小、最大、平均值"""
+    upstream_count = len(columns.upstream_names)
+    totals = np.bincount(columns.upstream_codes, weights=columns.weights, minlength=upstream_count)
+    members = np.bincount(columns.upstream_codes, minlength=upstream_count)
+    minimums = np.full(upstream_count, np.iinfo(np.int64).max, dtype=np.int64)
+    maximums = np.full(upstream_count, np.iinfo(np.int64).min, dtype=np.int64)
+    np.minimum.at(minimums, columns.upstream_codes, columns.weights)
+    np.maximum.at(maximums, columns.upstream_codes, columns.weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(members > 0, totals / np.maximum(members, 1), 0.0)
+    return totals, minimums, maximums, means
+
+
+def weight_histogram(columns):
+    """整个集群的权重分布"""
+    values, counts = np.unique(columns.weights, return_counts=True)
+    return [{'weight': int(value), 'count': int(count)} for value, count in zip(values, counts)]
+
+
+def top_hosts_by_backends(columns, top=10):
+    """后端成员最多的主机"""
+    if columns.size == 0:
+        return []
+    client_ids, counts = np.unique(columns.client_ids, return_counts=True)
+    top = min(top, len(client_ids))
+    indexes = np.argpartition(-counts, top - 1)[:top]
+    indexes = indexes[np.argsort(-counts[indexes], kind='stable')]
+    hosts = dict(ClientInfo.objects.filter(id__in=client_ids[indexes].tolist()).values_list('id', 'host'))
+    return [{
+        'client': int(client_ids[index]),
+        'client_ip': hosts.get(int(client_ids[index])),
+        'backend_servers': int(counts[index])
+    } for index in indexes]
+
+
+def backend_summary(client_id=None, top=10, limit=100):
+    """
+    汇总后端服务器容量统计
+
+    参数:
+        client_id: 只统计指定客户端（可选）
+        top: 返回后端最多的主机数
+        limit: 按成员数降序最多返回的upstream数
+
+    返回:
+        dict: upstreams、weight_histogram、top_hosts、totals
+    """
+    columns = load_backend_columns()
+    if client_id is not None:
+        columns = columns.filter_client(client_id)
+
+    status_counts, member_counts = upstream_status_counts(columns)
+    totals, minimums, maximums, means = upstream_weight_stats(columns)
+    host_counts = upstream_host_counts(columns)
+
+    # 只输出当前数据中出现过的upstream
+    present = np.flatnonzero(member_counts)
+    ordered = present[np.argsort(-member_counts[present], kind='stable')][:limit]
+    upstreams = [{
+        'upstream': str(columns.upstream_names[index]),
+        'protocol': str(columns.upstream_protocols[index]),
+        'hosts': int(host_counts[index]),
+        'members': int(member_counts[index]),
+        'up': int(status_counts[index, 0]),
+        'down': int(status_counts[index, 1]),
+        'backup': int(status_counts[index, 2]),
+        'weight_total': int(totals[index]),
+        'weight_min': int(minimums[index]),
+        'weight_max': int(maximums[index]),
+        'weight_mean': round(float(means[index]), 3)
+    } for index in ordered]
+
+    status_totals = np.bincount(columns.status_codes, minlength=len(STATUS_CODES)) if columns.size else \
+        np.zeros(len(STATUS_CODES), dtype=np.int64)
+    return {
+        'totals': {
+            'backend_servers': int(columns.size),
+            'upstreams': int(len(present)),
+            **{status: int(status_totals[code]) for code, status in enumerate(STATUS_CODES)}
+        },
+        'upstreams': upstreams,
+        'weight_histogram': weight_histogram(columns),
+        'top_hosts': top_hosts_by_backends(columns, top)
+    }
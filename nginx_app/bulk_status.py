@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+批量摘除/恢复后端
+按地址索引找出所有引用该地址的主机和文件，每台主机读取一次受影响的文件（内容未变化时使用缓存），
+所有upstream中的命中项在同一次编辑中修改并只传输补丁，整台主机的文件在一个配置事务中写入，
+只执行一次nginx -t和一次reload；各主机并行执行，分别返回结果
+"""
+
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from client_app.capabilities import attach_capabilities
+from client_app.client import NginxParamikoClient
+from client_app.host_queue import queued_commit, reload_window
+from client_app.routing import address_host
+from client_app.transaction import NginxConfigTransaction
+from client_app.upstream_edit import UpstreamEditor
+from .analytics import invalidate_backend_columns
+from .models import BackendServerInfo
+
+logger = logging.getLogger(__name__)
+
+
+def address_filter(address):
+    """
+    地址索引上的查询条件
+
+    ip:port精确匹配；不带端口的ip匹配该主机的所有端口，用前缀查询仍然可以走backend_server_addr索引
+    """
+    host = address_host(address)
+    if host != address:
+        return Q(backend_server_addr=address)
+    prefix = f'[{host}]:' if ':' in host else f'{host}:'
+    return Q(backend_server_addr=host) | Q(backend_server_addr__startswith=prefix)
+
+
+def find_occurrences(address, client_ips=None):
+    """
+    用地址索引找出引用该地址的主机和配置文件
+
+    同一主机同一地址只有一行，记录的是最后同步的那个upstream，因此这里不按upstream过滤，
+    由UpstreamEditor.set_matching_status在文件中按upstream筛选
+
+    返回:
+        dict: ClientInfo.id -> {'server': ClientInfo, 'files': set}
+    """
+    rows = BackendServerInfo.objects.filter(address_filter(address)).select_related('client')
+    if client_ips:
+        rows = rows.filter(client__host__in=client_ips)
+
+    occurrences = {}
+    for row in rows:
+        entry = occurrences.setdefault(row.client_id, {'server': row.client, 'files': set()})
+        if row.file_path:
+            entry['files'].add(row.file_path)
+    return occurrences
+
+
+def graph_files(graph, address, upstreams=None):
+    """路由图中引用该地址的所有upstream所在的文件"""
+    files = set()
+    for resolved in graph.resolve_addresses(address):
+        for key in graph.upstreams_by_backend.get(resolved, {}):
+            if upstreams and key[1] not in upstreams:
+                continue
+            files.update(member.file_path for member in graph.members_by_upstream[key] if member.address == resolved)
+    return files
+
+
+def apply_to_host(server, files, address, status, upstreams=None, dry_run=False, fsync=False, graph_for=None):
+    """
+    在一台主机上修改所有命中的server指令
+
+    数据库中同一主机同一地址只有一行，地址出现在多个upstream时其余文件由graph_for补充：
+    graph_for(client_ip)返回该主机的RoutingGraph或None；没有路由图时只修改数据库中记录的文件，complete为False
+
+    返回:
+        dict: client_ip、success、complete、stage、changes（每项包含文件、upstream、行号、新旧指令）、transaction
+    """
+    result = {
+        'client_ip': server.host,
+        'success': False,
+        'complete': False,
+        'stage': 'connect',
+        'files': [],
+        'changes': [],
+        'transaction': None,
+        'error': '',
+    }
+    client = NginxParamikoClient(host=server.host, port=server.port, username=server.username,
+                                 password=server.password)
+    try:
+        graph = None
+        if graph_for is not None:
+            try:
+                graph = graph_for(server.host)
+            except Exception as e:
+                logger.warning('分析主机配置失败，只修改数据库中记录的文件 host=%s error=%s', server.host, e)
+        if graph is not None:
+            files = set(files) | graph_files(graph, address, upstreams)
+        result['complete'] = graph is not None
+
+        if not client.connect():
+            result['error'] = f'无法建立SSH连接到 {server.host}:{server.port}'
+            return result
+        attach_capabilities(client, server)
+
+        # 文件在读取之后被修改时补丁不会应用，重新读取后再试一次
+        for attempt in range(2):
+            result['stage'] = 'read'
+            edits, changes = [], []
+            for file_path, read_result in client.read_config_files(sorted(files), use_cache=attempt == 0).items():
+                if not read_result['success']:
+                    result['error'] = read_result['error']
+                    return result
+                editor = UpstreamEditor(read_result['content'])
+                file_changes = editor.set_matching_status(address, status, upstreams)
+                if file_changes:
+                    edits.append(editor.as_edit(file_path))
+                    changes.extend(dict(change, file_path=file_path) for change in file_changes)
+            result['files'] = [edit['file_path'] for edit in edits]
+            result['changes'] = changes
+
+            if not edits or dry_run:
+                result['stage'] = 'dry_run' if dry_run else 'done'
+                result['success'] = True
+                return result
+
+            result['stage'] = 'commit'
+            transaction_result = queued_commit(NginxConfigTransaction(client, edits,
+                                                                      nginx_path=server.nginx_config_path or None,
+                                                                      fsync=fsync),
+                                               window=reload_window(server))
+            if not transaction_result['stale']:
+                break
+        result['transaction'] = transaction_result
+        result['stage'] = transaction_result['stage']
+        result['success'] = transaction_result['success']
+        result['error'] = transaction_result['error']
+        return result
+    except Exception as e:
+        logger.error('批量修改后端状态失败 host=%s address=%s error=%s', server.host, address, e)
+        result['error'] = str(e)
+        return result
+    finally:
+        client.close()
+        # 能力探测结果可能在工作线程中写回ClientInfo，释放该线程的数据库连接
+        connection.close()
+
+
+def sync_upstream_changes(server, changes):
+    """
+    把已生效的set_status、set_weight修改写回该主机的BackendServerInfo
+
+    update()不会更新auto_now字段，显式写入updated_at，列式统计的快照据此判断过期
+    """
+    updated = False
+    for change in changes:
+        rows = BackendServerInfo.objects.filter(client=server, upstream=change['upstream'],
+                                                backend_server_addr=change['address'])
+        if change['op'] == 'set_status':
+            updated = rows.update(status=change['new_status'], updated_at=timezone.now()) or updated
+        elif change['op'] == 'set_weight':
+            updated = rows.update(weight=change['weight'], updated_at=timezone.now()) or updated
+    if updated:
+        invalidate_backend_columns()
+
+
+def bulk_set_status(address, status, client_ips=None, upstreams=None, dry_run=False, fsync=False, workers=8,
+                    graph_for=None):
+    """
+    在所有引用该地址的主机上把它设为status
+
+    返回:
+        dict: address、status、hosts（每台主机的结果）、summary；summary的incomplete为没有路由图、
+        可能遗漏了数据库中没有记录的upstream的主机数
+    """
+    occurrences = find_occurrences(address, client_ips)
+    hosts = []
+    if occurrences:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(occurrences)))) as executor:
+            # 每台主机在提交线程上下文的副本中执行，远程操作的耗时计入发起请求的耗时分解
+            futures = [executor.submit(contextvars.copy_context().run, apply_to_host, entry['server'], entry['files'],
+                                       address, status, upstreams, dry_run, fsync, graph_for)
+                       for entry in occurrences.values()]
+            hosts = [future.result() for future in futures]
+
+    if not dry_run:
+        # 数据库中的状态只在该主机的事务成功后更新
+        servers = {entry['server'].host: client_id for client_id, entry in occurrences.items()}
+        updated = False
+        for host in hosts:
+            changed_addresses = {change['address'].strip('"\'') for change in host['changes']}
+            if host['success'] and changed_addresses:
+                updated = BackendServerInfo.objects.filter(
+                    client_id=servers[host['client_ip']], backend_server_addr__in=changed_addresses
+                ).update(status=status, updated_at=timezone.now()) or updated
+        if updated:
+            invalidate_backend_columns()
+
+    return {
+        'address': address,
+        'status': status,
+        'dry_run': dry_run,
+        'hosts': sorted(hosts, key=lambda host: host['client_ip']),
+        'summary': {
+            'hosts': len(hosts),
+            'succeeded': sum(1 for host in hosts if host['success']),
+            'failed': sum(1 for host in hosts if not host['success']),
+            'unchanged': sum(1 for host in hosts if host['success'] and not host['changes']),
+            'incomplete': sum(1 for host in hosts if not host['complete']),
+            'files': sum(len(host['files']) for host in hosts),
+            'changes': sum(len(host['changes']) for host in hosts),
+        },
+    }
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+stub_status和访问日志采集器
+每个采集周期并行请求所有主机的stub_status（每台主机一次远程命令），SSH连接跨周期复用；
+远程请求在线程池中执行，采样写入、降采样和过期清理在调用线程中进行。
+访问日志从上次的位置增量读取，逐行解析并汇总到分钟汇总
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from client_app.access_log import DEFAULT_TAIL_BYTES, AccessLogTail, LogFormat
+from client_app.capabilities import attach_capabilities
+from client_app.client import NginxParamikoClient
+from client_app.models import ClientInfo
+from client_app.stub_status import DEFAULT_STUB_STATUS_URL, parse_stub_status, stub_status_command
+from . import access_logs, timeseries
+from .models import AccessLogSource
+
+logger = logging.getLogger(__name__)
+
+
+class HostConnections:
+    """
+    按ClientInfo.id保存已连接的客户端，跨采集周期复用，连接断开时重连
+
+    同一主机的检查和重连在该主机的锁内完成，并发调用方不会各自建立连接、互相覆盖而泄漏其中一个
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.host_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, server):
+        with self.lock:
+            host_lock = self.host_locks.setdefault(server.id, threading.Lock())
+        with host_lock:
+            with self.lock:
+                client = self.clients.get(server.id)
+            transport = client.ssh_client.get_transport() if client and client.ssh_client else None
+            if transport is not None and transport.is_active():
+                return client
+            if client is not None:
+                client.close()
+            client = NginxParamikoClient(host=server.host, port=server.port, username=server.username,
+                                         password=server.password)
+            if not client.connect():
+                with self.lock:
+                    self.clients.pop(server.id, None)
+                raise ConnectionError(f'无法建立SSH连接到 {server.host}:{server.port}')
+            attach_capabilities(client, server)
+            with self.lock:
+                self.clients[server.id] = client
+            return client
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+
+class MetricsCollector:
+    """
+    参数:
+        workers: 并行采集的主机数
+        default_url: ClientInfo未设置stub_status_url时使用的地址
+        downsample_every: 每隔多少个周期执行一次降采样和过期清理
+    """
+
+    def __init__(self, workers=8, default_url=DEFAULT_STUB_STATUS_URL, downsample_every=4, connections=None):
+        self.workers = workers
+        self.default_url = default_url
+        self.downsample_every = downsample_every
+        self.connections = connections or HostConnections()
+        self.cycles = 0
+
+    def scrape(self, server):
+        """采集一台主机，返回 (时间戳, stub_status字典)"""
+        try:
+            client = self.connections.get(server)
+            url = server.stub_status_url or self.default_url
+            result = client.execute_command(stub_status_command(url, client.get_capabilities()), timeout=10,
+                                            max_output_bytes=64 * 1024)
+        finally:
+            # 能力探测结果在工作线程中写回ClientInfo，释放该线程的数据库连接
+            connection.close()
+        ts = time.time()
+        sample = parse_stub_status(result.get('output', ''))
+        if sample is None:
+            raise ValueError(f'stub_status输出无法解析 url={url} error={result.get("error", "")[:200]}')
+        return ts, sample
+
+    def collect_once(self, servers=None):
+        """
+        执行一个采集周期
+
+        返回:
+            dict: ok、failed（主机 -> 错误）、elapsed
+        """
+        started = time.monotonic()
+        servers = list(servers if servers is not None else ClientInfo.objects.all())
+        summary = {'ok': 0, 'failed': {}}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(servers) or 1))) as executor:
+            futures = {executor.submit(self.scrape, server): server for server in servers}
+            for future, server in futures.items():
+                try:
+                    ts, sample = future.result()
+                except Exception as e:
+                    logger.warning('stub_status采集失败 host=%s error=%s', server.host, e)
+                    summary['failed'][server.host] = str(e)
+                    continue
+                timeseries.record_sample(server.id, sample, ts)
+                summary['ok'] += 1
+
+        self.cycles += 1
+        if self.cycles % self.downsample_every == 0:
+            for server in servers:
+                timeseries.downsample(server.id)
+            timeseries.enforce_retention()
+        summary['elapsed'] = round(time.monotonic() - started, 3)
+        return summary
+
+    def close(self):
+        self.connections.close()
+
+
+class AccessLogCollector:
+    """
+    访问日志增量采集
+
+    每个日志源每个周期一次远程命令，读取量受max_bytes限制；同一主机的多个日志源共用一个SSH连接，
+    不同日志源在线程池中并行读取和汇总，汇总在工作线程中按批写入数据库
+
+    参数:
+        workers: 并行读取的日志源数
+        max_bytes: 每个日志源每周期最多读取的字节数
+        max_buckets: 每个日志源内存中最多保留的汇总数
+        retention_every: 每隔多少个周期清理一次过期汇总
+    """
+
+    def __init__(self, workers=8, max_bytes=DEFAULT_TAIL_BYTES, max_buckets=access_logs.DEFAULT_MAX_BUCKETS,
+                 retention_every=60, connections=None):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_buckets = max_buckets
+        self.retention_every = retention_every
+        self.connections = connections or HostConnections()
+        self.formats = {}  # log_format字符串 -> 编译后的LogFormat
+        self.cycles = 0
+
+    def _format(self, log_format):
+        parser = self.formats.get(log_format)
+        if parser is None:
+            parser = self.formats[log_format] = LogFormat(log_format)
+        return parser
+
+    def tail(self, source):
+        """
+        读取一个日志源的新增内容
+
+        返回:
+            dict: lines、skipped（无法解析的行数）、bytes、rotated、rollups（写入的汇总数）
+        """
+        try:
+            client = self.connections.get(source.client)
+            parser = self._format(source.log_format)
+            aggregator = access_logs.RollupAggregator.for_source(source, self.max_buckets)
+            tail = AccessLogTail(client, source.path, source.inode, source.offset, self.max_bytes)
+            skipped = 0
+            rollups = 0
+            for line, (inode, offset) in tail:
+                record = parser.parse(line)
+                if record is None:
+                    skipped += 1
+                    continue
+                aggregator.add(record)
+                if aggregator.full:
+                    rollups += aggregator.flush(inode, offset)
+            if tail.result is None or tail.result['return_code'] not in (0, None):
+                error = (tail.result or {}).get('error') or '读取失败'
+                raise RuntimeError(f'{source.path}: {error.strip()[:300]}')
+            rollups += aggregator.flush(tail.inode, tail.offset)
+            return {'lines': tail.lines, 'skipped': skipped, 'bytes': tail.bytes_read, 'rotated': tail.rotated,
+                    'rollups': rollups}
+        except Exception as e:
+            access_logs.record_error(source, e)
+            raise
+        finally:
+            connection.close()
+
+    def collect_once(self, sources=None):
+        """
+        执行一个采集周期
+
+        返回:
+            dict: ok、failed（主机:路径 -> 错误）、lines、skipped、bytes、elapsed
+        """
+        started = time.monotonic()
+        if sources is None:
+            sources = AccessLogSource.objects.filter(enabled=True)
+        sources = list(sources.select_related('client') if hasattr(sources, 'select_related') else sources)
+        summary = {'ok': 0, 'failed': {}, 'lines': 0, 'skipped': 0, 'bytes': 0}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(sources) or 1))) as executor:
+            futures = {executor.submit(self.tail, source): source for source in sources}
+            for future, source in futures.items():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning('访问日志读取失败 host=%s path=%s error=%s', source.client.host, source.path, e)
+                    summary['failed'][f'{source.client.host}:{source.path}'] = str(e)
+                    continue
+                summary['ok'] += 1
+                for field in ('lines', 'skipped', 'bytes'):
+                    summary[field] += result[field]
+
+        self.cycles += 1
+        if self.cycles % self.retention_every == 0:
+            access_logs.enforce_retention()
+        summary['elapsed'] = round(time.monotonic() - started, 3)
+        return summary
+
+    def close(self):
+        self.connections.close()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+按计划采集各主机的stub_status
+
+用法:
+    python manage.py collect_nginx_metrics --interval 15
+    python manage.py collect_nginx_metrics --once --client-ip 10.0.0.1
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from client_app.models import ClientInfo
+from client_app.stub_status import DEFAULT_STUB_STATUS_URL
+from nginx_app.collector import MetricsCollector
+
+
+class Command(BaseCommand):
+    help = '按计划采集各主机的stub_status并写入时间序列'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=15, help='采集间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='只执行一个采集周期')
+        parser.add_argument('--workers', type=int, default=8, help='并行采集的主机数')
+        parser.add_argument('--url', default=DEFAULT_STUB_STATUS_URL, help='主机未设置stub_status_url时的默认地址')
+        parser.add_argument('--client-ip', action='append', help='只采集指定主机，可重复')
+
+    def handle(self, *args, **options):
+        collector = MetricsCollector(workers=options['workers'], default_url=options['url'])
+        try:
+            while True:
+                started = time.monotonic()
+                servers = ClientInfo.objects.all()
+                if options['client_ip']:
+                    servers = servers.filter(client_ip__in=options['client_ip'])
+                summary = collector.collect_once(servers)
+                self.stdout.write(f"采集完成 ok={summary['ok']} failed={len(summary['failed'])} "
+                                  f"elapsed={summary['elapsed']}s")
+                for host, error in summary['failed'].items():
+                    self.stderr.write(f'  {host}: {error}')
+                if options['once']:
+                    return
+                time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
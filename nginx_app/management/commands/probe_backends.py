@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+主动探测所有后端地址并写回存活状态
+
+用法:
+    python manage.py probe_backends --interval 10 --concurrency 500
+    python manage.py probe_backends --once
+"""
+
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from nginx_app.models import BackendServerInfo
+from nginx_app.prober import DEFAULT_FALL, DEFAULT_INTERVAL, DEFAULT_RISE, DEFAULT_TIMEOUT, BackendProber
+
+
+class Command(BaseCommand):
+    help = '主动探测后端地址（TCP或HTTP），按批写回BackendServerInfo的存活状态和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='默认探测间隔（秒）')
+        parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='单次探测超时（秒）')
+        parser.add_argument('--concurrency', type=int, default=500, help='同时进行的探测数')
+        parser.add_argument('--rise', type=int, default=DEFAULT_RISE, help='恢复需要的连续成功次数')
+        parser.add_argument('--fall', type=int, default=DEFAULT_FALL, help='判定不可达需要的连续失败次数')
+        parser.add_argument('--flush-interval', type=float, default=5, help='写回数据库的间隔（秒）')
+        parser.add_argument('--duration', type=float, help='运行多少秒后退出，默认一直运行')
+        parser.add_argument('--once', action='store_true', help='所有后端各探测一次后退出')
+        parser.add_argument('--client-ip', action='append', help='只探测指定主机的后端，可重复')
+
+    def handle(self, *args, **options):
+        queryset = None
+        if options['client_ip']:
+            queryset = BackendServerInfo.objects.filter(client__client_ip__in=options['client_ip'])
+        prober = BackendProber(interval=options['interval'], timeout=options['timeout'],
+                               concurrency=options['concurrency'], rise=options['rise'], fall=options['fall'],
+                               flush_interval=options['flush_interval'], queryset=queryset)
+        try:
+            if options['once']:
+                stats = asyncio.run(prober.probe_once())
+            else:
+                stats = asyncio.run(prober.run(options['duration']))
+        except KeyboardInterrupt:
+            stats = dict(prober.stats, targets=len(prober.targets))
+        finally:
+            prober.close()
+        self.stdout.write(f"探测结束 targets={stats['targets']} probes={stats['probes']} "
+                          f"failures={stats['failures']} changes={stats['changes']} "
+                          f"rows_written={stats['rows_written']}")
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+按计划增量读取各主机的访问日志并写入分钟汇总
+
+用法:
+    python manage.py tail_access_logs --interval 10
+    python manage.py tail_access_logs --once --client-ip 10.0.0.1
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from client_app.access_log import DEFAULT_TAIL_BYTES
+from nginx_app.collector import AccessLogCollector
+from nginx_app.models import AccessLogSource
+
+
+class Command(BaseCommand):
+    help = '按计划增量读取访问日志并写入分钟汇总'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=10, help='读取间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='只执行一个读取周期')
+        parser.add_argument('--workers', type=int, default=8, help='并行读取的日志源数')
+        parser.add_argument('--max-bytes', type=int, default=DEFAULT_TAIL_BYTES, help='每个日志源每周期最多读取的字节数')
+        parser.add_argument('--client-ip', action='append', help='只读取指定主机的日志，可重复')
+
+    def handle(self, *args, **options):
+        collector = AccessLogCollector(workers=options['workers'], max_bytes=options['max_bytes'])
+        try:
+            while True:
+                started = time.monotonic()
+                sources = AccessLogSource.objects.filter(enabled=True)
+                if options['client_ip']:
+                    sources = sources.filter(client__client_ip__in=options['client_ip'])
+                summary = collector.collect_once(sources)
+                self.stdout.write(f"读取完成 ok={summary['ok']} failed={len(summary['failed'])} "
+                                  f"lines={summary['lines']} skipped={summary['skipped']} "
+                                  f"bytes={summary['bytes']} elapsed={summary['elapsed']}s")
+                for source, error in summary['failed'].items():
+                    self.stderr.write(f'  {source}: {error}')
+                if options['once']:
+                    return
+                time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+请求耗时分解中间件
+为每个请求记录SSH连接、远程命令、SFTP、解析、分析和数据库各阶段的耗时，
+通过Server-Timing响应头返回，并按视图写入进程内的Prometheus指标
+"""
+
+import time
+
+from django.db import connections
+
+from client_app.instrumentation import current_profile, end_profile, record, registry, start_profile
+
+
+class RequestTimingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile, token = start_profile()
+        db = {'queries': 0, 'seconds': 0.0}
+
+        def db_wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                db['queries'] += 1
+                db['seconds'] += time.perf_counter() - started
+
+        try:
+            with connections['default'].execute_wrapper(db_wrapper):
+                response = self.get_response(request)
+            if db['queries']:
+                # 数据库耗时按请求汇总为一个span，避免每条SQL都写一次直方图
+                record('db', db['seconds'], calls=db['queries'])
+        finally:
+            end_profile(token)
+
+        view = profile.view or 'unresolved'
+        registry.observe('request_seconds', profile.elapsed, '请求总耗时', view=view,
+                         status=str(response.status_code))
+        response['Server-Timing'] = profile.server_timing()
+        # 前端与后端跨域部署，允许浏览器读取Server-Timing
+        response['Timing-Allow-Origin'] = '*'
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = current_profile()
+        if profile is not None and request.resolver_match is not None:
+            profile.view = request.resolver_match.url_name or request.resolver_match.view_name
+        return None
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0002_clientinfo_host_clientinfo_name_and_more'),
+        ('nginx_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='backendserverinfo',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='protocol',
+            field=models.CharField(choices=[('http', 'HTTP'), ('stream', 'TCP/UDP')], db_index=True, default='http', max_length=10),
+        ),
+        migrations.AlterUniqueTogether(
+            name='backendserverinfo',
+            unique_together={('client', 'protocol', 'backend_server_addr')},
+        ),
+    ]
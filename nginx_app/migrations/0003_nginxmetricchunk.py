@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0004_clientinfo_stub_status_url'),
+        ('nginx_app', '0002_backendserverinfo_protocol'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NginxMetricChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField(default=0)),
+                ('chunk_start', models.BigIntegerField()),
+                ('points', models.IntegerField(default=0)),
+                ('last_ts', models.BigIntegerField(default=0)),
+                ('data', models.BinaryField(default=b'')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metric_chunks', to='client_app.clientinfo')),
+            ],
+            options={
+                'db_table': 'nginx_metric_chunk',
+                'indexes': [models.Index(fields=['resolution', 'chunk_start'], name='nginx_metri_resolut_c95f59_idx')],
+                'unique_together': {('client', 'resolution', 'chunk_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0004_clientinfo_stub_status_url'),
+        ('nginx_app', '0003_nginxmetricchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessLogRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.BigIntegerField()),
+                ('vhost', models.CharField(max_length=255)),
+                ('upstream', models.CharField(max_length=255)),
+                ('requests', models.IntegerField(default=0)),
+                ('status_1xx', models.IntegerField(default=0)),
+                ('status_2xx', models.IntegerField(default=0)),
+                ('status_3xx', models.IntegerField(default=0)),
+                ('status_4xx', models.IntegerField(default=0)),
+                ('status_5xx', models.IntegerField(default=0)),
+                ('bytes_sent', models.BigIntegerField(default=0)),
+                ('upstream_requests', models.IntegerField(default=0)),
+                ('upstream_time_sum', models.FloatField(default=0)),
+                ('latency_histogram', models.BinaryField(default=b'')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access_log_rollups', to='client_app.clientinfo')),
+            ],
+            options={
+                'db_table': 'access_log_rollup',
+                'indexes': [models.Index(fields=['minute'], name='access_log__minute_4d8578_idx')],
+                'unique_together': {('client', 'minute', 'vhost', 'upstream')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AccessLogSource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500)),
+                ('log_format', models.TextField()),
+                ('inode', models.BigIntegerField(blank=True, null=True)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('enabled', models.BooleanField(default=True)),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.CharField(blank=True, default='', max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access_logs', to='client_app.clientinfo')),
+            ],
+            options={
+                'db_table': 'access_log_source',
+                'unique_together': {('client', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nginx_app', '0004_accesslogrollup_accesslogsource'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='health',
+            field=models.CharField(choices=[('unknown', '未探测'), ('healthy', '存活'), ('unhealthy', '不可达')], db_index=True, default='unknown', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='health_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='health_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='health_error',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='latency_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='probe_interval',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backendserverinfo',
+            name='probe_path',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+    ]
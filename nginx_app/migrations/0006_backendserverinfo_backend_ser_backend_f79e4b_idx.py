@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0004_clientinfo_stub_status_url'),
+        ('nginx_app', '0005_backendserverinfo_health_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backendserverinfo',
+            index=models.Index(fields=['backend_server_addr'], name='backend_ser_backend_f79e4b_idx'),
+        ),
+    ]
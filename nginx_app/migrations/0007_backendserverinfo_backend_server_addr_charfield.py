@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nginx_app', '0006_backendserverinfo_backend_ser_backend_f79e4b_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backendserverinfo',
+            name='backend_server_addr',
+            field=models.CharField(max_length=255),
+        ),
+    ]
@@ -27,19 +27,118 @@ class BackendServerInfo(models.Model):
         ('down', '下线'),
         ('backup', '备用'),
     ]
+    PROTOCOL_CHOICES = [
+        ('http', 'HTTP'),
+        ('stream', 'TCP/UDP'),
+    ]
+    HEALTH_CHOICES = [
+        ('unknown', '未探测'),
+        ('healthy', '存活'),
+        ('unhealthy', '不可达'),
+    ]
 
     client = models.ForeignKey(ClientInfo, on_delete=models.CASCADE, related_name='backend_servers')
-    backend_server_addr = models.GenericIPAddressField()
+    backend_server_addr = models.CharField(max_length=255)  # ip:port、[ipv6]:port、域名:port或unix:路径
     file_path = models.CharField(max_length=500)  # 改为CharField并指定长度
     upstream = models.CharField(max_length=255)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='up')
     weight = models.IntegerField(default=1)
+    protocol = models.CharField(max_length=10, choices=PROTOCOL_CHOICES, default='http', db_index=True)
+    # 主动探测结果，status仍然是配置文件中的状态
+    health = models.CharField(max_length=10, choices=HEALTH_CHOICES, default='unknown', db_index=True)
+    health_checked_at = models.DateTimeField(null=True, blank=True)
+    health_changed_at = models.DateTimeField(null=True, blank=True)
+    health_error = models.CharField(max_length=200, blank=True, default='')
+    latency_ms = models.FloatField(null=True, blank=True)
+    probe_interval = models.IntegerField(null=True, blank=True)  # 探测间隔（秒），为空时使用探测器的默认值
+    probe_path = models.CharField(max_length=200, null=True, blank=True)  # 设置时用HTTP GET探测，否则只建立TCP连接
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'backend_server_info'
-        unique_together = ['client', 'backend_server_addr']
+        unique_together = ['client', 'protocol', 'backend_server_addr']
+        # 跨主机按地址查找（批量摘除/恢复）
+        indexes = [models.Index(fields=['backend_server_addr'])]
+
+    def __str__(self):
+        return f"{self.backend_server_addr} ({self.status})"
+
+
+class NginxMetricChunk(models.Model):
+    """
+    stub_status时间序列块
+
+    每行保存一台主机某一分辨率下一个时间段内的全部采样点，按timeseries.POINT_DTYPE打包，
+    resolution为0表示原始采样
+    """
+    client = models.ForeignKey(ClientInfo, on_delete=models.CASCADE, related_name='metric_chunks')
+    resolution = models.IntegerField(default=0)
+    chunk_start = models.BigIntegerField()  # 块起始时间戳（秒），按块长度对齐
+    points = models.IntegerField(default=0)
+    last_ts = models.BigIntegerField(default=0)
+    data = models.BinaryField(default=b'')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'nginx_metric_chunk'
+        unique_together = ['client', 'resolution', 'chunk_start']
+        indexes = [models.Index(fields=['resolution', 'chunk_start'])]
+
+    def __str__(self):
+        return f"{self.client_id}/{self.resolution}/{self.chunk_start} ({self.points})"
+
+
+class AccessLogSource(models.Model):
+    """
+    需要增量读取的访问日志
+
+    inode和offset为下一次读取的位置，与对应的分钟汇总在同一个事务中更新
+    """
+    client = models.ForeignKey(ClientInfo, on_delete=models.CASCADE, related_name='access_logs')
+    path = models.CharField(max_length=500)
+    log_format = models.TextField()  # nginx log_format字符串
+    inode = models.BigIntegerField(null=True, blank=True)
+    offset = models.BigIntegerField(default=0)
+    enabled = models.BooleanField(default=True)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=500, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'access_log_source'
+        unique_together = ['client', 'path']
+
+    def __str__(self):
+        return f"{self.client_id}:{self.path} @{self.offset}"
+
+
+class AccessLogRollup(models.Model):
+    """
+    访问日志按分钟、虚拟主机和upstream的汇总
+
+    上游耗时按access_logs.LATENCY_BOUNDS分桶计数，桶计数可以直接相加，分位数在查询时计算
+    """
+    client = models.ForeignKey(ClientInfo, on_delete=models.CASCADE, related_name='access_log_rollups')
+    minute = models.BigIntegerField()  # 分钟起始时间戳（秒）
+    vhost = models.CharField(max_length=255)
+    upstream = models.CharField(max_length=255)
+    requests = models.IntegerField(default=0)
+    status_1xx = models.IntegerField(default=0)
+    status_2xx = models.IntegerField(default=0)
+    status_3xx = models.IntegerField(default=0)
+    status_4xx = models.IntegerField(default=0)
+    status_5xx = models.IntegerField(default=0)
+    bytes_sent = models.BigIntegerField(default=0)
+    upstream_requests = models.IntegerField(default=0)  # 有上游耗时的请求数
+    upstream_time_sum = models.FloatField(default=0)
+    latency_histogram = models.BinaryField(default=b'')
+
+    class Meta:
+        db_table = 'access_log_rollup'
+        unique_together = ['client', 'minute', 'vhost', 'upstream']
+        indexes = [models.Index(fields=['minute'])]
 
     def __str__(self):
-        return f"{self.backend_server_addr} ({self.status})"
\ No newline at end of file
+        return f"{self.client_id}/{self.minute}/{self.vhost}/{self.upstream} ({self.requests})"
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+后端主动探测
+在管理端用asyncio并发探测所有后端地址（TCP连接，或设置了probe_path时HTTP GET），每个地址按自己的间隔调度；
+同一地址出现在多台nginx主机或多个upstream中时只探测一次。存活状态经过连续成功/失败次数和抖动惩罚
+两层阻尼后才改变，结果在内存中累积，按批写回BackendServerInfo的health、latency_ms等字段
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import close_old_connections
+
+from .models import BackendServerInfo
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+DEFAULT_TIMEOUT = 2
+# 连续成功rise次才恢复，连续失败fall次才判定不可达
+DEFAULT_RISE = 2
+DEFAULT_FALL = 3
+# 每次状态变化记1分惩罚，按半衰期衰减；惩罚不低于阈值时不恢复为存活
+FLAP_HALF_LIFE = 300
+FLAP_SUPPRESS = 3
+
+HEALTH_FIELDS = ['health', 'health_checked_at', 'health_changed_at', 'health_error', 'latency_ms']
+
+
+def parse_address(address, default_port=80):
+    """
+    nginx server参数中的地址 -> (host, port)
+
+    支持 ip、ip:port、[ipv6]:port、域名:port；unix套接字和无效端口返回None
+    """
+    address = (address or '').strip()
+    if not address or address.startswith('unix:'):
+        return None
+    if address.startswith('['):
+        host, _, rest = address[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host, port = address, ''
+    if port and not (port.isdigit() and 0 < int(port) < 65536):
+        return None
+    return host, int(port) if port else default_port
+
+
+def _datetime(ts):
+    return datetime.fromtimestamp(ts, tz=dt_timezone.utc) if ts else None
+
+
+class ProbeTarget:
+    """一个探测地址及其阻尼状态，rows为共用该地址的BackendServerInfo.id"""
+
+    __slots__ = ('host', 'port', 'path', 'interval', 'rows', 'health', 'successes', 'failures', 'penalty',
+                 'penalty_at', 'latency_ms', 'error', 'checked_at', 'changed_at', 'dirty', 'written_at',
+                 'in_flight')
+
+    def __init__(self, host, port, path, interval, health='unknown'):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.rows = set()
+        self.health = health
+        self.successes = 0
+        self.failures = 0
+        self.penalty = 0.0
+        self.penalty_at = 0.0
+        self.latency_ms = None
+        self.error = ''
+        self.checked_at = None
+        self.changed_at = None
+        self.dirty = False
+        self.written_at = 0.0
+        self.in_flight = False
+
+    @property
+    def key(self):
+        return self.host, self.port, self.path
+
+
+class BackendProber:
+    """
+    参数:
+        interval: 没有设置probe_interval的后端的探测间隔（秒）
+        timeout: 单次探测超时（秒）
+        concurrency: 同时进行的探测数
+        rise、fall: 恢复和判定不可达需要的连续成功、失败次数
+        flush_interval: 写回数据库的间隔（秒），状态变化在下一次写回时生效
+        touch_interval: 状态没有变化的后端多久刷新一次探测时间和延迟
+        refresh_interval: 重新读取后端列表的间隔（秒）
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT, concurrency=500, rise=DEFAULT_RISE,
+                 fall=DEFAULT_FALL, flush_interval=5, touch_interval=60, refresh_interval=60, queryset=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.rise = rise
+        self.fall = fall
+        self.flush_interval = flush_interval
+        self.touch_interval = touch_interval
+        self.refresh_interval = refresh_interval
+        self.queryset = queryset
+        self.targets = {}
+        # 调度堆中时间相同的条目按加入顺序排列，不比较目标对象
+        self.sequence = itertools.count()
+        # 数据库读写都在这一个线程里执行，不阻塞事件循环
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prober-db')
+        self.stats = {'probes': 0, 'failures': 0, 'changes': 0, 'rows_written': 0}
+
+    # ---- 目标列表 ----
+
+    def load_targets(self):
+        """从BackendServerInfo重建目标列表，保留已有目标的阻尼状态，返回新增的目标"""
+        close_old_connections()
+        queryset = self.queryset if self.queryset is not None else BackendServerInfo.objects.all()
+        rows = queryset.values_list('id', 'backend_server_addr', 'probe_interval', 'probe_path', 'health')
+        targets = {}
+        for row_id, address, interval, path, health in rows:
+            parsed = parse_address(address)
+            if parsed is None:
+                continue
+            key = parsed + (path or None,)
+            target = targets.get(key)
+            if target is None:
+                target = self.targets.get(key) or ProbeTarget(*key, interval or self.interval, health)
+                target.rows = set()
+                targets[key] = target
+            # 同一地址有多个间隔设置时取最短的
+            target.interval = min(target.interval, interval or self.interval) if target.rows \
+                else interval or self.interval
+            target.rows.add(row_id)
+        added = [target for key, target in targets.items() if key not in self.targets]
+        self.targets = targets
+        return added
+
+    # ---- 探测 ----
+
+    async def probe(self, target):
+        """
+        探测一次
+
+        返回:
+            tuple: (是否成功, 延迟毫秒数, 错误信息)；HTTP探测的延迟为收到状态行的时间
+        """
+        started = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(target.host, target.port),
+                                                    self.timeout)
+            if target.path:
+                host = f'[{target.host}]' if ':' in target.host else target.host
+                writer.write(f'GET {target.path} HTTP/1.0\r\nHost: {host}\r\nUser-Agent: manageNginx-prober\r\n'
+                             f'Connection: close\r\n\r\n'.encode())
+                remaining = max(self.timeout - (time.perf_counter() - started), 0.01)
+                line = await asyncio.wait_for(reader.readline(), remaining)
+                parts = line.decode('latin-1').split()
+                code = int(parts[1]) if len(parts) >= 2 and parts[1].isdigit() else 0
+                if not 200 <= code < 400:
+                    return False, None, f'HTTP {code}' if code else '无效的HTTP响应'
+            return True, round((time.perf_counter() - started) * 1000, 2), ''
+        except asyncio.TimeoutError:
+            return False, None, f'超时({self.timeout}秒)'
+        except OSError as e:
+            return False, None, (e.strerror or str(e))[:200]
+        except Exception as e:
+            # 无法解析的主机名（如 a..b 的UnicodeError）等，探测失败而不是让任务异常退出
+            return False, None, f'{type(e).__name__}: {e}'[:200]
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def apply(self, target, ok, latency_ms, error, now, damping=True):
+        """记录一次探测结果，按阻尼规则决定是否改变存活状态"""
+        self.stats['probes'] += 1
+        target.checked_at = now
+        target.latency_ms = latency_ms
+        target.error = error
+        if ok:
+            target.successes += 1
+            target.failures = 0
+        else:
+            self.stats['failures'] += 1
+            target.failures += 1
+            target.successes = 0
+
+        if target.penalty:
+            target.penalty *= 0.5 ** ((now - target.penalty_at) / FLAP_HALF_LIFE)
+            target.penalty_at = now
+
+        health = target.health
+        if not damping or health == 'unknown':
+            health = 'healthy' if ok else 'unhealthy'
+        elif health == 'healthy' and target.failures >= self.fall:
+            health = 'unhealthy'
+        elif health == 'unhealthy' and target.successes >= self.rise and target.penalty < FLAP_SUPPRESS:
+            health = 'healthy'
+
+        if health != target.health:
+            if target.health != 'unknown':
+                target.penalty += 1
+                target.penalty_at = now
+            target.health = health
+            target.changed_at = now
+            target.dirty = True
+            self.stats['changes'] += 1
+            logger.info('后端存活状态变化 %s:%s -> %s %s', target.host, target.port, health, error)
+        elif now - target.written_at >= self.touch_interval:
+            target.dirty = True
+
+    async def _probe_and_apply(self, target, semaphore, heap):
+        try:
+            async with semaphore:
+                ok, latency_ms, error = await self.probe(target)
+            self.apply(target, ok, latency_ms, error, time.time())
+        finally:
+            # 无论结果如何都重新排队，目标不会因为一次异常而不再被探测
+            target.in_flight = False
+            heapq.heappush(heap, (time.monotonic() + target.interval, next(self.sequence), target))
+
+    # ---- 写回 ----
+
+    def _collect(self):
+        """在事件循环线程中取出需要写回的行，写回本身交给数据库线程"""
+        changed, touched = [], []
+        now = time.time()
+        for target in self.targets.values():
+            if not target.dirty:
+                continue
+            checked_at = _datetime(target.checked_at)
+            changed_at = _datetime(target.changed_at)
+            for row_id in target.rows:
+                row = BackendServerInfo(id=row_id, health=target.health, health_checked_at=checked_at,
+                                        health_error=target.error, latency_ms=target.latency_ms,
+                                        health_changed_at=changed_at)
+                # 状态没有变化过的目标不覆盖health_changed_at
+                (changed if changed_at else touched).append(row)
+            target.dirty = False
+            target.written_at = now
+        return changed, touched
+
+    def _write(self, changed, touched):
+        close_old_connections()
+        if changed:
+            BackendServerInfo.objects.bulk_update(changed, HEALTH_FIELDS, batch_size=500)
+        if touched:
+            BackendServerInfo.objects.bulk_update(
+                touched, [field for field in HEALTH_FIELDS if field != 'health_changed_at'], batch_size=500)
+        self.stats['rows_written'] += len(changed) + len(touched)
+        return len(changed) + len(touched)
+
+    def flush(self):
+        """把有变化或需要刷新的目标写回数据库，每批一条UPDATE"""
+        return self._write(*self._collect())
+
+    # ---- 运行 ----
+
+    async def probe_once(self):
+        """所有目标各探测一次，不做阻尼，直接写回"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.db_executor, self.load_targets)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(target):
+            async with semaphore:
+                ok, latency_ms, error = await self.probe(target)
+            self.apply(target, ok, latency_ms, error, time.time(), damping=False)
+
+        await asyncio.gather(*(run(target) for target in self.targets.values()))
+        await loop.run_in_executor(self.db_executor, self._write, *self._collect())
+        return dict(self.stats, targets=len(self.targets))
+
+    async def probe_rows(self):
+        """
+        所有目标各探测一次，只返回结果：不改变阻尼状态，不写回数据库
+
+        返回:
+            dict: BackendServerInfo.id -> 是否成功；探测本身出错的目标状态未知，不在结果中
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.db_executor, self.load_targets)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(target):
+            async with semaphore:
+                return await self.probe(target)
+
+        targets = list(self.targets.values())
+        results = await asyncio.gather(*(run(target) for target in targets), return_exceptions=True)
+        reachable = {}
+        for target, result in zip(targets, results):
+            if isinstance(result, BaseException):
+                logger.warning('探测 %s:%s 出错: %s', target.host, target.port, result)
+                continue
+            for row_id in target.rows:
+                reachable[row_id] = result[0]
+        return reachable
+
+    async def run(self, duration=None):
+        """
+        持续探测
+
+        新目标的第一次探测在一个间隔内随机分散，避免同时发起上千个连接
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        heap = []
+        tasks = set()
+        started = time.monotonic()
+        next_flush = started + self.flush_interval
+        next_refresh = started
+        writing = None
+        try:
+            while duration is None or time.monotonic() - started < duration:
+                now = time.monotonic()
+                if now >= next_refresh:
+                    added = await loop.run_in_executor(self.db_executor, self.load_targets)
+                    if not heap and not tasks:
+                        added = list(self.targets.values())
+                    for target in added:
+                        heapq.heappush(heap, (now + random.uniform(0, target.interval), next(self.sequence), target))
+                    next_refresh = now + self.refresh_interval
+                if now >= next_flush and (writing is None or writing.done()):
+                    # 写回不阻塞调度，上一次写回还没完成时顺延到下一个周期
+                    writing = loop.run_in_executor(self.db_executor, self._write, *self._collect())
+                    next_flush = now + self.flush_interval
+
+                while heap and heap[0][0] <= now:
+                    _, _, target = heapq.heappop(heap)
+                    # 堆中保存目标对象本身：已从配置中删除的目标不再调度，删除后又加回的地址是新对象，
+                    # 旧对象的条目在这里丢弃，不会与新对象形成两条探测链
+                    if self.targets.get(target.key) is not target or target.in_flight:
+                        continue
+                    target.in_flight = True
+                    task = asyncio.create_task(self._probe_and_apply(target, semaphore, heap))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                wake = min(next_flush, next_refresh, heap[0][0] if heap else next_flush)
+                await asyncio.sleep(min(max(wake - time.monotonic(), 0.01), 0.5))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if writing is not None:
+                await asyncio.gather(writing, return_exceptions=True)
+            await loop.run_in_executor(self.db_executor, self._write, *self._collect())
+        return dict(self.stats, targets=len(self.targets))
+
+    def close(self):
+        self.db_executor.shutdown(wait=True)
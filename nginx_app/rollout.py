@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+分波次灰度发布配置
+把同一个配置修改按波次应用到多台主机，同一波内各主机并行执行（经各自主机的操作队列，保留备份）；
+每波生效后观察一段时间，比较生效前后的健康信号：stub_status丢弃的连接数和请求速率、
+经nginx请求的健康检查地址、后端主动探测结果。出现退化的主机数超过阈值时撤销该波所有主机的修改并停止，
+之前已经通过检查的波次保持不变
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from client_app.host_queue import host_queues, queued_commit, reload_window
+from client_app.stub_status import DEFAULT_STUB_STATUS_URL, http_status_command, parse_stub_status, stub_status_command
+from client_app.transaction import NginxConfigTransaction
+from client_app.upstream_edit import UpstreamEditError, apply_operations
+from .bulk_status import sync_upstream_changes
+from .collector import HostConnections
+from .models import BackendServerInfo
+from .prober import BackendProber
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOAK_SECONDS = 10
+HTTP_MARKER = '@@http'
+
+
+def plan_waves(servers, sizes):
+    """按sizes把主机分成波次，sizes用完后按最后一个大小继续分，例如[1, 10]为先1台、之后每波10台"""
+    waves = []
+    index = 0
+    while index < len(servers):
+        size = sizes[min(len(waves), len(sizes) - 1)]
+        waves.append(servers[index:index + size])
+        index += size
+    return waves
+
+
+class HealthThresholds:
+    """
+    参数:
+        max_dropped: 观察期内每台主机允许丢弃的连接数（stub_status中accepts与handled之差的增量）
+        max_request_drop: 请求速率允许下降的比例
+        min_request_rate: 生效前的请求速率（每秒）低于此值时不比较速率，流量太小时速率没有意义
+        max_unhealthy: 每台主机允许新增的不可达后端数
+    """
+
+    def __init__(self, max_dropped=0, max_request_drop=0.5, min_request_rate=1.0, max_unhealthy=0):
+        self.max_dropped = max_dropped
+        self.max_request_drop = max_request_drop
+        self.min_request_rate = min_request_rate
+        self.max_unhealthy = max_unhealthy
+
+
+def _rate(before, after):
+    elapsed = after['ts'] - before['ts']
+    if elapsed <= 0:
+        return None
+    return (after['stub']['requests'] - before['stub']['requests']) / elapsed
+
+
+def evaluate(baseline, before, after, thresholds):
+    """
+    比较一台主机生效前后的健康信号
+
+    参数:
+        baseline: 发布开始时的采样，与before一起给出生效前的请求速率
+        before、after: 生效前和观察期结束时的采样，包含ts、stub、http_status、unhealthy
+
+    返回:
+        list: 退化原因，空列表表示通过
+    """
+    problems = []
+    if before['stub'] is not None:
+        if after['stub'] is None:
+            problems.append(f'stub_status不可用: {after["error"]}')
+        elif after['stub']['requests'] < before['stub']['requests']:
+            problems.append('stub_status计数器被重置，nginx可能已重启')
+        else:
+            dropped = ((after['stub']['accepts'] - after['stub']['handled'])
+                       - (before['stub']['accepts'] - before['stub']['handled']))
+            if dropped > thresholds.max_dropped:
+                problems.append(f'丢弃了{dropped}个连接')
+            rate_before = _rate(baseline, before) if baseline and baseline['stub'] is not None else None
+            rate_after = _rate(before, after)
+            if rate_before is not None and rate_after is not None and rate_before >= thresholds.min_request_rate \
+                    and rate_after < rate_before * (1 - thresholds.max_request_drop):
+                problems.append(f'请求速率从{rate_before:.1f}/s降到{rate_after:.1f}/s')
+    if after['http_status'] is not None and not 200 <= after['http_status'] < 400 \
+            and (before['http_status'] is None or 200 <= before['http_status'] < 400):
+        problems.append(f'健康检查返回{after["http_status"] or "连接失败"}')
+    if before['unhealthy'] is not None and after['unhealthy'] is not None \
+            and after['unhealthy'] - before['unhealthy'] > thresholds.max_unhealthy:
+        problems.append(f'不可达后端从{before["unhealthy"]}个增加到{after["unhealthy"]}个')
+    return problems
+
+
+class ConfigRollout:
+    """
+    参数:
+        servers: 目标主机（ClientInfo），按发布顺序排列
+        files: 写入每台主机的文件，[{'file_path', 'file_content'}]
+        upstream_edits: 在每台主机上执行的upstream结构化修改，[{'file_path', 'operations'}]
+        waves: 各波次的主机数，见plan_waves
+        soak_seconds: 每波生效后的观察时间
+        failure_threshold: 一波内允许退化的主机数，超过时撤销该波并停止
+        health_url: 在每台主机本地经nginx请求的健康检查地址，返回2xx/3xx为正常（可选）
+        probe_backends: 观察期结束时主动探测该波主机的后端，比较不可达后端数
+    """
+
+    def __init__(self, servers, files=None, upstream_edits=None, waves=(1,), soak_seconds=DEFAULT_SOAK_SECONDS,
+                 failure_threshold=0, thresholds=None, health_url=None, probe_backends=True, workers=8,
+                 fsync=False, stub_status_url=DEFAULT_STUB_STATUS_URL, connections=None):
+        self.servers = list(servers)
+        self.files = list(files or [])
+        self.upstream_edits = list(upstream_edits or [])
+        self.waves = plan_waves(self.servers, list(waves) or [1])
+        self.soak_seconds = soak_seconds
+        self.failure_threshold = failure_threshold
+        self.thresholds = thresholds or HealthThresholds()
+        self.health_url = health_url
+        self.probe_backends = probe_backends
+        self.workers = workers
+        self.fsync = fsync
+        self.stub_status_url = stub_status_url
+        self.connections = connections or HostConnections()
+        self.prober = BackendProber() if probe_backends else None
+        self.baseline = {}  # 主机 -> 发布开始时的采样
+        self.unhealthy = {}  # ClientInfo.id -> 不可达后端数
+        self.transactions = {}  # 主机 -> 已提交、保留了备份的事务
+
+    # ---- 健康信号 ----
+
+    def sample(self, server):
+        """一次远程命令读取stub_status，设置了health_url时同时经nginx请求健康检查地址"""
+        sample = {'ts': None, 'stub': None, 'http_status': None, 'unhealthy': self.unhealthy.get(server.id),
+                  'error': ''}
+        try:
+            client = self.connections.get(server)
+            caps = client.get_capabilities()
+            command = stub_status_command(server.stub_status_url or self.stub_status_url, caps)
+            if self.health_url:
+                command = f'{command}; echo; echo "{HTTP_MARKER} $({http_status_command(self.health_url, caps)})"'
+            result = client.execute_command(command, timeout=15, max_output_bytes=64 * 1024)
+            sample['ts'] = time.time()
+            output = result.get('output', '')
+            sample['stub'] = parse_stub_status(output)
+            if sample['stub'] is None:
+                sample['error'] = result.get('error', '')[:200] or 'stub_status输出无法解析'
+            for line in output.splitlines():
+                if line.startswith(HTTP_MARKER):
+                    code = line[len(HTTP_MARKER):].strip()
+                    sample['http_status'] = int(code) if code.isdigit() else 0
+        except Exception as e:
+            sample['error'] = str(e)
+        finally:
+            # 能力探测结果可能在工作线程中写回ClientInfo，释放该线程的数据库连接
+            connection.close()
+        return sample
+
+    def refresh_unhealthy(self, servers):
+        """
+        主动探测这些主机的后端一次，按内存中的探测结果统计每台主机的不可达后端数
+
+        结果不写回数据库，后端的health仍由常驻探测进程经过阻尼后更新；探测出错时不可达后端数记为未知（None），
+        evaluate不比较未知的数量
+        """
+        if self.prober is None:
+            return
+        client_ids = [server.id for server in servers]
+        try:
+            self.prober.queryset = BackendServerInfo.objects.filter(client_id__in=client_ids)
+            rows = dict(self.prober.queryset.values_list('id', 'client_id'))
+            reachable = asyncio.run(self.prober.probe_rows())
+        except Exception as e:
+            logger.warning('灰度发布探测后端失败 hosts=%s error=%s', [server.host for server in servers], e)
+            for client_id in client_ids:
+                self.unhealthy[client_id] = None
+            return
+        counts = Counter(rows[row_id] for row_id, ok in reachable.items() if not ok and row_id in rows)
+        for client_id in client_ids:
+            self.unhealthy[client_id] = counts.get(client_id, 0)
+
+    def _parallel(self, func, items):
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(items)))) as executor:
+            # 上下文不能同时在多个线程中进入，每个任务使用各自的副本
+            futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+            return [future.result() for future in futures]
+
+    # ---- 应用和撤销 ----
+
+    def _edits(self, client, use_cache):
+        edits = [{'file_path': edit['file_path'], 'file_content': edit['file_content']} for edit in self.files]
+        changes = []
+        if self.upstream_edits:
+            paths = [edit['file_path'] for edit in self.upstream_edits]
+            contents = client.read_config_files(paths, use_cache=use_cache)
+            for edit in self.upstream_edits:
+                read_result = contents[edit['file_path']]
+                if not read_result['success']:
+                    raise UpstreamEditError(read_result['error'])
+                editor = apply_operations(read_result['content'], edit['operations'])
+                if editor.changes:
+                    edits.append(editor.as_edit(edit['file_path']))
+                    changes.extend(dict(change, file_path=edit['file_path']) for change in editor.changes)
+        return edits, changes
+
+    def apply(self, server):
+        """在一台主机上生效：先采样，再提交事务（保留备份）"""
+        entry = {
+            'client_ip': server.host,
+            'success': False,
+            'stage': 'connect',
+            'changes': [],
+            'transaction': None,
+            'before': None,
+            'after': None,
+            'problems': [],
+            'reverted': None,
+            'error': '',
+        }
+        try:
+            client = self.connections.get(server)
+            entry['before'] = self.sample(server)
+            # 补丁的原内容与远程文件不符时重新读取后再试一次
+            for attempt in range(2):
+                entry['stage'] = 'edit'
+                edits, entry['changes'] = self._edits(client, use_cache=attempt == 0)
+                if not edits:
+                    entry['stage'] = 'unchanged'
+                    entry['success'] = True
+                    return entry
+                entry['stage'] = 'commit'
+                transaction = NginxConfigTransaction(client, edits, nginx_path=server.nginx_config_path or None,
+                                                     fsync=self.fsync, keep_backups=True)
+                transaction_result = queued_commit(transaction, window=reload_window(server))
+                if not transaction_result['stale']:
+                    break
+            entry['transaction'] = transaction_result
+            entry['stage'] = transaction_result['stage']
+            entry['success'] = transaction_result['success']
+            entry['error'] = transaction_result['error']
+            if transaction_result['success']:
+                self.transactions[server.host] = transaction
+        except Exception as e:
+            logger.error('灰度发布应用失败 host=%s error=%s', server.host, e)
+            entry['error'] = str(e)
+        finally:
+            connection.close()
+        return entry
+
+    def revert(self, server):
+        """
+        经主机操作队列撤销该主机的修改
+
+        发布后又被他人修改的文件不恢复，结果的conflicts列出这些文件；
+        观察期内采样可能已经重连并关闭了apply时的客户端，撤销前换用当前的连接
+        """
+        transaction = self.transactions.pop(server.host)
+        try:
+            transaction.client = self.connections.get(server)
+            return host_queues.get(server.host).run(transaction.revert)
+        except Exception as e:
+            logger.error('灰度发布撤销失败 host=%s error=%s', server.host, e)
+            return {'success': False, 'error': str(e), 'conflicts': []}
+
+    def accept(self, server, entry):
+        """该波通过检查：删除备份，把upstream修改写回数据库"""
+        transaction = self.transactions.pop(server.host)
+        try:
+            transaction.client = self.connections.get(server)
+            transaction.cleanup()
+        except Exception as e:
+            # 修改已经生效，备份没有删除不影响结果
+            logger.warning('灰度发布删除备份失败 host=%s error=%s', server.host, e)
+        if entry['changes']:
+            sync_upstream_changes(server, entry['changes'])
+
+    # ---- 发布 ----
+
+    def run(self):
+        """
+        依次发布各波次
+
+        返回:
+            dict: status（completed或halted）、waves（每波每台主机的结果和健康信号）、summary
+        """
+        report = {'status': 'completed', 'waves': [], 'summary': None}
+        try:
+            self.refresh_unhealthy(self.servers)
+            samples = self._parallel(self.sample, self.servers)
+            self.baseline = {server.host: sample for server, sample in zip(self.servers, samples)}
+            # 第一波生效前先观察一段时间，得到生效前的请求速率
+            time.sleep(self.soak_seconds)
+
+            for index, servers in enumerate(self.waves):
+                wave = {'index': index, 'hosts': [], 'regressions': 0, 'rolled_back': False, 'conflicts': []}
+                report['waves'].append(wave)
+                entries = self._parallel(self.apply, servers)
+                wave['hosts'] = entries
+
+                applied = [(server, entry) for server, entry in zip(servers, entries)
+                           if server.host in self.transactions]
+                if applied:
+                    time.sleep(self.soak_seconds)
+                    self.refresh_unhealthy([server for server, _ in applied])
+                    after = self._parallel(self.sample, [server for server, _ in applied])
+                    for (server, entry), sample in zip(applied, after):
+                        entry['after'] = sample
+                        entry['problems'] = evaluate(self.baseline.get(server.host), entry['before'], sample,
+                                                     self.thresholds)
+
+                failed = [entry for entry in entries if not entry['success'] or entry['problems']]
+                wave['regressions'] = len(failed)
+                if len(failed) > self.failure_threshold:
+                    logger.warning('灰度发布第%d波有%d台主机未通过，撤销该波并停止', index + 1, len(failed))
+                    reverted = self._parallel(self.revert, [server for server, _ in applied])
+                    for (server, entry), revert_result in zip(applied, reverted):
+                        entry['reverted'] = revert_result
+                        if revert_result.get('conflicts'):
+                            logger.warning('灰度发布撤销时主机 %s 的文件已被他人修改，未恢复: %s',
+                                           server.host, ', '.join(revert_result['conflicts']))
+                            wave['conflicts'].append(server.host)
+                    wave['rolled_back'] = True
+                    report['status'] = 'halted'
+                    break
+                for server, entry in applied:
+                    self.accept(server, entry)
+        finally:
+            # 异常退出时仍保留着备份的主机撤销修改，不留下没有经过检查的配置
+            leftover = [server for server in self.servers if server.host in self.transactions]
+            if leftover:
+                self._parallel(self.revert, leftover)
+            self.connections.close()
+            if self.prober is not None:
+                self.prober.close()
+
+        done = [entry for wave in report['waves'] if not wave['rolled_back'] for entry in wave['hosts']]
+        report['summary'] = {
+            'hosts': len(self.servers),
+            'waves': len(self.waves),
+            'completed_waves': sum(1 for wave in report['waves'] if not wave['rolled_back']),
+            'applied': sum(1 for entry in done if entry['success'] and entry['stage'] != 'unchanged'),
+            'unchanged': sum(1 for entry in done if entry['stage'] == 'unchanged'),
+            'rolled_back': sum(1 for wave in report['waves'] if wave['rolled_back'] for entry in wave['hosts']
+                               if entry['reverted'] is not None),
+            'conflicts': sum(len(wave['conflicts']) for wave in report['waves']),
+            'not_started': len(self.servers) - sum(len(wave['hosts']) for wave in report['waves']),
+        }
+        return report
@@ -1,6 +1,40 @@
+import ipaddress
+import re
+
 from rest_framework import serializers
+from client_app.validator import FILE_CONTEXTS
 from .models import ClientInfo, NginxConfigFile, BackendServerInfo
 
+_ADDRESS_RE = re.compile(r'^(\[[0-9A-Fa-f:.]+\]|[A-Za-z0-9_.-]+)(:\d{1,5})?$')
+# 读取时文件内容的sha256；空字符串表示文件应当不存在
+_SHA256_PATTERN = r'^([0-9a-f]{64})?$'
+# upstream名称和server参数写回配置时不加引号，不能包含空白、引号和分隔符
+_WORD_RE = re.compile(r'^[^\s;{}#\'"]+$')
+
+
+class BackendAddressField(serializers.CharField):
+    """后端地址: ip、ip:port、[ipv6]:port、域名:port或unix:路径"""
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data).strip()
+        if value.startswith('unix:') and len(value) > len('unix:'):
+            return value
+        try:
+            ipaddress.ip_address(value)
+            return value
+        except ValueError:
+            pass
+        match = _ADDRESS_RE.match(value)
+        if not match or (match.group(2) and not 0 < int(match.group(2)[1:]) < 65536):
+            raise serializers.ValidationError('无效的后端地址，应为ip、ip:port、[ipv6]:port或域名:port')
+        if match.group(1).startswith('['):
+            try:
+                ipaddress.ip_address(match.group(1)[1:-1])
+            except ValueError:
+                raise serializers.ValidationError('无效的IPv6地址')
+        return value
+
+
 
 class NginxConfigFileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -19,10 +53,127 @@ class NginxConfigCreateSerializer(serializers.Serializer):
 class NginxConfigUpdateSerializer(serializers.Serializer):
     client_ip = serializers.IPAddressField()
     file_path = serializers.CharField()
-    file_content = serializers.CharField()
+    # 内容按原样写入，不去掉首尾空白，写入后的sha256与调用方计算的一致
+    file_content = serializers.CharField(trim_whitespace=False)
+    base_sha256 = serializers.RegexField(_SHA256_PATTERN, required=False, allow_blank=True)
+    # 文件被include时所处的块，未指定时取主机配置分析中的include上下文
+    context = serializers.ChoiceField(choices=list(FILE_CONTEXTS), required=False)
+    fsync = serializers.BooleanField(required=False, default=False)
+    verify_checksum = serializers.BooleanField(required=False, default=False)
+
+class NginxConfigEditSerializer(serializers.Serializer):
+    file_path = serializers.CharField()
+    file_content = serializers.CharField(trim_whitespace=False)
+    base_sha256 = serializers.RegexField(_SHA256_PATTERN, required=False, allow_blank=True)
+    context = serializers.ChoiceField(choices=list(FILE_CONTEXTS), required=False)
+
+class NginxConfigBatchUpdateSerializer(serializers.Serializer):
+    client_ip = serializers.IPAddressField()
+    files = NginxConfigEditSerializer(many=True, allow_empty=False)
+    nginx_path = serializers.CharField(required=False, default='/etc/nginx/nginx.conf')
+    fsync = serializers.BooleanField(required=False, default=False)
+    verify_checksum = serializers.BooleanField(required=False, default=False)
+
+    def validate_files(self, value):
+        file_paths = [edit['file_path'] for edit in value]
+        if len(set(file_paths)) != len(file_paths):
+            raise serializers.ValidationError('files中存在重复的file_path')
+        return value
+
+class NginxConfigValidateSerializer(serializers.Serializer):
+    client_ip = serializers.IPAddressField()
+    files = NginxConfigEditSerializer(many=True, allow_empty=False)
+    nginx_path = serializers.CharField(required=False, default='/etc/nginx/nginx.conf')
 
 class BackendServerStatusSerializer(serializers.Serializer):
     client_ip = serializers.IPAddressField()
     file_path = serializers.CharField()
-    backend_server_addr = serializers.IPAddressField()
-    status = serializers.ChoiceField(choices=['up', 'down', 'backup'])
\ No newline at end of file
+    backend_server_addr = BackendAddressField()
+    status = serializers.ChoiceField(choices=['up', 'down', 'backup'])
+
+class BackendServerBulkStatusSerializer(serializers.Serializer):
+    backend_server_addr = BackendAddressField()
+    status = serializers.ChoiceField(choices=['up', 'down', 'backup'])
+    client_ips = serializers.ListField(child=serializers.IPAddressField(), required=False, allow_empty=False)
+    upstreams = serializers.ListField(child=serializers.CharField(), required=False, allow_empty=False)
+    dry_run = serializers.BooleanField(required=False, default=False)
+    full_scan = serializers.BooleanField(required=False, default=True)
+    fsync = serializers.BooleanField(required=False, default=False)
+
+class ConfigWordField(serializers.CharField):
+    """写回配置文件的单个词：upstream名称或server参数（weight=2、max_fails=3等）"""
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        if not _WORD_RE.match(value):
+            raise serializers.ValidationError(f'不能包含空白、引号、分号、花括号或#: {value}')
+        return value
+
+class UpstreamServerSerializer(serializers.Serializer):
+    address = BackendAddressField()
+    params = serializers.ListField(child=ConfigWordField(), required=False, default=list)
+
+class UpstreamOperationSerializer(serializers.Serializer):
+    # 各操作必须提供的参数
+    REQUIRED_FIELDS = {
+        'set_status': ('address', 'status'),
+        'set_weight': ('address', 'weight'),
+        'add_server': ('address',),
+        'remove_server': ('address',),
+        'add_upstream': ('servers',),
+    }
+
+    op = serializers.ChoiceField(choices=list(REQUIRED_FIELDS))
+    upstream = ConfigWordField()
+    address = BackendAddressField(required=False)
+    status = serializers.ChoiceField(choices=['up', 'down', 'backup'], required=False)
+    weight = serializers.IntegerField(min_value=1, required=False)
+    params = serializers.ListField(child=ConfigWordField(), required=False, default=list)
+    servers = UpstreamServerSerializer(many=True, required=False)
+
+    def validate(self, attrs):
+        missing = [field for field in self.REQUIRED_FIELDS[attrs['op']] if not attrs.get(field)]
+        if missing:
+            raise serializers.ValidationError(f'{attrs["op"]}操作缺少参数: {", ".join(missing)}')
+        return attrs
+
+class UpstreamEditSerializer(serializers.Serializer):
+    client_ip = serializers.IPAddressField()
+    file_path = serializers.CharField()
+    operations = UpstreamOperationSerializer(many=True, allow_empty=False)
+    context = serializers.ChoiceField(choices=list(FILE_CONTEXTS), required=False)
+    dry_run = serializers.BooleanField(required=False, default=False)
+    fsync = serializers.BooleanField(required=False, default=False)
+    verify_checksum = serializers.BooleanField(required=False, default=False)
+
+class UpstreamFileEditSerializer(serializers.Serializer):
+    file_path = serializers.CharField()
+    operations = UpstreamOperationSerializer(many=True, allow_empty=False)
+
+class NginxConfigRolloutSerializer(serializers.Serializer):
+    client_ips = serializers.ListField(child=serializers.IPAddressField(), allow_empty=False)
+    files = NginxConfigEditSerializer(many=True, required=False, default=list)
+    upstream_edits = UpstreamFileEditSerializer(many=True, required=False, default=list)
+    waves = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, default=[1],
+                                  allow_empty=False)
+    soak_seconds = serializers.FloatField(min_value=0, max_value=600, required=False, default=10)
+    failure_threshold = serializers.IntegerField(min_value=0, required=False, default=0)
+    max_dropped = serializers.IntegerField(min_value=0, required=False, default=0)
+    max_request_drop = serializers.FloatField(min_value=0, max_value=1, required=False, default=0.5)
+    min_request_rate = serializers.FloatField(min_value=0, required=False, default=1.0)
+    max_unhealthy = serializers.IntegerField(min_value=0, required=False, default=0)
+    health_url = serializers.URLField(required=False)
+    probe_backends = serializers.BooleanField(required=False, default=True)
+    workers = serializers.IntegerField(min_value=1, max_value=64, required=False, default=8)
+    fsync = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, attrs):
+        if not attrs['files'] and not attrs['upstream_edits']:
+            raise serializers.ValidationError('files和upstream_edits至少提供一项')
+        file_paths = [edit['file_path'] for edit in attrs['files']] + \
+                     [edit['file_path'] for edit in attrs['upstream_edits']]
+        if len(set(file_paths)) != len(file_paths):
+            raise serializers.ValidationError('files和upstream_edits中存在重复的file_path')
+        if len(set(attrs['client_ips'])) != len(attrs['client_ips']):
+            raise serializers.ValidationError('client_ips中存在重复的主机')
+        return attrs
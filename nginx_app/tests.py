@@ -1,3 +1,564 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+
+from benchmarks.ssh_fixture import FakeNginxHost
+from client_app.instrumentation import end_profile, start_profile
+from client_app.models import ClientInfo
+from client_app.tests import FakeNginxClient
+from .analytics import backend_summary, invalidate_backend_columns
+from .bulk_status import address_filter, bulk_set_status, find_occurrences
+from . import timeseries
+from .models import BackendServerInfo, NginxMetricChunk
+from .prober import FLAP_HALF_LIFE, BackendProber, ProbeTarget, parse_address
+from .rollout import ConfigRollout, HealthThresholds
+from .views import get_routing_graph, invalidate_routing_graphs
+
+
+class AddressFilterTestCase(TestCase):
+    def setUp(self):
+        self.server = ClientInfo.objects.create(host='10.0.0.100', client_ip='10.0.0.100', client_port=0)
+        for address in ('10.0.0.1:80', '10.0.0.1:8080', '10.0.0.1', '10.0.0.11:80', '[::1]:80'):
+            BackendServerInfo.objects.create(client=self.server, backend_server_addr=address, file_path='/a.conf',
+                                             upstream='app')
+
+    def addresses(self, address):
+        return sorted(BackendServerInfo.objects.filter(address_filter(address))
+                      .values_list('backend_server_addr', flat=True))
+
+    def test_exact_address(self):
+        self.assertEqual(self.addresses('10.0.0.1:80'), ['10.0.0.1:80'])
+
+    def test_host_matches_every_port_but_not_longer_hosts(self):
+        self.assertEqual(self.addresses('10.0.0.1'), ['10.0.0.1', '10.0.0.1:80', '10.0.0.1:8080'])
+
+    def test_ipv6(self):
+        self.assertEqual(self.addresses('::1'), ['[::1]:80'])
+
+
+class BackendAddressStorageTestCase(TestCase):
+    def test_hostname_and_unix_addresses_are_stored(self):
+        server = ClientInfo.objects.create(host='10.0.0.100', client_port=0)
+        for address in ('app-backend-01.internal.example.com:8080', 'unix:/run/app/backend.sock', '[::1]:8080'):
+            row = BackendServerInfo(client=server, backend_server_addr=address, file_path='/a.conf', upstream='app')
+            row.full_clean()
+            row.save()
+        self.assertEqual(BackendServerInfo.objects.filter(address_filter('app-backend-01.internal.example.com'))
+                         .count(), 1)
+
+
+class FindOccurrencesTestCase(TestCase):
+    def setUp(self):
+        self.first = ClientInfo.objects.create(host='10.0.0.100', client_ip='10.0.0.100', client_port=0)
+        self.second = ClientInfo.objects.create(host='10.0.0.101', client_ip='10.0.0.101', client_port=0)
+        BackendServerInfo.objects.create(client=self.first, backend_server_addr='10.1.1.1:8080', file_path='/a.conf',
+                                         upstream='app')
+        BackendServerInfo.objects.create(client=self.first, backend_server_addr='10.1.1.1:9090', file_path='/b.conf',
+                                         upstream='api')
+        BackendServerInfo.objects.create(client=self.second, backend_server_addr='10.1.1.1:8080',
+                                         file_path='/c.conf', upstream='web')
+
+    def test_groups_files_by_host(self):
+        occurrences = find_occurrences('10.1.1.1')
+        self.assertEqual({entry['server'].host: entry['files'] for entry in occurrences.values()},
+                         {'10.0.0.100': {'/a.conf', '/b.conf'}, '10.0.0.101': {'/c.conf'}})
+
+    def test_client_ips(self):
+        occurrences = find_occurrences('10.1.1.1:8080', client_ips=['10.0.0.101'])
+        self.assertEqual([entry['server'].host for entry in occurrences.values()], ['10.0.0.101'])
+
+
+UPSTREAM_APP = 'upstream app {\n    server 10.1.1.1:8080;\n    server 10.1.1.2:8080;\n}\n'
+UPSTREAM_API = 'upstream api {\n    server 10.1.1.1:8080 max_fails=2;\n}\n'
+
+
+class BulkSetStatusTestCase(TransactionTestCase):
+    """在模拟的SSH主机上执行，工作线程各自使用数据库连接，因此不能在TestCase的事务中运行"""
+
+    def setUp(self):
+        self.host = FakeNginxHost().start()
+        self.addCleanup(self.host.stop)
+        conf_dir = os.path.join(self.host.work_dir, 'conf.d')
+        os.makedirs(conf_dir)
+        self.nginx_conf = os.path.join(self.host.work_dir, 'nginx.conf')
+        self.write(self.nginx_conf, f'events {{}}\nhttp {{\n    include {conf_dir}/*.conf;\n}}\n')
+        self.app_conf = os.path.join(conf_dir, 'app.conf')
+        self.api_conf = os.path.join(conf_dir, 'api.conf')
+        self.write(self.app_conf, UPSTREAM_APP)
+        self.write(self.api_conf, UPSTREAM_API)
+        self.server = ClientInfo.objects.create(host='127.0.0.1', port=self.host.port, username=self.host.username,
+                                                password=self.host.password, client_ip='127.0.0.1', client_port=0,
+                                                nginx_config_path=self.nginx_conf)
+        # 同一主机同一地址只有一行，记录在最后同步的upstream下
+        self.row = BackendServerInfo.objects.create(client=self.server, backend_server_addr='10.1.1.1:8080',
+                                                    file_path=self.app_conf, upstream='app')
+        invalidate_routing_graphs(['127.0.0.1'])
+        self.addCleanup(invalidate_routing_graphs, ['127.0.0.1'])
+
+    @staticmethod
+    def write(path, content):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    @staticmethod
+    def read(path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def graph_for(self, client_ip):
+        return get_routing_graph(client_ip)[0]
+
+    def test_upstream_not_recorded_in_database_is_found_through_the_graph(self):
+        result = bulk_set_status('10.1.1.1:8080', 'down', upstreams=['api'], graph_for=self.graph_for)
+
+        host = result['hosts'][0]
+        self.assertTrue(host['success'], host['error'])
+        self.assertTrue(host['complete'])
+        self.assertEqual([(change['upstream'], change['file_path']) for change in host['changes']],
+                         [('api', self.api_conf)])
+        self.assertIn('server 10.1.1.1:8080 max_fails=2 down;', self.read(self.api_conf))
+        self.assertEqual(self.read(self.app_conf), UPSTREAM_APP)
+        self.row.refresh_from_db()
+        self.assertEqual(self.row.status, 'down')
+
+    def test_every_upstream_is_changed_in_one_transaction(self):
+        result = bulk_set_status('10.1.1.1', 'down', graph_for=self.graph_for)
+
+        host = result['hosts'][0]
+        self.assertEqual(sorted(change['upstream'] for change in host['changes']), ['api', 'app'])
+        self.assertEqual(self.host.stats.events().count('reload'), 1)
+        self.assertIn('server 10.1.1.2:8080;', self.read(self.app_conf))
+        self.assertEqual(result['summary']['incomplete'], 0)
+
+    def test_worker_spans_are_recorded_in_the_request_profile(self):
+        profile, token = start_profile('bulk')
+        try:
+            bulk_set_status('10.1.1.1', 'down', graph_for=self.graph_for)
+        finally:
+            end_profile(token)
+
+        self.assertIn('sftp', profile.spans)
+        self.assertIn('127.0.0.1', profile.hosts)
+        self.assertGreater(profile.round_trips, 0)
+
+    def test_without_graph_reports_incomplete(self):
+        result = bulk_set_status('10.1.1.1:8080', 'down', upstreams=['api'])
+
+        self.assertEqual(result['summary']['incomplete'], 1)
+        self.assertFalse(result['hosts'][0]['complete'])
+        self.assertEqual(result['hosts'][0]['changes'], [])
+        self.assertEqual(self.read(self.api_conf), UPSTREAM_API)
+        self.row.refresh_from_db()
+        self.assertEqual(self.row.status, 'up')
+
+    def test_dry_run_does_not_write(self):
+        result = bulk_set_status('10.1.1.1:8080', 'backup', dry_run=True, graph_for=self.graph_for)
+
+        self.assertEqual(result['summary']['changes'], 2)
+        self.assertEqual((self.read(self.app_conf), self.read(self.api_conf)), (UPSTREAM_APP, UPSTREAM_API))
+        self.row.refresh_from_db()
+        self.assertEqual(self.row.status, 'up')
+
+
+class RolloutHostClient(FakeNginxClient):
+    """文件路径相对于主机目录的模拟客户端，关闭后再使用会抛出异常"""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.closed = False
+
+    def _ensure_open(self):
+        if self.closed:
+            raise ConnectionError('连接已关闭')
+
+    def get_capabilities(self):
+        return {}
+
+    def execute_command(self, command, timeout=None, max_output_bytes=None):
+        self._ensure_open()
+        result = subprocess.run(['sh', '-c', command], cwd=self.root, capture_output=True, text=True)
+        return {'success': result.returncode == 0, 'output': result.stdout, 'error': result.stderr,
+                'return_code': result.returncode}
+
+    def write_config_file(self, file_path, content, **kwargs):
+        self._ensure_open()
+        return super().write_config_file(os.path.join(self.root, file_path), content, **kwargs)
+
+    def check_nginx_config(self, nginx_path=None):
+        self._ensure_open()
+        return super().check_nginx_config(nginx_path)
+
+    def reload_nginx(self):
+        self._ensure_open()
+        return super().reload_nginx()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnections:
+    """按主机保存模拟客户端，drop中的主机下次获取时关闭旧连接并重连，与HostConnections一致"""
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.clients = {}
+        self.drop = set()
+        self.reconnects = 0
+
+    def get(self, server):
+        client = self.clients.get(server.id)
+        if client is not None and server.id in self.drop:
+            client.close()
+            client = None
+            self.drop.discard(server.id)
+            self.reconnects += 1
+        if client is None:
+            client = self.clients[server.id] = RolloutHostClient(self.roots[server.id])
+        return client
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+
+class SampledRollout(ConfigRollout):
+    """
+    用文件内容模拟健康信号：bad_hosts中的主机在site.conf为新内容时每次采样丢弃5个连接；
+    reconnect_hosts中的主机在生效后的采样前断线重连
+    """
+
+    bad_hosts = ()
+    reconnect_hosts = ()
+
+    def sample(self, server):
+        if server.host in self.reconnect_hosts and server.host in self.transactions:
+            self.connections.drop.add(server.id)
+        client = self.connections.get(server)
+        client.execute_command('true')
+        with open(os.path.join(client.root, 'site.conf'), encoding='utf-8') as f:
+            degraded = server.host in self.bad_hosts and f.read() == 'new\n'
+        self.samples = getattr(self, 'samples', 0) + 1
+        dropped = self.samples * 5 if degraded else 0
+        requests = self.samples * 100
+        return {'ts': time.time(), 'stub': {'accepts': requests, 'handled': requests - dropped, 'requests': requests},
+                'http_status': None, 'unhealthy': None, 'error': ''}
+
+
+class ConfigRolloutTestCase(SimpleTestCase):
+    def setUp(self):
+        self.servers = [ClientInfo(id=index, host=f'10.0.0.{index}', client_ip=f'10.0.0.{index}', client_port=0)
+                        for index in (1, 2, 3)]
+        roots = {}
+        for server in self.servers:
+            roots[server.id] = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, roots[server.id])
+            with open(os.path.join(roots[server.id], 'site.conf'), 'w', encoding='utf-8') as f:
+                f.write('old\n')
+        self.connections = FakeConnections(roots)
+
+    def rollout(self, bad_hosts=(), reconnect_hosts=(), **kwargs):
+        rollout = SampledRollout(self.servers, files=[{'file_path': 'site.conf', 'file_content': 'new\n'}],
+                                 soak_seconds=0, probe_backends=False, connections=self.connections,
+                                 thresholds=HealthThresholds(max_request_drop=1), **kwargs)
+        rollout.bad_hosts = bad_hosts
+        rollout.reconnect_hosts = reconnect_hosts
+        return rollout.run()
+
+    def contents(self):
+        result = []
+        for server in self.servers:
+            root = self.connections.roots[server.id]
+            self.assertEqual([name for name in os.listdir(root) if '.backup-' in name], [])
+            with open(os.path.join(root, 'site.conf'), encoding='utf-8') as f:
+                result.append(f.read())
+        return result
+
+    def test_all_waves_pass(self):
+        report = self.rollout(waves=[1, 2])
+
+        self.assertEqual(report['status'], 'completed')
+        self.assertEqual(report['summary']['applied'], 3)
+        self.assertEqual(self.contents(), ['new\n'] * 3)
+
+    def test_failing_wave_is_reverted_and_earlier_waves_are_kept(self):
+        report = self.rollout(bad_hosts={'10.0.0.3'}, waves=[1, 2])
+
+        self.assertEqual(report['status'], 'halted')
+        self.assertEqual([wave['rolled_back'] for wave in report['waves']], [False, True])
+        self.assertEqual(report['waves'][1]['regressions'], 1)
+        self.assertTrue(all(entry['reverted']['success'] for entry in report['waves'][1]['hosts']))
+        self.assertEqual(self.contents(), ['new\n', 'old\n', 'old\n'])
+        self.assertEqual(report['summary']['rolled_back'], 2)
+
+    def test_failures_within_threshold_continue(self):
+        report = self.rollout(bad_hosts={'10.0.0.2'}, waves=[1, 2], failure_threshold=1)
+
+        self.assertEqual(report['status'], 'completed')
+        self.assertEqual(report['waves'][1]['regressions'], 1)
+        self.assertEqual(self.contents(), ['new\n'] * 3)
+
+    def test_halt_stops_later_waves(self):
+        report = self.rollout(bad_hosts={'10.0.0.1'}, waves=[1])
+
+        self.assertEqual(report['status'], 'halted')
+        self.assertEqual(len(report['waves']), 1)
+        self.assertEqual(report['summary']['not_started'], 2)
+        self.assertEqual(self.contents(), ['old\n'] * 3)
+
+    def test_worker_spans_are_recorded_in_the_request_profile(self):
+        profile, token = start_profile('rollout')
+        try:
+            self.rollout(waves=[1, 2])
+        finally:
+            end_profile(token)
+
+        # 每台主机在工作线程中经操作队列提交一次
+        self.assertEqual(profile.spans['queue_wait'][0], 3)
+
+    def test_revert_after_reconnect_uses_the_new_connection(self):
+        report = self.rollout(bad_hosts={'10.0.0.1'}, reconnect_hosts={'10.0.0.1'}, waves=[1])
+
+        self.assertEqual(self.connections.reconnects, 1)
+        self.assertTrue(report['waves'][0]['hosts'][0]['reverted']['success'])
+        self.assertEqual(self.contents(), ['old\n'] * 3)
+
+
+class BackendSummaryTestCase(TestCase):
+    def setUp(self):
+        # ClientInfo.client_ip可以为空，主机按host查找
+        self.first = ClientInfo.objects.create(host='10.0.0.100', client_port=0)
+        self.second = ClientInfo.objects.create(host='10.0.0.101', client_port=0)
+        rows = [
+            (self.first, 'http', 'app', '10.1.1.1:80', 'up', 2),
+            (self.first, 'http', 'app', '10.1.1.2:80', 'down', 1),
+            (self.second, 'http', 'app', '10.1.1.1:80', 'up', 3),
+            (self.first, 'stream', 'app', '10.1.1.1:53', 'backup', 1),
+        ]
+        for client, protocol, upstream, address, status, weight in rows:
+            BackendServerInfo.objects.create(client=client, protocol=protocol, upstream=upstream,
+                                             backend_server_addr=address, status=status, weight=weight,
+                                             file_path='/a.conf')
+        invalidate_backend_columns()
+
+    @staticmethod
+    def upstreams(summary):
+        return {(row['protocol'], row['upstream']): row for row in summary['upstreams']}
+
+    def test_http_and_stream_upstreams_are_separate(self):
+        upstreams = self.upstreams(backend_summary())
+
+        self.assertEqual(set(upstreams), {('http', 'app'), ('stream', 'app')})
+        http = upstreams[('http', 'app')]
+        self.assertEqual((http['members'], http['hosts'], http['up'], http['down']), (3, 2, 2, 1))
+        self.assertEqual((http['weight_total'], http['weight_min'], http['weight_max']), (6, 1, 3))
+        stream = upstreams[('stream', 'app')]
+        self.assertEqual((stream['members'], stream['hosts'], stream['backup']), (1, 1, 1))
+
+    def test_filter_by_client(self):
+        upstreams = self.upstreams(backend_summary(client_id=self.second.id))
+
+        self.assertEqual(list(upstreams), [('http', 'app')])
+        self.assertEqual(upstreams[('http', 'app')]['members'], 1)
+
+    def test_api_looks_up_host(self):
+        response = APIClient().get('/api/servers/backend_server/summary/', {'client_ip': '10.0.0.100'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['totals']['backend_servers'], 3)
+        self.assertEqual(response.data['data']['top_hosts'][0]['client_ip'], '10.0.0.100')
+        missing = APIClient().get('/api/servers/backend_server/summary/', {'client_ip': '10.0.0.9'})
+        self.assertEqual(missing.status_code, 404)
+
+
+class ParseAddressTestCase(SimpleTestCase):
+    def test_addresses(self):
+        self.assertEqual(parse_address('10.0.0.1:8080'), ('10.0.0.1', 8080))
+        self.assertEqual(parse_address(' 10.0.0.1 '), ('10.0.0.1', 80))
+        self.assertEqual(parse_address('10.0.0.1', default_port=443), ('10.0.0.1', 443))
+        self.assertEqual(parse_address('backend.example.com:81'), ('backend.example.com', 81))
+        self.assertEqual(parse_address('[::1]:8443'), ('::1', 8443))
+        self.assertEqual(parse_address('[::1]'), ('::1', 80))
+        self.assertEqual(parse_address('::1'), ('::1', 80))
+
+    def test_unusable(self):
+        for address in ('', None, 'unix:/run/app.sock', '10.0.0.1:0', '10.0.0.1:65536', '10.0.0.1:http',
+                        '[::1]:x'):
+            self.assertIsNone(parse_address(address), address)
+
+
+class ProbeDampingTestCase(SimpleTestCase):
+    def setUp(self):
+        self.prober = BackendProber(rise=2, fall=3)
+        self.target = ProbeTarget('10.0.0.1', 80, None, 10, health='healthy')
+        self.now = 1000.0
+
+    def tearDown(self):
+        self.prober.db_executor.shutdown()
+
+    def results(self, *results, step=1):
+        for ok in results:
+            self.now += step
+            self.prober.apply(self.target, ok, 1.0 if ok else None, '' if ok else 'refused', self.now)
+        return self.target.health
+
+    def test_fall_and_rise(self):
+        self.assertEqual(self.results(False, False), 'healthy')
+        self.assertEqual(self.results(False), 'unhealthy')
+        self.assertEqual(self.results(True), 'unhealthy')
+        self.assertEqual(self.results(True), 'healthy')
+        self.assertEqual(self.prober.stats['changes'], 2)
+
+    def test_interrupted_streak_does_not_change(self):
+        self.assertEqual(self.results(False, False, True, False, False, True), 'healthy')
+        self.assertEqual(self.prober.stats['changes'], 0)
+
+    def test_unknown_takes_first_result(self):
+        self.target.health = 'unknown'
+        self.assertEqual(self.results(False), 'unhealthy')
+        self.assertEqual(self.target.penalty, 0)
+
+    def test_flapping_is_suppressed_until_penalty_decays(self):
+        # 短时间内变化5次，惩罚超过阈值，之后连续成功也不恢复
+        self.results(*[False, False, False, True, True] * 2, False, False, False)
+        self.assertEqual(self.target.health, 'unhealthy')
+        self.assertEqual(self.prober.stats['changes'], 5)
+        self.assertEqual(self.results(True, True, True), 'unhealthy')
+        # 惩罚经过一个半衰期降到阈值以下，再次满足rise后恢复
+        self.assertEqual(self.results(True, step=FLAP_HALF_LIFE), 'healthy')
+
+    def test_without_damping(self):
+        self.prober.apply(self.target, False, None, 'refused', self.now, damping=False)
+        self.assertEqual(self.target.health, 'unhealthy')
+        self.prober.apply(self.target, True, 1.0, '', self.now + 1, damping=False)
+        self.assertEqual(self.target.health, 'healthy')
+
+
+class ScriptedProber(BackendProber):
+    """每次刷新按phases的顺序给出目标地址，探测只记录时间和目标对象"""
+
+    def __init__(self, phases, **kwargs):
+        super().__init__(**kwargs)
+        self.phases = phases
+        self.refreshes = 0
+        self.probed = []
+
+    def load_targets(self):
+        keys = self.phases[min(self.refreshes, len(self.phases) - 1)]
+        self.refreshes += 1
+        targets = {key: self.targets.get(key) or ProbeTarget(*key, self.interval) for key in keys}
+        added = [target for key, target in targets.items() if key not in self.targets]
+        self.targets = targets
+        return added
+
+    async def probe(self, target):
+        self.probed.append((time.monotonic(), target))
+        return True, 1.0, ''
+
+    def _write(self, changed, touched):
+        return 0
+
+
+class ProbeScheduleTestCase(SimpleTestCase):
+    def test_readded_target_has_one_probe_chain(self):
+        key = ('10.0.0.1', 80, None)
+        # 第一次刷新时存在，第二次删除，第三次加回（新的目标对象）
+        prober = ScriptedProber([[key], [], [key]], interval=0.5, refresh_interval=0.1, flush_interval=10)
+        self.addCleanup(prober.db_executor.shutdown)
+        with mock.patch('nginx_app.prober.random.uniform', return_value=0):
+            asyncio.run(prober.run(duration=1.6))
+
+        readded = prober.targets[key]
+        times = [at for at, target in prober.probed if target is readded]
+        # 加回后约每0.5秒一次；旧对象遗留在堆中的条目不能再形成第二条探测链
+        self.assertTrue(3 <= len(times) <= 4, times)
+        self.assertTrue(all(b - a >= 0.4 for a, b in zip(times, times[1:])), times)
+
+
+class TimeseriesTestCase(TestCase):
+    # 按天对齐，各级的块和降采样区间都从这里开始
+    T = 1_700_000_000 - 1_700_000_000 % 86400
+
+    def setUp(self):
+        self.client_id = ClientInfo.objects.create(host='10.0.0.100', client_ip='10.0.0.100', client_port=0).id
+
+    def points(self, start, count, interval=15, requests=None):
+        """从start开始每interval秒一个采样，active依次为0、1、2…，requests默认每个间隔增加150"""
+        requests = requests or [150 * index for index in range(count)]
+        return timeseries.make_points([
+            (start + index * interval, {'active': index, 'reading': 1, 'writing': 2, 'waiting': 3,
+                                        'accepts': index, 'handled': index, 'requests': requests[index]})
+            for index in range(count)
+        ])
+
+    def test_append_points_splits_chunks_and_drops_stale(self):
+        # 最后一点跨入下一个1小时的原始块
+        points = self.points(self.T + 3600 - 30, 3)
+        self.assertEqual(timeseries.append_points(self.client_id, 0, points), 3)
+        chunks = NginxMetricChunk.objects.filter(client_id=self.client_id, resolution=0).order_by('chunk_start')
+        self.assertEqual([(chunk.chunk_start, chunk.points) for chunk in chunks],
+                         [(self.T, 2), (self.T + 3600, 1)])
+
+        # 重复和乱序的采样不再写入
+        self.assertEqual(timeseries.append_points(self.client_id, 0, points[:2]), 0)
+        self.assertEqual(timeseries.append_points(self.client_id, 0, self.points(self.T + 3600, 2)), 1)
+        loaded = timeseries.load_points(self.client_id, 0, self.T, self.T + 7200)
+        self.assertEqual(loaded['ts'].tolist(), [self.T + 3570, self.T + 3585, self.T + 3600, self.T + 3615])
+
+    def test_downsample(self):
+        timeseries.append_points(self.client_id, 0, self.points(self.T, 10))
+        # 只有[T, T+120)是完整的1分钟区间
+        self.assertEqual(timeseries.downsample(self.client_id, now=self.T + 150), {60: 2, 900: 0})
+        minutes = timeseries.load_points(self.client_id, 60, self.T, self.T + 900)
+        self.assertEqual(minutes['ts'].tolist(), [self.T, self.T + 60])
+        self.assertEqual(minutes['active'].tolist(), [1.5, 5.5])  # gauge取平均
+        self.assertEqual(minutes['requests'].tolist(), [450, 1050])  # 计数器取区间内最后一个值
+
+        # 已经降采样的区间不重复处理，下一次只处理新结束的区间
+        self.assertEqual(timeseries.downsample(self.client_id, now=self.T + 150), {900: 0})
+        self.assertEqual(timeseries.downsample(self.client_id, now=self.T + 180), {60: 1, 900: 0})
+        minutes = timeseries.load_points(self.client_id, 60, self.T, self.T + 900)
+        self.assertEqual(minutes['ts'].tolist(), [self.T, self.T + 60, self.T + 120])
+
+    def test_query_range_uses_finest_covering_tier(self):
+        now = self.T + 20 * 86400
+        cases = [(now - 3600, 0), (now - 3 * 86400, 60), (now - 20 * 86400, 900), (now - 1000 * 86400, 900)]
+        for start, resolution in cases:
+            self.assertEqual(timeseries.query_range(self.client_id, start, now, now=now)['tier'], resolution)
+
+    def test_query_range_aggregates_to_max_points(self):
+        timeseries.append_points(self.client_id, 0, self.points(self.T, 100))
+        end = self.T + 1500
+        data = timeseries.query_range(self.client_id, self.T, end, max_points=10, now=end)
+
+        self.assertEqual(data['tier'], 0)
+        self.assertEqual(data['resolution'], 150)
+        self.assertEqual(len(data['timestamps']), 10)
+        self.assertEqual(data['timestamps'][:2], [self.T, self.T + 150])
+        self.assertEqual(data['active'][0], 4.5)
+        self.assertEqual(data['requests_per_second'][:2], [None, 10.0])
+
+    def test_query_range_counter_reset(self):
+        points = self.points(self.T, 4, requests=[100, 250, 40, 190])
+        timeseries.append_points(self.client_id, 0, points)
+        data = timeseries.query_range(self.client_id, self.T, self.T + 60, now=self.T + 60)
+
+        self.assertIsNone(data['resolution'])
+        self.assertEqual(data['requests_per_second'], [None, 10.0, None, 10.0])
+
+    def test_enforce_retention(self):
+        now = self.T + 400 * 86400
+        for resolution, chunk_start in [(0, now - 3 * 86400), (0, now - 3600), (60, now - 10 * 86400),
+                                        (900, now - 500 * 86400)]:
+            NginxMetricChunk.objects.create(client_id=self.client_id, resolution=resolution,
+                                            chunk_start=chunk_start)
+
+        self.assertEqual(timeseries.enforce_retention(now=now), 2)
+        self.assertEqual(sorted(NginxMetricChunk.objects.values_list('resolution', 'chunk_start')),
+                         [(0, now - 3600), (60, now - 10 * 86400)])
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Nginx运行指标时间序列存储
+stub_status采样按主机和分辨率打包为定长二进制记录块（每块一行），写入时追加到当前块，
+读取时用NumPy直接解码；原始采样逐级降采样为1分钟和15分钟两级，各级按保留期删除过期块
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.db import transaction
+
+from .models import NginxMetricChunk
+
+# 每个采样点44字节；gauge降采样后取平均值，计数器取区间内最后一个值
+POINT_DTYPE = np.dtype([
+    ('ts', '<u4'),
+    ('active', '<f4'),
+    ('reading', '<f4'),
+    ('writing', '<f4'),
+    ('waiting', '<f4'),
+    ('accepts', '<u8'),
+    ('handled', '<u8'),
+    ('requests', '<u8'),
+])
+GAUGES = ('active', 'reading', 'writing', 'waiting')
+COUNTERS = ('accepts', 'handled', 'requests')
+
+Tier = namedtuple('Tier', ['resolution', 'chunk_seconds', 'retention_seconds'])
+
+# resolution为0表示原始采样，间隔由采集周期决定
+TIERS = (
+    Tier(0, 3600, 2 * 86400),
+    Tier(60, 86400, 14 * 86400),
+    Tier(900, 30 * 86400, 400 * 86400),
+)
+# 估算原始采样点数时使用的采集间隔
+DEFAULT_SCRAPE_INTERVAL = 15
+
+
+def _tier(resolution):
+    return next(tier for tier in TIERS if tier.resolution == resolution)
+
+
+def make_points(samples):
+    """[(时间戳, stub_status字典), ...] -> 结构化数组"""
+    points = np.zeros(len(samples), dtype=POINT_DTYPE)
+    for index, (ts, sample) in enumerate(samples):
+        points[index]['ts'] = int(ts)
+        for field in GAUGES + COUNTERS:
+            points[index][field] = sample[field]
+    return points
+
+
+def append_points(client_id, resolution, points):
+    """
+    按块追加采样点，时间戳不晚于块内最后一点的采样被丢弃（重复采集或乱序）
+
+    返回:
+        int: 实际写入的点数
+    """
+    if not len(points):
+        return 0
+    chunk_seconds = _tier(resolution).chunk_seconds
+    chunk_starts = points['ts'] - points['ts'] % chunk_seconds
+    written = 0
+    with transaction.atomic():
+        for chunk_start in np.unique(chunk_starts):
+            chunk_points = points[chunk_starts == chunk_start]
+            chunk, _ = NginxMetricChunk.objects.select_for_update().get_or_create(
+                client_id=client_id, resolution=resolution, chunk_start=int(chunk_start),
+                defaults={'data': b''})
+            chunk_points = chunk_points[chunk_points['ts'] > chunk.last_ts]
+            if not len(chunk_points):
+                continue
+            chunk.data = bytes(chunk.data) + chunk_points.tobytes()
+            chunk.points += len(chunk_points)
+            chunk.last_ts = int(chunk_points['ts'][-1])
+            chunk.save(update_fields=['data', 'points', 'last_ts', 'updated_at'])
+            written += len(chunk_points)
+    return written
+
+
+def record_sample(client_id, sample, ts=None):
+    """写入一个原始采样"""
+    return append_points(client_id, 0, make_points([(ts or time.time(), sample)]))
+
+
+def load_points(client_id, resolution, start, end):
+    """读取[start, end)内的采样点，只解码与区间重叠的块"""
+    chunk_seconds = _tier(resolution).chunk_seconds
+    chunks = NginxMetricChunk.objects.filter(
+        client_id=client_id, resolution=resolution,
+        chunk_start__gt=start - chunk_seconds, chunk_start__lt=end
+    ).order_by('chunk_start').values_list('data', flat=True)
+    blocks = [np.frombuffer(bytes(data), dtype=POINT_DTYPE) for data in chunks if data]
+    if not blocks:
+        return np.zeros(0, dtype=POINT_DTYPE)
+    points = np.concatenate(blocks)
+    return points[(points['ts'] >= start) & (points['ts'] < end)]
+
+
+def aggregate(points, step):
+    """按step秒对齐分桶：gauge取平均，计数器取桶内最后一个值，时间戳为桶起点"""
+    if not len(points):
+        return points
+    buckets = points['ts'] - points['ts'] % step
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(points)]
+    result = np.zeros(len(starts), dtype=POINT_DTYPE)
+    result['ts'] = buckets[starts]
+    sizes = ends - starts
+    for field in GAUGES:
+        result[field] = np.add.reduceat(points[field].astype(np.float64), starts) / sizes
+    for field in COUNTERS:
+        result[field] = points[field][ends - 1]
+    return result
+
+
+def _last_ts(client_id, resolution):
+    chunk = NginxMetricChunk.objects.filter(client_id=client_id, resolution=resolution) \
+        .order_by('-chunk_start').values_list('last_ts', flat=True).first()
+    return chunk or 0
+
+
+def downsample(client_id, now=None):
+    """把已经结束的区间从细一级降采样到粗一级，返回各级写入的点数"""
+    now = int(now or time.time())
+    written = {}
+    for finer, coarser in zip(TIERS, TIERS[1:]):
+        step = coarser.resolution
+        last = _last_ts(client_id, step)
+        start = last + step if last else now - finer.retention_seconds
+        end = now - now % step  # 只处理完整的区间
+        if start >= end:
+            continue
+        points = aggregate(load_points(client_id, finer.resolution, start, end), step)
+        written[step] = append_points(client_id, step, points)
+    return written
+
+
+def enforce_retention(now=None):
+    """删除所有主机超过保留期的块，每级一条DELETE"""
+    now = int(now or time.time())
+    deleted = 0
+    for tier in TIERS:
+        deleted += NginxMetricChunk.objects.filter(
+            resolution=tier.resolution,
+            chunk_start__lt=now - tier.retention_seconds - tier.chunk_seconds
+        ).delete()[0]
+    return deleted
+
+
+def _choose_tier(start, now):
+    """
+    保留期能覆盖起点的最细一级
+
+    不按原生点数挑选更粗的一级：粗一级只包含已经降采样的完整区间，分辨率也可能远大于所需的步长，
+    点数过多时由query_range聚合到max_points
+    """
+    for tier in TIERS:
+        if start >= now - tier.retention_seconds:
+            return tier
+    return TIERS[-1]
+
+
+def query_range(client_id, start, end, max_points=500, now=None):
+    """
+    范围查询
+
+    选择保留期能覆盖起点的最细一级，点数超过max_points时按等宽区间聚合；
+    请求速率由相邻点的requests计数器差值计算，计数器回绕（nginx重启）处为None
+
+    返回:
+        dict: 列式数据 timestamps、active、reading、writing、waiting、requests_per_second
+    """
+    now = int(now or time.time())
+    start, end = int(start), int(end)
+    tier = _choose_tier(start, now)
+    points = load_points(client_id, tier.resolution, start, end)
+    step = tier.resolution or None
+    if len(points) > max_points:
+        step = max(int(np.ceil((end - start) / max_points)), tier.resolution or 1)
+        # 桶按step对齐，首尾可能各占半个桶，步长不够时加大
+        while (end - 1) // step - start // step + 1 > max_points:
+            step += 1
+        points = aggregate(points, step)
+
+    rates = [None] * len(points)
+    if len(points) > 1:
+        elapsed = np.diff(points['ts'].astype(np.int64))
+        delta = np.diff(points['requests'].astype(np.int64))
+        valid = (elapsed > 0) & (delta >= 0)
+        values = np.where(valid, delta / np.maximum(elapsed, 1), 0.0)
+        rates[1:] = [round(float(value), 3) if ok else None for value, ok in zip(values, valid)]
+
+    return {
+        'resolution': step,
+        'tier': tier.resolution,
+        'timestamps': points['ts'].tolist(),
+        **{field: np.round(points[field], 2).tolist() for field in GAUGES},
+        'requests_per_second': rates,
+    }
+
+
+def latest_sample(client_id):
+    """最近一次原始采样，没有时返回None"""
+    data = NginxMetricChunk.objects.filter(client_id=client_id, resolution=0) \
+        .order_by('-chunk_start').values_list('data', flat=True).first()
+    if not data:
+        return None
+    point = np.frombuffer(bytes(data), dtype=POINT_DTYPE)[-1]
+    return {'ts': int(point['ts']), **{field: int(point[field]) for field in GAUGES + COUNTERS}}
@@ -10,6 +10,9 @@ urlpatterns = [
     # 配置操作
     path('create/', views.create_nginx_config, name='create-config'),
     path('update/', views.update_nginx_config, name='update-config'),
+    path('validate/', views.validate_nginx_config, name='validate-config'),
+    path('batch-update/', views.batch_update_nginx_config, name='batch-update-config'),
+    path('rollout/', views.rollout_nginx_config, name='rollout-config'),
     path('read/', views.read_nginx_config, name='read-config'),
     path('read-all/', views.read_all_nginx_configs, name='read-all-configs'),
 ]
\ No newline at end of file
@@ -9,12 +9,26 @@ urlpatterns = [
     path('connection/network/', views.test_connect, name='test_connection'),
     path('conf/create/', views.create_nginx_config, name='create-config'),
     path('conf/update/', views.update_nginx_config, name='update-config'),
+    path('conf/validate/', views.validate_nginx_config, name='validate-config'),
+    path('conf/batchUpdate/', views.batch_update_nginx_config, name='batch-update-config'),
+    path('conf/rollout/', views.rollout_nginx_config, name='rollout-config'),
     path('conf/read/', views.read_nginx_config, name='read-config'),
     path('conf/readAll/', views.read_all_nginx_configs, name='read-all-configs'),
     path('backend_server/readAll/', views.read_all_backend_servers, name='read_all_backend_servers'),
     path('/backend_serve_status/update/', views.read_all_backend_servers, name='read_all_backend_servers'),
 
     path('backend_server/readUpstream/', views.read_upstream_info, name='read_upstream_info'),
+    path('upstream/edit/', views.edit_upstream, name='edit_upstream'),
+    path('backend_server/summary/', views.backend_server_summary, name='backend_server_summary'),
+    path('backend_server/impact/', views.backend_server_impact, name='backend_server_impact'),
     # 服务器状态管理
     path('status/', views.update_backend_server_status, name='update-server-status'),
+    path('backend_server/status/bulk/', views.bulk_update_backend_server_status, name='bulk-update-server-status'),
+    # 请求耗时和SSH往返指标（Prometheus文本格式）
+    path('metrics/', views.metrics, name='metrics'),
+    # stub_status时间序列
+    path('metrics/nginx/', views.nginx_metrics_range, name='nginx_metrics_range'),
+    # 访问日志源和分钟汇总
+    path('access_logs/sources/', views.access_log_sources, name='access_log_sources'),
+    path('access_logs/', views.access_log_rollups, name='access_log_rollups'),
 ]
\ No newline at end of file
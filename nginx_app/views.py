@@ -9,16 +9,33 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.http import HttpResponse
 import hashlib
+import threading
+import time
 import requests
 from client_app.models import ClientInfo
 from client_app.client import NginxParamikoClient
-from .models import ClientInfo, NginxConfigFile, BackendServerInfo
+from client_app.instrumentation import registry
+from client_app.access_log import LOG_FORMAT_COMBINED, LogFormat
+from client_app.capabilities import attach_capabilities
+from client_app.transaction import NginxConfigTransaction
+from client_app.host_queue import queued_commit, reload_window
+from client_app.upstream_edit import UpstreamEditError, apply_operations
+from client_app.merge import conflict_report, snapshots
+from client_app.validator import FILE_CONTEXTS, NginxConfigValidator, ValidationContext
+from .models import ClientInfo, NginxConfigFile, BackendServerInfo, AccessLogSource
 from .serializers import (
     NginxConfigFileSerializer, BackendServerInfoSerializer,
-    NginxConfigCreateSerializer, NginxConfigUpdateSerializer, BackendServerStatusSerializer
+    NginxConfigCreateSerializer, NginxConfigUpdateSerializer, BackendServerStatusSerializer,
+    NginxConfigBatchUpdateSerializer, NginxConfigValidateSerializer, BackendServerBulkStatusSerializer,
+    UpstreamEditSerializer, NginxConfigRolloutSerializer
 )
 from .utils import get_client_port
+from .analytics import backend_summary
+from .bulk_status import bulk_set_status, sync_upstream_changes
+from .rollout import ConfigRollout, HealthThresholds
+from . import access_logs, timeseries
 
 
 def connect_to_client(client_ip):
@@ -55,6 +72,8 @@ def connect_to_client(client_ip):
         # 尝试建立SSH连接
         if client.connect():
             print(f'成功连接到客户端 {client_ip}')
+            # 载入缓存的主机能力，过期时在第一次需要时探测
+            attach_capabilities(client, server)
             return client, server, None  # 成功时返回client, server, None
         else:
             print(f'连接客户端 {client_ip} 失败')
@@ -64,6 +83,130 @@ def connect_to_client(client_ip):
         print(f'连接客户端 {client_ip} 时发生异常: {str(e)}')
         return None, None, Response({'msg': f'连接失败: {str(e)}', 'status': 400}, status=400)
 
+def build_validation_context(client_ip, nginx_main_conf_path='/etc/nginx/nginx.conf'):
+    """
+    构建本地校验上下文，不连接主机
+
+    有缓存的配置分析时，upstream、server_name、nginx加载的文件和各文件的include上下文都取自分析结果；
+    没有时只能用数据库中已同步的upstream，文件上下文按其中记录的协议推断，悬空引用只给出警告
+    """
+    analysis = cached_analysis(client_ip)
+    if analysis is not None:
+        known_upstreams = {(upstream.protocol, upstream.name): upstream.file_path
+                           for upstream in (*analysis.upstreams.values(), *analysis.stream_upstreams.values())}
+        return ValidationContext(
+            nginx_main_conf_path=nginx_main_conf_path,
+            known_upstreams=known_upstreams,
+            known_server_names=analysis.server_names,
+            known_files=analysis.config_files,
+            file_contexts=analysis.file_contexts,
+            known_proxy_hosts=analysis.routing.routes_by_backend,
+            analyzed=True
+        )
+
+    known_upstreams = {}
+    file_contexts = {}
+    for protocol, upstream, file_path in BackendServerInfo.objects.filter(
+            client__host=client_ip).values_list('protocol', 'upstream', 'file_path'):
+        known_upstreams[(protocol, upstream)] = file_path
+        file_contexts[file_path] = (protocol,)
+    return ValidationContext(
+        nginx_main_conf_path=nginx_main_conf_path,
+        known_upstreams=known_upstreams,
+        file_contexts=file_contexts
+    )
+
+
+def validate_config_edits(client_ip, edits, nginx_main_conf_path='/etc/nginx/nginx.conf'):
+    """
+    在连接主机之前对待写入的配置做本地校验
+
+    返回:
+        Response: 校验失败时返回错误响应，通过时返回None
+    """
+    validation_result = NginxConfigValidator(
+        build_validation_context(client_ip, nginx_main_conf_path)
+    ).validate(edits)
+    if validation_result['valid']:
+        return None
+    return Response({
+        'msg': f'配置本地校验失败: {validation_result["errors"][0]["error"]}',
+        'status': 400,
+        'result': validation_result
+    }, status=400)
+
+
+# 配置分析缓存: client_ip -> (构建时间, NginxAnalysis)，避免每次影响查询和本地校验都重新通过SSH分析配置
+ROUTING_GRAPH_TTL = 300
+_routing_graphs = {}
+_routing_graphs_lock = threading.Lock()
+
+
+def get_routing_graph(client_ip, refresh=False):
+    """
+    获取主机的路由图，缓存未过期时直接复用
+
+    返回:
+        tuple: (RoutingGraph, 构建时间, error_response)
+    """
+    with _routing_graphs_lock:
+        cached = _routing_graphs.get(client_ip)
+    if cached and not refresh and time.time() - cached[0] < ROUTING_GRAPH_TTL:
+        return cached[1].routing, cached[0], None
+
+    client, server, error_response = connect_to_client(client_ip)
+    if error_response:
+        return None, None, error_response
+    try:
+        analysis = client.analyze_nginx_config(server.nginx_config_path or '/etc/nginx/nginx.conf')
+    finally:
+        client.close()
+
+    built_at = time.time()
+    with _routing_graphs_lock:
+        _routing_graphs[client_ip] = (built_at, analysis)
+    return analysis.routing, built_at, None
+
+
+def cached_analysis(client_ip):
+    """未过期的缓存配置分析，没有缓存时返回None，不连接主机"""
+    with _routing_graphs_lock:
+        cached = _routing_graphs.get(client_ip)
+    if cached and time.time() - cached[0] < ROUTING_GRAPH_TTL:
+        return cached[1]
+    return None
+
+
+def cached_routing_graph(client_ip):
+    """未过期的缓存路由图，没有缓存时返回None，不连接主机"""
+    analysis = cached_analysis(client_ip)
+    return analysis.routing if analysis is not None else None
+
+
+def invalidate_routing_graphs(client_ips):
+    with _routing_graphs_lock:
+        for client_ip in client_ips:
+            _routing_graphs.pop(client_ip, None)
+
+
+def stale_conflicts(client, edits, stale_files):
+    """
+    写入因文件已被他人修改而被拒绝时，读取这些文件的当前内容，与基准内容、待写入内容做三方对比
+
+    当前内容同时保存为快照，调用方基于它合并后再次提交时仍然可以三方对比
+    """
+    current = client.read_config_files(stale_files)
+    conflicts = []
+    for edit in edits:
+        file_path = edit['file_path']
+        if file_path not in current:
+            continue
+        theirs = current[file_path]['content'] if current[file_path]['success'] else ''
+        snapshots.put(theirs)
+        conflicts.append(conflict_report(file_path, snapshots.get(edit.get('base_sha256') or ''),
+                                         edit['file_content'], theirs))
+    return conflicts
+
 @api_view(['POST'])
 def test_connect(request):
     """
@@ -152,6 +295,10 @@ def create_nginx_config(request):
         request: 包含创建配置信息的POST请求
         - client_ip: 客户端IP地址
         - file_path: 文件路径
+        - file_content: 文件内容（可选）
+        - context: 文件被include时所处的块（可选，main、http、stream、server等，默认按主机的配置分析推断）
+        - fsync: 是否在替换前落盘（可选，默认False）
+        - verify_checksum: 是否校验远程文件sha256（可选，默认False）
 
     返回:
         Response: 创建操作的结果
@@ -161,12 +308,25 @@ def create_nginx_config(request):
     file_path = request.data.get('file_path')
     print('file_path',file_path)
     file_content = request.data.get('file_content', f'#{file_path}')  # 默认内容
+    context_name = request.data.get('context')
+    fsync = str(request.data.get('fsync', False)).lower() in ('true', '1')
+    verify_checksum = str(request.data.get('verify_checksum', False)).lower() in ('true', '1')
 
     if not client_ip or not file_path:
         return Response({'msg': 'client_ip和file_path为必填参数', 'status': 400}, status=400)
+    if context_name and context_name not in FILE_CONTEXTS:
+        return Response({'msg': f'context应为{", ".join(FILE_CONTEXTS)}之一', 'status': 400}, status=400)
+
+    # 本地校验通过后才连接主机
+    error_response = validate_config_edits(client_ip, [{'file_path': file_path, 'file_content': file_content,
+                                                        'context': context_name}])
+    if error_response:
+        return error_response
 
     # 正确接收connect_to_client的返回值
-    client, server = connect_to_client(client_ip)
+    client, server, error_response = connect_to_client(client_ip)
+    if error_response:
+        return error_response
     # 建立ssh连接
     if not client.connect():
         return Response({'msg': f'无法连接到服务器{client_ip}', 'status': 400}, status=400)
@@ -177,41 +337,31 @@ def create_nginx_config(request):
         if check_result['success'] and 'exists' in check_result['output']:
             return Response({'msg': f'{file_path}此文件已存在', 'status': 201}, status=201)
 
-        # 检查目录存在，不存在则创建
-        dir_path = '/'.join(file_path.split('/')[:-1])
-        if dir_path:
-            mkdir_result = client.execute_command(f'mkdir -p {dir_path}')
-            if not mkdir_result['success']:
-                return Response({'msg': f'创建目录失败: {mkdir_result["error"]}', 'status': 201}, status=201)
-
-        # 写入配置文件
-        write_result = client.write_config_file(file_path, file_content)
-        if write_result['success']:
-            # 检查Nginx配置语法
-            check_config_result = client.check_nginx_config()
-            if check_config_result['success']:
-                # 重载Nginx配置
-                reload_result = client.reload_nginx()
-                if reload_result['success']:
-                    return Response({
-                        'msg': f'{file_path},此文件创建成功，nginx重载成功',
-                        'status': 200
-                    })
-                else:
-                    return Response({
-                        'msg': f'文件创建成功但Nginx重载失败: {reload_result["error"]}',
-                        'status': 201
-                    })
-            else:
-                # 配置检查失败，删除创建的文件
-                client.execute_command(f'rm -f {file_path}')
-                return Response({
-                    'msg': f'Nginx配置检查失败: {check_config_result["error"]}，已删除创建的文件',
-                    'status': 201
-                })
+        # 单文件事务经主机操作队列执行：创建目录 -> 原子写入 -> nginx -t -> reload，失败时删除创建的文件
+        transaction_result = queued_commit(NginxConfigTransaction(
+            client, [{'file_path': file_path, 'file_content': file_content}],
+            fsync=fsync, verify_checksum=verify_checksum
+        ), window=reload_window(server))
+        if transaction_result['success']:
+            invalidate_routing_graphs([client_ip])
+            return Response({
+                'msg': f'{file_path},此文件创建成功，nginx重载成功',
+                'status': 200,
+                'result': transaction_result
+            })
+        elif transaction_result['stage'] == 'reload':
+            return Response({
+                'msg': f'Nginx重载失败: {transaction_result["reload_result"]["error"]}，已删除创建的文件',
+                'status': 201
+            })
+        elif transaction_result['stage'] == 'check':
+            return Response({
+                'msg': f'Nginx配置检查失败: {transaction_result["check_result"]["error"]}，已删除创建的文件',
+                'status': 201
+            })
         else:
             return Response({
-                'msg': f'文件创建失败: {write_result["error"]}',
+                'msg': f'文件创建失败: {transaction_result["error"]}',
                 'status': 201
             })
 
@@ -233,7 +383,7 @@ def read_nginx_config(request):
         - file_path: 配置文件路径（必填）
 
     返回:
-        Response: 配置文件内容
+        Response: 配置文件内容及其sha256（修改时作为base_sha256提交）
     """
 
     try:
@@ -263,6 +413,8 @@ def read_nginx_config(request):
                 # 成功读取文件
                 config_content = read_result['output']
                 file_size = len(config_content.encode('utf-8')) if config_content else 0
+                # 修改时把sha256作为base_sha256提交，文件在此之后被他人修改时写入会被拒绝
+                config_sha256 = snapshots.put(config_content)
 
                 return Response({
                     'msg': '配置文件读取成功',
@@ -271,6 +423,7 @@ def read_nginx_config(request):
                         'file_path': file_path,
                         'content': config_content,
                         'file_size': file_size,
+                        'sha256': config_sha256,
                         'lines_count': len(config_content.split('\n')) if config_content else 0,
                         'success': True,
                         'output': read_result.get('output', ''),
@@ -393,7 +546,7 @@ def check_nginx_config(request):
     参数:
         request: 包含检查配置信息的POST请求
         - client_ip: 客户端IP地址
-        - nginx_path: Nginx配置文件路径（可选，默认为/etc/nginx/nginx.conf）
+        - nginx_path: Nginx配置文件路径（可选，默认为登记的配置路径或探测到的主配置路径）
 
     返回:
         Response: 配置检查结果
@@ -402,14 +555,15 @@ def check_nginx_config(request):
     try:
         #获取请求
         client_ip = request.GET.get('client_ip')
-        nginx_path = request.GET.get('nginx_path', '/etc/nginx/nginx.conf')
+        nginx_path = request.GET.get('nginx_path')
         if not client_ip:
             return Response({'msg': 'client_ip为必填参数', 'status': 400}, status=400)
 
-        client = connect_to_client(client_ip)
-        #建立连接
-        if not client.connect():
-            return Response({'msg': f'无法连接到服务器{client_ip}', 'status': 400}, status=400)
+        client, server, error_response = connect_to_client(client_ip)
+        if error_response:
+            return error_response
+        # 未指定路径时依次使用登记的配置路径和探测到的主配置路径
+        nginx_path = nginx_path or server.nginx_config_path
         try:
             #检查配置
             check_result = client.check_nginx_config(nginx_path)
@@ -473,7 +627,7 @@ def check_and_reload_nginx(request):
     参数:
         request: 包含检查配置信息的POST请求
         - client_ip: 客户端IP地址
-        - nginx_path: Nginx配置文件路径（可选，默认为/etc/nginx/nginx.conf）
+        - nginx_path: Nginx配置文件路径（可选，默认为登记的配置路径或探测到的主配置路径）
 
     返回:
         Response: 检查并重启操作结果
@@ -482,21 +636,22 @@ def check_and_reload_nginx(request):
     try:
         # 获取请求
         client_ip = request.data.get('client_ip')
-        nginx_path = request.data.get('nginx_path', '/etc/nginx/nginx.conf')
+        nginx_path = request.data.get('nginx_path')
         if not client_ip:
             return Response({'msg': 'client_ip为必填参数', 'status': 400}, status=400)
 
-        client, error_response = connect_to_client(client_ip)
+        client, server, error_response = connect_to_client(client_ip)
         if error_response:
             return error_response
-
-        # 建立连接
-        if not client.connect():
-            return Response({'msg': f'无法连接到服务器{client_ip}', 'status': 400}, status=400)
+        nginx_path = nginx_path or server.nginx_config_path
 
         try:
+            # 检查和重载经主机操作队列执行，与排队中的配置修改共用一次nginx -t和reload
+            transaction_result = queued_commit(NginxConfigTransaction(client, [], nginx_path=nginx_path),
+                                               window=reload_window(server))
+
             # 第一步：检查配置
-            check_result = client.check_nginx_config(nginx_path)
+            check_result = transaction_result['check_result']
 
             if not check_result['success']:
                 # 配置检查失败，直接返回错误
@@ -529,7 +684,7 @@ def check_and_reload_nginx(request):
                 })
 
             # 第二步：重启Nginx
-            reload_result = client.reload_nginx()
+            reload_result = transaction_result['reload_result']
 
             # 构建返回结果
             check_output_text = check_result['output']
@@ -554,6 +709,7 @@ def check_and_reload_nginx(request):
                             'return_code': reload_result.get('return_code', -1),
                             'success': reload_result['success']
                         },
+                        'reload_id': transaction_result['reload_id'],
                         'overall_success': True
                     }
                 })
@@ -574,6 +730,7 @@ def check_and_reload_nginx(request):
                             'return_code': reload_result.get('return_code', -1),
                             'success': reload_result['success']
                         },
+                        'reload_id': transaction_result['reload_id'],
                         'overall_success': False
                     }
                 })
@@ -589,16 +746,20 @@ def update_nginx_config(request):
     更新Nginx配置文件内容
     API端点: POST /api/configs/update/
 
-    功能: 更新指定客户端的配置文件内容，使用SCP方式替换服务端文件
+    功能: 更新指定客户端的配置文件内容，通过SFTP临时文件+rename原子替换服务端文件
 
     参数:
         request: 包含更新配置信息的POST请求
         - client_ip: 客户端IP地址
         - file_path: 文件路径
         - file_content: 文件内容
+        - base_sha256: 读取时返回的sha256（可选），文件在此之后被他人修改时拒绝写入并返回409和三方对比
+        - context: 文件被include时所处的块（可选，默认按主机的配置分析推断）
+        - fsync: 是否在替换前落盘（可选，默认False）
+        - verify_checksum: 是否校验远程文件sha256（可选，默认False）
 
     返回:
-        Response: 更新操作的结果
+        Response: 更新操作的结果，result中的reload_id为使修改生效的那次reload（主机合并窗口内的修改共用）
     """
     # 验证请求数据
     serializer = NginxConfigUpdateSerializer(data=request.data)
@@ -608,13 +769,16 @@ def update_nginx_config(request):
         file_path = data['file_path']
         file_content = data['file_content']
 
+        # 本地校验通过后才连接主机
+        error_response = validate_config_edits(client_ip, [{'file_path': file_path, 'file_content': file_content,
+                                                            'context': data.get('context')}])
+        if error_response:
+            return error_response
+
         # 连接客户端
         client, server, error_response = connect_to_client(client_ip)
-
-
-        # 建立SSH连接
-        if not client.connect():
-            return Response({'msg': f'无法连接到服务器{client_ip}', 'status': 400}, status=400)
+        if error_response:
+            return error_response
 
         try:
             # 检查文件是否存在
@@ -622,43 +786,37 @@ def update_nginx_config(request):
             if not check_result['success'] or 'not exists' in check_result['output']:
                 return Response({'msg': f'文件不存在: {file_path}', 'status': 404}, status=404)
 
-            # 备份原文件
-            backup_path = f"{file_path}.backup"
-            backup_result = client.execute_command(f'cp {file_path} {backup_path}')
-            if not backup_result['success']:
-                return Response({'msg': f'文件备份失败: {backup_result["error"]}', 'status': 400}, status=400)
-
-            # 使用SCP方式上传配置内容
-            upload_result = client.upload_config_content(file_content, file_path)
-            if not upload_result['success']:
-                # 上传失败，恢复备份
-                client.execute_command(f'cp {backup_path} {file_path}')
-                return Response({'msg': upload_result['error'], 'status': 400}, status=400)
-
-            # 检查Nginx配置语法
-            check_config_result = client.check_nginx_config()
-            if check_config_result['success']:
-                # 重载Nginx配置
-                reload_result = client.reload_nginx()
-                if reload_result['success']:
-                    # 删除备份文件
-                    client.execute_command(f'rm -f {backup_path}')
-                    return Response({
-                        'msg': f'配置文件更新成功，Nginx重载成功',
-                        'status': 200
-                    })
-                else:
-                    # 重载失败，恢复备份
-                    client.execute_command(f'cp {backup_path} {file_path}')
-                    return Response({
-                        'msg': f'配置文件更新成功但Nginx重载失败: {reload_result["error"]}，已恢复原文件',
-                        'status': 201
-                    })
+            # 单文件事务：备份 -> 原子写入 -> nginx -t -> reload，失败自动恢复原文件
+            edits = [{'file_path': file_path, 'file_content': file_content, 'base_sha256': data.get('base_sha256')}]
+            transaction_result = queued_commit(NginxConfigTransaction(
+                client, edits, fsync=data['fsync'], verify_checksum=data['verify_checksum']
+            ), window=reload_window(server))
+
+            if transaction_result['stale']:
+                return Response({
+                    'msg': f'{file_path}在读取之后已被修改，未写入',
+                    'status': 409,
+                    'data': {'conflicts': stale_conflicts(client, edits, transaction_result['stale_files'])}
+                }, status=409)
+            if transaction_result['success']:
+                invalidate_routing_graphs([client_ip])
+                return Response({
+                    'msg': f'配置文件更新成功，Nginx重载成功',
+                    'status': 200,
+                    'result': transaction_result
+                })
+            elif transaction_result['stage'] == 'backup':
+                return Response({'msg': f'文件备份失败: {transaction_result["error"]}', 'status': 400}, status=400)
+            elif transaction_result['stage'] == 'write':
+                return Response({'msg': transaction_result['error'], 'status': 400}, status=400)
+            elif transaction_result['stage'] == 'reload':
+                return Response({
+                    'msg': f'配置文件更新成功但Nginx重载失败: {transaction_result["reload_result"]["error"]}，已恢复原文件',
+                    'status': 201
+                })
             else:
-                # 配置检查失败，恢复备份
-                client.execute_command(f'cp {backup_path} {file_path}')
                 return Response({
-                    'msg': f'Nginx配置检查失败: {check_config_result["error"]}，已恢复原文件',
+                    'msg': f'Nginx配置检查失败: {transaction_result["check_result"]["error"]}，已恢复原文件',
                     'status': 400
                 })
 
@@ -669,6 +827,189 @@ def update_nginx_config(request):
 
     return Response(serializer.errors, status=400)
 
+@api_view(['POST'])
+def validate_nginx_config(request):
+    """
+    本地校验Nginx配置
+    API端点: POST /api/configs/validate/
+
+    功能: 不连接主机，在本地检查待写入配置的语法、指令上下文、重复的upstream和server_name、
+          proxy_pass引用和include路径
+
+    参数:
+        request: 包含校验信息的POST请求
+        - client_ip: 客户端IP地址
+        - files: 文件列表，每项包含file_path、file_content和可选的context（文件被include时所处的块）
+        - nginx_path: Nginx主配置文件路径（可选，默认为/etc/nginx/nginx.conf）
+
+    返回:
+        Response: 校验结果，包含errors和warnings
+    """
+    serializer = NginxConfigValidateSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+
+    data = serializer.validated_data
+    try:
+        validation_result = NginxConfigValidator(
+            build_validation_context(data['client_ip'], data['nginx_path'])
+        ).validate(data['files'])
+        return Response({
+            'msg': '配置校验通过' if validation_result['valid'] else '配置校验失败',
+            'status': 200 if validation_result['valid'] else 201,
+            'result': validation_result
+        })
+    except Exception as e:
+        return Response({'msg': str(e), 'status': 400}, status=400)
+
+@api_view(['POST'])
+def batch_update_nginx_config(request):
+    """
+    批量更新Nginx配置文件
+    API端点: POST /api/configs/batch-update/
+
+    功能: 在一个事务中修改同一客户端的多个配置文件，统一备份和写入后只执行一次
+          nginx -t和一次reload，任一步骤失败时所有文件一起回滚
+
+    参数:
+        request: 包含批量更新信息的POST请求
+        - client_ip: 客户端IP地址
+        - files: 文件修改列表，每项包含file_path、file_content，可选的base_sha256（读取时返回的sha256）和context
+        - nginx_path: Nginx主配置文件路径（可选，默认为/etc/nginx/nginx.conf）
+        - fsync: 是否在替换前落盘（可选，默认False）
+        - verify_checksum: 是否校验远程文件sha256（可选，默认False）
+
+    返回:
+        Response: 事务执行结果；有文件在读取之后被他人修改时整批不写入，返回409和这些文件的三方对比
+    """
+    serializer = NginxConfigBatchUpdateSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+
+    data = serializer.validated_data
+    client_ip = data['client_ip']
+
+    # 所有文件一起做本地校验，跨文件的重复定义和引用也能发现
+    error_response = validate_config_edits(client_ip, data['files'], data['nginx_path'])
+    if error_response:
+        return error_response
+
+    client, server, error_response = connect_to_client(client_ip)
+    if error_response:
+        return error_response
+
+    try:
+        transaction_result = queued_commit(NginxConfigTransaction(
+            client, data['files'], nginx_path=data['nginx_path'],
+            fsync=data['fsync'], verify_checksum=data['verify_checksum']
+        ), window=reload_window(server))
+
+        if transaction_result['stale']:
+            return Response({
+                'msg': f'{", ".join(transaction_result["stale_files"])}在读取之后已被修改，所有文件均未更新',
+                'status': 409,
+                'result': transaction_result,
+                'data': {'conflicts': stale_conflicts(client, data['files'], transaction_result['stale_files'])}
+            }, status=409)
+        if transaction_result['success']:
+            invalidate_routing_graphs([client_ip])
+            return Response({
+                'msg': f'{len(data["files"])}个配置文件更新成功，Nginx重载成功',
+                'status': 200,
+                'result': transaction_result
+            })
+        return Response({
+            'msg': f'批量更新在{transaction_result["stage"]}阶段失败: {transaction_result["error"]}，'
+                   f'{"已恢复所有文件" if transaction_result["rolled_back"] else "回滚失败，请人工检查"}',
+            'status': 400,
+            'result': transaction_result
+        }, status=400)
+
+    except Exception as e:
+        return Response({'msg': str(e), 'status': 400}, status=400)
+    finally:
+        client.close()
+
+@api_view(['POST'])
+def rollout_nginx_config(request):
+    """
+    分波次灰度发布配置
+    API端点: POST /api/configs/rollout/
+
+    功能: 把同一个配置修改按波次应用到多台主机，同一波内各主机并行执行；每波生效后观察soak_seconds，
+          比较生效前后的stub_status丢弃连接数和请求速率、健康检查地址和后端主动探测结果，
+          退化的主机数超过failure_threshold时撤销该波所有主机的修改并停止
+
+    参数:
+        request: 包含发布信息的POST请求
+        - client_ips: 按发布顺序排列的主机
+        - files: 写入每台主机的文件，每项包含file_path和file_content（与upstream_edits至少提供一项）
+        - upstream_edits: 在每台主机上执行的upstream修改，每项包含file_path和operations（同upstream/edit/）
+        - waves: 各波次的主机数（可选，默认[1]，用完后按最后一个大小继续分）
+        - soak_seconds: 每波生效后的观察时间（可选，默认10秒）
+        - failure_threshold: 一波内允许退化的主机数（可选，默认0）
+        - max_dropped、max_request_drop、min_request_rate、max_unhealthy: 退化判定阈值（可选）
+        - health_url: 在主机本地经nginx请求的健康检查地址（可选）
+        - probe_backends: 是否主动探测后端（可选，默认True）
+        - workers: 同一波内并行的主机数（可选，默认8）
+        - fsync: 是否在替换前落盘（可选，默认False）
+
+    返回:
+        Response: 每波每台主机的执行结果、健康信号和退化原因；发布被停止时HTTP状态为207
+    """
+    serializer = NginxConfigRolloutSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    data = serializer.validated_data
+
+    servers = {server.host: server for server in ClientInfo.objects.filter(host__in=data['client_ips'])}
+    missing = [client_ip for client_ip in data['client_ips'] if client_ip not in servers]
+    if missing:
+        return Response({'msg': f'未找到以下主机的配置: {", ".join(missing)}', 'status': 404}, status=404)
+    servers = [servers[client_ip] for client_ip in data['client_ips']]
+
+    # 开始发布前在本地校验每台主机，明显的错误不会等到某一波才发现
+    if data['files']:
+        for server in servers:
+            error_response = validate_config_edits(server.host, data['files'],
+                                                   server.nginx_config_path or '/etc/nginx/nginx.conf')
+            if error_response:
+                error_response.data['msg'] = f'{server.host}: {error_response.data["msg"]}'
+                return error_response
+
+    try:
+        report = ConfigRollout(
+            servers, files=data['files'], upstream_edits=data['upstream_edits'], waves=data['waves'],
+            soak_seconds=data['soak_seconds'], failure_threshold=data['failure_threshold'],
+            thresholds=HealthThresholds(max_dropped=data['max_dropped'], max_request_drop=data['max_request_drop'],
+                                        min_request_rate=data['min_request_rate'],
+                                        max_unhealthy=data['max_unhealthy']),
+            health_url=data.get('health_url'), probe_backends=data['probe_backends'], workers=data['workers'],
+            fsync=data['fsync']
+        ).run()
+    except Exception as e:
+        return Response({'msg': f'灰度发布失败: {str(e)}，已撤销未通过检查的修改', 'status': 500}, status=500)
+
+    invalidate_routing_graphs(entry['client_ip'] for wave in report['waves'] for entry in wave['hosts']
+                              if entry['stage'] != 'unchanged')
+    summary = report['summary']
+    if report['status'] == 'halted':
+        wave = report['waves'][-1]
+        msg = f'第{wave["index"] + 1}波有{wave["regressions"]}台主机未通过检查，已撤销该波并停止发布，' \
+              f'{summary["applied"]}台主机已生效，{summary["not_started"]}台主机未开始'
+        if wave['conflicts']:
+            msg += f'；以下主机的文件在发布后已被他人修改，未撤销: {", ".join(wave["conflicts"])}'
+        return Response({
+            'msg': msg,
+            'data': report,
+            'status': 207
+        }, status=status.HTTP_207_MULTI_STATUS)
+    return Response({
+        'msg': f'发布完成：{summary["waves"]}波，{summary["applied"]}台主机已生效，{summary["unchanged"]}台主机无变化',
+        'data': report,
+        'status': 200
+    })
+
 @api_view(['GET'])
 def get_nginx_status(request):
     """
@@ -695,12 +1036,8 @@ def get_nginx_status(request):
         if error_response:
             return error_response
 
-        # 建立连接
-        if not client.connect():
-            return Response({'msg': f'无法连接到服务器{client_ip}', 'status': 400}, status=400)
-
         try:
-            # 获取Nginx状态
+            # 获取Nginx状态，只执行该主机init系统对应的状态命令
             status_result = client.get_nginx_status()
 
             # 分析状态结果
@@ -741,7 +1078,9 @@ def get_nginx_status(request):
                         'return_code': return_code,
                         'is_running': True,
                         'status_type': status_type,
-                        'success': status_result['success']
+                        'success': status_result['success'],
+                        # 采集器最近一次stub_status采样，没有采集时为None
+                        'metrics': timeseries.latest_sample(server.id)
                     }
                 })
             else:
@@ -834,12 +1173,18 @@ def read_all_backend_servers(request):
             config_analysis_result = client.get_nginx_config_analysis()
             print('配置文件返回值',config_analysis_result)
 
-            # 从配置分析结果中提取upstream信息
-            upstreams_info = config_analysis_result.get('upstreams_info', {})
+            # 从配置分析结果中提取http和stream的upstream信息
+            upstreams_info = [
+                ('http', upstream_name, upstream_info)
+                for upstream_name, upstream_info in config_analysis_result.get('upstreams_info', {}).items()
+            ] + [
+                ('stream', upstream_name, upstream_info)
+                for upstream_name, upstream_info in config_analysis_result.get('stream_upstreams_info', {}).items()
+            ]
             backend_servers_list = []
 
             # 遍历所有upstream配置
-            for upstream_name, upstream_info in upstreams_info.items():
+            for protocol, upstream_name, upstream_info in upstreams_info:
                 file_path = upstream_info.get('file_path', '')
                 backend_servers = upstream_info.get('backend_servers', [])
 
@@ -868,7 +1213,8 @@ def read_all_backend_servers(request):
                         'file_path': file_path,
                         'upstream': upstream_name,
                         'status': status,
-                        'weight': weight
+                        'weight': weight,
+                        'protocol': protocol
                     }
 
                     backend_servers_list.append(backend_server_info)
@@ -888,6 +1234,7 @@ def read_all_backend_servers(request):
                 # 检查是否已存在相同记录
                 existing_server = BackendServerInfo.objects.filter(
                     client=server_info['client'],
+                    protocol=server_info['protocol'],
                     backend_server_addr=server_info['backend_server_addr']
                 ).first()
 
@@ -899,7 +1246,8 @@ def read_all_backend_servers(request):
                         file_path=server_info['file_path'],
                         upstream=server_info['upstream'],
                         status=server_info['status'],
-                        weight=server_info['weight']
+                        weight=server_info['weight'],
+                        protocol=server_info['protocol']
                     )
                     saved_servers.append(backend_server)
                 else:
@@ -979,6 +1327,161 @@ def update_backend_server_status(request):
     return Response(serializer.errors, status=400)
 
 
+@api_view(['POST'])
+def bulk_update_backend_server_status(request):
+    """
+    批量摘除/恢复后端服务器
+    API端点: POST /api/servers/backend_server/status/bulk/
+
+    功能: 在所有引用该地址的主机、所有upstream中修改它的状态；每台主机的受影响文件在一个事务中写入，
+         只执行一次nginx -t和一次reload，失败时该主机的所有文件回滚；各主机并行执行
+
+    参数:
+        request: POST请求
+        - backend_server_addr: 后端地址，ip:port，或ip（该主机的所有端口）
+        - status: 目标状态，up、down或backup
+        - client_ips: 只修改这些主机（可选，默认所有引用该地址的主机）
+        - upstreams: 只修改这些upstream（可选）
+        - dry_run: 为true时只返回将要做的修改（可选）
+        - full_scan: 没有缓存路由图的主机先分析一次配置，找出数据库中没有记录的upstream（可选，默认true）；
+          为false时只使用缓存的路由图，没有缓存的主机只修改数据库中记录的文件，结果中complete为false
+        - fsync: 是否在替换前落盘（可选，默认False）
+
+    返回:
+        Response: 每台主机的执行结果和汇总；部分主机失败时HTTP状态为207
+    """
+    serializer = BackendServerBulkStatusSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    data = serializer.validated_data
+
+    try:
+        result = bulk_set_status(
+            data['backend_server_addr'], data['status'], client_ips=data.get('client_ips'),
+            upstreams=data.get('upstreams'), dry_run=data['dry_run'], fsync=data['fsync'],
+            graph_for=(lambda client_ip: get_routing_graph(client_ip)[0]) if data['full_scan'] else cached_routing_graph
+        )
+    except Exception as e:
+        return Response({'msg': f'批量修改失败: {str(e)}', 'status': 500}, status=500)
+
+    summary = result['summary']
+    if not summary['hosts']:
+        return Response({'msg': f'没有主机引用后端 {data["backend_server_addr"]}', 'status': 404}, status=404)
+    if not data['dry_run']:
+        invalidate_routing_graphs(host['client_ip'] for host in result['hosts'] if host['changes'])
+    if summary['failed']:
+        return Response({
+            'msg': f'{summary["succeeded"]}台主机成功，{summary["failed"]}台主机失败',
+            'data': result,
+            'status': 207
+        }, status=status.HTTP_207_MULTI_STATUS)
+    msg = f'{"预览" if data["dry_run"] else "修改"}完成：{summary["hosts"]}台主机，' \
+          f'{summary["files"]}个文件，{summary["changes"]}处server指令'
+    if summary['incomplete']:
+        msg += f'；{summary["incomplete"]}台主机没有路由图，只修改了数据库中记录的文件，其他upstream可能未修改'
+    return Response({
+        'msg': msg,
+        'data': result,
+        'status': 200
+    })
+
+
+@api_view(['POST'])
+def edit_upstream(request):
+    """
+    结构化修改upstream
+    API端点: POST /api/servers/upstream/edit/
+
+    功能: 在配置文件的解析结果上设置server状态/权重、添加/删除server、新建upstream，
+         只对受影响的指令生成补丁并只传输补丁，注释和格式保持原样；写入、nginx -t和reload在一个事务中完成，
+         文件在读取之后被他人修改时补丁不会应用，自动重新读取后再试一次
+
+    参数:
+        request: POST请求
+        - client_ip: 客户端IP地址
+        - file_path: 配置文件路径
+        - operations: 按顺序执行的操作，每项包含op（set_status、set_weight、add_server、remove_server、
+          add_upstream）、upstream，以及address、status、weight、params、servers中该操作需要的参数
+        - context: 文件被include时所处的块（可选，默认按主机的配置分析推断）
+        - dry_run: 为true时只返回将要做的修改（可选）
+        - fsync: 是否在替换前落盘（可选，默认False）
+        - verify_checksum: 是否校验修改后文件的sha256（可选，默认False）
+
+    返回:
+        Response: 修改列表、文件和补丁大小以及事务结果
+    """
+    serializer = UpstreamEditSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    data = serializer.validated_data
+    client_ip = data['client_ip']
+    file_path = data['file_path']
+
+    client, server, error_response = connect_to_client(client_ip)
+    if error_response:
+        return error_response
+
+    try:
+        for attempt in range(2):
+            read_result = client.read_config_files([file_path], use_cache=attempt == 0)[file_path]
+            if not read_result['success']:
+                return Response({'msg': read_result['error'], 'status': 404}, status=404)
+            try:
+                editor = apply_operations(read_result['content'], data['operations'])
+            except UpstreamEditError as e:
+                return Response({'msg': str(e), 'status': 400}, status=400)
+
+            result = {
+                'file_path': file_path,
+                'changes': editor.changes,
+                'file_bytes': len(read_result['content'].encode('utf-8')),
+                'patch_bytes': None,
+                'cached': read_result['cached'],
+                'transaction': None,
+            }
+            if not editor.changes:
+                return Response({'msg': '配置没有变化', 'data': result, 'status': 200})
+
+            edit = editor.as_edit(file_path)
+            if edit['patch'] is not None:
+                result['patch_bytes'] = edit['patch'].bytes_out
+            error_response = validate_config_edits(client_ip, [dict(edit, context=data.get('context'))],
+                                                   server.nginx_config_path or '/etc/nginx/nginx.conf')
+            if error_response:
+                return error_response
+            if data['dry_run']:
+                return Response({'msg': f'预览完成：{len(editor.changes)}处修改', 'data': result, 'status': 200})
+
+            transaction_result = queued_commit(NginxConfigTransaction(
+                client, [edit], nginx_path=server.nginx_config_path or None,
+                fsync=data['fsync'], verify_checksum=data['verify_checksum']
+            ), window=reload_window(server))
+            if not transaction_result['stale']:
+                break
+        result['transaction'] = transaction_result
+
+        if transaction_result['success']:
+            invalidate_routing_graphs([client_ip])
+            sync_upstream_changes(server, editor.changes)
+            return Response({
+                'msg': f'{len(editor.changes)}处修改已生效，Nginx重载成功',
+                'data': result,
+                'status': 200
+            })
+        if transaction_result['stale']:
+            return Response({'msg': transaction_result['error'], 'data': result, 'status': 409}, status=409)
+        return Response({
+            'msg': f'修改在{transaction_result["stage"]}阶段失败: {transaction_result["error"]}，'
+                   f'{"已恢复原文件" if transaction_result["rolled_back"] else "回滚失败，请人工检查"}',
+            'data': result,
+            'status': 400
+        }, status=400)
+    except Exception as e:
+        return Response({'msg': str(e), 'status': 400}, status=400)
+    finally:
+        client.close()
+
+
 @api_view(['GET'])
 def read_upstream_info(request):
     """
@@ -991,6 +1494,7 @@ def read_upstream_info(request):
         request: GET请求，包含查询参数
         - client_ip: 客户端IP地址（必需）
         - upstream: upstream名称，支持模糊匹配（必需）
+        - protocol: http或stream（可选）
 
     返回:
         Response: 匹配的后端服务器信息列表
@@ -998,6 +1502,7 @@ def read_upstream_info(request):
     # 从查询参数中获取客户端IP和upstream名称
     client_ip = request.GET.get('client_ip')
     upstream = request.GET.get('upstream')
+    protocol = request.GET.get('protocol')
 
     # 验证必需参数
     if not client_ip:
@@ -1012,6 +1517,8 @@ def read_upstream_info(request):
             client__client_ip=client_ip,
             upstream__icontains=upstream  # 使用icontains进行不区分大小写的模糊匹配
         )
+        if protocol:
+            servers = servers.filter(protocol=protocol)
 
         # 构建返回数据
         upstream_info_list = []
@@ -1020,7 +1527,8 @@ def read_upstream_info(request):
                 'backend_server_addr': server.backend_server_addr,
                 'file_path': server.file_path,
                 'upstream': server.upstream,
-                'status': server.status
+                'status': server.status,
+                'protocol': server.protocol
             }
             upstream_info_list.append(server_info)
 
@@ -1048,6 +1556,7 @@ def search_backend_servers(request):
         - upstream: upstream名称，支持模糊匹配（可选）
         - status: 服务器状态（可选）
         - backend_server_addr: 服务器地址，支持模糊匹配（可选）
+        - protocol: http或stream（可选）
 
     返回:
         Response: 匹配的后端服务器信息列表
@@ -1058,6 +1567,7 @@ def search_backend_servers(request):
         upstream = request.GET.get('upstream')
         status = request.GET.get('status')
         backend_server_addr = request.GET.get('backend_server_addr')
+        protocol = request.GET.get('protocol')
 
         # 构建查询条件
         query_filters = {}
@@ -1074,6 +1584,9 @@ def search_backend_servers(request):
         if backend_server_addr:
             query_filters['backend_server_addr__icontains'] = backend_server_addr
 
+        if protocol:
+            query_filters['protocol'] = protocol
+
         # 执行查询
         servers = BackendServerInfo.objects.filter(**query_filters)
 
@@ -1089,3 +1602,250 @@ def search_backend_servers(request):
 
     except Exception as e:
         return Response({'msg': f'搜索失败: {str(e)}', 'status': 500}, status=500)
+
+
+@api_view(['GET'])
+def backend_server_summary(request):
+    """
+    后端服务器容量统计
+    API端点: GET /api/servers/backend_server/summary/
+
+    功能: 基于列式快照统计每个upstream的up/down/backup成员数、权重分布以及后端最多的主机；
+         upstream按协议和名称区分，统计整个集群时各主机上的同名upstream合并，hosts为所在主机数
+
+    参数:
+        request: GET请求，包含查询参数
+        - client_ip: 客户端IP地址（可选，不传时统计整个集群）
+        - top: 返回后端最多的主机数（可选，默认10）
+        - limit: 最多返回的upstream数（可选，默认100）
+
+    返回:
+        Response: 统计结果
+    """
+    try:
+        client_ip = request.GET.get('client_ip')
+        top = int(request.GET.get('top', 10))
+        limit = int(request.GET.get('limit', 100))
+
+        client_id = None
+        if client_ip:
+            client_id = ClientInfo.objects.filter(host=client_ip).values_list('id', flat=True).first()
+            if client_id is None:
+                return Response({'msg': f'未找到IP为{client_ip}的客户端', 'status': 404}, status=404)
+
+        return Response({
+            'msg': '统计成功',
+            'data': backend_summary(client_id=client_id, top=top, limit=limit),
+            'status': 200
+        })
+
+    except Exception as e:
+        return Response({'msg': f'统计失败: {str(e)}', 'status': 500}, status=500)
+
+
+@api_view(['GET'])
+def backend_server_impact(request):
+    """
+    后端服务器摘除影响查询
+    API端点: GET /api/servers/backend_server/impact/
+
+    功能: 基于主机的路由图查询摘除某个后端后受影响的upstream、location和虚拟主机，
+         或查询某个虚拟主机的各location转发到哪些后端
+
+    参数:
+        request: GET请求，包含查询参数
+        - client_ip: 客户端IP地址（必填）
+        - backend: 后端地址，ip:port或ip，ip时包含该主机的所有端口（与server_name二选一）
+        - server_name: 虚拟主机名称，stream为listen，如3306、53/udp（与backend二选一）
+        - protocol: server_name所属协议，http或stream（可选，默认http）
+        - refresh: 为true时忽略缓存重新分析配置（可选）
+
+    返回:
+        Response: 查询结果
+    """
+    try:
+        client_ip = request.GET.get('client_ip')
+        backend = request.GET.get('backend')
+        server_name = request.GET.get('server_name')
+        refresh = request.GET.get('refresh', '').lower() in ('true', '1')
+
+        if not client_ip or not (backend or server_name):
+            return Response({'msg': 'client_ip以及backend或server_name为必填参数', 'status': 400}, status=400)
+
+        graph, built_at, error_response = get_routing_graph(client_ip, refresh)
+        if error_response:
+            return error_response
+
+        if backend:
+            data = graph.impact(backend)
+            if not data['addresses']:
+                return Response({'msg': f'配置中未找到后端 {backend}', 'status': 404}, status=404)
+        else:
+            protocol = request.GET.get('protocol', 'http')
+            data = {'server_name': server_name, 'protocol': protocol,
+                    'routes': graph.routes_for_server(server_name, protocol)}
+            if not data['routes']:
+                return Response({'msg': f'配置中未找到虚拟主机 {server_name} 的路由', 'status': 404}, status=404)
+
+        data['graph_age'] = round(time.time() - built_at, 1)
+        return Response({'msg': '查询成功', 'data': data, 'status': 200})
+
+    except Exception as e:
+        return Response({'msg': f'查询失败: {str(e)}', 'status': 500}, status=500)
+
+
+@api_view(['GET'])
+def metrics(request):
+    """
+    进程内指标，Prometheus文本格式
+
+    包括按视图的请求耗时直方图、按视图/主机/阶段的span耗时直方图，以及SSH往返次数和传输字节数计数器；
+    多进程部署时每个进程分别统计
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['GET'])
+def nginx_metrics_range(request):
+    """
+    查询主机的stub_status时间序列
+
+    参数:
+        request: GET请求，包含查询参数
+        - client_ip: 客户端IP地址（必填）
+        - start: 起始时间戳（秒，可选，默认end前1小时）
+        - end: 结束时间戳（秒，可选，默认当前时间）
+        - max_points: 最多返回的点数（可选，默认500，最大5000）
+
+    返回:
+        Response: 列式数据，包括活动连接、reading/writing/waiting和每秒请求数
+    """
+    try:
+        client_ip = request.GET.get('client_ip')
+        if not client_ip:
+            return Response({'msg': 'client_ip为必填参数', 'status': 400}, status=400)
+        server = ClientInfo.objects.filter(host=client_ip).first()
+        if server is None:
+            return Response({'msg': f'未找到IP为{client_ip}的服务器配置', 'status': 404}, status=404)
+
+        end = int(request.GET.get('end') or time.time())
+        start = int(request.GET.get('start') or end - 3600)
+        max_points = min(int(request.GET.get('max_points', 500)), 5000)
+        if start >= end or max_points <= 0:
+            return Response({'msg': 'start必须早于end，max_points必须大于0', 'status': 400}, status=400)
+
+        data = timeseries.query_range(server.id, start, end, max_points)
+        data.update({'client_ip': client_ip, 'start': start, 'end': end})
+        return Response({'msg': '查询成功', 'data': data, 'status': 200})
+    except ValueError:
+        return Response({'msg': 'start、end、max_points必须为整数', 'status': 400}, status=400)
+    except Exception as e:
+        return Response({'msg': f'查询失败: {str(e)}', 'status': 500}, status=500)
+
+
+@api_view(['GET', 'POST'])
+def access_log_sources(request):
+    """
+    访问日志源的查询和登记
+
+    GET参数:
+        - client_ip: 客户端IP地址（可选，不填时返回全部）
+    POST参数:
+        - client_ip: 客户端IP地址（必填）
+        - path: 远程日志文件路径（必填）
+        - log_format: 该日志使用的nginx log_format（可选，默认combined）；按upstream统计和上游耗时
+          需要日志中包含$proxy_host或$upstream_addr以及$upstream_response_time
+        - enabled: 是否读取（可选，默认true）
+
+    返回:
+        Response: 日志源列表，包括读取位置和最近一次错误
+    """
+    try:
+        if request.method == 'GET':
+            sources = AccessLogSource.objects.select_related('client').order_by('id')
+            client_ip = request.GET.get('client_ip')
+            if client_ip:
+                sources = sources.filter(client__host=client_ip)
+            data = [{
+                'id': source.id,
+                'client_ip': source.client.host,
+                'path': source.path,
+                'log_format': source.log_format,
+                'enabled': source.enabled,
+                'inode': source.inode,
+                'offset': source.offset,
+                'last_read_at': source.last_read_at,
+                'last_error': source.last_error,
+            } for source in sources]
+            return Response({'msg': '查询成功', 'data': data, 'status': 200})
+
+        client_ip = request.data.get('client_ip')
+        path = request.data.get('path')
+        if not client_ip or not path:
+            return Response({'msg': 'client_ip和path为必填参数', 'status': 400}, status=400)
+        server = ClientInfo.objects.filter(host=client_ip).first()
+        if server is None:
+            return Response({'msg': f'未找到IP为{client_ip}的服务器配置', 'status': 404}, status=404)
+        log_format = request.data.get('log_format') or LOG_FORMAT_COMBINED
+        if not LogFormat(log_format).has_time:
+            return Response({'msg': 'log_format中需要包含$time_local、$time_iso8601或$msec', 'status': 400},
+                            status=400)
+        enabled = str(request.data.get('enabled', True)).lower() not in ('false', '0')
+        source, created = AccessLogSource.objects.get_or_create(
+            client=server, path=path, defaults={'log_format': log_format, 'enabled': enabled})
+        if not created:
+            if source.log_format != log_format:
+                # 格式变化后旧位置之后的内容按新格式解析
+                source.log_format = log_format
+            source.enabled = enabled
+            source.save(update_fields=['log_format', 'enabled', 'updated_at'])
+        return Response({'msg': '登记成功' if created else '更新成功',
+                         'data': {'id': source.id, 'client_ip': client_ip, 'path': path, 'enabled': source.enabled},
+                         'status': 200})
+    except Exception as e:
+        return Response({'msg': f'操作失败: {str(e)}', 'status': 500}, status=500)
+
+
+@api_view(['GET'])
+def access_log_rollups(request):
+    """
+    查询访问日志的分钟汇总
+
+    参数:
+        request: GET请求，包含查询参数
+        - client_ip: 客户端IP地址（必填）
+        - start: 起始时间戳（秒，可选，默认end前1小时）
+        - end: 结束时间戳（秒，可选，默认当前时间）
+        - step: 时间间隔（秒，可选，默认60，按分钟取整）
+        - vhost、upstream: 只返回指定虚拟主机或upstream（可选）
+        - group_by: 逗号分隔的分组字段，vhost、upstream（可选，默认两者）；传空字符串时合为一个序列
+
+    返回:
+        Response: 每个分组的每秒请求数、状态码分布和上游耗时p50/p99
+    """
+    try:
+        client_ip = request.GET.get('client_ip')
+        if not client_ip:
+            return Response({'msg': 'client_ip为必填参数', 'status': 400}, status=400)
+        server = ClientInfo.objects.filter(host=client_ip).first()
+        if server is None:
+            return Response({'msg': f'未找到IP为{client_ip}的服务器配置', 'status': 404}, status=404)
+
+        end = int(request.GET.get('end') or time.time())
+        start = int(request.GET.get('start') or end - 3600)
+        step = int(request.GET.get('step', 60))
+        group_by = tuple(field for field in request.GET.get('group_by', 'vhost,upstream').split(',') if field)
+        if start >= end or step <= 0 or (end - start) // max(step, 60) > 10000:
+            return Response({'msg': 'start必须早于end，step必须大于0且点数不超过10000', 'status': 400}, status=400)
+        if any(field not in ('vhost', 'upstream') for field in group_by):
+            return Response({'msg': 'group_by只能包含vhost、upstream', 'status': 400}, status=400)
+
+        series = access_logs.query_rollups(server.id, start, end, step, vhost=request.GET.get('vhost'),
+                                           upstream=request.GET.get('upstream'), group_by=group_by)
+        return Response({'msg': '查询成功', 'data': {
+            'client_ip': client_ip, 'start': start, 'end': end, 'step': max(step // 60, 1) * 60, 'series': series,
+        }, 'status': 200})
+    except ValueError:
+        return Response({'msg': 'start、end、step必须为整数', 'status': 400}, status=400)
+    except Exception as e:
+        return Response({'msg': f'查询失败: {str(e)}', 'status': 500}, status=500)